@@ -0,0 +1,612 @@
+#!/usr/bin/env python
+"""Simulates many lightweight GRR clients to load test frontends.
+
+The pool client runs full GRRClient threads, which limits it to a few hundred
+clients per machine. This tool simulates tens of thousands of clients on a
+single event loop instead. The clients speak the real GRR protocol with the
+keys stored in --cert_file, but they do not run client actions: every request
+of the server is answered after --action_latency seconds with a response of
+--response_size bytes.
+
+To size frontends and data stores, run a frontend and a worker against a test
+data store (e.g. SqliteDataStore or FakeDataStore) and enroll the clients
+once. The missing keys are generated and added to --cert_file:
+
+  loadclient.py --nrclients 10000 --cert_file /tmp/keys --enroll_only
+
+Then keep the clients polling while flows or hunts are scheduled for them:
+
+  loadclient.py --nrclients 10000 --cert_file /tmp/keys \
+      --action_latency 0.5 --response_size 4096
+
+Frontend latency percentiles, message rates and error rates are logged every
+--report_interval seconds and for the whole run on exit.
+"""
+
+
+import collections
+import errno
+import heapq
+import os
+import pickle
+import posixpath
+import select
+import socket
+import time
+import urllib2
+import urlparse
+
+
+import logging
+
+from grr.client import comms
+from grr.client import poolclient
+from grr.lib import communicator
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import startup
+from grr.lib import utils
+
+flags.DEFINE_integer("max_connections", 1000,
+                     "Maximum number of concurrent requests to the frontend. "
+                     "Clients due to poll wait for a free connection.")
+
+flags.DEFINE_float("action_latency", 0.0,
+                   "Seconds a simulated client action takes.")
+
+flags.DEFINE_list("action_latencies", [],
+                  "Latencies of specific client actions as Name=seconds, "
+                  "overriding --action_latency.")
+
+flags.DEFINE_integer("response_size", 1024,
+                     "Size in bytes of the response of a simulated client "
+                     "action.")
+
+flags.DEFINE_list("response_sizes", [],
+                  "Response sizes of specific client actions as Name=bytes, "
+                  "overriding --response_size.")
+
+flags.DEFINE_integer("request_timeout", 120,
+                     "Seconds after which a request to the frontend fails.")
+
+flags.DEFINE_integer("report_interval", 10,
+                     "Seconds between two reports of the load statistics.")
+
+flags.DEFINE_integer("duration", 0,
+                     "Seconds to run for, 0 runs until interrupted.")
+
+
+def LoadPrivateKeys(path, n):
+  """Loads n client keys from path, generating and storing missing ones.
+
+  The file has the format written by the pool client, so both tools can share
+  their clients.
+
+  Args:
+    path: The path of the key file.
+    n: The number of keys needed.
+
+  Returns:
+    A list of n PEMPrivateKey objects.
+  """
+  try:
+    with open(path, "rb") as fd:
+      keys = pickle.load(fd)
+  except (IOError, EOFError):
+    keys = []
+
+  if len(keys) >= n:
+    return keys[:n]
+
+  logging.info("Generating %d client keys.", n - len(keys))
+  while len(keys) < n:
+    keys.append(rdfvalue.PEMPrivateKey.GenKey(
+        bits=comms.ClientCommunicator.BITS))
+    if len(keys) % 1000 == 0:
+      logging.info("Generated %d/%d client keys.", len(keys), n)
+
+  with open(path, "wb") as fd:
+    pickle.dump(keys, fd)
+
+  return keys
+
+
+def Percentile(values, percentile):
+  """Returns a percentile of a sorted list."""
+  if not values:
+    return 0
+  return values[min(len(values) - 1, int(len(values) * percentile / 100.0))]
+
+
+def ParseActionSettings(settings, convert):
+  """Parses a list of Name=value flags into a dict."""
+  result = {}
+  for setting in settings:
+    name, _, value = setting.partition("=")
+    result[name] = convert(value)
+  return result
+
+
+class LoadClientCommunicator(comms.ClientCommunicator):
+  """A client communicator which does not start any threads."""
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, private_key, pub_key_cache, server_name=None):
+    # The caches made by Communicator.__init__ start a housekeeping thread
+    # each, which does not scale to thousands of clients.
+    self.cipher_cache = utils.FastStore(max_size=10)
+    self.encrypted_cipher_cache = utils.FastStore(max_size=10)
+    self.session_tickets = None
+    self.private_key = private_key
+    self.certificate = None
+
+    # The server key is parsed and verified only once for all clients.
+    self.pub_key_cache = pub_key_cache
+    self.server_name = server_name
+    self._LoadOurCertificate()
+
+
+class SimulatedClient(object):
+  """The protocol state of a simulated client."""
+
+  def __init__(self, communicator_obj):
+    self.communicator = communicator_obj
+    self.outbox = []
+    self.sent = []
+    self.nonce = None
+    self.sleep_time = config_lib.CONFIG["Client.poll_min"]
+    self.last_foreman_check = 0
+    self.last_enrollment_time = 0
+    self.enrolled = False
+    self.pending_actions = 0
+    # Bumped whenever the next poll is rescheduled.
+    self.generation = 0
+
+  def MakeRequest(self):
+    """Returns the body of a poll with all the queued messages."""
+    now = time.time()
+    if (now > self.last_foreman_check +
+        config_lib.CONFIG["Client.foreman_check_frequency"]):
+      self.outbox.append(rdfvalue.GrrMessage(
+          session_id=rdfvalue.FlowSessionID(flow_name="Foreman"),
+          payload=rdfvalue.DataBlob(),
+          priority=rdfvalue.GrrMessage.Priority.LOW_PRIORITY,
+          require_fastpoll=False))
+      self.last_foreman_check = now
+
+    self.sent, self.outbox = self.outbox, []
+    message_list = rdfvalue.MessageList()
+    for message in self.sent:
+      message_list.job.Append(message)
+
+    payload = rdfvalue.ClientCommunication(queue_size=self.pending_actions)
+    self.nonce = self.communicator.EncodeMessages(message_list, payload)
+    return payload.SerializeToString()
+
+  def RequeueSentMessages(self):
+    """Queues the messages of a failed poll again, as real clients do."""
+    for message in self.sent:
+      message.ttl -= 1
+      if message.ttl > 0:
+        self.outbox.append(message)
+    self.sent = []
+
+  def InitiateEnrolment(self):
+    """Queues a CSR, at most once every 10 minutes like real clients."""
+    now = time.time()
+    if now > self.last_enrollment_time + 10 * 60:
+      if not self.last_enrollment_time:
+        self.sleep_time = config_lib.CONFIG["Client.poll_min"]
+      self.last_enrollment_time = now
+      self.outbox.append(rdfvalue.GrrMessage(
+          session_id=rdfvalue.SessionID(queue=queues.ENROLLMENT,
+                                        flow_name="Enrol"),
+          payload=rdfvalue.Certificate(type=rdfvalue.Certificate.Type.CSR,
+                                       pem=self.communicator.GetCSR())))
+
+  def DecodeResponse(self, body):
+    """Returns the messages of a response from the frontend.
+
+    Args:
+      body: The body of the HTTP response.
+
+    Returns:
+      A list of GrrMessages.
+
+    Raises:
+      communicator.DecodingError: If the response is not valid.
+    """
+    messages, source, server_nonce = self.communicator.DecryptMessage(body)
+    if server_nonce != self.nonce:
+      raise communicator.DecodingError("Nonce not matched.")
+    if source != self.communicator.server_name:
+      raise communicator.DecodingError("Response not from the server.")
+
+    self.enrolled = True
+    self.sent = []
+    return messages
+
+  def NextPollDelay(self, code, fastpoll):
+    """Returns the time until the next poll, like GRRHTTPClient.Wait()."""
+    if code == 500:
+      return max(config_lib.CONFIG["Client.error_poll_min"], self.sleep_time)
+
+    if fastpoll:
+      self.sleep_time = config_lib.CONFIG["Client.poll_min"]
+
+    delay = self.sleep_time
+    self.sleep_time = min(
+        config_lib.CONFIG["Client.poll_max"],
+        max(config_lib.CONFIG["Client.poll_min"], self.sleep_time) *
+        config_lib.CONFIG["Client.poll_slew"])
+    return delay
+
+
+class _Request(object):
+  """An HTTP POST of a simulated client in flight."""
+
+  __slots__ = ("client", "sock", "fd", "data", "sent", "received", "start",
+               "connected")
+
+  def __init__(self, client, data):
+    self.client = client
+    self.data = data
+    self.sent = 0
+    self.received = []
+    self.start = time.time()
+    self.connected = False
+    self.sock = None
+    self.fd = None
+
+
+class LoadStats(object):
+  """The measurements of the simulated clients over a period."""
+
+  def __init__(self):
+    self.start = time.time()
+    self.latencies = []
+    self.polls = 0
+    self.sent_messages = 0
+    self.received_messages = 0
+    self.sent_bytes = 0
+    self.received_bytes = 0
+    self.errors = collections.Counter()
+
+  def Add(self, other):
+    self.latencies.extend(other.latencies)
+    self.polls += other.polls
+    self.sent_messages += other.sent_messages
+    self.received_messages += other.received_messages
+    self.sent_bytes += other.sent_bytes
+    self.received_bytes += other.received_bytes
+    self.errors.update(other.errors)
+
+  def Report(self, title):
+    """Logs the statistics."""
+    elapsed = max(time.time() - self.start, 1e-6)
+    latencies = sorted(self.latencies)
+    errors = sum(self.errors.values())
+    logging.info(
+        "%s: %.1f polls/s, latency p50 %.3fs p90 %.3fs p99 %.3fs "
+        "max %.3fs, %.1f messages/s sent, %.1f messages/s received, "
+        "%.1f kB/s sent, %.1f kB/s received, errors %.2f%% %s",
+        title, self.polls / elapsed, Percentile(latencies, 50),
+        Percentile(latencies, 90), Percentile(latencies, 99),
+        latencies[-1] if latencies else 0,
+        self.sent_messages / elapsed, self.received_messages / elapsed,
+        self.sent_bytes / 1024.0 / elapsed,
+        self.received_bytes / 1024.0 / elapsed,
+        100.0 * errors / max(self.polls, 1), dict(self.errors))
+
+
+class LoadGenerator(object):
+  """Runs simulated clients against a frontend on a single event loop."""
+
+  def __init__(self, clients, url):
+    self.clients = clients
+    self.url = url
+    location = urlparse.urlparse(url)
+    self.address = (location.hostname, location.port or 80)
+    self.request_line = "POST %s?api=%s HTTP/1.1\r\n" % (
+        location.path or "/", config_lib.CONFIG["Network.api"])
+    self.host = location.netloc
+
+    self.action_latencies = ParseActionSettings(
+        flags.FLAGS.action_latencies, float)
+    self.response_sizes = ParseActionSettings(flags.FLAGS.response_sizes, int)
+    # Responses are random so compression does not make them cheaper.
+    self.response_data = os.urandom(
+        max([flags.FLAGS.response_size] + self.response_sizes.values()))
+
+    if hasattr(select, "epoll"):
+      self.poller = select.epoll()
+      self.poll_scale = 1
+    else:
+      self.poller = select.poll()
+      self.poll_scale = 1000
+
+    self.requests = {}
+    self.waiting = collections.deque()
+    self.timers = []
+    self.timer_count = 0
+    self.stats = LoadStats()
+    self.total_stats = LoadStats()
+
+  def CallLater(self, delay, callback, *args):
+    self.timer_count += 1
+    heapq.heappush(self.timers,
+                   (time.time() + delay, self.timer_count, callback, args))
+
+  def SchedulePoll(self, client, delay):
+    client.generation += 1
+    self.CallLater(delay, self._Poll, client, client.generation)
+
+  def _Poll(self, client, generation):
+    if generation != client.generation:
+      return
+
+    if len(self.requests) >= flags.FLAGS.max_connections:
+      self.waiting.append(client)
+    else:
+      self._Send(client)
+
+  def _Send(self, client):
+    """Starts the POST of a client poll."""
+    body = client.MakeRequest()
+    request = _Request(client, "".join((
+        self.request_line,
+        "Host: %s\r\n" % self.host,
+        "Content-Type: binary/octet-stream\r\n",
+        "Content-Length: %d\r\n" % len(body),
+        "Connection: close\r\n\r\n",
+        body)))
+    self.stats.polls += 1
+    self.stats.sent_messages += len(client.sent)
+    self.stats.sent_bytes += len(body)
+
+    try:
+      request.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+      request.sock.setblocking(0)
+      request.fd = request.sock.fileno()
+      err = request.sock.connect_ex(self.address)
+      if err not in (0, errno.EINPROGRESS):
+        raise socket.error(err, os.strerror(err))
+    except socket.error as e:
+      if request.sock:
+        request.sock.close()
+      self._Finish(request, 500, error="connect: %s" % e.args[0])
+      return
+
+    self.requests[request.fd] = request
+    self.poller.register(request.fd, select.POLLOUT)
+
+  def _HandleEvent(self, request, events):
+    """Sends and receives the data of a request as the socket allows."""
+    try:
+      if events & select.POLLOUT:
+        if not request.connected:
+          err = request.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+          if err:
+            raise socket.error(err, os.strerror(err))
+          request.connected = True
+
+        request.sent += request.sock.send(
+            buffer(request.data, request.sent, 65536))
+        if request.sent == len(request.data):
+          self.poller.modify(request.fd, select.POLLIN)
+        return
+
+      data = request.sock.recv(65536)
+      if data:
+        request.received.append(data)
+        return
+
+    except socket.error as e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      self._Close(request)
+      self._Finish(request, 500, error="socket: %s" % e.args[0])
+      return
+
+    # The frontend closed the connection, the response is complete.
+    self._Close(request)
+    self._HandleResponse(request, "".join(request.received))
+
+  def _Close(self, request):
+    del self.requests[request.fd]
+    self.poller.unregister(request.fd)
+    request.sock.close()
+
+  def _HandleResponse(self, request, response):
+    """Parses the HTTP response of a poll."""
+    head, _, body = response.partition("\r\n\r\n")
+    try:
+      code = int(head.split(" ", 2)[1])
+    except (IndexError, ValueError):
+      self._Finish(request, 500, error="bad http response")
+      return
+
+    self.stats.received_bytes += len(response)
+    if code == 200:
+      self._Finish(request, code, body=body)
+    else:
+      self._Finish(request, code, error="http %d" % code)
+
+  def _Finish(self, request, code, body=None, error=None):
+    """Records a finished poll and schedules the next one of its client."""
+    client = request.client
+    self.stats.latencies.append(time.time() - request.start)
+
+    fastpoll = False
+    if body is not None:
+      try:
+        messages = client.DecodeResponse(body)
+        self.stats.received_messages += len(messages)
+        for message in messages:
+          fastpoll |= bool(message.require_fastpoll)
+          self._StartAction(client, message)
+      except (communicator.DecodingError, rdfvalue.DecodeError) as e:
+        code, error = 500, "decoding: %s" % e.__class__.__name__
+
+    if error:
+      self.stats.errors[error] += 1
+      client.RequeueSentMessages()
+
+    if code == 406:
+      client.InitiateEnrolment()
+
+    self.SchedulePoll(client, client.NextPollDelay(code, fastpoll))
+
+    # Hand the connection over to the next waiting client.
+    while self.waiting and len(self.requests) < flags.FLAGS.max_connections:
+      self._Send(self.waiting.popleft())
+
+  def _StartAction(self, client, message):
+    client.pending_actions += 1
+    self.CallLater(
+        self.action_latencies.get(message.name, flags.FLAGS.action_latency),
+        self._FinishAction, client, message)
+
+  def _FinishAction(self, client, message):
+    """Queues the responses of a simulated client action."""
+    client.pending_actions -= 1
+    size = self.response_sizes.get(message.name, flags.FLAGS.response_size)
+
+    response = rdfvalue.GrrMessage(
+        session_id=message.session_id, name=message.name,
+        request_id=message.request_id, response_id=1,
+        task_id=message.task_id, type=rdfvalue.GrrMessage.Type.MESSAGE)
+    response.payload = rdfvalue.DataBlob(data=self.response_data[:size])
+
+    status = rdfvalue.GrrStatus(
+        status=rdfvalue.GrrStatus.ReturnedStatus.OK,
+        network_bytes_sent=len(response.SerializeToString()))
+    status_message = rdfvalue.GrrMessage(
+        session_id=message.session_id, name=message.name,
+        request_id=message.request_id, response_id=2,
+        task_id=message.task_id, type=rdfvalue.GrrMessage.Type.STATUS)
+    status_message.payload = status
+    status_message.args = status.SerializeToString()
+
+    client.outbox.extend([response, status_message])
+
+  def _ExpireRequests(self, now):
+    for request in self.requests.values():
+      if request.start + flags.FLAGS.request_timeout < now:
+        self._Close(request)
+        self._Finish(request, 500, error="timeout")
+
+  def Run(self, duration=0, enroll_only=False):
+    """Runs the clients until interrupted, duration passed or all enrolled."""
+    start = time.time()
+    # Spread the first polls so the clients do not all start at once.
+    spread = min(config_lib.CONFIG["Client.poll_max"], len(self.clients) / 100.)
+    for i, client in enumerate(self.clients):
+      self.SchedulePoll(client, spread * i / len(self.clients))
+
+    next_report = start + flags.FLAGS.report_interval
+    next_expiry = start + 1
+    try:
+      while True:
+        now = time.time()
+        while self.timers and self.timers[0][0] <= now:
+          _, _, callback, args = heapq.heappop(self.timers)
+          callback(*args)
+
+        timeout = 1.0
+        if self.timers:
+          timeout = min(timeout, max(0, self.timers[0][0] - time.time()))
+
+        try:
+          events = self.poller.poll(timeout * self.poll_scale)
+        except (IOError, OSError, select.error) as e:
+          if e.args[0] != errno.EINTR:
+            raise
+          events = []
+
+        for fd, event in events:
+          request = self.requests.get(fd)
+          if request is not None:
+            self._HandleEvent(request, event)
+
+        now = time.time()
+        if now >= next_expiry:
+          self._ExpireRequests(now)
+          next_expiry = now + 1
+
+        if now >= next_report:
+          self.Report()
+          next_report = now + flags.FLAGS.report_interval
+
+        if duration and now > start + duration:
+          break
+
+        if enroll_only and all(client.enrolled for client in self.clients):
+          logging.info("All clients enrolled, exiting.")
+          break
+
+    except KeyboardInterrupt:
+      pass
+
+    self.Report()
+    self.total_stats.Report("Total")
+
+  def Report(self):
+    enrolled = len([c for c in self.clients if c.enrolled])
+    self.stats.Report("%d/%d clients enrolled, %d requests open, %d waiting" %
+                      (enrolled, len(self.clients), len(self.requests),
+                       len(self.waiting)))
+    self.total_stats.Add(self.stats)
+    self.stats = LoadStats()
+
+
+def LoadServerCertificate(url, private_key, pub_key_cache):
+  """Fetches and verifies the server certificate.
+
+  Args:
+    url: The control url of the frontend.
+    private_key: The key of any client.
+    pub_key_cache: The PubKeyCache shared by the clients.
+
+  Returns:
+    The common name of the server.
+  """
+  cert_url = "/".join((posixpath.dirname(url), "server.pem"))
+  server_pem = urllib2.urlopen(cert_url, timeout=10).read()
+
+  communicator_obj = LoadClientCommunicator(private_key, pub_key_cache)
+  communicator_obj.LoadServerCertificate(
+      server_certificate=server_pem,
+      ca_certificate=config_lib.CONFIG["CA.certificate"])
+  return communicator_obj.server_name
+
+
+def main(unused_argv):
+  config_lib.CONFIG.AddContext(
+      "PoolClient Context",
+      "Context applied when we run the pool client.")
+
+  startup.ClientInit()
+
+  config_lib.CONFIG.SetWriteBack("/dev/null")
+
+  poolclient.CheckLocation()
+
+  keys = LoadPrivateKeys(flags.FLAGS.cert_file, flags.FLAGS.nrclients)
+  url = config_lib.CONFIG["Client.control_urls"][0]
+  pub_key_cache = communicator.PubKeyCache()
+  server_name = LoadServerCertificate(url, keys[0], pub_key_cache)
+
+  clients = [SimulatedClient(LoadClientCommunicator(key, pub_key_cache,
+                                                    server_name))
+             for key in keys]
+  logging.info("Simulating %d clients against %s.", len(clients), url)
+
+  LoadGenerator(clients, url).Run(duration=flags.FLAGS.duration,
+                                  enroll_only=flags.FLAGS.enroll_only)
+
+
+if __name__ == "__main__":
+  flags.StartMain(main)
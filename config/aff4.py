@@ -19,6 +19,33 @@ config_lib.DEFINE_integer(
     "AFF4.intermediate_cache_max_size", 2000,
     "Maximum size of the AFF4 index cache.")
 
+config_lib.DEFINE_string(
+    "AFF4.shared_cache_implementation", "",
+    "The AFF4SharedCache used as a second cache tier shared by all processes "
+    "on a node, e.g. MmapAFF4SharedCache. Disabled if empty.")
+
+config_lib.DEFINE_string(
+    "AFF4.shared_cache_path", "/dev/shm/grr-aff4-shared-cache",
+    "The file backing the MmapAFF4SharedCache. All processes using the same "
+    "file share the cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_age", 60,
+    "The number of seconds AFF4 objects live in the shared cache.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_buckets", 16384,
+    "Number of entries the shared cache can hold.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_bucket_size", 4096,
+    "Maximum size in bytes of a single shared cache entry. Larger objects are "
+    "only cached locally.")
+
+config_lib.DEFINE_integer(
+    "AFF4.shared_cache_generation_slots", 65536,
+    "Number of generation counters used to invalidate shared cache entries.")
+
 config_lib.DEFINE_integer(
     "AFF4.notification_rules_cache_age", 60,
     "The number of seconds AFF4 notification rules are cached.")
@@ -220,7 +220,10 @@ config_lib.DEFINE_integer("Nanny.unresponsive_kill_period", 60,
 
 config_lib.DEFINE_integer("Network.api", 3,
                           "The version of the network protocol the client "
-                          "uses.")
+                          "uses. Version 4 lets the frontends answer in the "
+                          "session of the client and resume it from a "
+                          "session ticket, saving the RSA operations of "
+                          "repeated polls.")
 
 config_lib.DEFINE_string("Network.compression", default="ZCOMPRESS",
                          help="Type of compression (ZCOMPRESS, UNCOMPRESSED)")
@@ -16,9 +16,56 @@ config_lib.DEFINE_integer("Dataserver.max_connections", 5,
                           ("Maximum number of connections to the data server "
                            "per process."))
 
+config_lib.DEFINE_integer("Dataserver.min_connections", 1,
+                          ("Number of connections to the data server kept "
+                           "open per process."))
+
 config_lib.DEFINE_integer("Dataserver.port", 7000,
                           "Port for a specific data server.")
 
+config_lib.DEFINE_list("Dataserver.replicas", [],
+                       "Read only replicas of the data servers, given as "
+                       "<data server>=<replica>, for example "
+                       "http://127.0.0.1:7001=http://127.0.0.1:7101.")
+
+config_lib.DEFINE_integer("Dataserver.change_log_size", 0,
+                          ("Number of writes a data server keeps for its "
+                           "replicas to catch up. 0 disables the change log, "
+                           "data servers with replicas must set it."))
+
+config_lib.DEFINE_integer("Dataserver.replica_wait_timeout", 2,
+                          ("Number of seconds a replica waits to apply the "
+                           "writes a read has to see before it sends the "
+                           "client back to the primary data server."))
+
+config_lib.DEFINE_integer("Dataserver.virtual_nodes", 64,
+                          ("Number of virtual nodes per data server of weight "
+                           "1 on the consistent hashing ring. Adding a server "
+                           "or changing its weight only moves the keys of its "
+                           "own nodes. 0 gives each server a single interval "
+                           "of hashes instead."))
+
+config_lib.DEFINE_integer("Dataserver.rebalance_chunks", 1024,
+                          ("Number of chunks the range of hashes is split "
+                           "into when rebalancing. Data servers move one "
+                           "chunk at a time while they keep serving."))
+
+config_lib.DEFINE_integer("Dataserver.rebalance_bandwidth", 10 * 1024 * 1024,
+                          ("Maximum number of bytes per second a data server "
+                           "sends to another one when rebalancing. 0 disables "
+                           "the limit."))
+
+config_lib.DEFINE_integer("Dataserver.rebalance_files_per_second", 50,
+                          ("Maximum number of database files per second a "
+                           "data server copies when rebalancing. 0 disables "
+                           "the limit."))
+
+config_lib.DEFINE_integer("Dataserver.rebalance_cleanup_delay", 300,
+                          ("Number of seconds data servers keep forwarding "
+                           "writes to the chunks they moved before they "
+                           "delete their files. Must be longer than "
+                           "HTTPDataStore.mapping_refresh_interval."))
+
 # Login information for clients of the data servers.
 config_lib.DEFINE_list("Dataserver.client_credentials", ["user:pass:rw"],
                        "List of data server client credentials, given as "
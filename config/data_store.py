@@ -17,6 +17,13 @@ config_lib.DEFINE_string("Datastore.implementation", "FakeDataStore",
 config_lib.DEFINE_integer("Datastore.transaction_timeout", default=600,
                           help="How long do we wait for a transaction lock.")
 
+config_lib.DEFINE_integer("Datastore.retention_compaction_interval",
+                          default=3600,
+                          help=("Interval (in seconds) between the background "
+                                "passes which delete the attribute versions "
+                                "dropped by retention policies. 0 disables "
+                                "them."))
+
 DATASTORE_PATHING = [r"%{(?P<path>files/hash/generic/sha256/...).*}",
                      r"%{(?P<path>files/hash/generic/sha1/...).*}",
                      r"%{(?P<path>files/hash/generic/md5/...).*}",
@@ -60,6 +67,36 @@ config_lib.DEFINE_integer("SqliteDatastore.connection_cache_size", default=1000,
                           help=("Number of file handles kept in the SQLite "
                                 "data_store cache."))
 
+config_lib.DEFINE_bool("SqliteDatastore.wal_mode", default=False,
+                       help=("Keep the sqlite files in write-ahead-log mode. "
+                             "Reads then run concurrently with the writer, "
+                             "writes of many threads are committed together "
+                             "and checkpoints run in the background."))
+
+config_lib.DEFINE_integer("SqliteDatastore.reader_connections", default=4,
+                          help=("Number of idle read only connections kept "
+                                "open for every sqlite file in WAL mode."))
+
+config_lib.DEFINE_integer("SqliteDatastore.checkpoint_interval", default=10,
+                          help=("Interval (in seconds) between checkpoints of "
+                                "the write-ahead-logs in WAL mode."))
+
+# Memory data store.
+config_lib.DEFINE_integer("MemoryDatastore.shards", default=64,
+                          help=("Number of shards of the in-memory data store. "
+                                "Every shard is guarded by its own lock."))
+
+config_lib.DEFINE_string("MemoryDatastore.snapshot_path", default="",
+                         help=("File which keeps a snapshot of the in-memory "
+                               "data store. It is loaded on startup and written "
+                               "periodically and on exit. Empty disables "
+                               "snapshots."))
+
+config_lib.DEFINE_integer("MemoryDatastore.snapshot_interval", default=300,
+                          help=("Minimum interval (in seconds) between "
+                                "snapshots of the in-memory data store. 0 only "
+                                "writes a snapshot on exit."))
+
 # Mongo data store.
 config_lib.DEFINE_string("Mongo.server", "localhost",
                          "The mongo server hostname.")
@@ -115,3 +152,41 @@ config_lib.DEFINE_integer("HTTPDataStore.reconnect_timeout", 10 * 60,
 config_lib.DEFINE_integer("HTTPDataStore.retry_time", 5,
                           help=("Number of seconds to wait in-between attempts"
                                 "to reconnect to the database."))
+
+config_lib.DEFINE_bool("HTTPDataStore.compact_protocol", True,
+                       help=("Send asynchronous writes to data servers which "
+                             "support it in compact batched frames."))
+
+config_lib.DEFINE_integer("HTTPDataStore.compact_batch_size", 100,
+                          help=("Maximum number of asynchronous writes sent "
+                                "in one compact frame."))
+
+config_lib.DEFINE_integer("HTTPDataStore.compact_compression_threshold", 1024,
+                          help=("Compact frames of at least this many bytes "
+                                "are compressed with zlib. 0 disables "
+                                "compression."))
+
+config_lib.DEFINE_integer("HTTPDataStore.connection_wait_timeout", 60,
+                          help=("Number of seconds to wait for a free "
+                                "connection to a data server when all of them "
+                                "are busy."))
+
+config_lib.DEFINE_integer("HTTPDataStore.mapping_refresh_interval", 60,
+                          help=("Number of seconds between checks for a new "
+                                "mapping of the data servers, which changes "
+                                "while they are rebalancing."))
+
+config_lib.DEFINE_bool("HTTPDataStore.replica_reads", False,
+                       help=("Send reads to the replicas of the data servers "
+                             "in Dataserver.replicas. Reads still see the "
+                             "writes of the same thread, transactions and "
+                             "writes always use the primary data server."))
+
+config_lib.DEFINE_integer("HTTPDataStore.replica_connect_timeout", 2,
+                          help=("Number of seconds to wait for a replica to "
+                                "accept a connection. Replicas are not "
+                                "retried, reads go to the primary instead."))
+
+config_lib.DEFINE_integer("HTTPDataStore.replica_retry_time", 30,
+                          help=("Number of seconds a replica which could not "
+                                "be reached gets no reads."))
@@ -38,6 +38,27 @@ config_lib.DEFINE_integer("Worker.notification_retry_interval", 30,
                           "The queue manager retries to work on requests it "
                           "could not complete after this many seconds.")
 
+config_lib.DEFINE_integer("Worker.flow_batch_size", 1,
+                          "The number of flows a worker thread leases and "
+                          "processes together, sharing data store reads and "
+                          "writes. 1 processes each flow on its own.")
+
+config_lib.DEFINE_string("Worker.queue_notifier", "",
+                         "The QueueNotifier used to wake up workers on this "
+                         "node as soon as notifications are written, e.g. "
+                         "UnixSocketQueueNotifier. Disabled if empty.")
+
+config_lib.DEFINE_string("Worker.queue_notifier_socket_dir",
+                         "/tmp/grr-queue-notifier",
+                         "The directory holding the sockets of the "
+                         "UnixSocketQueueNotifier. All processes using the "
+                         "same directory wake each other up.")
+
+config_lib.DEFINE_integer("Worker.queue_notifier_polling_interval", 10,
+                          "Workers subscribed to a queue notifier still poll "
+                          "their queues every this many seconds to pick up "
+                          "notifications written on other nodes.")
+
 # We write a journal entry for the flow when it's about to be processed.
 # If the journal entry is there after this time, the flow will get terminated.
 config_lib.DEFINE_integer(
@@ -117,6 +138,66 @@ config_lib.DEFINE_integer("Frontend.message_expiry_time", 600,
                           "Maximum time messages remain valid within the "
                           "system.")
 
+config_lib.DEFINE_integer("Frontend.client_key_cache_size", 64 * 1024 * 1024,
+                          "Memory in bytes used to cache the parsed public "
+                          "keys of clients.")
+
+config_lib.DEFINE_string("Frontend.client_key_shared_cache_path", "",
+                         "If set, the public keys of clients are also cached "
+                         "in this memory mapped file, shared by all frontends "
+                         "on the host, e.g. /dev/shm/grr-client-keys.")
+
+config_lib.DEFINE_integer("Frontend.client_key_shared_cache_buckets", 131072,
+                          "Number of client keys the shared cache can hold. "
+                          "Each one uses 1kb of the file.")
+
+config_lib.DEFINE_bool("Frontend.client_key_cache_prewarm", False,
+                       "Load the public keys of the clients in the client "
+                       "index when the frontend starts.")
+
+config_lib.DEFINE_list("Frontend.session_ticket_keys", [],
+                       "Secrets the frontends seal client sessions into "
+                       "session tickets with, so clients using api version 4 "
+                       "can resume their session on any frontend without RSA "
+                       "operations. The first secret seals new tickets, the "
+                       "others are still accepted while rotating secrets. "
+                       "Session tickets are disabled if empty.")
+
+config_lib.DEFINE_integer("Frontend.session_ticket_lifetime", 24 * 3600,
+                          "Seconds a session ticket is accepted for.")
+
+config_lib.DEFINE_float("Frontend.receive_batch_interval", 0.005,
+                        "Seconds the messages received from a client may wait "
+                        "for the ones of concurrent requests, so they are "
+                        "written to the data store together.")
+
+config_lib.DEFINE_integer("Frontend.receive_batch_size", 1000,
+                          "Number of pending changes which make the frontend "
+                          "write the received messages without waiting for "
+                          "more requests.")
+
+config_lib.DEFINE_bool("Frontend.event_loop", False,
+                       "Serve the client connections from a single event loop "
+                       "thread and process the message bundles on a pool of "
+                       "worker threads, instead of one thread per request.")
+
+config_lib.DEFINE_integer("Frontend.worker_threads", 50,
+                          "Number of threads processing message bundles when "
+                          "Frontend.event_loop is set.")
+
+config_lib.DEFINE_integer("Frontend.max_pending_requests", 500,
+                          "Maximum number of requests waiting for a worker "
+                          "thread. Clients over the limit get a 503 and retry "
+                          "later.")
+
+config_lib.DEFINE_integer("Frontend.keep_alive_timeout", 60,
+                          "Seconds an idle keep-alive connection stays open "
+                          "with Frontend.event_loop set.")
+
+config_lib.DEFINE_integer("Frontend.max_request_size", 64 * 1024 * 1024,
+                          "Maximum size in bytes of a client POST with "
+                          "Frontend.event_loop set.")
+
 # The Admin UI web application.
 config_lib.DEFINE_integer("AdminUI.port", 8000, "port to listen on")
 
@@ -15,6 +15,7 @@ import logging
 
 
 from grr.lib import access_control
+from grr.lib import aff4_shared_cache
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import lexer
@@ -71,6 +72,18 @@ class Factory(object):
         max_size=config_lib.CONFIG["AFF4.intermediate_cache_max_size"],
         max_age=config_lib.CONFIG["AFF4.intermediate_cache_age"])
 
+    # An optional second cache tier which is shared by all the processes on
+    # this node.
+    self.shared_cache = None
+    shared_cache_name = config_lib.CONFIG["AFF4.shared_cache_implementation"]
+    if shared_cache_name:
+      try:
+        cls = aff4_shared_cache.AFF4SharedCache.GetPlugin(shared_cache_name)
+      except KeyError:
+        raise RuntimeError("No shared cache %s found." % shared_cache_name)
+
+      self.shared_cache = cls()
+
     # Create a token for system level actions:
     self.root_token = rdfvalue.ACLToken(username="GRRSystem",
                                         reason="Maintenance").SetUID()
@@ -106,13 +119,20 @@ class Factory(object):
         key = self._MakeCacheInvariant(subject, token, age)
 
         try:
-          yield subject, self.cache.Get(key)
+          yield subject, self._GetCachedAttributes(key, subject)
           urns.remove(subject)
         except KeyError:
           pass
 
     # If there are any urns left we get them from the database.
     if urns:
+      # Generations must be read before the data store so that a write racing
+      # with this read invalidates what we are about to cache.
+      generations = {}
+      if self.shared_cache is not None:
+        for subject in urns:
+          generations[subject] = self.shared_cache.GetGeneration(subject)
+
       for subject, values in data_store.DB.MultiResolveRegex(
           urns, AFF4_PREFIXES, timestamp=self.ParseAgeSpecification(age),
           token=token, limit=None):
@@ -120,10 +140,47 @@ class Factory(object):
         # Ensure the values are sorted.
         values.sort(key=lambda x: x[-1], reverse=True)
 
+        subject = utils.SmartUnicode(subject)
         key = self._MakeCacheInvariant(subject, token, age)
-        self.cache.Put(key, values)
+        generation = generations.get(subject)
+        self.cache.Put(key, (generation, values))
+        if generation is not None:
+          self.shared_cache.Put(key, subject, values, generation)
+
+        yield subject, values
+
+  def _GetCachedAttributes(self, key, subject):
+    """Looks up the attributes in the local and the shared cache.
+
+    Args:
+      key: The cache invariant as returned by _MakeCacheInvariant().
+      subject: The urn the attributes belong to.
+
+    Returns:
+      A list of (attribute, value, timestamp) tuples.
+
+    Raises:
+      KeyError: If the attributes are not cached in either tier.
+    """
+    if self.shared_cache is None:
+      return self.cache.Get(key)[1]
+
+    # Entries in the local cache are only valid as long as no process on this
+    # node wrote the object after they were cached.
+    generation = self.shared_cache.GetGeneration(subject)
+    try:
+      cached_generation, values = self.cache.Get(key)
+      if cached_generation == generation:
+        return values
+
+      self.cache.ExpireObject(key)
+    except KeyError:
+      pass
+
+    values = self.shared_cache.Get(key, subject)
+    self.cache.Put(key, (generation, values))
 
-        yield utils.SmartUnicode(subject), values
+    return values
 
   def SetAttributes(self, urn, attributes, to_delete, add_child_index=True,
                     sync=False, token=None):
@@ -142,6 +199,11 @@ class Factory(object):
     data_store.DB.MultiSet(urn, attributes, token=token,
                            replace=False, sync=sync, to_delete=to_delete)
 
+    # Other processes on this node might have cached the old version. This must
+    # happen after the write, otherwise they could cache the old data again.
+    if self.shared_cache is not None:
+      self.shared_cache.Invalidate(urn)
+
     # TODO(user): This can run in the thread pool since its not time
     # critical.
     self._UpdateIndex(urn, attributes, add_child_index, token)
@@ -181,31 +243,40 @@ class Factory(object):
 
       token: The token to use.
     """
-    try:
-      # Create navigation aids by touching intermediate subject names.
-      while urn.Path() != "/":
-        basename = urn.Basename()
-        dirname = rdfvalue.RDFURN(urn.Dirname())
+    # Create navigation aids by touching intermediate subject names.
+    to_set = {}
+    paths = []
+    while urn.Path() != "/":
+      basename = urn.Basename()
+      dirname = rdfvalue.RDFURN(urn.Dirname())
 
-        try:
-          self.intermediate_cache.Get(urn.Path())
-          return
-        except KeyError:
-          data_store.DB.MultiSet(dirname, {
-              AFF4Object.SchemaCls.LAST: [
-                  rdfvalue.RDFDatetime().Now().SerializeToDataStore()],
+      try:
+        self.intermediate_cache.Get(urn.Path())
+        break
+      except KeyError:
+        to_set[dirname] = {
+            AFF4Object.SchemaCls.LAST: [
+                rdfvalue.RDFDatetime().Now().SerializeToDataStore()],
 
-              # This updates the directory index.
-              "index:dir/%s" % utils.SmartStr(basename): [EMPTY_DATA],
-          },
-                                 token=token, replace=True, sync=False)
+            # This updates the directory index.
+            "index:dir/%s" % utils.SmartStr(basename): [EMPTY_DATA],
+        }
+        paths.append(urn.Path())
 
-          self.intermediate_cache.Put(urn.Path(), 1)
+        urn = dirname
 
-          urn = dirname
+    if not to_set:
+      return
 
+    # All the parent directories are written at once.
+    try:
+      data_store.DB.MultiSubjectMultiSet(to_set, token=token, replace=True,
+                                         sync=False)
     except access_control.UnauthorizedAccess:
-      pass
+      return
+
+    for path in paths:
+      self.intermediate_cache.Put(path, 1)
 
   def _DeleteChildFromIndex(self, urn, token):
     try:
@@ -367,6 +438,48 @@ class Factory(object):
 
     return obj
 
+  def MultiOpenWithLock(self, urns, aff4_type=None, token=None,
+                        age=NEWEST_TIME, lease_time=100):
+    """Opens and locks a number of urns.
+
+    This does not block: urns which are locked by someone else or do not exist
+    are skipped. The locks are taken one by one but all the objects are read
+    from the data store at once.
+
+    Args:
+      urns: The urns to open.
+      aff4_type: If set, objects which are not instances of this type are
+          skipped.
+      token: The Security Token to use for opening these items.
+      age: The age policy used to build the objects.
+      lease_time: Maximum time the objects stay locked.
+
+    Returns:
+      A list of locked objects. Each must be closed to release its lock.
+    """
+    transactions = {}
+    for urn in urns:
+      urn = rdfvalue.RDFURN(urn)
+      try:
+        transactions[urn] = self._AcquireLock(urn, token=token,
+                                              blocking=False,
+                                              lease_time=lease_time)
+      except LockError:
+        pass
+
+    result = []
+    for obj in self.MultiOpen(transactions, mode="rw", ignore_cache=True,
+                              token=token, aff4_type=aff4_type, age=age,
+                              follow_symlinks=False):
+      obj.transaction = transactions.pop(obj.urn)
+      result.append(obj)
+
+    # These urns could not be opened so we do not need the locks.
+    for transaction in transactions.values():
+      transaction.Commit()
+
+    return result
+
   def _AcquireLock(self, urn, token=None, blocking=None,
                    blocking_lock_timeout=None, lease_time=None,
                    blocking_sleep_interval=None):
@@ -504,7 +617,7 @@ class Factory(object):
     return result
 
   def MultiOpen(self, urns, mode="rw", ignore_cache=False, token=None,
-                aff4_type=None, age=NEWEST_TIME):
+                aff4_type=None, age=NEWEST_TIME, follow_symlinks=True):
     """Opens a bunch of urns efficiently."""
     if token is None:
       token = data_store.default_token
@@ -520,7 +633,7 @@ class Factory(object):
         obj = self.Open(urn, mode=mode, ignore_cache=ignore_cache, token=token,
                         local_cache={urn: values}, aff4_type=aff4_type, age=age,
                         follow_symlinks=False)
-        if isinstance(obj, AFF4Symlink):
+        if follow_symlinks and isinstance(obj, AFF4Symlink):
           target = obj.Get(obj.Schema.SYMLINK_TARGET)
           if target is not None:
             symlinks.append(target)
@@ -822,6 +935,8 @@ class Factory(object):
     data_store.DB.Flush()
     self.cache.Flush()
     self.intermediate_cache.Flush()
+    if self.shared_cache is not None:
+      self.shared_cache.Flush()
 
   def UpdateNotificationRules(self):
     fd = self.Open(rdfvalue.RDFURN("aff4:/config/aff4_rules"), mode="r",
@@ -858,7 +973,8 @@ class Attribute(object):
   def __init__(self, predicate, attribute_type=rdfvalue.RDFString,
                description="", name=None, _copy=False, default=None, index=None,
                versioned=True, lock_protected=False,
-               creates_new_object_version=True):
+               creates_new_object_version=True, max_versions=None,
+               max_age=None):
     """Constructor.
 
     Args:
@@ -881,6 +997,10 @@ class Attribute(object):
        creates_new_object_version: If this is set, a write to this attribute
           will also write a new version of the parent attribute. This should be
           False for attributes where lots of entries are collected like logs.
+       max_versions: The data store keeps at most this many versions of the
+          attribute.
+       max_age: The data store deletes versions older than this Duration. The
+          newest version is always kept.
     """
     self.name = name
     self.predicate = predicate
@@ -891,6 +1011,8 @@ class Attribute(object):
     self.versioned = versioned
     self.lock_protected = lock_protected
     self.creates_new_object_version = creates_new_object_version
+    self.max_versions = max_versions
+    self.max_age = max_age
 
     # Field names can refer to a specific component of an attribute
     self.field_names = []
@@ -913,6 +1035,11 @@ class Attribute(object):
       if name:
         self.NAMES[name] = self
 
+      if max_versions or max_age:
+        data_store.RETENTION_POLICIES[predicate] = data_store.RetentionPolicy(
+            max_versions=max_versions,
+            max_age=max_age and rdfvalue.Duration(max_age).seconds)
+
   def Copy(self):
     """Return a copy without registering in the attribute registry."""
     return Attribute(self.predicate, self.attribute_type, self.description,
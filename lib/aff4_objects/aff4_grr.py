@@ -59,7 +59,8 @@ class VFSGRRClient(standard.VFSDirectory):
 
     CLIENT_INFO = aff4.Attribute(
         "metadata:ClientInfo", rdfvalue.ClientInformation,
-        "GRR client information", "GRR client", default="")
+        "GRR client information", "GRR client", default="",
+        max_versions=100)
 
     LAST_BOOT_TIME = aff4.Attribute("metadata:LastBootTime",
                                     rdfvalue.RDFDatetime,
@@ -129,7 +130,8 @@ class VFSGRRClient(standard.VFSDirectory):
 
     PING = aff4.Attribute("metadata:ping", rdfvalue.RDFDatetime,
                           "The last time the server heard from this client.",
-                          "LastCheckin", versioned=False, default=0)
+                          "LastCheckin", versioned=False, default=0,
+                          max_versions=1)
 
     CLOCK = aff4.Attribute("metadata:clock", rdfvalue.RDFDatetime,
                            "The last clock read on the client "
@@ -402,6 +404,128 @@ class VFSAnalysisFile(VFSFile):
     pass
 
 
+class CompiledForemanRules(object):
+  """A ForemanRules list prepared for evaluating many clients.
+
+  The conditions of all the rules are deduplicated and indexed by the
+  (path, attribute) they read, so every attribute of a client is fetched and
+  converted once and every distinct condition is tested once, no matter how
+  many rules use it.
+  """
+
+  def __init__(self, rules):
+    self.rules = list(rules)
+    self.latest_rule = max([rule.created for rule in self.rules] or [0])
+
+    # Maps (path, attribute name) to a list of (condition id, test) where test
+    # is a function taking the attribute value.
+    self.tests_by_attribute = {}
+
+    # For each rule, the ids of the conditions it needs and the paths they read.
+    self.rule_conditions = []
+    self.rule_paths = []
+
+    condition_ids = {}
+    for rule in self.rules:
+      conditions = set()
+      paths = set()
+      for regex_rule in rule.regex_rules:
+        key = (regex_rule.path, regex_rule.attribute_name, "regex",
+               str(regex_rule.attribute_regex))
+        conditions.add(self._AddCondition(
+            condition_ids, key, self._RegexTest(regex_rule.attribute_regex)))
+        paths.add(regex_rule.path)
+
+      for integer_rule in rule.integer_rules:
+        key = (integer_rule.path, integer_rule.attribute_name, "integer",
+               int(integer_rule.operator), int(integer_rule.value))
+        conditions.add(self._AddCondition(
+            condition_ids, key,
+            self._IntegerTest(integer_rule.operator, integer_rule.value)))
+        paths.add(integer_rule.path)
+
+      self.rule_conditions.append(conditions)
+      self.rule_paths.append(paths)
+
+  def _AddCondition(self, condition_ids, key, test):
+    if key not in condition_ids:
+      condition_ids[key] = len(condition_ids)
+      self.tests_by_attribute.setdefault(key[:2], []).append(
+          (condition_ids[key], test))
+
+    return condition_ids[key]
+
+  def _RegexTest(self, regex):
+    return lambda value: bool(regex.Search(utils.SmartStr(value)))
+
+  def _IntegerTest(self, op, expected):
+    """Returns a function testing an attribute value against an integer."""
+    operators = rdfvalue.ForemanAttributeInteger.Operator
+    if op == operators.LESS_THAN:
+      compare = lambda value: value < expected
+    elif op == operators.GREATER_THAN:
+      compare = lambda value: value > expected
+    elif op == operators.EQUAL:
+      compare = lambda value: value == expected
+    else:
+      # Unknown operator.
+      return lambda value: False
+
+    def Test(value):
+      try:
+        return compare(int(value))
+      except (ValueError, TypeError):
+        # Not an integer attribute.
+        return False
+
+    return Test
+
+  def MatchingRules(self, client_id, rule_indexes, token=None):
+    """Returns the rules which match a client.
+
+    Args:
+      client_id: The client to evaluate the rules for.
+      rule_indexes: The indexes of the rules to evaluate.
+      token: The token used to open the client's objects.
+
+    Returns:
+      A list of the matching rules, in rule order.
+    """
+    paths = set()
+    conditions = set()
+    for i in rule_indexes:
+      paths.update(self.rule_paths[i])
+      conditions.update(self.rule_conditions[i])
+
+    # For efficiency we open all the objects we want in one round trip.
+    objects = {}
+    for fd in aff4.FACTORY.MultiOpen([client_id.Add(path) for path in paths],
+                                     token=token):
+      objects[fd.urn] = fd
+
+    results = {}
+    for (path, attribute_name), tests in self.tests_by_attribute.iteritems():
+      needed = [(condition_id, test) for condition_id, test in tests
+                if condition_id in conditions]
+      if not needed:
+        continue
+
+      fd = objects.get(client_id.Add(path))
+      attribute = aff4.Attribute.NAMES.get(attribute_name)
+      if fd is None or attribute is None:
+        # The requested attribute was not found.
+        for condition_id, _ in needed:
+          results[condition_id] = False
+        continue
+
+      value = fd.Get(attribute)
+      for condition_id, test in needed:
+        results[condition_id] = test(value)
+
+    return [self.rules[i] for i in rule_indexes
+            if all(results[c] for c in self.rule_conditions[i])]
+
+
 class GRRForeman(aff4.AFF4Object):
   """The foreman starts flows for clients depending on rules."""
 
@@ -411,6 +535,17 @@ class GRRForeman(aff4.AFF4Object):
                            "The rules the foreman uses.",
                            default=rdfvalue.ForemanRules())
 
+  compiled_rules = None
+
+  def _GetCompiledRules(self):
+    """Returns the rules compiled for evaluation, compiling them if needed."""
+    rules = self.Get(self.Schema.RULES)
+    version = (rules.age, len(rules))
+    if self.compiled_rules is None or self.compiled_rules[0] != version:
+      self.compiled_rules = (version, CompiledForemanRules(rules))
+
+    return self.compiled_rules[1]
+
   def ExpireRules(self):
     """Removes any rules with an expiration date in the past."""
     rules = self.Get(self.Schema.RULES)
@@ -436,64 +571,24 @@ class GRRForeman(aff4.AFF4Object):
       self.Set(self.Schema.RULES, new_rules)
       self.Flush()
 
-  def _CheckIfHuntTaskWasAssigned(self, client_id, hunt_id):
-    """Will return True if hunt's task was assigned to this client before."""
-    for _ in aff4.FACTORY.Stat(
-        [client_id.Add("flows/%s:hunt" %
-                       rdfvalue.RDFURN(hunt_id).Basename())],
-        token=self.token):
-      return True
+  def _GetAssignedHunts(self, client_id, hunt_ids):
+    """Returns the hunts among hunt_ids which already ran on this client."""
+    urns = dict((client_id.Add("flows/%s:hunt" %
+                               rdfvalue.RDFURN(hunt_id).Basename()), hunt_id)
+                for hunt_id in hunt_ids)
+    if not urns:
+      return set()
 
-    return False
+    return set(urns[stat["urn"]]
+               for stat in aff4.FACTORY.Stat(urns, token=self.token))
 
-  def _EvaluateRules(self, objects, rule, client_id):
-    """Evaluates the rules."""
-    try:
-      # Do the attribute regex first.
-      for regex_rule in rule.regex_rules:
-        path = client_id.Add(regex_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[regex_rule.attribute_name]
-        value = utils.SmartStr(fd.Get(attribute))
-        if not regex_rule.attribute_regex.Search(value):
-          return False
-
-      # Now the integer rules.
-      for integer_rule in rule.integer_rules:
-        path = client_id.Add(integer_rule.path)
-        fd = objects[path]
-        attribute = aff4.Attribute.NAMES[integer_rule.attribute_name]
-        try:
-          value = int(fd.Get(attribute))
-        except (ValueError, TypeError):
-          # Not an integer attribute.
-          return False
-        op = integer_rule.operator
-        if op == rdfvalue.ForemanAttributeInteger.Operator.LESS_THAN:
-          if value >= integer_rule.value:
-            return False
-        elif op == rdfvalue.ForemanAttributeInteger.Operator.GREATER_THAN:
-          if value <= integer_rule.value:
-            return False
-        elif op == rdfvalue.ForemanAttributeInteger.Operator.EQUAL:
-          if value != integer_rule.value:
-            return False
-        else:
-          # Unknown operator.
-          return False
-
-      return True
-
-    except KeyError:
-      # The requested attribute was not found.
-      return False
-
-  def _RunActions(self, rule, client_id):
+  def _RunActions(self, rule, client_id, assigned_hunts):
     """Run all the actions specified in the rule.
 
     Args:
       rule: Rule which actions are to be executed.
       client_id: Id of a client where rule's actions are to be executed.
+      assigned_hunts: Hunts which were already started on this client.
 
     Returns:
       Number of actions started.
@@ -507,7 +602,7 @@ class GRRForeman(aff4.AFF4Object):
         token.username = "Foreman"
 
         if action.HasField("hunt_id"):
-          if self._CheckIfHuntTaskWasAssigned(client_id, action.hunt_id):
+          if action.hunt_id in assigned_hunts:
             logging.info("Foreman: ignoring hunt %s on client %s: was started "
                          "here before", client_id, action.hunt_id)
           else:
@@ -516,6 +611,7 @@ class GRRForeman(aff4.AFF4Object):
 
             flow_cls = flow.GRRFlow.classes[action.hunt_name]
             flow_cls.StartClients(action.hunt_id, [client_id])
+            assigned_hunts.add(action.hunt_id)
             actions_count += 1
         else:
           flow.GRRFlow.StartFlow(
@@ -541,8 +637,8 @@ class GRRForeman(aff4.AFF4Object):
     """
     client_id = rdfvalue.ClientURN(client_id)
 
-    rules = self.Get(self.Schema.RULES)
-    if not rules: return 0
+    compiled_rules = self._GetCompiledRules()
+    if not compiled_rules.rules: return 0
 
     client = aff4.FACTORY.Open(client_id, mode="rw", token=self.token)
     try:
@@ -550,47 +646,39 @@ class GRRForeman(aff4.AFF4Object):
     except AttributeError:
       last_foreman_run = 0
 
-    latest_rule = max([rule.created for rule in rules])
-
-    if latest_rule <= int(last_foreman_run):
+    if compiled_rules.latest_rule <= int(last_foreman_run):
       return 0
 
     # Update the latest checked rule on the client.
-    client.Set(client.Schema.LAST_FOREMAN_TIME(latest_rule))
+    client.Set(client.Schema.LAST_FOREMAN_TIME(compiled_rules.latest_rule))
     client.Close()
 
-    # For efficiency we collect all the objects we want to open first and then
-    # open them all in one round trip.
-    object_urns = {}
     relevant_rules = []
     expired_rules = False
 
     now = time.time() * 1e6
 
-    for rule in rules:
+    for i, rule in enumerate(compiled_rules.rules):
       if rule.expires < now:
         expired_rules = True
         continue
       if rule.created <= int(last_foreman_run):
         continue
 
-      relevant_rules.append(rule)
-      for regex in rule.regex_rules:
-        aff4_object = client_id.Add(regex.path)
-        object_urns[str(aff4_object)] = aff4_object
-      for int_rule in rule.integer_rules:
-        aff4_object = client_id.Add(int_rule.path)
-        object_urns[str(aff4_object)] = aff4_object
+      relevant_rules.append(i)
 
-    # Retrieve all aff4 objects we need.
-    objects = {}
-    for fd in aff4.FACTORY.MultiOpen(object_urns, token=self.token):
-      objects[fd.urn] = fd
+    matching_rules = compiled_rules.MatchingRules(client_id, relevant_rules,
+                                                  token=self.token)
+
+    # Check all the hunts we might start at once.
+    assigned_hunts = self._GetAssignedHunts(
+        client_id, set(action.hunt_id for rule in matching_rules
+                       for action in rule.actions
+                       if action.HasField("hunt_id")))
 
     actions_count = 0
-    for rule in relevant_rules:
-      if self._EvaluateRules(objects, rule, client_id):
-        actions_count += self._RunActions(rule, client_id)
+    for rule in matching_rules:
+      actions_count += self._RunActions(rule, client_id, assigned_hunts)
 
     if expired_rules:
       self.ExpireRules()
@@ -178,13 +178,17 @@ class FileStoreImage(aff4.VFSBlobImage):
                             "List of hashes of each chunk in this file.",
                             versioned=False)
 
+  @staticmethod
+  def IndexPredicate(target):
+    """Returns the predicate indexing a reference to the target URN."""
+    return ("index:target:%s" % target).lower()
+
   def AddIndex(self, target):
     """Adds an indexed reference to the target URN."""
     if "w" not in self.mode:
       raise IOError("FileStoreImage %s is not in write mode.", self.urn)
-    predicate = ("index:target:%s" % target).lower()
-    data_store.DB.MultiSet(self.urn, {predicate: target}, token=self.token,
-                           replace=True, sync=False)
+    data_store.DB.MultiSet(self.urn, {self.IndexPredicate(target): target},
+                           token=self.token, replace=True, sync=False)
 
   def Query(self, target_regex=".", limit=100):
     """Search the index for matches to the file specified by the regex.
@@ -399,10 +403,17 @@ class HashFileStore(FileStore):
       file_store_fd = aff4.FACTORY.Create(file_store_urn, "FileStoreImage",
                                           mode="w", token=self.token)
       file_store_fd.FromBlobImage(fd)
-      file_store_fd.AddIndex(fd.urn)
 
       file_store_files.append(file_store_fd)
 
+    # The references to the file are indexed in all images at once.
+    if file_store_files:
+      predicate = FileStoreImage.IndexPredicate(fd.urn)
+      data_store.DB.MultiSubjectMultiSet(
+          dict((file_store_fd.urn, {predicate: [fd.urn]})
+               for file_store_fd in file_store_files),
+          token=self.token, replace=True, sync=False)
+
     # Write the hashes attribute to all the created files..
     for file_store_fd in file_store_files:
       file_store_fd.Set(hashes)
@@ -15,7 +15,7 @@ class ClientStats(standard.VFSDirectory):
   class SchemaCls(standard.VFSDirectory.SchemaCls):
     STATS = aff4.Attribute("aff4:stats", rdfvalue.ClientStats,
                            "Client Stats.", "Client stats",
-                           creates_new_object_version=False)
+                           creates_new_object_version=False, max_age="31d")
 
 
 class ClientFleetStats(aff4.AFF4Object):
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+"""A node wide cache of AFF4 attributes shared by all GRR processes.
+
+The AFF4 factory keeps a short lived, per process cache of the attributes it
+read from the data store. When many workers and frontends run on the same host,
+every process keeps its own copy of the hot objects (e.g. clients) and issues
+its own MultiResolveRegex calls to fill it.
+
+The shared cache adds a second tier which is visible to all processes on a
+node. It also maintains a table of generation counters: every write through the
+factory bumps the generation of the written urn and cache entries which were
+filled at an older generation are considered invalid. This allows processes to
+stop serving stale data as soon as another process on the same node has
+written the object.
+"""
+
+
+import fcntl
+import marshal
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class AFF4SharedCache(object):
+  """Base class for all shared AFF4 attribute cache implementations."""
+
+  __metaclass__ = registry.MetaclassRegistry
+  __abstract = True  # pylint: disable=g-bad-name
+
+  def GetGeneration(self, urn):
+    """Returns the current generation of the urn.
+
+    Callers must read the generation before reading the attributes from the
+    data store, and pass it to Put() together with the values read.
+
+    Args:
+      urn: The subject to check.
+
+    Returns:
+      An opaque value which changes every time the urn is invalidated.
+    """
+    raise NotImplementedError()
+
+  def Invalidate(self, urn):
+    """Invalidates all entries cached for the urn on all processes."""
+    raise NotImplementedError()
+
+  def Get(self, key, urn):
+    """Retrieves the attributes stored under key.
+
+    Args:
+      key: The cache invariant as returned by Factory._MakeCacheInvariant().
+      urn: The subject these attributes belong to.
+
+    Returns:
+      A list of (attribute, value, timestamp) tuples.
+
+    Raises:
+      KeyError: If the key is not cached, expired or has been invalidated.
+    """
+    raise NotImplementedError()
+
+  def Put(self, key, urn, values, generation):
+    """Stores the attributes under key.
+
+    Args:
+      key: The cache invariant as returned by Factory._MakeCacheInvariant().
+      urn: The subject these attributes belong to.
+      values: A list of (attribute, value, timestamp) tuples.
+      generation: The generation of the urn read before the values were
+        fetched from the data store.
+    """
+    raise NotImplementedError()
+
+  def Flush(self):
+    """Drops all the entries from the cache."""
+
+
+class MmapAFF4SharedCache(AFF4SharedCache):
+  """A shared cache stored in a memory mapped file.
+
+  The file is laid out as a header, followed by a 64 bit epoch counter, a table
+  of 64 bit generation counters and a number of fixed size buckets:
+
+    header | epoch | generation slots | bucket 0 | bucket 1 | ... | bucket n
+
+  Each urn hashes to one generation slot and each cache key hashes to one
+  bucket, so a newer entry simply replaces an older one sharing its bucket. The
+  epoch is bumped by Flush() and invalidates all the entries at once.
+
+  Buckets are written without locking. Instead, every bucket carries a
+  checksum over its content and readers treat entries with a bad checksum
+  (e.g. a torn concurrent write) as misses. Counter updates are read-modify-
+  write operations and are therefore serialized with a byte range lock.
+  """
+
+  MAGIC = "GRRAFF4C"
+  HEADER = struct.Struct("<8sIII")
+  COUNTER = struct.Struct("<Q")
+  BUCKET_HEADER = struct.Struct("<QQIdII")
+
+  def __init__(self, path=None, buckets=None, bucket_size=None,
+               generation_slots=None, max_age=None):
+    super(MmapAFF4SharedCache, self).__init__()
+    self.path = path or config_lib.CONFIG["AFF4.shared_cache_path"]
+    self.buckets = buckets or config_lib.CONFIG["AFF4.shared_cache_buckets"]
+    self.bucket_size = (bucket_size or
+                        config_lib.CONFIG["AFF4.shared_cache_bucket_size"])
+    self.generation_slots = (
+        generation_slots or
+        config_lib.CONFIG["AFF4.shared_cache_generation_slots"])
+    if max_age is None:
+      max_age = config_lib.CONFIG["AFF4.shared_cache_age"]
+    self.max_age = max_age
+
+    if self.bucket_size <= self.BUCKET_HEADER.size:
+      raise ValueError("Shared cache bucket size too small.")
+
+    self.epoch_offset = self.HEADER.size
+    self.generation_offset = self.epoch_offset + self.COUNTER.size
+    self.bucket_offset = (self.generation_offset +
+                          self.generation_slots * self.COUNTER.size)
+    self.size = self.bucket_offset + self.buckets * self.bucket_size
+
+    # Protects counter updates between threads, the byte range lock only
+    # protects them between processes.
+    self.lock = threading.Lock()
+    self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+    self._InitializeFile()
+    self.mmap = mmap.mmap(self.fd, self.size)
+
+  def _InitializeFile(self):
+    """Creates or resets the file unless it already has the right layout."""
+    expected_header = self.HEADER.pack(self.MAGIC, self.generation_slots,
+                                       self.buckets, self.bucket_size)
+    fcntl.flock(self.fd, fcntl.LOCK_EX)
+    try:
+      if (os.fstat(self.fd).st_size == self.size and
+          os.read(self.fd, self.HEADER.size) == expected_header):
+        return
+
+      logging.info("Initializing AFF4 shared cache in %s (%d bytes).",
+                   self.path, self.size)
+      os.ftruncate(self.fd, 0)
+      os.ftruncate(self.fd, self.size)
+      os.lseek(self.fd, 0, os.SEEK_SET)
+      os.write(self.fd, expected_header)
+    finally:
+      fcntl.flock(self.fd, fcntl.LOCK_UN)
+
+  def _Hash(self, value):
+    return zlib.crc32(utils.SmartStr(value)) & 0xffffffff
+
+  def _GenerationOffset(self, urn):
+    slot = self._Hash(urn) % self.generation_slots
+    return self.generation_offset + slot * self.COUNTER.size
+
+  def _BucketOffset(self, key):
+    return self.bucket_offset + (self._Hash(key) % self.buckets *
+                                 self.bucket_size)
+
+  def _Checksum(self, epoch, generation, timestamp, key, data):
+    checksum = zlib.crc32(struct.pack("<QQd", epoch, generation, timestamp))
+    checksum = zlib.crc32(key, checksum)
+    return zlib.crc32(data, checksum) & 0xffffffff
+
+  def _ReadCounter(self, offset):
+    return self.COUNTER.unpack(self.mmap[offset:offset + self.COUNTER.size])[0]
+
+  def _IncrementCounter(self, offset):
+    with self.lock:
+      fcntl.lockf(self.fd, fcntl.LOCK_EX, self.COUNTER.size, offset)
+      try:
+        value = self._ReadCounter(offset)
+        self.mmap[offset:offset + self.COUNTER.size] = self.COUNTER.pack(
+            (value + 1) & 0xffffffffffffffff)
+      finally:
+        fcntl.lockf(self.fd, fcntl.LOCK_UN, self.COUNTER.size, offset)
+
+  def GetGeneration(self, urn):
+    return (self._ReadCounter(self.epoch_offset),
+            self._ReadCounter(self._GenerationOffset(urn)))
+
+  def Invalidate(self, urn):
+    self._IncrementCounter(self._GenerationOffset(urn))
+    stats.STATS.IncrementCounter("aff4_shared_cache_invalidations")
+
+  def Get(self, key, urn):
+    key = utils.SmartStr(key)
+    try:
+      values = self._Read(key, urn)
+    except KeyError:
+      stats.STATS.IncrementCounter("aff4_shared_cache_misses")
+      raise
+
+    stats.STATS.IncrementCounter("aff4_shared_cache_hits")
+    return values
+
+  def _Read(self, key, urn):
+    """Reads and validates the entry stored for key."""
+    offset = self._BucketOffset(key)
+    header_end = offset + self.BUCKET_HEADER.size
+    epoch, generation, checksum, timestamp, key_length, data_length = (
+        self.BUCKET_HEADER.unpack(self.mmap[offset:header_end]))
+
+    if (key_length != len(key) or
+        key_length + data_length > self.bucket_size - self.BUCKET_HEADER.size):
+      raise KeyError(key)
+
+    stored_key = self.mmap[header_end:header_end + key_length]
+    data = self.mmap[header_end + key_length:
+                     header_end + key_length + data_length]
+
+    if (stored_key != key or
+        self._Checksum(epoch, generation, timestamp, stored_key,
+                       data) != checksum):
+      raise KeyError(key)
+
+    if timestamp + self.max_age < time.time():
+      raise KeyError("Expired")
+
+    if (epoch, generation) != self.GetGeneration(urn):
+      raise KeyError("Invalidated")
+
+    try:
+      return marshal.loads(data)
+    except (EOFError, ValueError, TypeError):
+      raise KeyError(key)
+
+  def Put(self, key, urn, values, generation):
+    key = utils.SmartStr(key)
+    try:
+      data = marshal.dumps(values)
+    except ValueError:
+      # The data store returned values we can not share, e.g. driver specific
+      # types. These are only cached locally.
+      return
+
+    if (len(key) + len(data) >
+        self.bucket_size - self.BUCKET_HEADER.size):
+      return
+
+    epoch, generation = generation
+    timestamp = time.time()
+    header = self.BUCKET_HEADER.pack(
+        epoch, generation,
+        self._Checksum(epoch, generation, timestamp, key, data),
+        timestamp, len(key), len(data))
+
+    offset = self._BucketOffset(key)
+    end = offset + len(header) + len(key) + len(data)
+    self.mmap[offset:end] = header + key + data
+
+  def Flush(self):
+    self._IncrementCounter(self.epoch_offset)
+
+
+class AFF4SharedCacheInit(registry.InitHook):
+  """Registers the shared cache stats."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_hits")
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_misses")
+    stats.STATS.RegisterCounterMetric("aff4_shared_cache_invalidations")
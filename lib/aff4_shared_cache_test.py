@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+"""Tests for the shared AFF4 attribute cache."""
+
+
+import os
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import aff4_shared_cache
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import stats
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class MmapAFF4SharedCacheTest(test_lib.GRRBaseTest):
+  """Test the memory mapped shared cache."""
+
+  def setUp(self):
+    super(MmapAFF4SharedCacheTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "aff4_cache")
+
+  def _MakeCache(self, **kwargs):
+    # Each instance maps the file independently, just like separate processes.
+    return aff4_shared_cache.MmapAFF4SharedCache(
+        path=self.path, buckets=64, bucket_size=512, generation_slots=64,
+        max_age=10, **kwargs)
+
+  def testValuesAreSharedBetweenInstances(self):
+    cache1 = self._MakeCache()
+    cache2 = self._MakeCache()
+
+    values = [(u"aff4:type", u"VFSGRRClient", 10), ("aff4:size", 5, 20)]
+    cache1.Put("key", "aff4:/C.1", values, cache1.GetGeneration("aff4:/C.1"))
+
+    self.assertEqual(cache2.Get("key", "aff4:/C.1"), values)
+    self.assertRaises(KeyError, cache2.Get, "other key", "aff4:/C.1")
+
+  def testInvalidation(self):
+    cache1 = self._MakeCache()
+    cache2 = self._MakeCache()
+
+    generation = cache1.GetGeneration("aff4:/C.1")
+    cache1.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)], generation)
+    cache2.Invalidate("aff4:/C.1")
+
+    self.assertNotEqual(cache1.GetGeneration("aff4:/C.1"), generation)
+    self.assertRaises(KeyError, cache1.Get, "key", "aff4:/C.1")
+
+    # Values read before the invalidation must not be served afterwards.
+    cache1.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)], generation)
+    self.assertRaises(KeyError, cache2.Get, "key", "aff4:/C.1")
+
+  def testFlush(self):
+    cache1 = self._MakeCache()
+    cache2 = self._MakeCache()
+
+    cache1.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)],
+               cache1.GetGeneration("aff4:/C.1"))
+    cache2.Flush()
+
+    self.assertRaises(KeyError, cache1.Get, "key", "aff4:/C.1")
+
+  def testExpiry(self):
+    cache = self._MakeCache()
+
+    with test_lib.FakeTime(100):
+      cache.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)],
+                cache.GetGeneration("aff4:/C.1"))
+
+    with test_lib.FakeTime(105):
+      self.assertEqual(cache.Get("key", "aff4:/C.1"), [("aff4:size", 5, 20)])
+
+    with test_lib.FakeTime(111):
+      self.assertRaises(KeyError, cache.Get, "key", "aff4:/C.1")
+
+  def testLargeValuesAreNotCached(self):
+    cache = self._MakeCache()
+    cache.Put("key", "aff4:/C.1", [("aff4:content", "X" * 1000, 20)],
+              cache.GetGeneration("aff4:/C.1"))
+
+    self.assertRaises(KeyError, cache.Get, "key", "aff4:/C.1")
+
+  def testCorruptEntriesAreMisses(self):
+    cache = self._MakeCache()
+    cache.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)],
+              cache.GetGeneration("aff4:/C.1"))
+
+    # Simulate a torn write by flipping a byte in the bucket payload.
+    offset = cache._BucketOffset("key") + cache.BUCKET_HEADER.size + 4
+    cache.mmap[offset] = chr(ord(cache.mmap[offset]) ^ 0xff)
+
+    self.assertRaises(KeyError, cache.Get, "key", "aff4:/C.1")
+
+  def testStats(self):
+    cache = self._MakeCache()
+    hits = stats.STATS.GetMetricValue("aff4_shared_cache_hits")
+    misses = stats.STATS.GetMetricValue("aff4_shared_cache_misses")
+    invalidations = stats.STATS.GetMetricValue(
+        "aff4_shared_cache_invalidations")
+
+    self.assertRaises(KeyError, cache.Get, "key", "aff4:/C.1")
+    cache.Put("key", "aff4:/C.1", [("aff4:size", 5, 20)],
+              cache.GetGeneration("aff4:/C.1"))
+    cache.Get("key", "aff4:/C.1")
+    cache.Invalidate("aff4:/C.1")
+
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_shared_cache_hits"),
+                     hits + 1)
+    self.assertEqual(stats.STATS.GetMetricValue("aff4_shared_cache_misses"),
+                     misses + 1)
+    self.assertEqual(
+        stats.STATS.GetMetricValue("aff4_shared_cache_invalidations"),
+        invalidations + 1)
+
+
+class FactorySharedCacheTest(test_lib.AFF4ObjectTest):
+  """Test the AFF4 factory with a shared cache tier."""
+
+  def setUp(self):
+    super(FactorySharedCacheTest, self).setUp()
+    config_lib.CONFIG.Set("AFF4.shared_cache_implementation",
+                          "MmapAFF4SharedCache")
+    config_lib.CONFIG.Set("AFF4.shared_cache_path",
+                          os.path.join(self.temp_dir, "aff4_cache"))
+    config_lib.CONFIG.Set("AFF4.shared_cache_buckets", 256)
+    config_lib.CONFIG.Set("AFF4.shared_cache_generation_slots", 256)
+
+    # Two factories sharing the cache behave like two processes on a node.
+    self.factory1 = aff4.Factory()
+    self.factory2 = aff4.Factory()
+    self.urn = rdfvalue.RDFURN("aff4:/foo/bar")
+
+    with aff4.FACTORY.Create(self.urn, "AFF4Volume", mode="w",
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.STORED("aff4:/first"))
+
+  def _GetStored(self, factory):
+    for _, values in factory.GetAttributes([self.urn], token=self.token):
+      for attribute, value, _ in values:
+        if attribute == "aff4:stored":
+          return value
+
+  def testReadsAreShared(self):
+    self.assertEqual(self._GetStored(self.factory1), "aff4:/first")
+
+    with utils.Stubber(data_store.DB, "MultiResolveRegex", None):
+      # The second factory must not touch the data store.
+      self.assertEqual(self._GetStored(self.factory2), "aff4:/first")
+
+  def testWritesInvalidateOtherFactories(self):
+    self.assertEqual(self._GetStored(self.factory1), "aff4:/first")
+    self.assertEqual(self._GetStored(self.factory2), "aff4:/first")
+
+    with utils.Stubber(aff4, "FACTORY", self.factory2):
+      with aff4.FACTORY.Create(self.urn, "AFF4Volume", mode="w",
+                               token=self.token) as fd:
+        fd.Set(fd.Schema.STORED("aff4:/second"))
+
+    # The first factory would serve its local cache for AFF4.cache_age
+    # seconds, but the write on the other factory invalidated it.
+    self.assertEqual(self._GetStored(self.factory1), "aff4:/second")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
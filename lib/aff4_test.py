@@ -1549,6 +1549,57 @@ class ForemanTests(test_lib.AFF4ObjectTest):
                        rdfvalue.ClientURN("C.0000000000000014"))
       self.assertEqual(self.clients_launched[3][1], eq_flow)
 
+  def testCompiledRulesShareConditions(self):
+    """Tests that conditions used by many rules are only evaluated once."""
+    fd = aff4.FACTORY.Create("C.0000000000000031", "VFSGRRClient",
+                             token=self.token)
+    fd.Set(fd.Schema.SYSTEM, rdfvalue.RDFString("Windows 7"))
+    fd.Set(fd.Schema.INSTALL_DATE(1336480583077736))
+    fd.Close()
+
+    rule_set = rdfvalue.ForemanRules()
+    for i in range(10):
+      rule = rdfvalue.ForemanRule(created=1000 * 1000000, description="%d" % i)
+      rule.regex_rules.Append(attribute_name=fd.Schema.SYSTEM.name,
+                              attribute_regex="Windows")
+      rule.integer_rules.Append(
+          attribute_name=fd.Schema.INSTALL_DATE.name,
+          operator=rdfvalue.ForemanAttributeInteger.Operator.GREATER_THAN,
+          value=i)
+      rule_set.Append(rule)
+
+    # This one has a condition nobody else uses.
+    rule = rdfvalue.ForemanRule(created=1000 * 1000000, description="Linux")
+    rule.regex_rules.Append(attribute_name=fd.Schema.SYSTEM.name,
+                            attribute_regex="Linux")
+    rule_set.Append(rule)
+
+    compiled = aff4_grr.CompiledForemanRules(rule_set)
+
+    # One regex condition per distinct regex and one integer condition per
+    # distinct value.
+    self.assertEqual(sum(len(tests) for tests in
+                         compiled.tests_by_attribute.values()), 12)
+
+    opened = []
+    original_multi_open = aff4.FACTORY.MultiOpen
+
+    def MultiOpen(urns, **kwargs):
+      opened.append(list(urns))
+      return original_multi_open(urns, **kwargs)
+
+    with utils.Stubber(aff4.FACTORY, "MultiOpen", MultiOpen):
+      matching = compiled.MatchingRules(
+          rdfvalue.ClientURN("C.0000000000000031"), range(len(rule_set)),
+          token=self.token)
+
+    self.assertEqual([rule.description for rule in matching],
+                     [str(i) for i in range(10)])
+
+    # All the rules read the same object which is opened once.
+    self.assertEqual(len(opened), 1)
+    self.assertEqual(len(opened[0]), 1)
+
   def testRuleExpiration(self):
     with test_lib.FakeTime(1000):
       foreman = aff4.FACTORY.Open("aff4:/foreman", mode="rw", token=self.token)
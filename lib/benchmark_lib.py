@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+"""Helpers to summarize, store and compare benchmark results.
+
+Benchmarks time every repetition of an operation. The timings are summarized
+into throughput and latency percentiles which are stored as JSON, so the
+results of two runs (e.g. before and after a change) can be compared.
+"""
+
+
+import json
+import os
+import time
+
+
+# The latency percentiles reported for every benchmark.
+PERCENTILES = (50, 90, 99)
+
+
+def Percentile(sorted_values, percentile):
+  """Returns the percentile of a sorted list using linear interpolation."""
+  if not sorted_values:
+    return 0.0
+
+  position = (len(sorted_values) - 1) * percentile / 100.0
+  lower = int(position)
+  upper = min(lower + 1, len(sorted_values) - 1)
+  fraction = position - lower
+
+  return (sorted_values[lower] * (1 - fraction) +
+          sorted_values[upper] * fraction)
+
+
+def Summarize(name, durations, operations=1):
+  """Summarizes the timings of a benchmark.
+
+  Args:
+    name: The name of the benchmark.
+    durations: A list of the durations of every repetition, in seconds.
+    operations: The number of operations done in every repetition. This is
+        used to calculate the throughput, e.g. the number of messages per
+        second when every repetition handles a batch of messages.
+
+  Returns:
+    A dict with the summary which can be serialized as JSON.
+  """
+  sorted_durations = sorted(durations)
+  total_time = sum(sorted_durations)
+
+  result = dict(name=name,
+                repetitions=len(sorted_durations),
+                operations=operations * len(sorted_durations),
+                total_time=total_time,
+                mean=total_time / max(len(sorted_durations), 1),
+                max=sorted_durations[-1] if sorted_durations else 0.0,
+                throughput=0.0)
+
+  if total_time:
+    result["throughput"] = result["operations"] / total_time
+
+  for percentile in PERCENTILES:
+    result["p%d" % percentile] = Percentile(sorted_durations, percentile)
+
+  return result
+
+
+def CompareResults(baseline, results, threshold=0.1):
+  """Finds benchmarks which got slower than in the baseline.
+
+  Args:
+    baseline: A list of summaries as returned by Summarize() of an earlier run.
+    results: A list of summaries of the current run.
+    threshold: The relative change which is considered a regression, e.g. 0.1
+        flags benchmarks whose throughput dropped or whose median latency grew
+        by more than 10%.
+
+  Returns:
+    A list of (name, metric, baseline value, current value) tuples, one for
+    every regression found. Benchmarks missing from either run are skipped.
+  """
+  baseline_by_name = dict((result["name"], result) for result in baseline)
+
+  regressions = []
+  for result in results:
+    old = baseline_by_name.get(result["name"])
+    if old is None:
+      continue
+
+    if result["throughput"] < old["throughput"] * (1 - threshold):
+      regressions.append((result["name"], "throughput", old["throughput"],
+                          result["throughput"]))
+
+    if result["p50"] > old["p50"] * (1 + threshold):
+      regressions.append((result["name"], "p50", old["p50"], result["p50"]))
+
+  return regressions
+
+
+def ResultsPath(directory, benchmark):
+  return os.path.join(directory, "%s.json" % benchmark)
+
+
+def WriteResults(directory, benchmark, results, **metadata):
+  """Writes the results of a benchmark into directory as a JSON file."""
+  if not os.path.isdir(directory):
+    os.makedirs(directory)
+
+  data = dict(metadata, benchmark=benchmark, time=time.time(),
+              results=results)
+  with open(ResultsPath(directory, benchmark), "wb") as fd:
+    json.dump(data, fd, indent=2, sort_keys=True)
+
+
+def ReadResults(directory, benchmark):
+  """Returns the results of a benchmark written by WriteResults() or None."""
+  try:
+    with open(ResultsPath(directory, benchmark), "rb") as fd:
+      return json.load(fd)["results"]
+  except (IOError, ValueError, KeyError):
+    return None
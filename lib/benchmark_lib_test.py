@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+"""Tests for the benchmark result helpers."""
+
+
+
+from grr.lib import benchmark_lib
+from grr.lib import flags
+from grr.lib import test_lib
+
+
+class BenchmarkLibTest(test_lib.GRRBaseTest):
+  """Tests summarizing and comparing benchmark results."""
+
+  def testPercentile(self):
+    values = range(101)
+    self.assertEqual(benchmark_lib.Percentile(values, 50), 50)
+    self.assertEqual(benchmark_lib.Percentile(values, 99), 99)
+    self.assertEqual(benchmark_lib.Percentile([1.0, 2.0], 50), 1.5)
+    self.assertEqual(benchmark_lib.Percentile([], 50), 0.0)
+
+  def testSummarize(self):
+    result = benchmark_lib.Summarize("test", [0.2, 0.1, 0.3, 0.4],
+                                     operations=10)
+
+    self.assertEqual(result["name"], "test")
+    self.assertEqual(result["repetitions"], 4)
+    self.assertEqual(result["operations"], 40)
+    self.assertAlmostEqual(result["total_time"], 1.0)
+    self.assertAlmostEqual(result["mean"], 0.25)
+    self.assertAlmostEqual(result["throughput"], 40)
+    self.assertAlmostEqual(result["p50"], 0.25)
+    self.assertAlmostEqual(result["max"], 0.4)
+
+  def testCompareResults(self):
+    baseline = [benchmark_lib.Summarize("same", [0.1] * 10),
+                benchmark_lib.Summarize("slower", [0.1] * 10),
+                benchmark_lib.Summarize("removed", [0.1] * 10)]
+    results = [benchmark_lib.Summarize("same", [0.105] * 10),
+               benchmark_lib.Summarize("slower", [0.2] * 10),
+               benchmark_lib.Summarize("added", [0.1] * 10)]
+
+    regressions = benchmark_lib.CompareResults(baseline, results,
+                                               threshold=0.1)
+    self.assertEqual(sorted(metric for name, metric, _, _ in regressions),
+                     ["p50", "throughput"])
+    for name, _, old, new in regressions:
+      self.assertEqual(name, "slower")
+      self.assertNotEqual(old, new)
+
+    # With a large enough threshold nothing is reported.
+    self.assertEqual(
+        benchmark_lib.CompareResults(baseline, results, threshold=2), [])
+
+  def testWriteAndReadResults(self):
+    results = [benchmark_lib.Summarize("test", [0.1, 0.2])]
+    benchmark_lib.WriteResults(self.temp_dir, "Benchmarks.testFoo", results,
+                               data_store="FakeDataStore")
+
+    self.assertEqual(benchmark_lib.ReadResults(self.temp_dir,
+                                               "Benchmarks.testFoo"), results)
+    self.assertEqual(benchmark_lib.ReadResults(self.temp_dir,
+                                               "Benchmarks.testBar"), None)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
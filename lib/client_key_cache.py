@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""Caches of the parsed public keys of clients, used by the frontends.
+
+Verifying a client message needs the public key of the client. Reading it
+means opening the client in AFF4 and parsing its certificate, which is much
+more expensive than the verification itself. The frontends therefore keep the
+parsed keys of as many clients as fit in Frontend.client_key_cache_size bytes.
+
+With Frontend.client_key_shared_cache_path set, the PEM encoded keys are also
+stored in a memory mapped file shared by all the processes of a host, so a
+frontend seeing a client for the first time does not have to read it from the
+data store. The file carries a generation counter per client which is bumped
+when the client enrolls again. Every process checks it before using a key it
+cached, so re-enrollments done on the same host invalidate the keys of all the
+frontends at once.
+"""
+
+
+import collections
+import threading
+import weakref
+
+
+from M2Crypto import BIO
+from M2Crypto import RSA
+
+import logging
+
+from grr.lib import aff4
+from grr.lib import aff4_shared_cache
+from grr.lib import client_index
+from grr.lib import config_lib
+from grr.lib import rdfvalue
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class MmapClientKeySharedCache(aff4_shared_cache.MmapAFF4SharedCache):
+  """The memory mapped file holding the PEM public keys of clients."""
+
+  __abstract = True  # pylint: disable=g-bad-name
+
+  # Keys of enrolled clients do not change, they only expire to bound the time
+  # a deleted client can still talk to the frontends of other hosts.
+  MAX_AGE = 24 * 3600
+  BUCKET_SIZE = 1024
+
+  def __init__(self, path, buckets):
+    super(MmapClientKeySharedCache, self).__init__(
+        path=path, buckets=buckets, bucket_size=self.BUCKET_SIZE,
+        generation_slots=buckets, max_age=self.MAX_AGE)
+
+  def Get(self, key, urn):
+    return self._Read(utils.SmartStr(key), urn)
+
+  def Invalidate(self, urn):
+    self._IncrementCounter(self._GenerationOffset(urn))
+
+
+class ClientKeyCache(object):
+  """An LRU cache of parsed client public keys, bounded by memory."""
+
+  # Estimate of the memory used by an entry besides its PEM encoded key.
+  ENTRY_OVERHEAD = 1024
+
+  def __init__(self, max_size, shared_cache=None):
+    self.max_size = max_size
+    self.shared_cache = shared_cache
+    self.size = 0
+    # Maps common names to (rsa key, size, generation), least recently used
+    # first.
+    self.entries = collections.OrderedDict()
+    self.lock = threading.Lock()
+    _CACHES.add(self)
+
+  def __len__(self):
+    return len(self.entries)
+
+  def GetGeneration(self, common_name):
+    """Returns the generation to pass to Put() for keys read from now on."""
+    if self.shared_cache is None:
+      return None
+    return self.shared_cache.GetGeneration(common_name)
+
+  def Get(self, common_name):
+    """Returns the parsed public key of a client.
+
+    Args:
+      common_name: The common name of the client, i.e. its URN.
+
+    Returns:
+      An M2Crypto RSA public key.
+
+    Raises:
+      KeyError: If the key is not cached.
+    """
+    generation = self.GetGeneration(common_name)
+    with self.lock:
+      entry = self.entries.pop(common_name, None)
+      if entry is not None and entry[2] == generation:
+        self.entries[common_name] = entry
+        stats.STATS.IncrementCounter("client_key_cache_hits")
+        return entry[0]
+      if entry is not None:
+        self.size -= entry[1]
+
+    if self.shared_cache is not None:
+      try:
+        pem = self.shared_cache.Get(common_name, common_name)
+        stats.STATS.IncrementCounter("client_key_cache_shared_hits")
+        return self._Add(common_name, pem, generation)
+      except KeyError:
+        pass
+
+    stats.STATS.IncrementCounter("client_key_cache_misses")
+    raise KeyError(common_name)
+
+  def Put(self, common_name, pem, generation=None):
+    """Caches the PEM encoded public key of a client.
+
+    Args:
+      common_name: The common name of the client.
+      pem: The PEM encoded public key.
+      generation: The value of GetGeneration() before the key was read.
+
+    Returns:
+      The parsed key.
+    """
+    if generation is None:
+      generation = self.GetGeneration(common_name)
+    if self.shared_cache is not None:
+      self.shared_cache.Put(common_name, common_name, pem, generation)
+    return self._Add(common_name, pem, generation)
+
+  def _Add(self, common_name, pem, generation):
+    rsa = RSA.load_pub_key_bio(BIO.MemoryBuffer(pem))
+    size = len(pem) + self.ENTRY_OVERHEAD
+    with self.lock:
+      old = self.entries.pop(common_name, None)
+      if old is not None:
+        self.size -= old[1]
+      self.entries[common_name] = (rsa, size, generation)
+      self.size += size
+      while self.size > self.max_size and len(self.entries) > 1:
+        _, (_, expired_size, _) = self.entries.popitem(last=False)
+        self.size -= expired_size
+    return rsa
+
+  def Invalidate(self, common_name):
+    """Drops the key of a client from this process and the shared cache."""
+    with self.lock:
+      entry = self.entries.pop(common_name, None)
+      if entry is not None:
+        self.size -= entry[1]
+    if self.shared_cache is not None:
+      self.shared_cache.Invalidate(common_name)
+
+  def Flush(self):
+    with self.lock:
+      self.entries.clear()
+      self.size = 0
+
+  def Prewarm(self, token=None, batch_size=1000):
+    """Loads the keys of the clients in the client index.
+
+    Args:
+      token: The token used to read the clients.
+      batch_size: Number of clients read at once.
+
+    Returns:
+      The number of keys loaded.
+    """
+    index = aff4.FACTORY.Create(client_index.MAIN_INDEX,
+                                aff4_type="ClientIndex", mode="rw",
+                                token=token)
+    # All clients are indexed with the universal keyword.
+    client_urns = sorted(index.LookupClients(["."]))
+    loaded = 0
+    for batch in utils.Grouper(client_urns, batch_size):
+      generations = dict((str(urn), self.GetGeneration(str(urn)))
+                         for urn in batch)
+      for client in aff4.FACTORY.MultiOpen(batch, aff4_type="VFSGRRClient",
+                                           token=token):
+        cert = client.Get(client.Schema.CERT)
+        if not cert:
+          continue
+        common_name = str(client.urn)
+        # Clients with a mismatching cert have to enroll again anyway.
+        if rdfvalue.RDFURN(cert.common_name) != client.urn:
+          continue
+        try:
+          self.Put(common_name, PEMFromCert(cert), generations[common_name])
+        except RSA.RSAError as e:
+          logging.warning("Could not load the key of %s: %s", common_name, e)
+          continue
+        loaded += 1
+        if self.size >= self.max_size:
+          return loaded
+    return loaded
+
+
+def PEMFromCert(cert):
+  """Returns the PEM encoded public key of an RDFX509Cert."""
+  bio = BIO.MemoryBuffer()
+  cert.GetPubKey().save_pub_key_bio(bio)
+  return bio.read_all()
+
+
+# The caches of this process, invalidated by InvalidateClient().
+_CACHES = weakref.WeakSet()
+
+# The shared caches of this host by path, used to invalidate the keys of other
+# processes.
+_shared_caches = {}
+_shared_caches_lock = threading.Lock()
+
+
+def GetSharedCache():
+  """Returns the shared client key cache of this host, None if disabled."""
+  path = config_lib.CONFIG["Frontend.client_key_shared_cache_path"]
+  if not path:
+    return None
+
+  with _shared_caches_lock:
+    if path not in _shared_caches:
+      _shared_caches[path] = MmapClientKeySharedCache(
+          path, config_lib.CONFIG["Frontend.client_key_shared_cache_buckets"])
+    return _shared_caches[path]
+
+
+def InvalidateClient(common_name):
+  """Drops the cached key of a client, e.g. when it enrolls again."""
+  common_name = str(rdfvalue.ClientURN(common_name))
+  for cache in list(_CACHES):
+    cache.Invalidate(common_name)
+
+  shared_cache = GetSharedCache()
+  if shared_cache is not None:
+    shared_cache.Invalidate(common_name)
+
+
+class ClientKeyCacheInit(registry.InitHook):
+  """Registers the client key cache stats."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    stats.STATS.RegisterCounterMetric("client_key_cache_hits")
+    stats.STATS.RegisterCounterMetric("client_key_cache_shared_hits")
+    stats.STATS.RegisterCounterMetric("client_key_cache_misses")
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+"""Tests for the client public key caches."""
+
+
+import os
+
+
+from M2Crypto import BIO
+from M2Crypto import RSA
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import aff4
+from grr.lib import client_index
+from grr.lib import client_key_cache
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+def _MakePEM():
+  bio = BIO.MemoryBuffer()
+  RSA.gen_key(512, 65537, lambda: None).save_pub_key_bio(bio)
+  return bio.read_all()
+
+
+class ClientKeyCacheTest(test_lib.GRRBaseTest):
+  """Test the local and shared client key caches."""
+
+  def setUp(self):
+    super(ClientKeyCacheTest, self).setUp()
+    self.path = os.path.join(self.temp_dir, "client_key_cache")
+    self.pem = _MakePEM()
+
+  def _MakeCache(self, max_size=1024 * 1024, shared=True):
+    # Each instance maps the file independently, just like separate processes.
+    shared_cache = None
+    if shared:
+      shared_cache = client_key_cache.MmapClientKeySharedCache(self.path, 64)
+    return client_key_cache.ClientKeyCache(max_size, shared_cache=shared_cache)
+
+  def testKeysAreParsedOnce(self):
+    cache = self._MakeCache(shared=False)
+    self.assertRaises(KeyError, cache.Get, "aff4:/C.1")
+
+    key = cache.Put("aff4:/C.1", self.pem)
+    self.assertTrue(cache.Get("aff4:/C.1") is key)
+
+  def testSizeIsBounded(self):
+    entry_size = len(self.pem) + client_key_cache.ClientKeyCache.ENTRY_OVERHEAD
+    cache = self._MakeCache(max_size=3 * entry_size, shared=False)
+
+    for i in range(5):
+      cache.Put("aff4:/C.%d" % i, self.pem)
+      # Keep the first key in use.
+      cache.Get("aff4:/C.0")
+
+    self.assertEqual(len(cache), 3)
+    self.assertEqual(cache.size, 3 * entry_size)
+    cache.Get("aff4:/C.0")
+    cache.Get("aff4:/C.4")
+    self.assertRaises(KeyError, cache.Get, "aff4:/C.1")
+
+  def testKeysAreSharedBetweenInstances(self):
+    cache1 = self._MakeCache()
+    cache2 = self._MakeCache()
+
+    cache1.Put("aff4:/C.1", self.pem, cache1.GetGeneration("aff4:/C.1"))
+
+    key = cache2.Get("aff4:/C.1")
+    bio = BIO.MemoryBuffer()
+    key.save_pub_key_bio(bio)
+    self.assertEqual(bio.read_all(), self.pem)
+
+  def testInvalidation(self):
+    cache1 = self._MakeCache()
+    cache2 = self._MakeCache()
+
+    generation = cache1.GetGeneration("aff4:/C.1")
+    cache1.Put("aff4:/C.1", self.pem, generation)
+    cache2.Get("aff4:/C.1")
+
+    cache2.Invalidate("aff4:/C.1")
+    self.assertRaises(KeyError, cache1.Get, "aff4:/C.1")
+    self.assertRaises(KeyError, cache2.Get, "aff4:/C.1")
+
+    # Keys read before the invalidation must not be served afterwards.
+    cache1.Put("aff4:/C.1", self.pem, generation)
+    self.assertRaises(KeyError, cache1.Get, "aff4:/C.1")
+    self.assertRaises(KeyError, cache2.Get, "aff4:/C.1")
+
+  def testInvalidateClient(self):
+    config_lib.CONFIG.Set("Frontend.client_key_shared_cache_path", self.path)
+    cache = self._MakeCache(shared=False)
+    cache.Put("aff4:/C.1000000000000001", self.pem)
+    other = self._MakeCache()
+    generation = other.GetGeneration("aff4:/C.1000000000000001")
+
+    client_key_cache.InvalidateClient("C.1000000000000001")
+    self.assertRaises(KeyError, cache.Get, "aff4:/C.1000000000000001")
+
+    # Other processes see the invalidation through the shared cache.
+    self.assertNotEqual(other.GetGeneration("aff4:/C.1000000000000001"),
+                        generation)
+
+  def testPrewarm(self):
+    self.SetupClients(2)
+
+    # Only clients whose certificate matches their name are loaded.
+    cert = rdfvalue.RDFX509Cert(self.ClientCertFromPrivateKey(
+        config_lib.CONFIG["Client.private_key"]).as_pem())
+    client_id = rdfvalue.ClientURN(cert.common_name)
+    with aff4.FACTORY.Create(client_id, "VFSGRRClient", mode="rw",
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.CERT, cert)
+      fd.Flush()
+      aff4.FACTORY.Create(client_index.MAIN_INDEX, aff4_type="ClientIndex",
+                          mode="rw", token=self.token).AddClient(fd)
+
+    cache = self._MakeCache()
+    self.assertEqual(cache.Prewarm(token=self.token), 1)
+    self.assertEqual(len(cache), 1)
+    cache.Get(str(client_id))
+    self.assertRaises(KeyError, cache.Get, "aff4:/C.1000000000000000")
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -41,6 +41,8 @@ class CommunicatorInit(registry.InitHook):
     stats.STATS.RegisterCounterMetric("grr_authenticated_messages")
     stats.STATS.RegisterCounterMetric("grr_unauthenticated_messages")
     stats.STATS.RegisterCounterMetric("grr_rsa_operations")
+    stats.STATS.RegisterCounterMetric("grr_resumed_sessions")
+    stats.STATS.RegisterCounterMetric("grr_session_ticket_error")
 
 
 class Error(stats.CountingExceptionMixin, Exception):
@@ -68,11 +70,30 @@ class UnknownClientCert(DecodingError):
   counter = "grr_client_unknown"
 
 
+class SessionTicketError(DecodingError):
+  """Raised when a session ticket can not be opened."""
+  counter = "grr_session_ticket_error"
+
+
+def ConstantTimeEqual(a, b):
+  """A Constant time comparison."""
+  if len(a) != len(b):
+    return False
+
+  result = 0
+  for x, y in zip(a, b):
+    result |= ord(x) ^ ord(y)
+
+  return result == 0
+
+
 class PubKeyCache(object):
   """A cache of public keys for different destinations."""
 
   def __init__(self):
     self.pub_key_cache = utils.FastStore(max_size=50000)
+    # The parsed keys, so the PEM is not parsed for every message.
+    self.rsa_key_cache = utils.FastStore(max_size=50000)
 
   @staticmethod
   def GetCNFromCert(cert):
@@ -96,9 +117,11 @@ class PubKeyCache(object):
   def Flush(self):
     """Flushes the cert cache."""
     self.pub_key_cache.Flush()
+    self.rsa_key_cache.Flush()
 
   def Put(self, destination, pub_key):
     self.pub_key_cache.Put(destination, pub_key)
+    self.rsa_key_cache.ExpireObject(destination)
 
   def GetRSAPublicKey(self, common_name="Server"):
     """Retrieve the relevant public key for that common name.
@@ -112,10 +135,17 @@ class PubKeyCache(object):
     Returns:
       A valid public key.
     """
+    try:
+      return self.rsa_key_cache.Get(common_name)
+    except KeyError:
+      pass
+
     try:
       pub_key = self.pub_key_cache.Get(common_name)
       bio = BIO.MemoryBuffer(pub_key)
-      return RSA.load_pub_key_bio(bio)
+      rsa_key = RSA.load_pub_key_bio(bio)
+      self.rsa_key_cache.Put(common_name, rsa_key)
+      return rsa_key
     except (KeyError, X509.X509Error):
       raise KeyError("No certificate found")
 
@@ -136,6 +166,9 @@ class Cipher(object):
   encrypted_cipher = None
   encrypted_cipher_metadata = None
 
+  # The ticket our peer sealed this session into, sent along from then on.
+  session_ticket = None
+
   def __init__(self, source, destination, private_key, pub_key_cache):
     self.private_key = private_key
 
@@ -165,6 +198,7 @@ class Cipher(object):
     # We never want to have a password dialog
     private_key = self.private_key.GetPrivateKey()
 
+    stats.STATS.IncrementCounter("grr_rsa_operations")
     self.cipher_metadata.signature = private_key.sign(
         digest, self.hash_function_name)
 
@@ -219,6 +253,29 @@ class Cipher(object):
 
     return hmac.final()
 
+  def FullHMAC(self, comms, direction):
+    """Returns the FULL_HMAC of a ClientCommunication.
+
+    Args:
+      comms: The ClientCommunication.
+      direction: CLIENT_TO_SERVER or SERVER_TO_CLIENT, the way comms travels.
+
+    Returns:
+      The HMAC.
+    """
+    data = [comms.encrypted,
+            comms.encrypted_cipher,
+            comms.encrypted_cipher_metadata,
+            comms.packet_iv,
+            struct.pack("<I", comms.api_version),
+            comms.session_ticket]
+    if comms.api_version >= 4:
+      # Both directions of a session use the same key, so an answer could be
+      # sent back to the frontend as a request if it did not say its way.
+      data.append(direction)
+
+    return self.HMAC(*data)
+
 
 class ReceivedCipher(Cipher):
   """A cipher which we received from our peer."""
@@ -226,8 +283,12 @@ class ReceivedCipher(Cipher):
   # Indicates if the cipher contained in the response_comms is verified.
   signature_verified = False
 
+  # Our own Cipher, if the peer answered in the session we started.
+  local_cipher = None
+
   # pylint: disable=super-init-not-called
-  def __init__(self, response_comms, private_key, pub_key_cache):
+  def __init__(self, response_comms, private_key, pub_key_cache,
+               direction=None):
     self.private_key = private_key
     self.pub_key_cache = pub_key_cache
 
@@ -238,6 +299,7 @@ class ReceivedCipher(Cipher):
       # The encrypted_cipher contains the session key, iv and hmac_key.
       self.encrypted_cipher = response_comms.encrypted_cipher
 
+      stats.STATS.IncrementCounter("grr_rsa_operations")
       # M2Crypto verifies the key on each private_decrypt call which is horribly
       # slow therefore we just call the swig wrapped method directly.
       self.serialized_cipher = m2.rsa_private_decrypt(
@@ -252,7 +314,7 @@ class ReceivedCipher(Cipher):
         raise DecryptionError("Invalid cipher.")
 
       # Check the hmac key for sanity.
-      self.VerifyHMAC(response_comms)
+      self.VerifyHMAC(response_comms, direction)
 
       # Cipher_metadata contains information about the cipher - It is encrypted
       # using the symmetric session key. It contains the RSA signature of the
@@ -267,17 +329,9 @@ class ReceivedCipher(Cipher):
       raise DecryptionError(e)
 
   def IsEqual(self, a, b):
-    """A Constant time comparison."""
-    if len(a) != len(b):
-      return False
+    return ConstantTimeEqual(a, b)
 
-    result = 0
-    for x, y in zip(a, b):
-      result |= ord(x) ^ ord(y)
-
-    return result == 0
-
-  def VerifyHMAC(self, response_comms):
+  def VerifyHMAC(self, response_comms, direction=None):
     # Ensure that the hmac key is reasonable.
     if len(self.cipher.hmac_key) != self.key_size / 8:
       raise DecryptionError("Invalid cipher.")
@@ -289,11 +343,7 @@ class ReceivedCipher(Cipher):
         raise DecryptionError("HMAC verification failed.")
 
     elif self.hmac_type == "FULL_HMAC":
-      hmac = self.HMAC(response_comms.encrypted,
-                       response_comms.encrypted_cipher,
-                       response_comms.encrypted_cipher_metadata,
-                       response_comms.packet_iv,
-                       struct.pack("<I", response_comms.api_version))
+      hmac = self.FullHMAC(response_comms, direction)
 
       if not self.IsEqual(hmac, response_comms.full_hmac):
         raise DecryptionError("HMAC verification failed.")
@@ -323,10 +373,132 @@ class ReceivedCipher(Cipher):
         pass
 
 
+class ResumedCipher(ReceivedCipher):
+  """The cipher of a verified session, resumed without RSA operations."""
+
+  signature_verified = True
+
+  # pylint: disable=super-init-not-called
+  def __init__(self, cipher, source, session_ticket=None, local_cipher=None):
+    """Constructor.
+
+    Args:
+      cipher: The CipherProperties of the session.
+      source: The common name of the peer.
+      session_ticket: The ticket the session was resumed from, if any.
+      local_cipher: Our own Cipher, if the session is the one we started.
+    """
+    self.cipher = cipher
+    self.cipher_metadata = rdfvalue.CipherMetadata(source=source)
+    self.session_ticket = session_ticket
+    self.local_cipher = local_cipher
+
+
+class SessionTickets(object):
+  """Seals verified client sessions into tickets any frontend can resume.
+
+  A ticket holds the CipherProperties of a session, encrypted and
+  authenticated with a secret shared by the frontends. Clients send it along
+  with their RSA encrypted cipher, so a frontend holding the secret needs no
+  RSA operation to decrypt and verify the cipher. The first secret seals new
+  tickets, the others are only accepted so the secrets can be rotated.
+  """
+
+  cipher_name = "aes_128_cbc"
+  key_id_size = 4
+  iv_size = 16
+  hmac_size = 32
+
+  def __init__(self, secrets, lifetime):
+    self.keys = [self._DeriveKeys(secret) for secret in secrets]
+    self.lifetime = lifetime
+
+  def _DeriveKeys(self, secret):
+    secret = utils.SmartStr(secret)
+    key_id = hashlib.sha256("id" + secret).digest()[:self.key_id_size]
+    encryption_key = hashlib.sha256("encryption" + secret).digest()[:16]
+    hmac_key = hashlib.sha256("hmac" + secret).digest()
+    return key_id, encryption_key, hmac_key
+
+  def _HMAC(self, hmac_key, data):
+    hmac = EVP.HMAC(hmac_key, algo="sha256")
+    hmac.update(data)
+    return hmac.final()
+
+  def Seal(self, cipher):
+    """Returns a ticket for a verified session."""
+    key_id, encryption_key, hmac_key = self.keys[0]
+    state = rdfvalue.SessionTicketState(
+        cipher=cipher.cipher, source=cipher.cipher_metadata.source,
+        expires=long((time.time() + self.lifetime) * 1e6))
+
+    iv = os.urandom(self.iv_size)
+    evp_cipher = EVP.Cipher(alg=self.cipher_name, key=encryption_key, iv=iv,
+                            op=ENCRYPT)
+    data = key_id + iv + evp_cipher.update(state.SerializeToString())
+    data += evp_cipher.final()
+    return data + self._HMAC(hmac_key, data)
+
+  def Open(self, ticket):
+    """Resumes the session sealed into a ticket.
+
+    Args:
+      ticket: A ticket returned by Seal().
+
+    Returns:
+      A ResumedCipher.
+
+    Raises:
+      SessionTicketError: If the ticket is invalid, expired or was sealed with
+        a secret we do not know.
+    """
+    if len(ticket) < self.key_id_size + self.iv_size + self.hmac_size:
+      raise SessionTicketError("Session ticket too short.")
+
+    key_id = ticket[:self.key_id_size]
+    for known_id, encryption_key, hmac_key in self.keys:
+      if known_id == key_id:
+        break
+    else:
+      raise SessionTicketError("Session ticket sealed with an unknown key.")
+
+    data, hmac = ticket[:-self.hmac_size], ticket[-self.hmac_size:]
+    if not ConstantTimeEqual(self._HMAC(hmac_key, data), hmac):
+      raise SessionTicketError("Session ticket HMAC verification failed.")
+
+    iv = data[self.key_id_size:self.key_id_size + self.iv_size]
+    try:
+      evp_cipher = EVP.Cipher(alg=self.cipher_name, key=encryption_key, iv=iv,
+                              op=DECRYPT)
+      plain = evp_cipher.update(data[self.key_id_size + self.iv_size:])
+      plain += evp_cipher.final()
+      state = rdfvalue.SessionTicketState(plain)
+    except (EVP.EVPError, rdfvalue.DecodeError) as e:
+      raise SessionTicketError("Invalid session ticket: %s" % e)
+
+    if state.expires.AsMicroSecondsFromEpoch() < time.time() * 1e6:
+      raise SessionTicketError("Session ticket expired.")
+
+    return ResumedCipher(state.cipher, state.source, session_ticket=ticket)
+
+
+# The directions covered by the FULL_HMAC from api version 4 on.
+CLIENT_TO_SERVER = "client"
+SERVER_TO_CLIENT = "server"
+
+
 class Communicator(object):
   """A class responsible for encoding and decoding comms."""
   server_name = None
 
+  # The directions of the comms we send and receive.
+  sent_direction = CLIENT_TO_SERVER
+  received_direction = SERVER_TO_CLIENT
+
+  # The cipher we encrypted our last message with, the server answers in it
+  # from api version 4 on.
+  last_cipher = None
+
   def __init__(self, certificate=None, private_key=None):
     """Creates a communicator.
 
@@ -342,6 +514,9 @@ class Communicator(object):
     # A cache for encrypted ciphers
     self.encrypted_cipher_cache = utils.FastStore(max_size=50000)
 
+    # Seals the sessions of our peers into tickets, only used by frontends.
+    self.session_tickets = None
+
     # A cache of public keys
     self.pub_key_cache = PubKeyCache()
     self._LoadOurCertificate()
@@ -372,7 +547,7 @@ class Communicator(object):
         signed_message_list.message_list = compressed_data
 
   def EncodeMessages(self, message_list, result, destination=None,
-                     timestamp=None, api_version=3):
+                     timestamp=None, api_version=3, session=None):
     """Accepts a list of messages and encodes for transmission.
 
     This function signs and then encrypts the payload.
@@ -390,6 +565,10 @@ class Communicator(object):
 
        api_version: The api version which this should be encoded in.
 
+       session: The cipher of the request we answer. From api version 4 on,
+              answers to verified requests are encrypted in the session of
+              the peer so no cipher has to be made for it.
+
     Returns:
        A nonce (based on time) which is inserted to the encrypted payload. The
        client can verify that the server is able to decrypt the message and
@@ -398,8 +577,8 @@ class Communicator(object):
     Raises:
        RuntimeError: If we do not support this api version.
     """
-    if api_version not in [3]:
-      raise RuntimeError("Unsupported api version: %s, expected 3." %
+    if api_version not in [3, 4]:
+      raise RuntimeError("Unsupported api version: %s, expected 3 or 4." %
                          api_version)
 
     if destination is None:
@@ -409,23 +588,35 @@ class Communicator(object):
     if timestamp is None:
       self.timestamp = timestamp = long(time.time() * 1000000)
 
-    # Do we have a cached cipher to talk to this destination?
-    try:
-      cipher = self.cipher_cache.Get(destination)
+    if (api_version >= 4 and session is not None and
+        session.signature_verified and session.hmac_type == "FULL_HMAC"):
+      # Answer in the session of our peer, the answer carries no cipher.
+      cipher = session
+      if self.session_tickets is not None and not session.session_ticket:
+        result.session_ticket = self.session_tickets.Seal(session)
 
-    except KeyError:
-      # Make a new one
-      cipher = Cipher(self.common_name, destination, self.private_key,
-                      self.pub_key_cache)
-      self.cipher_cache.Put(destination, cipher)
+    else:
+      # Do we have a cached cipher to talk to this destination?
+      try:
+        cipher = self.cipher_cache.Get(destination)
 
-    signed_message_list = rdfvalue.SignedMessageList(timestamp=timestamp)
-    self.EncodeMessageList(message_list, signed_message_list)
+      except KeyError:
+        # Make a new one
+        cipher = Cipher(self.common_name, destination, self.private_key,
+                        self.pub_key_cache)
+        self.cipher_cache.Put(destination, cipher)
+
+      self.last_cipher = cipher
+      result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
+
+      # Include the encrypted cipher.
+      result.encrypted_cipher = cipher.encrypted_cipher
 
-    result.encrypted_cipher_metadata = cipher.encrypted_cipher_metadata
+      if api_version >= 4 and cipher.session_ticket:
+        result.session_ticket = cipher.session_ticket
 
-    # Include the encrypted cipher.
-    result.encrypted_cipher = cipher.encrypted_cipher
+    signed_message_list = rdfvalue.SignedMessageList(timestamp=timestamp)
+    self.EncodeMessageList(message_list, signed_message_list)
 
     serialized_message_list = signed_message_list.SerializeToString()
 
@@ -440,14 +631,8 @@ class Communicator(object):
     # Newer endpoints only look at this HMAC. It is recalculated for each packet
     # in the session. Note that encrypted_cipher and encrypted_cipher_metadata
     # do not change between all packets in this session.
-    result.full_hmac = cipher.HMAC(
-        result.encrypted,
-        result.encrypted_cipher,
-        result.encrypted_cipher_metadata,
-        result.packet_iv,
-        struct.pack("<I", api_version))
-
     result.api_version = api_version
+    result.full_hmac = cipher.FullHMAC(result, self.sent_direction)
 
     if isinstance(result, rdfvalue.RDFValue):
       # Store the number of messages contained.
@@ -502,22 +687,31 @@ class Communicator(object):
 
     return result
 
-  def DecodeMessages(self, response_comms):
-    """Extract and verify server message.
+  def DecodeCipher(self, response_comms):
+    """Finds the cipher a ClientCommunication was encrypted with.
 
     Args:
         response_comms: A ClientCommunication rdfvalue
 
     Returns:
-       list of messages and the CN where they came from.
+       A ReceivedCipher.
 
     Raises:
-       DecryptionError: If the message failed to decrypt properly.
+       DecryptionError: If the cipher could not be decrypted.
     """
-    if response_comms.api_version not in [3]:
-      raise DecryptionError("Unsupported api version: %s, expected 3." %
+    if response_comms.api_version not in [3, 4]:
+      raise DecryptionError("Unsupported api version: %s, expected 3 or 4." %
                             response_comms.api_version)
 
+    if response_comms.session_ticket and self.session_tickets is not None:
+      try:
+        cipher = self.session_tickets.Open(response_comms.session_ticket)
+        stats.STATS.IncrementCounter("grr_resumed_sessions")
+        return cipher
+      except SessionTicketError:
+        # Fall back to the encrypted cipher sent along.
+        pass
+
     if response_comms.encrypted_cipher:
       # Have we seen this cipher before?
       try:
@@ -525,31 +719,65 @@ class Communicator(object):
             response_comms.encrypted_cipher)
       except KeyError:
         cipher = ReceivedCipher(response_comms, self.private_key,
-                                self.pub_key_cache)
+                                self.pub_key_cache,
+                                direction=self.received_direction)
 
         if cipher.signature_verified:
           # Remember it for next time.
           self.encrypted_cipher_cache.Put(response_comms.encrypted_cipher,
                                           cipher)
 
-      # Verify the cipher HMAC with the new response_comms. This will raise
-      # DecryptionError if the HMAC does not agree.
-      cipher.VerifyHMAC(response_comms)
+      return cipher
 
-      # Decrypt the message with the per packet IV.
-      plain = cipher.Decrypt(
-          response_comms.encrypted, response_comms.packet_iv)
-      try:
-        signed_message_list = rdfvalue.SignedMessageList(plain)
-      except rdfvalue.DecodeError as e:
-        raise DecryptionError(str(e))
+    if response_comms.api_version >= 4 and self.server_name:
+      # The server answered in the session of our request, which may have
+      # expired from the cipher cache since.
+      local_cipher = self.last_cipher
+      if local_cipher is None:
+        raise DecryptionError("Server response for an unknown session.")
 
-      message_list = self.DecompressMessageList(signed_message_list)
+      return ResumedCipher(local_cipher.cipher, self.server_name,
+                           local_cipher=local_cipher)
 
-    else:
-      # The message is not encrypted. We do not allow unencrypted
-      # messages:
-      raise DecryptionError("Server response is not encrypted.")
+    # The message is not encrypted. We do not allow unencrypted
+    # messages:
+    raise DecryptionError("Server response is not encrypted.")
+
+  def DecodeMessages(self, response_comms, cipher=None):
+    """Extract and verify server message.
+
+    Args:
+        response_comms: A ClientCommunication rdfvalue
+
+        cipher: The cipher returned by DecodeCipher() for response_comms, if
+          the caller already needed it.
+
+    Returns:
+       list of messages and the CN where they came from.
+
+    Raises:
+       DecryptionError: If the message failed to decrypt properly.
+    """
+    if cipher is None:
+      cipher = self.DecodeCipher(response_comms)
+
+    # Verify the cipher HMAC with the new response_comms. This will raise
+    # DecryptionError if the HMAC does not agree.
+    cipher.VerifyHMAC(response_comms, self.received_direction)
+
+    # Decrypt the message with the per packet IV.
+    plain = cipher.Decrypt(
+        response_comms.encrypted, response_comms.packet_iv)
+    try:
+      signed_message_list = rdfvalue.SignedMessageList(plain)
+    except rdfvalue.DecodeError as e:
+      raise DecryptionError(str(e))
+
+    message_list = self.DecompressMessageList(signed_message_list)
+
+    if cipher.local_cipher is not None and response_comms.session_ticket:
+      # The server sealed our session into a ticket, we send it from now on.
+      cipher.local_cipher.session_ticket = response_comms.session_ticket
 
     # Are these messages authenticated?
     auth_state = self.VerifyMessageSignature(
@@ -586,7 +814,8 @@ class Communicator(object):
     Raises:
        DecryptionError: if the message is corrupt.
     """
-    # This is not used atm since we only support a single api version (3).
+    # This is not used atm since api versions 3 and 4 only differ in the way
+    # the cipher is found.
     _ = api_version
     result = rdfvalue.GrrMessage.AuthorizationState.UNAUTHENTICATED
 
@@ -232,6 +232,139 @@ class ClientCommsTest(test_lib.GRRBaseTest):
       except communicator.DecodingError as e:
         logging.debug("Detected alteration at %s: %s", x, e)
 
+  def _Poll(self, server_communicator, before_answer=None):
+    """Sends a request to the server and decodes its answer."""
+    message_list = rdfvalue.MessageList()
+    message_list.job.Append(session_id="aff4:/W:session", name="Request")
+    request = rdfvalue.ClientCommunication()
+    nonce = self.client_communicator.EncodeMessages(message_list, request)
+    request = rdfvalue.ClientCommunication(request.SerializeToString())
+
+    cipher = server_communicator.DecodeCipher(request)
+    messages, source, timestamp = server_communicator.DecodeMessages(
+        request, cipher=cipher)
+    self.assertEqual(messages[0].auth_state,
+                     rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    response = rdfvalue.ClientCommunication(api_version=request.api_version)
+    message_list = rdfvalue.MessageList()
+    message_list.job.Append(session_id="aff4:/W:session", name="Response")
+    server_communicator.EncodeMessages(
+        message_list, response, destination=source, timestamp=timestamp,
+        api_version=request.api_version, session=cipher)
+
+    if before_answer:
+      before_answer()
+
+    messages, source, server_nonce = self.client_communicator.DecryptMessage(
+        response.SerializeToString())
+    self.assertEqual(source, self.client_communicator.server_name)
+    self.assertEqual(server_nonce, nonce)
+    self.assertEqual(messages[0].name, "Response")
+    self.assertEqual(messages[0].auth_state,
+                     rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED)
+
+    return request, response
+
+  def testSessionResumption(self):
+    """Tests that frontends resume client sessions without RSA operations."""
+    config_lib.CONFIG.Set("Network.api", 4)
+    config_lib.CONFIG.Set("Frontend.session_ticket_keys", ["secret"])
+    self.MakeClientAFF4Record()
+    self.server_communicator = ServerCommunicatorFake(
+        certificate=self.server_certificate,
+        private_key=self.server_private_key,
+        token=self.token)
+
+    # The first poll is answered in the session of the client with a ticket.
+    request, response = self._Poll(self.server_communicator)
+    self.assertFalse(request.session_ticket)
+    self.assertFalse(response.encrypted_cipher)
+    ticket = response.session_ticket
+    self.assertTrue(ticket)
+
+    # Another frontend sharing the secret resumes the session from the ticket.
+    other_communicator = ServerCommunicatorFake(
+        certificate=self.server_certificate,
+        private_key=self.server_private_key,
+        token=self.token)
+    rsa_operations = stats.STATS.GetMetricValue("grr_rsa_operations")
+    resumed_sessions = stats.STATS.GetMetricValue("grr_resumed_sessions")
+
+    request, response = self._Poll(other_communicator)
+    self.assertEqual(request.session_ticket, ticket)
+    self.assertFalse(response.session_ticket)
+    self.assertEqual(stats.STATS.GetMetricValue("grr_rsa_operations"),
+                     rsa_operations)
+    self.assertEqual(stats.STATS.GetMetricValue("grr_resumed_sessions"),
+                     resumed_sessions + 1)
+
+    # Frontends which can not open the ticket fall back to the encrypted
+    # cipher and issue a new ticket.
+    other_communicator.session_tickets = communicator.SessionTickets(
+        ["other secret"], 3600)
+    _, response = self._Poll(other_communicator)
+    self.assertTrue(response.session_ticket)
+    self.assertNotEqual(response.session_ticket, ticket)
+    self.assertTrue(stats.STATS.GetMetricValue("grr_rsa_operations") >
+                    rsa_operations)
+
+  def testSessionAnswersAreNotRequests(self):
+    """Tests that answers in a client session can not be sent back."""
+    config_lib.CONFIG.Set("Network.api", 4)
+    config_lib.CONFIG.Set("Frontend.session_ticket_keys", ["secret"])
+    self.MakeClientAFF4Record()
+    self.server_communicator = ServerCommunicatorFake(
+        certificate=self.server_certificate,
+        private_key=self.server_private_key,
+        token=self.token)
+
+    _, response = self._Poll(self.server_communicator)
+    self.assertTrue(response.session_ticket)
+
+    # The ticket opens the session, but the HMAC says it is an answer.
+    cipher = self.server_communicator.DecodeCipher(response)
+    self.assertRaises(communicator.DecryptionError,
+                      self.server_communicator.DecodeMessages, response,
+                      cipher=cipher)
+
+  def testSessionAnswersAfterCipherExpiry(self):
+    """Tests that answers are decrypted with the cipher of their request."""
+    config_lib.CONFIG.Set("Network.api", 4)
+    self.MakeClientAFF4Record()
+
+    # The cipher of the request expires before the answer arrives.
+    self._Poll(self.server_communicator,
+               before_answer=self.client_communicator.cipher_cache.Flush)
+
+  def testSessionTickets(self):
+    """Tests sealing and opening session tickets."""
+    tickets = communicator.SessionTickets(["new secret", "old secret"], 10)
+    cipher = communicator.ResumedCipher(
+        rdfvalue.CipherProperties(name="aes_128_cbc", key="A" * 16,
+                                  hmac_key="B" * 16, hmac_type="FULL_HMAC"),
+        rdfvalue.ClientURN("C.1000000000000000"))
+
+    with test_lib.FakeTime(100):
+      ticket = tickets.Seal(cipher)
+
+    with test_lib.FakeTime(105):
+      resumed = tickets.Open(ticket)
+      self.assertEqual(resumed.cipher, cipher.cipher)
+      self.assertEqual(resumed.cipher_metadata.source,
+                       "aff4:/C.1000000000000000")
+      self.assertTrue(resumed.signature_verified)
+
+      # Tickets of retired secrets and altered tickets are refused.
+      self.assertRaises(communicator.SessionTicketError,
+                        communicator.SessionTickets(["old secret"], 10).Open,
+                        ticket)
+      altered = ticket[:-1] + chr(ord(ticket[-1]) ^ 1)
+      self.assertRaises(communicator.SessionTicketError, tickets.Open, altered)
+
+    with test_lib.FakeTime(111):
+      self.assertRaises(communicator.SessionTicketError, tickets.Open, ticket)
+
   def testEnrollingCommunicator(self):
     """Test that the ClientCommunicator generates good keys."""
     self.client_communicator = comms.ClientCommunicator(
@@ -79,6 +79,70 @@ class TransactionError(Error):
 # This token will be used by default if no token was provided.
 default_token = None
 
+# The retention policies of attributes by predicate. AFF4 attributes register
+# their policies here.
+RETENTION_POLICIES = {}
+
+
+class RetentionPolicy(object):
+  """Limits how many versions of an attribute are kept and for how long.
+
+  The newest version of an attribute is always kept.
+  """
+
+  def __init__(self, max_versions=None, max_age=None):
+    """Constructor.
+
+    Args:
+      max_versions: The maximum number of versions to keep.
+      max_age: Versions older than this many seconds are deleted.
+    """
+    self.max_versions = max_versions
+    self.max_age = max_age
+
+  def OldestTimestamp(self, now=None):
+    """Returns the oldest timestamp kept by max_age or None."""
+    if not self.max_age:
+      return None
+
+    if now is None:
+      now = time.time()
+    return int((now - self.max_age) * 1e6)
+
+  def Expired(self, timestamps, now=None):
+    """Finds the versions which are not kept.
+
+    Args:
+      timestamps: The timestamps of all versions of an attribute.
+      now: The current time in seconds, for tests.
+
+    Returns:
+      The newest timestamp of the versions to delete, all older versions are
+      deleted as well. None if all versions are kept.
+    """
+    timestamps = sorted(timestamps, reverse=True)
+
+    kept = len(timestamps)
+    if self.max_versions:
+      kept = min(kept, self.max_versions)
+
+    oldest_timestamp = self.OldestTimestamp(now)
+    if oldest_timestamp is not None:
+      for i, timestamp in enumerate(timestamps[1:kept]):
+        if timestamp < oldest_timestamp:
+          kept = i + 1
+          break
+
+    # Versions with the same timestamp as a kept version are kept as well.
+    while 0 < kept < len(timestamps) and (
+        timestamps[kept] == timestamps[kept - 1]):
+      kept += 1
+
+    if kept < len(timestamps):
+      return timestamps[kept]
+
+    return None
+
 
 class DataStore(object):
   """Abstract database access."""
@@ -92,6 +156,7 @@ class DataStore(object):
 
   flusher_thread = None
   monitor_thread = None
+  retention_thread = None
 
   def __init__(self):
     security_manager = access_control.BasicAccessControlManager.GetPlugin(
@@ -104,6 +169,14 @@ class DataStore(object):
     self.flusher_thread.start()
     self.monitor_thread = None
 
+    # Start the thread which enforces the retention policies of attributes.
+    interval = config_lib.CONFIG["Datastore.retention_compaction_interval"]
+    if interval:
+      self.last_compaction = time.time()
+      self.retention_thread = utils.InterruptableThread(
+          target=self._CompactInBackground, sleep_time=interval)
+      self.retention_thread.start()
+
   def GetRequiredResolveAccess(self, attribute_regex):
     """Returns required level of access for resolve operations.
 
@@ -153,6 +226,82 @@ class DataStore(object):
     """Measures size of DataStore."""
     stats.STATS.SetGaugeValue("datastore_size", self.Size())
 
+  def _CompactInBackground(self):
+    """Runs CompactRetention() once every compaction interval."""
+    # The thread calls this right after it starts.
+    interval = config_lib.CONFIG["Datastore.retention_compaction_interval"]
+    if time.time() < self.last_compaction + interval:
+      return
+
+    self.last_compaction = time.time()
+    if not RETENTION_POLICIES:
+      return
+
+    try:
+      self.CompactRetention(token=access_control.ACLToken(
+          username="GRRRetention", reason="Retention policies").SetUID())
+    except Exception as e:  # pylint: disable=broad-except
+      logging.exception("Enforcing retention policies failed: %s", e)
+
+  def RetentionPolicies(self, attributes):
+    """Returns a dict of the retention policies of some attributes."""
+    result = {}
+    for attribute in attributes:
+      try:
+        result[attribute] = RETENTION_POLICIES[attribute]
+      except KeyError:
+        pass
+
+    return result
+
+  def EnforceRetention(self, subject, attributes=None, sync=True, token=None):
+    """Deletes the versions which the retention policies don't keep.
+
+    This is called lazily for the attributes written by MultiSet(). Data
+    stores may override this with a cheaper implementation, this one reads
+    all versions of the attributes.
+
+    Args:
+      subject: The subject.
+      attributes: The attributes to check, by default all attributes which
+          have a retention policy.
+      sync: If true the versions are deleted before returning.
+      token: An ACL token.
+    """
+    if attributes is None:
+      attributes = RETENTION_POLICIES.keys()
+
+    policies = self.RetentionPolicies(attributes)
+    if not policies:
+      return
+
+    timestamps = {}
+    for attribute, _, timestamp in self.ResolveMulti(
+        subject, policies.keys(), timestamp=self.ALL_TIMESTAMPS, token=token):
+      timestamps.setdefault(attribute, []).append(timestamp)
+
+    for attribute, attribute_timestamps in timestamps.iteritems():
+      expired = policies[attribute].Expired(attribute_timestamps)
+      if expired is not None:
+        self.DeleteAttributes(subject, [attribute], start=0, end=expired,
+                              sync=sync, token=token)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects.
+
+    This runs periodically in the background to clean up versions which
+    were not deleted on write, e.g. those which became too old since. Data
+    stores which can enumerate their subjects implement this.
+
+    Args:
+      token: An ACL token.
+
+    Returns:
+      The number of subjects or files which were compacted.
+    """
+    _ = token
+    return 0
+
   def Initialize(self):
     """Initialization of the datastore."""
 
@@ -274,6 +423,40 @@ class DataStore(object):
       token: An ACL token.
     """
 
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Set multiple attributes' values for many subjects in one operation.
+
+    Data stores override this to write all subjects with a few round trips,
+    by default every subject is written by MultiSet().
+
+    Args:
+      values: A dict of subjects to dicts of attributes and values, as taken by
+              MultiSet().
+      timestamp: The timestamp for the entries in microseconds since the
+              epoch. None means now.
+      replace: Bool whether or not to overwrite current records.
+      sync: If true we block until the operation completes.
+      to_delete: A dict of subjects to arrays of attributes to clear prior to
+              setting. Subjects may have attributes to delete and no values.
+      token: An ACL token.
+    """
+    to_delete = to_delete or {}
+    for subject in set(values) | set(to_delete):
+      self.MultiSet(subject, values.get(subject, {}), timestamp=timestamp,
+                    replace=replace, sync=sync,
+                    to_delete=list(to_delete.get(subject, [])), token=token)
+
+  def MultiDelete(self, to_delete, sync=True, token=None):
+    """Removes all versions of attributes of many subjects in one operation.
+
+    Args:
+      to_delete: A dict of subjects to arrays of attributes to remove.
+      sync: If true we block until the operation completes.
+      token: An ACL token.
+    """
+    self.MultiSubjectMultiSet({}, to_delete=to_delete, sync=sync, token=token)
+
   @abc.abstractmethod
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
@@ -393,6 +576,8 @@ class DataStore(object):
   def __del__(self):
     if self.flusher_thread:
       self.flusher_thread.Stop()
+    if self.retention_thread:
+      self.retention_thread.Stop()
     if self.monitor_thread:
       self.monitor_thread.Stop()
     try:
@@ -196,6 +196,57 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     self.assertEqual(stored, "hello")
     self.assertEqual(type(stored), str)
 
+  def testMultiSubjectMultiSet(self):
+    """Test the MultiSubjectMultiSet() and MultiDelete() methods."""
+    subjects = ["aff4:/row:%s" % i for i in range(10)]
+    for subject in subjects[5:]:
+      data_store.DB.MultiSet(subject, {"metadata:old": ["old"],
+                                       "metadata:kept": ["kept"]},
+                             token=self.token)
+
+    data_store.DB.MultiSubjectMultiSet(
+        dict((subject, {"metadata:predicate": [(subject, 100)],
+                        "aff4:size": [(5, 200)]})
+             for subject in subjects[:5]),
+        to_delete=dict((subject, ["metadata:old"])
+                       for subject in subjects[5:]),
+        token=self.token)
+
+    for subject in subjects[:5]:
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:predicate",
+                                             token=self.token), (subject, 100))
+      self.assertEqual(data_store.DB.Resolve(subject, "aff4:size",
+                                             token=self.token), (5, 200))
+
+    for subject in subjects[5:]:
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:old",
+                                             token=self.token), (None, 0))
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:kept",
+                                             token=self.token)[0], "kept")
+
+    # Values are added as new versions unless replace is set.
+    data_store.DB.MultiSubjectMultiSet(
+        dict((subject, {"metadata:predicate": [("new", 300)]})
+             for subject in subjects[:5]),
+        replace=False, token=self.token)
+
+    for subject in subjects[:5]:
+      values = data_store.DB.ResolveMulti(
+          subject, ["metadata:predicate"],
+          timestamp=data_store.DB.ALL_TIMESTAMPS, token=self.token)
+      self.assertEqual(sorted(value for _, value, _ in values),
+                       sorted([subject, "new"]))
+
+    data_store.DB.MultiDelete(
+        dict((subject, ["metadata:predicate"]) for subject in subjects[:5]),
+        token=self.token)
+
+    for subject in subjects[:5]:
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:predicate",
+                                             token=self.token), (None, 0))
+      self.assertEqual(data_store.DB.Resolve(subject, "aff4:size",
+                                             token=self.token), (5, 200))
+
   def testMultiSet2(self):
     """Test the MultiSet() methods."""
     # Specify a per element timestamp
@@ -360,6 +411,63 @@ class _DataStoreTest(test_lib.GRRBaseTest):
     self.CheckLast(predicate, None, 0)
     self.CheckLength(predicate, 0)
 
+  @DeletionTest
+  def testRetentionPolicyOnWrite(self):
+    """Versions dropped by a retention policy are deleted on write."""
+    predicate = "metadata:retained"
+    policies = {predicate: data_store.RetentionPolicy(max_versions=2)}
+
+    with utils.Stubber(data_store, "RETENTION_POLICIES", policies):
+      for timestamp in [100, 200, 300, 400]:
+        data_store.DB.Set(self.test_row, predicate, "hello%d" % timestamp,
+                          timestamp=timestamp, replace=False, token=self.token)
+
+    self.CheckLast(predicate, "hello400", 400)
+    self.CheckLength(predicate, 2)
+
+    # Other attributes keep all their versions.
+    for timestamp in [100, 200, 300]:
+      data_store.DB.Set(self.test_row, "metadata:tspredicate", "hello",
+                        timestamp=timestamp, replace=False, token=self.token)
+    self.CheckLength("metadata:tspredicate", 3)
+
+  @DeletionTest
+  def testCompactRetention(self):
+    """Versions which expired since they were written are compacted."""
+    predicate = "metadata:retained"
+    for timestamp in [100, 200, 300, 400]:
+      data_store.DB.Set(self.test_row, predicate, "hello%d" % timestamp,
+                        timestamp=timestamp, replace=False, token=self.token)
+
+    data_store.DB.Flush()
+    self.CheckLength(predicate, 4)
+
+    # All but the newest version are older than a day.
+    policies = {predicate: data_store.RetentionPolicy(max_age=24 * 60 * 60)}
+    with utils.Stubber(data_store, "RETENTION_POLICIES", policies):
+      self.assertTrue(data_store.DB.CompactRetention(token=self.token))
+
+    self.CheckLast(predicate, "hello400", 400)
+    self.CheckLength(predicate, 1)
+
+  def testRetentionPolicyExpired(self):
+    policy = data_store.RetentionPolicy(max_versions=3)
+    self.assertEqual(policy.Expired([100, 200, 300]), None)
+    self.assertEqual(policy.Expired([400, 100, 300, 200]), 100)
+
+    # Versions with the same timestamp as a kept version are kept as well.
+    policy = data_store.RetentionPolicy(max_versions=2)
+    self.assertEqual(policy.Expired([100, 200, 200, 300]), 100)
+    self.assertEqual(policy.Expired([200, 200, 300]), None)
+
+    # max_age is in seconds, timestamps in microseconds.
+    policy = data_store.RetentionPolicy(max_age=100)
+    self.assertEqual(policy.Expired([100e6, 150e6, 200e6], now=220), 100e6)
+
+    # The newest version is always kept.
+    self.assertEqual(policy.Expired([100e6], now=1000), None)
+    self.assertEqual(policy.Expired([100e6, 200e6], now=1000), 100e6)
+
   @DeletionTest
   def testDeleteSubjects(self):
     predicate = "metadata:tspredicate"
@@ -1345,6 +1453,7 @@ class _DataStoreTest(test_lib.GRRBaseTest):
            "DeleteSubject",
            "MultiResolveRegex",
            "MultiSet",
+           "MultiSubjectMultiSet",
            "Resolve",
            "ResolveMulti",
            "ResolveRegex",
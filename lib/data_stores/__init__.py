@@ -6,6 +6,7 @@
 
 
 from grr.lib.data_stores import fake_data_store
+from grr.lib.data_stores import memory_data_store
 try:
   from grr.lib.data_stores import mongo_data_store
 except ImportError:
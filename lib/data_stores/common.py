@@ -6,6 +6,7 @@ import collections
 import os
 import re
 import stat
+import string
 
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -14,6 +15,16 @@ from grr.lib import utils
 from grr.server.data_server import constants
 
 
+# Characters which match themselves in an attribute regex.
+_LITERAL_CHARACTERS = frozenset(string.ascii_letters + string.digits +
+                                " _-/:%@,;=<>!'\"#&~")
+
+# Characters which match themselves when escaped with a backslash.
+_ESCAPED_CHARACTERS = frozenset(".^$*+?{}[]()|\\/-:")
+
+_QUANTIFIERS = frozenset("*+?{")
+
+
 def ConvertStringToFilename(name):
   """Converts an unicode string to a filesystem safe filename.
 
@@ -100,3 +111,62 @@ def DatabaseDirectorySize(root_path, extension):
       except OSError:
         continue
   return total_size, total_files
+
+
+def DatabaseFiles(root_path, extension):
+  """Yields the directory and filename of every file of a data store.
+
+  These are relative to root_path and without the extension, like the
+  destinations returned by ResolveSubjectDestination().
+
+  Args:
+   root_path: The location of the data store.
+   extension: The extension of the database files.
+  """
+  for directory, directories, filenames in os.walk(root_path):
+    if constants.REBALANCE_DIRECTORY in directories:
+      directories.remove(constants.REBALANCE_DIRECTORY)
+
+    relative_directory = os.path.relpath(directory, root_path)
+    if relative_directory == ".":
+      relative_directory = ""
+
+    for filename in filenames:
+      if filename.endswith("." + extension):
+        yield relative_directory, filename[:-len(extension) - 1]
+
+
+def SplitLiteralPrefix(regex):
+  """Splits an attribute regex into a literal prefix and the rest.
+
+  Every attribute matched by the regex starts with the prefix.
+
+  Args:
+    regex: The attribute regex.
+
+  Returns:
+    A tuple of the prefix and the remaining regex.
+  """
+  # An alternation may not share the prefix.
+  if "|" in regex:
+    return "", regex
+
+  prefix = []
+  # Attribute regexes are always matched at the start.
+  i = 1 if regex.startswith("^") else 0
+  while i < len(regex):
+    if regex[i] in _LITERAL_CHARACTERS:
+      literal, length = regex[i], 1
+    elif regex[i] == "\\" and regex[i + 1:i + 2] in _ESCAPED_CHARACTERS:
+      literal, length = regex[i + 1], 2
+    else:
+      break
+
+    # A quantified character may not appear at all.
+    if regex[i + length:i + length + 1] in _QUANTIFIERS:
+      break
+
+    prefix.append(literal)
+    i += length
+
+  return "".join(prefix), regex[i:]
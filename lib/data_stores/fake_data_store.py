@@ -153,6 +153,24 @@ class FakeDataStore(data_store.DataStore):
         self.Set(subject, k, v, timestamp=element_timestamp, token=token,
                  replace=replace, sync=sync)
 
+    # Versions added to attributes with retention policies may make older ones
+    # expire.
+    if not replace:
+      retained = self.RetentionPolicies(values)
+      if retained:
+        self.EnforceRetention(subject, retained, token=token)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects."""
+    with self.lock:
+      subjects = [subject for subject, record in self.subjects.iteritems()
+                  if self.RetentionPolicies(record)]
+
+    for subject in subjects:
+      self.EnforceRetention(subject, token=token)
+
+    return len(subjects)
+
   @utils.Synchronized
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        token=None, sync=None):
@@ -9,6 +9,7 @@ from grr.lib import server_plugins
 
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import server_benchmark_test
 from grr.lib import test_lib
 
 
@@ -27,6 +28,10 @@ class FakeDataStoreBenchmarks(data_store_test.DataStoreBenchmarks):
   """
 
 
+class FakeDataStoreServerBenchmarks(server_benchmark_test._ServerBenchmarks):
+  """Benchmark the server on the fake data store."""
+
+
 def main(args):
   test_lib.main(args)
 
@@ -4,9 +4,12 @@
 
 import base64
 import binascii
+import collections
+import contextlib
 import httplib
 import random
 import re
+import select
 import socket
 import threading
 import time
@@ -18,10 +21,12 @@ from grr.lib import access_control
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
 from grr.lib.data_stores import common
 
 from grr.server.data_server import auth
+from grr.server.data_server import codec
 from grr.server.data_server import constants
 from grr.server.data_server import utils as sutils
 
@@ -43,6 +48,9 @@ def CheckResponseStatus(response):
   elif response.status == rdfvalue.DataStoreResponse.Status.DATA_STORE_ERROR:
     raise data_store.Error(response.status_desc)
 
+  elif response.status == rdfvalue.DataStoreResponse.Status.REPLICA_BEHIND:
+    raise ReplicaBehindError(response.status_desc)
+
   raise data_store.Error("Unknown error %s" % response.status_desc)
 
 
@@ -56,6 +64,15 @@ class HTTPDataStoreError(Error):
   pass
 
 
+class ReplicaBehindError(Error):
+  """Raised when a replica did not apply the writes a read has to see."""
+  pass
+
+
+# Session position of a data server with writes it did not acknowledge yet.
+_UNACKNOWLEDGED = -1
+
+
 class DataServerConnection(object):
   """Represents one connection to a data server."""
 
@@ -67,6 +84,16 @@ class DataServerConnection(object):
     # Mark pending requests and subjects that are scheduled to change on
     # the database.
     self.requests = []
+    # Pipelined requests waiting for their responses, keyed by request id.
+    self.pipeline = collections.OrderedDict()
+    self.last_request_id = 0
+    # Set when the data server accepts compact frames.
+    self.compact = False
+    # Set when the data server copies request ids into its responses.
+    self.pipelining = False
+    self.encoder = None
+    # Asynchronous writes waiting to be sent in one compact frame.
+    self.batch = None
     self._DoConnection()
 
   def Address(self):
@@ -91,6 +118,8 @@ class DataServerConnection(object):
       replylen = sutils.SIZE_PACKER.unpack(replylen_str)[0]
       reply = self._ReadExactly(replylen)
       response = rdfvalue.DataStoreResponse(reply)
+      if response.sequence:
+        self.server.UpdateSequence(response.sequence)
       CheckResponseStatus(response)
       return response
     except (socket.error, socket.timeout):
@@ -113,7 +142,12 @@ class DataServerConnection(object):
     return True
 
   def _SendRequest(self, command):
-    request_str = command.SerializeToString()
+    if isinstance(command, codec.CompactBatch):
+      request_str = self.encoder.Encode(command)
+    elif self.compact:
+      request_str = codec.FRAME_PROTO + command.SerializeToString()
+    else:
+      request_str = command.SerializeToString()
     request_body = sutils.SIZE_PACKER.pack(len(request_str)) + request_str
     self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.send_timeout"])
     try:
@@ -139,7 +173,12 @@ class DataServerConnection(object):
     try:
       logging.info("Attempting to connect to data server %s:%d",
                    self.Address(), self.Port())
-      self.conn = httplib.HTTPConnection(self.Address(), self.Port())
+      if self.server.replica:
+        self.conn = httplib.HTTPConnection(
+            self.Address(), self.Port(),
+            timeout=config_lib.CONFIG["HTTPDataStore.replica_connect_timeout"])
+      else:
+        self.conn = httplib.HTTPConnection(self.Address(), self.Port())
       username = config_lib.CONFIG.Get("HTTPDataStore.username")
       password = config_lib.CONFIG.Get("HTTPDataStore.password")
       if not username:
@@ -160,16 +199,36 @@ class DataServerConnection(object):
       token = rdf_token.SerializeToString()
       # We trick HTTP here and use the underlying socket to pipeline requests.
       headers = {"Content-Length": len(token)}
+      capabilities = [constants.CAPABILITY_PIPELINE]
+      if config_lib.CONFIG["HTTPDataStore.compact_protocol"]:
+        capabilities.append(constants.CAPABILITY_COMPACT)
+      headers[constants.CLIENT_CAPABILITIES_HEADER] = ",".join(capabilities)
       self.conn.request("POST", "/client/start", token, headers)
       self.sock = self.conn.sock
+      # Idle pooled connections are kept alive.
+      self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
       # Confirm handshake.
       self.sock.setblocking(1)
       self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.login_timeout"])
       ack = self._ReadExactly(3)
-      if ack == "IP\n":
+      if ack == constants.CLIENT_INVALID_PASSWORD:
         raise HTTPDataStoreError("Invalid data server username/password.")
-      if ack != "OK\n":
+      if ack == constants.CLIENT_ACK_CAPABILITIES:
+        size = sutils.SIZE_PACKER.unpack(
+            self._ReadExactly(sutils.SIZE_PACKER.size))[0]
+        accepted = self._ReadExactly(size).split(",")
+      elif ack == constants.CLIENT_ACK_COMPACT:
+        # Data servers from before pipelining do not echo request ids.
+        accepted = [constants.CAPABILITY_COMPACT]
+      elif ack == constants.CLIENT_ACK:
+        accepted = []
+      else:
         return False
+      # Interned attributes only live as long as the connection.
+      self.compact = constants.CAPABILITY_COMPACT in accepted
+      self.pipelining = constants.CAPABILITY_PIPELINE in accepted
+      self.encoder = codec.CompactEncoder(config_lib.CONFIG[
+          "HTTPDataStore.compact_compression_threshold"])
       logging.info("Connected to data server %s:%d", self.Address(),
                    self.Port())
       return True
@@ -187,6 +246,15 @@ class DataServerConnection(object):
     """Send all the requests again."""
     if self.requests:
       logging.info("Replaying the failed requests")
+    if not self.compact:
+      # The data server does not accept compact frames anymore.
+      requests = []
+      for request in self.requests:
+        if isinstance(request, codec.CompactBatch):
+          requests.extend(reversed(codec.BatchToCommands(request)))
+        else:
+          requests.append(request)
+      self.requests = requests
     while self.requests:
       req = self.requests[-1]
       if not self._SendRequest(req):
@@ -204,6 +272,15 @@ class DataServerConnection(object):
 
   def _DoConnection(self):
     """Cleanups the current connection and creates another one."""
+    if self.server.replica:
+      # Reads fall back to the primary data server, so there is no point in
+      # waiting for a replica.
+      if self._Reconnect() and self._ReplaySync():
+        return
+      self.server.MarkDown()
+      raise HTTPDataStoreError("Could not connect to replica %s:%d." %
+                               (self.Address(), self.Port()))
+
     started = time.time()
     while True:
       if self._Reconnect() and self._ReplaySync():
@@ -223,17 +300,68 @@ class DataServerConnection(object):
                     self.Port())
     self._DoConnection()
 
-  @utils.Synchronized
-  def MakeRequestAndContinue(self, command, unused_subject):
-    """Make request but do not sync with the data server."""
+  def _ReplicaFailed(self):
+    """Gives up on a replica which did not answer a read."""
+    self.server.MarkDown()
+    # A late reply would be taken as the reply to the next request.
+    self.pipeline.clear()
+    self.Close()
+    self.sock = None
+    raise HTTPDataStoreError("Replica %s:%d did not answer." %
+                             (self.Address(), self.Port()))
+
+  def _SendAsync(self, command):
     while not self._SendRequest(command):
       self._RedoConnection()
     self.requests.insert(0, command)
+
+  def _SendBatch(self):
+    """Sends the batched writes to the data server."""
+    if not self.batch:
+      return
+
+    batch, self.batch = self.batch, None
+    if self.compact:
+      self._SendAsync(batch)
+    else:
+      for command in codec.BatchToCommands(batch):
+        self._SendAsync(command)
+
+  @utils.Synchronized
+  def AddToBatch(self, subject, entries, token):
+    """Queues an asynchronous MultiSet to be sent in a compact frame.
+
+    Args:
+      subject: The subject to write to.
+      entries: A list of (attribute, replace, timestamp, value) tuples.
+      token: An ACL token.
+    """
+    if self.batch and self.batch.token != token:
+      self._SendBatch()
+
+    if not self.batch:
+      self.batch = codec.CompactBatch(token=token)
+
+    self.batch.Add(subject, entries)
+    if len(self.batch) >= config_lib.CONFIG[
+        "HTTPDataStore.compact_batch_size"]:
+      self._SendBatch()
+
+  @utils.Synchronized
+  def SendBatch(self):
+    self._SendBatch()
+
+  @utils.Synchronized
+  def MakeRequestAndContinue(self, command, unused_subject):
+    """Make request but do not sync with the data server."""
+    self._SendBatch()
+    self._SendAsync(command)
     return None
 
   @utils.Synchronized
   def SyncAndMakeRequest(self, command):
     """Make a request to the data server and return the response."""
+    self._SendBatch()
     if not self._Sync():
       # Must reconnect and resend requests.
       self._RedoConnection()
@@ -243,6 +371,8 @@ class DataServerConnection(object):
     self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
     response = self._ReadReply()
     if not response:
+      if self.server.replica:
+        self._ReplicaFailed()
       # Must reconnect and resend the request.
       while True:
         self._RedoConnection()
@@ -253,28 +383,141 @@ class DataServerConnection(object):
           break
     return response
 
+  def StartPipeline(self, commands):
+    """Sends read commands to the data server without waiting for replies.
+
+    The connection stays locked until all the responses were read with
+    ReadPipelinedResponse() and FinishPipeline() was called. Commands are
+    resent after a reconnection so they must not modify the data store.
+
+    Args:
+      commands: A list of DataStoreCommand objects.
+    """
+    self.lock.acquire()
+    try:
+      self._SendBatch()
+      if not self._Sync():
+        self._RedoConnection()
+
+      for command in commands:
+        self.last_request_id += 1
+        command.request.request_id = self.last_request_id
+        self.pipeline[self.last_request_id] = command
+
+      self._SendPipeline()
+    except:
+      self.FinishPipeline()
+      raise
+
+  def _SendPipeline(self):
+    """Sends all the pipelined commands, reconnecting if needed."""
+    while not all(self._SendRequest(command)
+                  for command in self.pipeline.itervalues()):
+      self._RedoConnection()
+
+  def ReadPipelinedResponse(self):
+    """Reads the next response to a pipelined command.
+
+    Returns:
+      A (command, response) tuple.
+    """
+    while True:
+      self.sock.settimeout(config_lib.CONFIG["HTTPDataStore.read_timeout"])
+      response = self._ReadReply()
+      if not response:
+        if self.server.replica:
+          self._ReplicaFailed()
+        # The responses we did not get yet are lost, ask again.
+        self._RedoConnection()
+        if not self.pipelining:
+          raise HTTPDataStoreError(
+              "Data server %s:%d does not pipeline requests anymore." %
+              (self.Address(), self.Port()))
+        self._SendPipeline()
+        continue
+
+      # Responses to requests sent before a reconnection are dropped.
+      command = self.pipeline.pop(response.request_id, None)
+      if command is not None:
+        return command, response
+
+  def FinishPipeline(self):
+    """Unlocks the connection after the pipelined responses were read."""
+    try:
+      if self.pipeline:
+        # Unread responses would be taken as replies to the next requests.
+        self.pipeline.clear()
+        self._Reconnect()
+    finally:
+      self.lock.release()
+
   @utils.Synchronized
   def Sync(self):
-    self._Sync()
+    """Waits for the replies to all the requests sent so far."""
+    self._SendBatch()
+    if not self._Sync():
+      # The requests which were not acknowledged are sent again after
+      # reconnecting.
+      self._RedoConnection()
 
   def NumPendingRequests(self):
-    return len(self.requests)
+    return len(self.requests) + len(self.pipeline) + len(self.batch or ())
+
+  def IsHealthy(self):
+    """Checks that the data server did not close this idle connection."""
+    if not self.sock:
+      return False
+    try:
+      readable, _, _ = select.select([self.sock], [], [], 0)
+    except (select.error, socket.error, ValueError):
+      return False
+    # Without pending requests there is nothing to read unless the data server
+    # went away.
+    return not readable
+
+  @utils.Synchronized
+  def Reconnect(self):
+    self._RedoConnection()
 
   def Close(self):
     self.conn.close()
 
 
 class DataServer(object):
-  """A DataServer object contains connections a data server."""
+  """A DataServer object holds a pool of connections to a data server.
+
+  Connections are handed out to one thread at a time. The pool keeps at least
+  Dataserver.min_connections open and opens more on demand, up to
+  Dataserver.max_connections. When they are all busy, threads wait for one to
+  be returned. Connections to replicas are only opened on demand, and a
+  replica which can not be reached is marked down for a while instead of
+  being retried.
+  """
 
-  def __init__(self, addr, port):
+  def __init__(self, addr, port, replica=False):
     self.addr = addr
     self.port = port
+    # Replicas are only connected to when reads are sent to them.
+    self.replica = replica
+    # Time until which an unreachable replica gets no reads.
+    self.down_until = 0
     self.conn = httplib.HTTPConnection(self.Address(), self.Port())
     self.lock = threading.Lock()
-    self.max_connections = config_lib.CONFIG["Dataserver.max_connections"]
-    # Start with a single connection.
-    self.connections = [DataServerConnection(self)]
+    self.pool_condition = threading.Condition(self.lock)
+    self.min_connections = max(
+        1, config_lib.CONFIG["Dataserver.min_connections"])
+    self.max_connections = max(
+        self.min_connections, config_lib.CONFIG["Dataserver.max_connections"])
+    if replica:
+      self.connections = []
+    else:
+      self.connections = [DataServerConnection(self)
+                          for _ in range(self.min_connections)]
+    self.idle_connections = list(self.connections)
+    # Connections being opened outside of the lock.
+    self.num_connecting = 0
+    # The latest position in the change log of the data server we know of.
+    self.last_sequence = 0
 
   def Port(self):
     return self.port
@@ -286,31 +529,114 @@ class DataServer(object):
     for conn in self.connections:
       conn.Close()
     self.connections = []
+    self.idle_connections = []
     if self.conn:
       self.conn.close()
       self.conn = None
 
-  @utils.Synchronized
   def Sync(self):
-    for conn in self.connections:
+    with self.lock:
+      connections = list(self.connections)
+
+    for conn in connections:
       conn.Sync()
 
-  @utils.Synchronized
+  def MarkDown(self):
+    logging.warning("Data server %s:%d is unreachable.", self.Address(),
+                    self.Port())
+    self.down_until = time.time() + config_lib.CONFIG[
+        "HTTPDataStore.replica_retry_time"]
+
+  def IsAvailable(self):
+    return time.time() >= self.down_until
+
+  def UpdateSequence(self, sequence):
+    with self.lock:
+      self.last_sequence = max(self.last_sequence, sequence)
+
   def GetConnection(self):
-    """Return a connection to the data server."""
-    best = min(self.connections, key=lambda x: x.NumPendingRequests())
-    if best.NumPendingRequests():
-      if len(self.connections) == self.max_connections:
-        # Too many connections, use this one.
-        return best
-      new = DataServerConnection(self)
-      self.connections.append(new)
-      return new
-    else:
-      return best
+    """Takes a connection to the data server out of the pool.
+
+    The connection must be given back with ReleaseConnection().
+
+    Returns:
+      A DataServerConnection.
+
+    Raises:
+      HTTPDataStoreError: If no connection became available in time.
+    """
+    started = time.time()
+    deadline = started + config_lib.CONFIG[
+        "HTTPDataStore.connection_wait_timeout"]
+    conn = None
+    with self.lock:
+      while True:
+        if self.idle_connections:
+          # Prefer connections without pending replies, then the most recently
+          # used one.
+          conn = min(reversed(self.idle_connections),
+                     key=lambda x: x.NumPendingRequests())
+          self.idle_connections.remove(conn)
+          break
 
-    # Attempt to get one connection with no pending requests.
-    return self.connections[0]
+        if len(self.connections) + self.num_connecting < self.max_connections:
+          self.num_connecting += 1
+          break
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          raise HTTPDataStoreError(
+              "Timed out waiting for a connection to %s:%d." %
+              (self.Address(), self.Port()))
+        self.pool_condition.wait(remaining)
+
+    # Connecting can take a long time, so it is done without holding the lock.
+    if conn is None:
+      try:
+        conn = DataServerConnection(self)
+      finally:
+        with self.lock:
+          self.num_connecting -= 1
+          if conn is not None:
+            self.connections.append(conn)
+          self.pool_condition.notify()
+
+    elif not conn.NumPendingRequests() and not conn.IsHealthy():
+      logging.info("Idle connection to %s:%d was closed, reconnecting.",
+                   self.Address(), self.Port())
+      try:
+        conn.Reconnect()
+      except HTTPDataStoreError:
+        self.ReleaseConnection(conn)
+        raise
+
+    stats.STATS.RecordEvent("http_data_store_connection_wait_time",
+                            time.time() - started)
+    self._UpdatePoolStats()
+    return conn
+
+  def ReleaseConnection(self, conn):
+    """Returns a connection taken with GetConnection() to the pool."""
+    with self.lock:
+      self.idle_connections.append(conn)
+      self.pool_condition.notify()
+    self._UpdatePoolStats()
+
+  @contextlib.contextmanager
+  def Connection(self):
+    conn = self.GetConnection()
+    try:
+      yield conn
+    finally:
+      self.ReleaseConnection(conn)
+
+  def _UpdatePoolStats(self):
+    fields = ["%s:%d" % (self.Address(), self.Port())]
+    stats.STATS.SetGaugeValue("http_data_store_open_connections",
+                              len(self.connections), fields=fields)
+    stats.STATS.SetGaugeValue(
+        "http_data_store_busy_connections",
+        len(self.connections) - len(self.idle_connections), fields=fields)
 
   def _FetchMapping(self):
     """Attempt to fetch mapping from the data server."""
@@ -359,6 +685,10 @@ class RemoteInquirer(object):
       port = loc.port
       self.servers.append(DataServer(addr, port))
     self.mapping_server = random.choice(self.servers)
+    # Lists of read only replicas by data server.
+    self.replicas = {}
+    if config_lib.CONFIG["HTTPDataStore.replica_reads"]:
+      self._LoadReplicas()
     self.mapping = self.mapping_server.LoadMapping()
 
     if len(self.mapping.servers) != len(server_list):
@@ -378,6 +708,27 @@ class RemoteInquirer(object):
         raise HTTPDataStoreError("There is a mismatch between the data "
                                  "servers and the configuration file.")
 
+  def _LoadReplicas(self):
+    """Connects to the replicas of the data servers."""
+    for entry in config_lib.CONFIG["Dataserver.replicas"]:
+      try:
+        primary, replica = entry.split("=", 1)
+      except ValueError:
+        raise HTTPDataStoreError("Invalid data server replica %s." % entry)
+
+      primary_loc = urlparse.urlparse(primary, scheme="http")
+      for server in self.servers:
+        if (server.Address() == primary_loc.hostname and
+            server.Port() == primary_loc.port):
+          break
+      else:
+        raise HTTPDataStoreError("Replica %s of unknown data server %s." %
+                                 (replica, primary))
+
+      loc = urlparse.urlparse(replica, scheme="http")
+      self.replicas.setdefault(server, []).append(
+          DataServer(loc.hostname, loc.port, replica=True))
+
   def MapKey(self, key):
     """Return the data server responsible for a given key."""
     sid = sutils.MapKeyToServer(self.mapping, key)
@@ -400,6 +751,9 @@ class RemoteInquirer(object):
   def CloseConnections(self):
     for serv in self.servers:
       serv.Close()
+    for replicas in self.replicas.itervalues():
+      for replica in replicas:
+        replica.Close()
 
 
 class RemoteMappingCache(utils.FastStore):
@@ -416,6 +770,16 @@ class RemoteMappingCache(utils.FastStore):
   def GetInquirer(self):
     return self.inquirer
 
+  def RenewMapping(self):
+    """Fetches the mapping and forgets the cached servers when it changed."""
+    version = self.inquirer.GetMapping().version
+    mapping = self.inquirer.RenewMapping()
+    if mapping.version != version:
+      logging.info("Data server mapping changed to version %d.",
+                   mapping.version)
+      self.Flush()
+    return mapping
+
   @utils.Synchronized
   def Get(self, subject):
     """This will create the object if needed so should not fail."""
@@ -433,19 +797,62 @@ class RemoteMappingCache(utils.FastStore):
 
 
 class HTTPDataStore(data_store.DataStore):
-  """A data store which calls a remote server."""
+  """A data store which calls a remote server.
+
+  With HTTPDataStore.replica_reads, reads go to the replicas of the data
+  servers. Every thread remembers the positions of its writes in the change
+  logs of the data servers and replicas only answer its reads once they
+  applied them, so a thread always reads its own writes. SessionToken() and
+  ResumeSession() carry these positions to other threads or processes.
+  """
 
   cache = None
   inquirer = None
+  batch_thread = None
+
+  # The maximum number of subjects read by a single pipelined request.
+  subjects_per_request = 100
+
+  WRITE_COMMANDS = frozenset([
+      rdfvalue.DataStoreCommand.Command.DELETE_ATTRIBUTES,
+      rdfvalue.DataStoreCommand.Command.DELETE_SUBJECT])
 
   def __init__(self):
     super(HTTPDataStore, self).__init__()
+    stats.STATS.RegisterEventMetric("http_data_store_connection_wait_time",
+                                    units="SECONDS")
+    stats.STATS.RegisterGaugeMetric("http_data_store_open_connections", int,
+                                    fields=[("data_server", str)])
+    stats.STATS.RegisterGaugeMetric("http_data_store_busy_connections", int,
+                                    fields=[("data_server", str)])
+    stats.STATS.RegisterCounterMetric("http_data_store_replica_fallbacks")
+    self.session = threading.local()
     self.cache = RemoteMappingCache(1000)
     self.inquirer = self.cache.GetInquirer()
     self._ComputeNewSize(self.inquirer.GetMapping(), time.time())
-
-  def GetServer(self, subject):
-    return self.cache.Get(subject).GetConnection()
+    # The mapping changes while the data servers are rebalancing.
+    self.last_mapping_refresh = time.time()
+    # Batched writes are sent at least every second.
+    self.batch_thread = utils.InterruptableThread(target=self._SendBatches,
+                                                  sleep_time=1)
+    self.batch_thread.start()
+
+  def _SendBatches(self):
+    for server in self.inquirer.servers:
+      for conn in list(server.connections):
+        try:
+          conn.SendBatch()
+        except Error as e:
+          logging.warning("Could not send batched writes to %s:%d: %s",
+                          server.Address(), server.Port(), e)
+
+    interval = config_lib.CONFIG["HTTPDataStore.mapping_refresh_interval"]
+    if time.time() - self.last_mapping_refresh >= interval:
+      self.last_mapping_refresh = time.time()
+      try:
+        self.cache.RenewMapping()
+      except Error as e:
+        logging.warning("Could not refresh the data server mapping: %s", e)
 
   def TimestampSpecFromTimestamp(self, timestamp):
     """Create a timestamp spec from a timestamp value.
@@ -480,17 +887,113 @@ class HTTPDataStore(data_store.DataStore):
         start=timestamp,
         type=rdfvalue.TimestampSpec.Type.SPECIFIC_TIME)
 
+  def _SessionPositions(self):
+    """Returns the positions of the writes of this thread by data server."""
+    try:
+      return self.session.positions
+    except AttributeError:
+      self.session.positions = {}
+      return self.session.positions
+
+  def _RecordWrite(self, server, sync):
+    """Remembers a write of this thread so its reads see it."""
+    if server not in self.inquirer.replicas:
+      return
+
+    positions = self._SessionPositions()
+    if not sync:
+      positions[server] = _UNACKNOWLEDGED
+    elif positions.get(server) != _UNACKNOWLEDGED:
+      # The reply to the write updated the position of the data server.
+      positions[server] = server.last_sequence
+
+  def _SessionPosition(self, server):
+    """Returns the position replicas must reach to answer our reads."""
+    positions = self._SessionPositions()
+    position = positions.get(server, 0)
+    if position == _UNACKNOWLEDGED:
+      # The positions of asynchronous writes are only known once the data
+      # server acknowledged them.
+      server.Sync()
+      position = positions[server] = server.last_sequence
+    return position
+
+  def SessionToken(self):
+    """Returns the positions of the writes of this thread.
+
+    Pass the token to ResumeSession() in another thread or process to read
+    these writes from the replicas there.
+
+    Returns:
+      A dict of data server indexes to positions in their change logs.
+    """
+    return dict((self.inquirer.servers.index(server),
+                 self._SessionPosition(server))
+                for server in list(self._SessionPositions()))
+
+  def ResumeSession(self, token):
+    """Makes the reads of this thread see the writes of a SessionToken()."""
+    positions = self._SessionPositions()
+    for index, sequence in token.iteritems():
+      server = self.inquirer.servers[index]
+      position = positions.get(server, 0)
+      if position != _UNACKNOWLEDGED:
+        positions[server] = max(position, sequence)
+
+  @contextlib.contextmanager
+  def PrimaryReads(self):
+    """Sends the reads of this thread to the primary data servers."""
+    self.session.primary_reads = getattr(self.session, "primary_reads", 0) + 1
+    try:
+      yield
+    finally:
+      self.session.primary_reads -= 1
+
+  def _ReadReplica(self, server):
+    """Returns a replica to send a read for the data server to or None."""
+    if getattr(self.session, "primary_reads", 0):
+      return None
+
+    replicas = [replica for replica in self.inquirer.replicas.get(server, ())
+                if replica.IsAvailable()]
+    if replicas:
+      return random.choice(replicas)
+
+  def _ReplicaFallback(self, error):
+    logging.debug("Reading from the primary data server: %s", error)
+    stats.STATS.IncrementCounter("http_data_store_replica_fallbacks")
+
   def _MakeSyncRequest(self, request, typ):
     return self._MakeRequestSyncOrAsync(request, typ, True)
 
+  def _MakeReadRequest(self, request, typ):
+    """Sends a read to a replica of the data server if there is one."""
+    server = self.cache.Get(request.subject[0])
+    replica = self._ReadReplica(server)
+    if replica:
+      request.min_sequence = self._SessionPosition(server)
+      cmd = rdfvalue.DataStoreCommand(command=typ, request=request)
+      try:
+        with replica.Connection() as conn:
+          return conn.SyncAndMakeRequest(cmd)
+      except (ReplicaBehindError, HTTPDataStoreError) as e:
+        self._ReplicaFallback(e)
+
+    return self._MakeSyncRequest(request, typ)
+
   def _MakeRequestSyncOrAsync(self, request, typ, sync):
     subject = request.subject[0]
-    server = self.GetServer(subject)
     cmd = rdfvalue.DataStoreCommand(command=typ, request=request)
-    if sync:
-      return server.SyncAndMakeRequest(cmd)
-    else:
-      return server.MakeRequestAndContinue(cmd, subject)
+    server = self.cache.Get(subject)
+    with server.Connection() as conn:
+      if sync:
+        response = conn.SyncAndMakeRequest(cmd)
+      else:
+        response = conn.MakeRequestAndContinue(cmd, subject)
+
+    if typ in self.WRITE_COMMANDS:
+      self._RecordWrite(server, sync)
+    return response
 
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
@@ -547,6 +1050,19 @@ class HTTPDataStore(data_store.DataStore):
   def MultiResolveRegex(self, subjects, attribute_regex,
                         timestamp=None, limit=None, token=None):
     """MultiResolveRegex."""
+    if not limit:
+      if self.inquirer.replicas:
+        try:
+          return self._PipelinedMultiResolveRegex(
+              subjects, attribute_regex, timestamp=timestamp, token=token,
+              replicas=True)
+        except (ReplicaBehindError, HTTPDataStoreError) as e:
+          self._ReplicaFallback(e)
+
+      return self._PipelinedMultiResolveRegex(subjects, attribute_regex,
+                                              timestamp=timestamp, token=token)
+
+    # The limit applies to the subjects in order so they are read one by one.
     typ = rdfvalue.DataStoreCommand.Command.MULTI_RESOLVE_REGEX
     results = {}
     remaining_limit = limit
@@ -555,7 +1071,7 @@ class HTTPDataStore(data_store.DataStore):
                                   timestamp=timestamp, token=token,
                                   limit=remaining_limit)
 
-      response = self._MakeSyncRequest(request, typ)
+      response = self._MakeReadRequest(request, typ)
 
       if response.results:
         result_set = response.results[0]
@@ -571,26 +1087,183 @@ class HTTPDataStore(data_store.DataStore):
 
     return results.iteritems()
 
+  def _PipelinedMultiResolveRegex(self, subjects, attribute_regex,
+                                  timestamp=None, token=None, replicas=False):
+    """Reads the subjects from all the data servers in parallel.
+
+    The subjects are grouped by the data server they map to and every data
+    server gets all its requests pipelined on one connection, so the whole
+    read takes about one round trip.
+
+    Args:
+      subjects: A list of subjects.
+      attribute_regex: The attribute regex.
+      timestamp: A timestamp as accepted by TimestampSpecFromTimestamp().
+      token: An ACL token.
+      replicas: Read from the replicas of the data servers which have some.
+
+    Returns:
+      An iterator over (subject, values) tuples in the order the responses
+      arrived.
+
+    Raises:
+      ReplicaBehindError: If a replica did not apply the writes of this thread.
+    """
+    typ = rdfvalue.DataStoreCommand.Command.MULTI_RESOLVE_REGEX
+    subjects_by_server = {}
+    for subject in subjects:
+      subjects_by_server.setdefault(self.cache.Get(subject), []).append(subject)
+
+    results = []
+    connections = []
+    try:
+      # Connections are always locked in the same order, otherwise two
+      # threads could wait on each other.
+      for server in sorted(subjects_by_server,
+                           key=self.inquirer.servers.index):
+        server_subjects = subjects_by_server[server]
+        target = replicas and self._ReadReplica(server)
+        min_sequence = self._SessionPosition(server) if target else 0
+        commands = []
+        for i in xrange(0, len(server_subjects), self.subjects_per_request):
+          request = self._MakeRequest(
+              server_subjects[i:i + self.subjects_per_request],
+              attribute_regex, timestamp=timestamp, token=token)
+          if min_sequence:
+            request.min_sequence = min_sequence
+          commands.append(rdfvalue.DataStoreCommand(command=typ,
+                                                    request=request))
+
+        target = target or server
+        connection = target.GetConnection()
+        try:
+          if connection.pipelining:
+            connection.StartPipeline(commands)
+          else:
+            # Older data servers can not tell which request a response
+            # belongs to, so the requests are sent one at a time.
+            for command in commands:
+              self._AddResults(results, connection.SyncAndMakeRequest(command))
+            target.ReleaseConnection(connection)
+            continue
+        except:
+          target.ReleaseConnection(connection)
+          raise
+        connections.append(connection)
+
+      # All the data servers are working on our requests by now.
+      for connection in connections:
+        while connection.pipeline:
+          _, response = connection.ReadPipelinedResponse()
+          self._AddResults(results, response)
+    finally:
+      for connection in connections:
+        connection.FinishPipeline()
+        connection.server.ReleaseConnection(connection)
+
+    # We do not yield while holding the connections since the caller may
+    # issue more data store requests while iterating.
+    return iter(results)
+
+  def _AddResults(self, results, response):
+    for result_set in response.results:
+      results.append((result_set.subject,
+                      [(pred, self._Decode(value), ts)
+                       for (pred, value, ts) in result_set.payload]))
+
   def MultiSet(self, subject, values, timestamp=None, replace=True,
                sync=True, to_delete=None, token=None):
     """MultiSet."""
-    request = rdfvalue.DataStoreRequest(sync=sync)
     token = token or data_store.default_token
-    if token:
-      request.token = token
+    now = int(time.time() * 1000000)
+
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = now
+
+    entries = self._MultiSetEntries(values, timestamp, now, replace, to_delete)
+
+    server = self.cache.Get(subject)
+    with server.Connection() as conn:
+      if sync:
+        conn.SyncAndMakeRequest(
+            codec.MultiSetCommand(subject, entries, token=token, sync=True))
+      elif conn.compact:
+        conn.AddToBatch(subject, entries, token)
+      else:
+        conn.MakeRequestAndContinue(
+            codec.MultiSetCommand(subject, entries, token=token), subject)
+
+    self._RecordWrite(server, sync)
 
-    request.subject.Append(subject)
-    now = time.time() * 1000000
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Writes many subjects with one round trip per data server.
+
+    The writes for every data server are sent on one connection without
+    waiting for the replies in between. Asynchronous writes go into the
+    compact batch of the connection if it has one.
+
+    Args:
+      values: A dict of subjects to dicts of attributes and values.
+      timestamp: The timestamp for the entries in microseconds since the
+              epoch. None means now.
+      replace: Bool whether or not to overwrite current records.
+      sync: If true we block until the operation completes.
+      to_delete: A dict of subjects to arrays of attributes to clear prior to
+              setting.
+      token: An ACL token.
+    """
+    token = token or data_store.default_token
+    now = int(time.time() * 1000000)
 
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = now
 
+    to_delete = to_delete or {}
+    writes_by_server = {}
+    for subject in set(values) | set(to_delete):
+      entries = self._MultiSetEntries(values.get(subject, {}), timestamp, now,
+                                      replace, to_delete.get(subject))
+      writes_by_server.setdefault(self.cache.Get(subject), []).append(
+          (subject, entries))
+
+    connections = []
+    try:
+      # Connections are always locked in the same order, otherwise two
+      # threads could wait on each other.
+      for server in sorted(writes_by_server, key=self.inquirer.servers.index):
+        conn = server.GetConnection()
+        connections.append(conn)
+
+        for subject, entries in writes_by_server[server]:
+          if sync:
+            conn.MakeRequestAndContinue(
+                codec.MultiSetCommand(subject, entries, token=token, sync=True),
+                subject)
+          elif conn.compact:
+            conn.AddToBatch(subject, entries, token)
+          else:
+            conn.MakeRequestAndContinue(
+                codec.MultiSetCommand(subject, entries, token=token), subject)
+
+      # All the data servers are working on the writes by now.
+      if sync:
+        for conn in connections:
+          conn.Sync()
+    finally:
+      for conn in connections:
+        conn.server.ReleaseConnection(conn)
+
+    for server in writes_by_server:
+      self._RecordWrite(server, sync)
+
+  def _MultiSetEntries(self, values, timestamp, now, replace, to_delete):
+    """Returns the (attribute, replace, timestamp, value) tuples to send."""
     to_delete = set(to_delete or [])
-    for attribute in to_delete:
-      if attribute not in values:
-        values[attribute] = [(None, 0)]
 
+    entries = []
     for k, seq in values.items():
+      attribute = utils.SmartUnicode(k)
       for v in seq:
         if isinstance(v, basestring):
           element_timestamp = timestamp
@@ -600,25 +1273,19 @@ class HTTPDataStore(data_store.DataStore):
           except (TypeError, ValueError):
             element_timestamp = timestamp
 
-        option = rdfvalue.DataStoreValue.Option.DEFAULT
-        if replace or k in to_delete:
-          option = rdfvalue.DataStoreValue.Option.REPLACE
-
-        new_value = request.values.Append(
-            attribute=utils.SmartUnicode(k),
-            option=option)
-
-        if element_timestamp is None:
+        if (element_timestamp is None or
+            element_timestamp == self.NEWEST_TIMESTAMP):
           element_timestamp = now
 
-        new_value.timestamp = self.TimestampSpecFromTimestamp(
-            element_timestamp)
+        entries.append((attribute, replace or k in to_delete,
+                        int(element_timestamp), v))
 
-        if v is not None:
-          new_value.value.SetValue(v)
+    # Attributes which are only deleted are sent without a value.
+    for attribute in to_delete:
+      if attribute not in values:
+        entries.append((utils.SmartUnicode(attribute), True, 0, None))
 
-    typ = rdfvalue.DataStoreCommand.Command.MULTI_SET
-    self._MakeRequestSyncOrAsync(request, typ, sync)
+    return entries
 
   def ResolveMulti(self, subject, attributes, timestamp=None, limit=None,
                    token=None):
@@ -627,7 +1294,7 @@ class HTTPDataStore(data_store.DataStore):
                                 limit=limit, token=token)
 
     typ = rdfvalue.DataStoreCommand.Command.RESOLVE_MULTI
-    response = self._MakeSyncRequest(request, typ)
+    response = self._MakeReadRequest(request, typ)
 
     results = []
     for result in response.results:
@@ -715,7 +1382,10 @@ class HTTPDataStore(data_store.DataStore):
       self.inquirer.Flush()
 
   def CloseConnections(self):
+    if self.batch_thread:
+      self.batch_thread.Stop()
     if self.inquirer:
+      self.inquirer.Flush()
       self.inquirer.CloseConnections()
 
   def _ComputeNewSize(self, mapping, new_time):
@@ -729,7 +1399,7 @@ class HTTPDataStore(data_store.DataStore):
     now = time.time()
     if now < self.last_size_update + 60:
       return self.last_size
-    mapping = self.inquirer.RenewMapping()
+    mapping = self.cache.RenewMapping()
     self._ComputeNewSize(mapping, now)
     return self.last_size
 
@@ -769,6 +1439,18 @@ class HTTPTransaction(data_store.CommonTransaction):
     self.expires = now + lease_time
     self.locked = True
 
+  # Reads under a lease must see the writes of the previous lease holder, so
+  # they are never sent to replicas.
+
+  def ResolveRegex(self, attribute_regex, timestamp=None):
+    with self.store.PrimaryReads():
+      return super(HTTPTransaction, self).ResolveRegex(attribute_regex,
+                                                       timestamp=timestamp)
+
+  def Resolve(self, attribute):
+    with self.store.PrimaryReads():
+      return super(HTTPTransaction, self).Resolve(attribute)
+
   def UpdateLease(self, duration):
     now = time.time()
     ret = self.store.ExtendSubjectLock(self.subject, self.transid, duration,
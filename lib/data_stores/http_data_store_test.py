@@ -5,6 +5,7 @@
 import httplib
 import socket
 import threading
+import time
 
 
 
@@ -17,10 +18,13 @@ from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
 from grr.lib import test_lib
+from grr.lib import utils
 
 from grr.lib.data_stores import http_data_store
 from grr.lib.data_stores import sqlite_data_store
 
+from grr.server.data_server import codec
+from grr.server.data_server import constants
 from grr.server.data_server import data_server
 
 
@@ -48,6 +52,15 @@ class MockRequestHandler(data_server.DataServerHandler):
       return super(MockRequestHandler, self).do_POST()
 
 
+class _OldServerConstants(object):
+  """The constants of a data server which does not know about pipelining."""
+
+  def __getattr__(self, name):
+    if name == "CAPABILITY_PIPELINE":
+      return None
+    return getattr(constants, name)
+
+
 STARTED_SERVER = None
 HTTP_DB = None
 PORT = None
@@ -138,6 +151,273 @@ class HTTPDataStoreTest(HTTPDataStoreMixin,
     # Disabled for now.
     pass
 
+  def testCompactRetention(self):
+    """The data servers compact their own data stores."""
+    predicate = "metadata:retained"
+    for timestamp in [100, 200, 300, 400]:
+      data_store.DB.Set(self.test_row, predicate, "hello%d" % timestamp,
+                        timestamp=timestamp, replace=False, token=self.token)
+
+    data_store.DB.Flush()
+    self.CheckLength(predicate, 4)
+
+    # All but the newest version are older than a day.
+    policies = {predicate: data_store.RetentionPolicy(max_age=24 * 60 * 60)}
+    with utils.Stubber(data_store, "RETENTION_POLICIES", policies):
+      self.assertTrue(HTTP_DB.CompactRetention(token=self.token))
+
+    self.CheckLast(predicate, "hello400", 400)
+    self.CheckLength(predicate, 1)
+
+  def testMultiResolveRegexIsPipelined(self):
+    subjects = ["aff4:/pipelined/%d" % i for i in range(25)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+
+    def Fail(*unused_args):
+      raise AssertionError("Request was not pipelined.")
+
+    with utils.MultiStubber(
+        (data_store.DB, "subjects_per_request", 10),
+        (http_data_store.DataServerConnection, "SyncAndMakeRequest", Fail)):
+      results = dict(data_store.DB.MultiResolveRegex(
+          subjects, "metadata:predicate", token=self.token))
+
+    self.assertEqual(len(results), 25)
+    for subject in subjects:
+      self.assertEqual(results[subject][0][1], subject)
+
+    for server in data_store.DB.inquirer.servers:
+      for connection in server.connections:
+        self.assertFalse(connection.pipeline)
+
+  def testMultiResolveRegexWithoutPipelining(self):
+    subjects = ["aff4:/sequential/%d" % i for i in range(25)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+
+    # Data servers from before pipelining do not accept the capability.
+    with utils.Stubber(data_server, "constants", _OldServerConstants()):
+      for server in data_store.DB.inquirer.servers:
+        for connection in server.connections:
+          self.assertTrue(connection.pipelining)
+          connection.Reconnect()
+          self.assertFalse(connection.pipelining)
+          self.assertTrue(connection.compact)
+
+    def Fail(*unused_args):
+      raise AssertionError("Request was pipelined.")
+
+    with utils.MultiStubber(
+        (data_store.DB, "subjects_per_request", 10),
+        (http_data_store.DataServerConnection, "StartPipeline", Fail)):
+      results = dict(data_store.DB.MultiResolveRegex(
+          subjects, "metadata:predicate", token=self.token))
+
+    self.assertEqual(len(results), 25)
+    for subject in subjects:
+      self.assertEqual(results[subject][0][1], subject)
+
+  def testAsyncMultiSetIsBatched(self):
+    server = data_store.DB.inquirer.servers[0]
+    self.assertTrue(server.connections[0].compact)
+
+    sent = []
+    original_send_request = http_data_store.DataServerConnection._SendRequest
+
+    def SendRequest(connection, command):
+      sent.append(command)
+      return original_send_request(connection, command)
+
+    subjects = ["aff4:/batched/%d" % i for i in range(25)]
+    with utils.Stubber(http_data_store.DataServerConnection, "_SendRequest",
+                       SendRequest):
+      for subject in subjects:
+        data_store.DB.MultiSet(subject, {"metadata:predicate": [subject],
+                                         "metadata:number": [5]},
+                               sync=False, token=self.token)
+      data_store.DB.Flush()
+
+    # The writes are sent in compact frames, usually all in the same one.
+    for batch in sent:
+      self.assertTrue(isinstance(batch, codec.CompactBatch))
+    self.assertEqual(sum(len(batch) for batch in sent), 25)
+
+    for subject in subjects:
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:predicate",
+                                             token=self.token)[0], subject)
+      self.assertEqual(data_store.DB.Resolve(subject, "metadata:number",
+                                             token=self.token)[0], 5)
+
+  def testLostSyncWritesAreResent(self):
+    config_lib.CONFIG.Set("HTTPDataStore.read_timeout", 1)
+    original_send_request = http_data_store.DataServerConnection._SendRequest
+    lost = []
+
+    def SendRequest(connection, command):
+      if not lost:
+        # The data server never gets the first request.
+        lost.append(command)
+        return True
+      return original_send_request(connection, command)
+
+    with utils.Stubber(http_data_store.DataServerConnection, "_SendRequest",
+                       SendRequest):
+      data_store.DB.MultiSubjectMultiSet(
+          {self.test_row: {"metadata:predicate": ["value"]}}, sync=True,
+          token=self.token)
+
+    self.assertEqual(len(lost), 1)
+    value, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate",
+                                     token=self.token)
+    self.assertEqual(value, "value")
+
+  def testConnectionPool(self):
+    server = data_store.DB.inquirer.servers[0]
+    config_lib.CONFIG.Set("HTTPDataStore.connection_wait_timeout", 0)
+
+    with utils.Stubber(server, "max_connections", 2):
+      first = server.GetConnection()
+      second = server.GetConnection()
+      self.assertNotEqual(first, second)
+
+      # All the connections are busy.
+      self.assertRaises(http_data_store.HTTPDataStoreError,
+                        server.GetConnection)
+
+      server.ReleaseConnection(second)
+      self.assertEqual(server.GetConnection(), second)
+
+      # A connection closed while in the pool is reopened when it is taken.
+      first.sock.shutdown(socket.SHUT_RDWR)
+      self.assertFalse(first.IsHealthy())
+      server.ReleaseConnection(first)
+      self.assertEqual(server.GetConnection(), first)
+      self.assertTrue(first.IsHealthy())
+
+      server.ReleaseConnection(first)
+      server.ReleaseConnection(second)
+
+    # The pool still works for normal requests.
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+    value, _ = data_store.DB.Resolve(self.test_row, "metadata:predicate",
+                                     token=self.token)
+    self.assertEqual(value, "value")
+
+  def _UseReplica(self, port):
+    """Recreates the data store with a replica of the data server."""
+    data_store.DB.CloseConnections()
+    config_lib.CONFIG.Set("HTTPDataStore.replica_reads", True)
+    config_lib.CONFIG.Set("Dataserver.replicas", [
+        "http://127.0.0.1:%d=http://127.0.0.1:%d" % (PORT, port)])
+    data_store.DB = http_data_store.HTTPDataStore()
+    server = data_store.DB.inquirer.servers[0]
+    return server, data_store.DB.inquirer.replicas[server][0]
+
+  def _RecordReads(self, reads):
+    """Records the servers and min_sequence of the reads made."""
+    original = http_data_store.DataServerConnection.SyncAndMakeRequest
+
+    def SyncAndMakeRequest(connection, command):
+      reads.append((connection.server, command.request.min_sequence))
+      return original(connection, command)
+
+    return utils.Stubber(http_data_store.DataServerConnection,
+                         "SyncAndMakeRequest", SyncAndMakeRequest)
+
+  def _Resolve(self):
+    return data_store.DB.Resolve(self.test_row, "metadata:predicate",
+                                 token=self.token)[0]
+
+  def testReplicaReads(self):
+    # The test data server has no change log, so it serves as its own replica.
+    server, replica = self._UseReplica(PORT)
+    self.assertFalse(replica.connections)
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+
+    reads = []
+    with self._RecordReads(reads):
+      self.assertEqual(self._Resolve(), "value")
+      with data_store.DB.PrimaryReads():
+        self.assertEqual(self._Resolve(), "value")
+
+    self.assertEqual([target for target, _ in reads], [replica, server])
+
+  def testReplicaReadsSeeOwnWrites(self):
+    server, replica = self._UseReplica(PORT)
+    server.UpdateSequence(42)
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+    session_token = data_store.DB.SessionToken()
+    self.assertEqual(session_token, {0: 42})
+
+    reads = []
+
+    def ReadInThread(token):
+      if token:
+        data_store.DB.ResumeSession(token)
+      self._Resolve()
+
+    with self._RecordReads(reads):
+      self._Resolve()
+      for token in [None, session_token]:
+        thread = threading.Thread(target=ReadInThread, args=(token,))
+        thread.start()
+        thread.join()
+
+    # Other threads only wait for our writes once they resume our session.
+    self.assertEqual(reads, [(replica, 42), (replica, 0), (replica, 42)])
+
+  def _CheckReplicaFallback(self, port):
+    server, replica = self._UseReplica(port)
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+
+    # Reads do not wait for the replica to come back.
+    started = time.time()
+    self.assertEqual(self._Resolve(), "value")
+    self.assertTrue(time.time() - started < config_lib.CONFIG[
+        "HTTPDataStore.retry_time"])
+    self.assertFalse(replica.IsAvailable())
+
+    # The replica gets no reads while it is down.
+    reads = []
+    with self._RecordReads(reads):
+      self.assertEqual(self._Resolve(), "value")
+      results = dict(data_store.DB.MultiResolveRegex(
+          [self.test_row], "metadata:predicate", token=self.token))
+    self.assertEqual(results[self.test_row][0][1], "value")
+    self.assertEqual(reads, [(server, 0)])
+
+    # After a while it is tried again.
+    replica.down_until = 0
+    self.assertTrue(replica.IsAvailable())
+    self.assertEqual(self._Resolve(), "value")
+    self.assertFalse(replica.IsAvailable())
+
+  def testUnreachableReplica(self):
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    # Nothing listens on the port.
+    sock.close()
+    self._CheckReplicaFallback(port)
+
+  def testUnresponsiveReplica(self):
+    config_lib.CONFIG.Set("HTTPDataStore.replica_connect_timeout", 1)
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    # Connections are accepted by the kernel but never answered.
+    sock.listen(5)
+    try:
+      self._CheckReplicaFallback(sock.getsockname()[1])
+    finally:
+      sock.close()
+
 
 class HTTPDataStoreBenchmarks(HTTPDataStoreMixin,
                               data_store_test.DataStoreBenchmarks):
@@ -0,0 +1,674 @@
+#!/usr/bin/env python
+"""An in-memory data store for busy tests and single node deployments.
+
+Unlike the FakeDataStore, subjects are spread over shards by their hash and
+every shard is guarded by its own lock, so threads working on different
+subjects rarely wait for each other. The attributes of a subject are kept
+sorted, which turns attribute regexes with a literal prefix into range scans,
+and the versions of an attribute are kept sorted by timestamp in packed arrays.
+
+The contents of the data store can be snapshotted to a file which is mapped
+into memory and loaded on startup.
+"""
+
+
+import array
+import atexit
+import bisect
+import logging
+import marshal
+import mmap
+import os
+import re
+import struct
+import sys
+import threading
+import time
+
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import utils
+from grr.lib.data_stores import common
+
+# Snapshot files start with this marker. It is followed by the marshalled
+# subjects of every shard, each prefixed with its length.
+SNAPSHOT_MARKER = "GRRMEMORY1"
+
+_SNAPSHOT_LENGTH = struct.Struct("<Q")
+
+# Timestamps are stored as 64 bit integers where the platform has them, doubles
+# represent microsecond timestamps exactly as well.
+TIMESTAMP_TYPECODE = "l" if array.array("l").itemsize >= 8 else "d"
+
+# Attribute regexes planned by PlanAttributeRegex().
+_REGEX_PLANS = utils.FastStore(max_size=1000)
+
+
+def PlanAttributeRegex(regex):
+  """Plans how to find the attributes matching a regex.
+
+  Args:
+    regex: The attribute regex.
+
+  Returns:
+    A tuple of the literal prefix of all matching attributes and the compiled
+    regex, or None if all attributes with the prefix match.
+  """
+  regex = utils.SmartStr(regex)
+  try:
+    return _REGEX_PLANS.Get(regex)
+  except KeyError:
+    pass
+
+  prefix, rest = common.SplitLiteralPrefix(regex)
+  if rest in ("", ".*"):
+    plan = (utils.SmartUnicode(prefix), None)
+  else:
+    plan = (utils.SmartUnicode(prefix), re.compile(regex, re.DOTALL))
+
+  _REGEX_PLANS.Put(regex, plan)
+  return plan
+
+
+class MemoryVersions(object):
+  """The versions of an attribute, sorted by timestamp."""
+
+  __slots__ = ("timestamps", "values")
+
+  def __init__(self, timestamps=None, values=None):
+    if timestamps is None:
+      timestamps = array.array(TIMESTAMP_TYPECODE)
+    self.timestamps = timestamps
+    self.values = values or []
+
+  def Add(self, value, timestamp):
+    # Versions with the same timestamp are kept in the order they were added.
+    i = bisect.bisect_right(self.timestamps, timestamp)
+    self.timestamps.insert(i, timestamp)
+    self.values.insert(i, value)
+
+  def _Slice(self, start, end):
+    i = 0 if start is None else bisect.bisect_left(self.timestamps, start)
+    j = (len(self.timestamps) if end is None else
+         bisect.bisect_right(self.timestamps, end))
+    return i, j
+
+  def Select(self, start=None, end=None, newest=False):
+    """Returns the (value, timestamp) pairs in a range, newest first."""
+    i, j = self._Slice(start, end)
+    if newest:
+      i = max(i, j - 1)
+
+    return [(self.values[k], int(self.timestamps[k]))
+            for k in xrange(j - 1, i - 1, -1)]
+
+  def Delete(self, start=None, end=None):
+    i, j = self._Slice(start, end)
+    del self.timestamps[i:j]
+    del self.values[i:j]
+
+  def Expire(self, policy):
+    """Deletes the versions which a retention policy doesn't keep."""
+    expired = policy.Expired(self.timestamps)
+    if expired is not None:
+      self.Delete(None, expired)
+
+  def Dump(self):
+    return self.timestamps.tostring(), self.values
+
+  @classmethod
+  def Load(cls, dumped):
+    timestamps = array.array(TIMESTAMP_TYPECODE)
+    timestamps.fromstring(dumped[0])
+    return cls(timestamps, dumped[1])
+
+  def __len__(self):
+    return len(self.timestamps)
+
+
+class MemoryRecord(object):
+  """The attributes of a subject, sorted by name."""
+
+  __slots__ = ("names", "versions")
+
+  def __init__(self):
+    self.names = []
+    self.versions = {}
+
+  def Get(self, attribute):
+    """Returns the versions of an attribute, adding it if needed."""
+    try:
+      return self.versions[attribute]
+    except KeyError:
+      bisect.insort(self.names, attribute)
+      versions = self.versions[attribute] = MemoryVersions()
+      return versions
+
+  def Remove(self, attribute):
+    if self.versions.pop(attribute, None) is not None:
+      del self.names[bisect.bisect_left(self.names, attribute)]
+
+  def Matching(self, attribute_regexes):
+    """Returns the sorted names of the attributes matching any of the regexes.
+
+    Only the range of attributes starting with the literal prefix of a regex is
+    checked.
+
+    Args:
+      attribute_regexes: A list of attribute regexes.
+
+    Returns:
+      A sorted list of attribute names.
+    """
+    matching = set()
+    for regex in attribute_regexes:
+      prefix, compiled = PlanAttributeRegex(regex)
+      for i in xrange(bisect.bisect_left(self.names, prefix), len(self.names)):
+        attribute = self.names[i]
+        if not attribute.startswith(prefix):
+          break
+
+        if compiled is None or compiled.match(utils.SmartStr(attribute)):
+          matching.add(attribute)
+
+    return sorted(matching)
+
+  def Dump(self):
+    return dict((attribute, versions.Dump())
+                for attribute, versions in self.versions.iteritems())
+
+  @classmethod
+  def Load(cls, dumped, intern_name):
+    record = cls()
+    for attribute, versions in dumped.iteritems():
+      attribute = intern_name(attribute)
+      record.versions[attribute] = MemoryVersions.Load(versions)
+    record.names = sorted(record.versions)
+    return record
+
+  def __len__(self):
+    return len(self.names)
+
+
+class MemoryShard(object):
+  """A part of the subjects of the data store with its own lock."""
+
+  def __init__(self):
+    # All access to the subjects of this shard must hold this lock.
+    self.lock = threading.RLock()
+    self.subjects = {}
+    # The transactions in flight on the subjects of this shard.
+    self.transactions = {}
+
+
+class MemoryTransaction(data_store.CommonTransaction):
+  """A transaction on a subject of the memory data store."""
+
+  def __init__(self, store, subject, lease_time=None, token=None):
+    super(MemoryTransaction, self).__init__(store, subject,
+                                            lease_time=lease_time, token=token)
+    self.locked = False
+    if lease_time is None:
+      lease_time = config_lib.CONFIG["Datastore.transaction_timeout"]
+
+    self.expires = time.time() + lease_time
+    self.shard = store.Shard(subject)
+
+    with self.shard.lock:
+      expires = self.shard.transactions.get(subject)
+      if expires and time.time() < expires:
+        raise data_store.TransactionError("Subject is locked")
+
+      self.shard.transactions[subject] = self.expires
+      self.locked = True
+
+  def UpdateLease(self, duration):
+    self.expires = time.time() + duration
+    with self.shard.lock:
+      self.shard.transactions[self.subject] = self.expires
+
+  def Abort(self):
+    self.Unlock()
+
+  def Commit(self):
+    super(MemoryTransaction, self).Commit()
+    self.Unlock()
+
+  def Unlock(self):
+    with self.shard.lock:
+      if self.locked:
+        self.shard.transactions.pop(self.subject, None)
+        self.locked = False
+
+
+class MemoryDataStore(data_store.DataStore):
+  """An in-memory data store with sharded locks and optional snapshots."""
+
+  def __init__(self):
+    self.shards = [MemoryShard()
+                   for _ in xrange(config_lib.CONFIG["MemoryDatastore.shards"])]
+    # Attribute names are shared by all subjects which have them.
+    self.names = {}
+
+    # Serializes snapshots. Set whenever the data changed since the last one.
+    self.snapshot_lock = threading.Lock()
+    self.dirty = False
+    self.last_snapshot = time.time()
+
+    super(MemoryDataStore, self).__init__()
+
+  def Initialize(self):
+    """Loads the snapshot and makes sure a new one is written on exit."""
+    path = config_lib.CONFIG["MemoryDatastore.snapshot_path"]
+    if not path:
+      return
+
+    if os.path.exists(path):
+      logging.info("Loaded %d subjects from %s.", self.Restore(path), path)
+
+    atexit.register(self.Snapshot)
+
+  def Shard(self, subject):
+    """Returns the shard which holds a subject."""
+    return self.shards[hash(utils.SmartUnicode(subject)) % len(self.shards)]
+
+  def _InternName(self, attribute):
+    attribute = utils.SmartUnicode(attribute)
+    return self.names.setdefault(attribute, attribute)
+
+  def _Encode(self, value):
+    """Encodes a value into one of the types stored by the data store.
+
+    Integers, floats and strings are kept, anything else is serialized.
+
+    Args:
+       value: The value to be encoded.
+
+    Returns:
+      An encoded value.
+    """
+    if isinstance(value, (basestring, int, long, float)):
+      return value
+
+    try:
+      return value.SerializeToDataStore()
+    except AttributeError:
+      try:
+        return value.SerializeToString()
+      except AttributeError:
+        return utils.SmartStr(value)
+
+  def Transaction(self, subject, lease_time=None, token=None):
+    return MemoryTransaction(self, subject, lease_time=lease_time, token=token)
+
+  def Set(self, subject, attribute, value, timestamp=None, token=None,
+          replace=True, sync=True):
+    """Set the value into the data store."""
+    # Values are never interpreted as (value, timestamp) tuples here.
+    self.MultiSet(subject, {attribute: [(value, None)]},
+                  timestamp=timestamp, replace=replace, sync=sync, token=token)
+
+  def MultiSet(self, subject, values, timestamp=None, replace=True, sync=True,
+               to_delete=None, token=None):
+    """Set multiple values at once."""
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      self._MultiSet(shard, subject, values, timestamp, replace, to_delete)
+
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Set values of many subjects, taking the lock of every shard once."""
+    _ = sync
+    to_delete = to_delete or {}
+    subjects = set(values) | set(to_delete)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    by_shard = {}
+    for subject in subjects:
+      shard = self.Shard(subject)
+      by_shard.setdefault(id(shard), (shard, []))[1].append(subject)
+
+    for shard, shard_subjects in by_shard.itervalues():
+      with shard.lock:
+        for subject in shard_subjects:
+          self._MultiSet(shard, utils.SmartUnicode(subject),
+                         values.get(subject, {}), timestamp, replace,
+                         to_delete.get(subject))
+
+  def _MultiSet(self, shard, subject, values, timestamp, replace, to_delete):
+    """Writes the values of a subject, the shard must be locked."""
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1000000
+
+    record = shard.subjects.get(subject)
+    if record is None:
+      record = shard.subjects[subject] = MemoryRecord()
+
+    for attribute in to_delete or []:
+      record.Remove(utils.SmartUnicode(attribute))
+
+    for attribute, seq in values.iteritems():
+      if not seq:
+        continue
+
+      attribute = self._InternName(attribute)
+      if replace:
+        record.Remove(attribute)
+
+      versions = record.Get(attribute)
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        versions.Add(self._Encode(v), int(element_timestamp))
+
+      # Versions added to attributes with retention policies may make older
+      # ones expire.
+      policy = data_store.RETENTION_POLICIES.get(attribute)
+      if policy and not replace:
+        versions.Expire(policy)
+
+    if not record:
+      del shard.subjects[subject]
+
+    self.dirty = True
+
+  def DeleteAttributes(self, subject, attributes, start=None, end=None,
+                       sync=True, token=None):
+    """Remove some attributes from a subject."""
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      record = shard.subjects.get(subject)
+      if record is None:
+        return
+
+      for attribute in attributes:
+        attribute = utils.SmartUnicode(attribute)
+        if start is None and end is None:
+          record.Remove(attribute)
+          continue
+
+        versions = record.versions.get(attribute)
+        if versions is None:
+          continue
+
+        versions.Delete(int(start or 0),
+                        None if end is None else int(end))
+        if not versions:
+          record.Remove(attribute)
+
+      if not record:
+        del shard.subjects[subject]
+
+      self.dirty = True
+
+  def DeleteSubject(self, subject, sync=False, token=None):
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      if shard.subjects.pop(subject, None) is not None:
+        self.dirty = True
+
+  def Clear(self):
+    for shard in self.shards:
+      with shard.lock:
+        shard.subjects = {}
+    self.dirty = True
+
+  def _TimestampRange(self, timestamp):
+    """Returns the range of timestamps selected and if only the newest is."""
+    if isinstance(timestamp, (list, tuple)):
+      start, end = timestamp  # pylint: disable=unpacking-non-sequence
+      return int(start), int(end), False
+
+    return None, None, timestamp == self.NEWEST_TIMESTAMP
+
+  def ResolveMulti(self, subject, attributes, timestamp=None, limit=None,
+                   token=None):
+    """Resolve multiple attributes for a subject."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attributes))
+
+    if isinstance(attributes, basestring):
+      attributes = [attributes]
+
+    start, end, newest = self._TimestampRange(timestamp)
+    results = []
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      record = shard.subjects.get(subject)
+      if record is None:
+        return results
+
+      for attribute in attributes:
+        versions = record.versions.get(utils.SmartUnicode(attribute))
+        if versions is None:
+          continue
+
+        for value, ts in versions.Select(start, end, newest=newest):
+          results.append((attribute, value, ts))
+          if limit and len(results) >= limit:
+            return results
+
+    return results
+
+  def ResolveRegex(self, subject, attribute_regex, timestamp=None,
+                   limit=None, token=None):
+    """Resolve all attributes for a subject matching a regex."""
+    self.security_manager.CheckDataStoreAccess(
+        token, [subject], self.GetRequiredResolveAccess(attribute_regex))
+
+    if isinstance(attribute_regex, basestring):
+      attribute_regex = [attribute_regex]
+
+    start, end, newest = self._TimestampRange(timestamp)
+    results = []
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      record = shard.subjects.get(subject)
+      if record is None:
+        return results
+
+      for attribute in record.Matching(attribute_regex):
+        for value, ts in record.versions[attribute].Select(start, end,
+                                                           newest=newest):
+          results.append((attribute, value, ts))
+          if limit and len(results) >= limit:
+            return results
+
+    return results
+
+  def MultiResolveRegex(self, subjects, attribute_regex, timestamp=None,
+                        limit=None, token=None):
+    """Result multiple subjects using one or more attribute regexps."""
+    result = {}
+
+    remaining_limit = limit
+    for subject in subjects:
+      values = self.ResolveRegex(subject, attribute_regex, token=token,
+                                 timestamp=timestamp, limit=remaining_limit)
+
+      if values:
+        if remaining_limit:
+          if len(values) >= remaining_limit:
+            result[subject] = values[:remaining_limit]
+            return result.iteritems()
+          else:
+            remaining_limit -= len(values)
+
+        result[subject] = values
+
+    return result.iteritems()
+
+  def EnforceRetention(self, subject, attributes=None, sync=True, token=None):
+    """Deletes the versions which the retention policies don't keep."""
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if attributes is None:
+      attributes = data_store.RETENTION_POLICIES.keys()
+
+    subject = utils.SmartUnicode(subject)
+    shard = self.Shard(subject)
+    with shard.lock:
+      record = shard.subjects.get(subject)
+      if record is None:
+        return
+
+      for attribute, policy in self.RetentionPolicies(attributes).iteritems():
+        versions = record.versions.get(utils.SmartUnicode(attribute))
+        if versions:
+          versions.Expire(policy)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects."""
+    _ = token
+    compacted = 0
+    for shard in self.shards:
+      with shard.lock:
+        for record in shard.subjects.itervalues():
+          policies = self.RetentionPolicies(record.names)
+          for attribute, policy in policies.iteritems():
+            record.versions[attribute].Expire(policy)
+
+          if policies:
+            compacted += 1
+
+    return compacted
+
+  def Flush(self):
+    """Writes a snapshot if the data changed and one is due."""
+    interval = config_lib.CONFIG["MemoryDatastore.snapshot_interval"]
+    if (not self.dirty or not interval or
+        time.time() < self.last_snapshot + interval or
+        not config_lib.CONFIG["MemoryDatastore.snapshot_path"]):
+      return
+
+    try:
+      self.Snapshot()
+    except (IOError, OSError) as e:
+      logging.exception("Writing the data store snapshot failed: %s", e)
+
+  def Snapshot(self, path=None):
+    """Writes the contents of the data store to a snapshot file.
+
+    Every shard is written while holding its lock, writes to the other shards
+    proceed meanwhile. The file is replaced once it is complete.
+
+    Args:
+      path: The snapshot file, by default MemoryDatastore.snapshot_path.
+
+    Returns:
+      The number of subjects written.
+    """
+    path = path or config_lib.CONFIG["MemoryDatastore.snapshot_path"]
+    if not path:
+      return 0
+
+    with self.snapshot_lock:
+      # Writes from now on need another snapshot.
+      self.dirty = False
+
+      subjects = 0
+      temp_path = "%s.tmp" % path
+      try:
+        with open(temp_path, "wb") as fd:
+          fd.write(SNAPSHOT_MARKER)
+          for shard in self.shards:
+            with shard.lock:
+              data = marshal.dumps(dict(
+                  (subject, record.Dump())
+                  for subject, record in shard.subjects.iteritems()))
+              subjects += len(shard.subjects)
+
+            fd.write(_SNAPSHOT_LENGTH.pack(len(data)))
+            fd.write(data)
+
+        os.rename(temp_path, path)
+      except (IOError, OSError):
+        self.dirty = True
+        raise
+
+      self.last_snapshot = time.time()
+
+    return subjects
+
+  def Restore(self, path):
+    """Loads the subjects of a snapshot file.
+
+    Args:
+      path: The snapshot file.
+
+    Returns:
+      The number of subjects loaded.
+
+    Raises:
+      IOError: The file is not a snapshot.
+    """
+    with open(path, "rb") as fd:
+      size = os.fstat(fd.fileno()).st_size
+      if size < len(SNAPSHOT_MARKER):
+        raise IOError("%s is not a data store snapshot." % path)
+
+      mapped = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+
+    subjects = 0
+    try:
+      if mapped[:len(SNAPSHOT_MARKER)] != SNAPSHOT_MARKER:
+        raise IOError("%s is not a data store snapshot." % path)
+
+      offset = len(SNAPSHOT_MARKER)
+      while offset < size:
+        end = offset + _SNAPSHOT_LENGTH.size
+        (length,) = _SNAPSHOT_LENGTH.unpack(mapped[offset:end])
+        offset = end + length
+
+        for subject, dumped in marshal.loads(mapped[end:offset]).iteritems():
+          record = MemoryRecord.Load(dumped, self._InternName)
+          # The number of shards may have changed since the snapshot.
+          shard = self.Shard(subject)
+          with shard.lock:
+            shard.subjects[subject] = record
+          subjects += 1
+    finally:
+      mapped.close()
+
+    return subjects
+
+  def Size(self):
+    total_size = 0
+    for shard in self.shards:
+      with shard.lock:
+        total_size += sys.getsizeof(shard.subjects)
+        for subject, record in shard.subjects.iteritems():
+          total_size += sys.getsizeof(subject) + sys.getsizeof(record.names)
+          total_size += sys.getsizeof(record.versions)
+          for versions in record.versions.itervalues():
+            total_size += sys.getsizeof(versions.timestamps)
+            total_size += sys.getsizeof(versions.values)
+            for value in versions.values:
+              total_size += sys.getsizeof(value)
+
+    # Attribute names are shared by all subjects.
+    for attribute in self.names:
+      total_size += sys.getsizeof(attribute)
+
+    return total_size
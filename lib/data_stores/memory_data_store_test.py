@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+# -*- mode: python; encoding: utf-8 -*-
+"""Tests the memory data store - sharded in memory implementation."""
+
+import os
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import access_control
+from grr.lib import config_lib
+from grr.lib import data_store
+from grr.lib import data_store_test
+from grr.lib import flags
+from grr.lib import server_benchmark_test
+from grr.lib import test_lib
+from grr.lib.data_stores import memory_data_store
+
+# pylint: mode=test
+
+
+class MemoryTestMixin(object):
+
+  def InitDatastore(self):
+    self.token = access_control.ACLToken(username="test",
+                                         reason="Running tests")
+    data_store.DB = memory_data_store.MemoryDataStore()
+    data_store.DB.security_manager = test_lib.MockSecurityManager()
+
+  def testCorrectDataStore(self):
+    self.assertTrue(isinstance(data_store.DB,
+                               memory_data_store.MemoryDataStore))
+
+
+class MemoryDataStoreTest(MemoryTestMixin, data_store_test._DataStoreTest):
+  """Test the memory data store."""
+
+  def testSubjectsAreSharded(self):
+    subjects = ["aff4:/row:%s" % i for i in range(20)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+
+    shards = [shard for shard in data_store.DB.shards if shard.subjects]
+    self.assertGreater(len(shards), 1)
+    self.assertEqual(sum(len(shard.subjects) for shard in shards), 20)
+
+    for subject in subjects:
+      self.assertTrue(subject in data_store.DB.Shard(subject).subjects)
+
+  def testPrefixRegexesAreRangeScans(self):
+    for attribute in ["aff4:type", "aff4:size", "metadata:aff4:x", "aff4s:x"]:
+      data_store.DB.Set(self.test_row, attribute, "value", token=self.token)
+
+    record = data_store.DB.Shard(self.test_row).subjects[self.test_row]
+    self.assertEqual(record.names, sorted(record.names))
+    self.assertEqual(record.Matching(["aff4:.*"]), ["aff4:size", "aff4:type"])
+    self.assertEqual(record.Matching(["aff4:t.*e", "aff4:type"]),
+                     ["aff4:type"])
+
+    self.assertEqual(memory_data_store.PlanAttributeRegex("aff4:.*"),
+                     (u"aff4:", None))
+    prefix, regex = memory_data_store.PlanAttributeRegex("aff4:t.*e")
+    self.assertEqual(prefix, u"aff4:t")
+    self.assertTrue(regex.match("aff4:type"))
+
+  def testSnapshot(self):
+    path = os.path.join(self.temp_dir, "snapshot")
+    data_store.DB.MultiSet(self.test_row,
+                           {"aff4:size": [(1, 100)],
+                            "aff4:stored": [(u"uñîcödé", 200)],
+                            "metadata:predicate": [("1", 100), ("2", 200)]},
+                           replace=False, token=self.token)
+
+    self.assertEqual(data_store.DB.Snapshot(path), 1)
+    self.assertFalse(data_store.DB.dirty)
+
+    store = memory_data_store.MemoryDataStore()
+    store.security_manager = test_lib.MockSecurityManager()
+    self.assertEqual(store.Restore(path), 1)
+    self.assertEqual(
+        store.ResolveRegex(self.test_row, ".*",
+                           timestamp=store.ALL_TIMESTAMPS, token=self.token),
+        [("aff4:size", 1, 100),
+         ("aff4:stored", u"uñîcödé", 200),
+         ("metadata:predicate", "2", 200),
+         ("metadata:predicate", "1", 100)])
+
+    with open(path, "wb") as fd:
+      fd.write("not a snapshot")
+    self.assertRaises(IOError, store.Restore, path)
+
+  def testFlushWritesSnapshots(self):
+    path = os.path.join(self.temp_dir, "snapshot")
+    config_lib.CONFIG.Set("MemoryDatastore.snapshot_path", path)
+    config_lib.CONFIG.Set("MemoryDatastore.snapshot_interval", 10)
+    data_store.DB.Set(self.test_row, "metadata:predicate", "1",
+                      token=self.token)
+
+    # The interval has not passed yet.
+    data_store.DB.Flush()
+    self.assertFalse(os.path.exists(path))
+
+    data_store.DB.last_snapshot -= 10
+    data_store.DB.Flush()
+    self.assertTrue(os.path.exists(path))
+    self.assertFalse(data_store.DB.dirty)
+
+
+class MemoryDataStoreBenchmarks(MemoryTestMixin,
+                                data_store_test.DataStoreBenchmarks):
+  """Benchmark the memory data store."""
+
+
+class MemoryServerBenchmarks(MemoryTestMixin,
+                             server_benchmark_test._ServerBenchmarks):
+  """Benchmark the server on the memory data store."""
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
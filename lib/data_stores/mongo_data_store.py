@@ -114,9 +114,78 @@ class MongoDataStore(data_store.DataStore):
     if timestamp is None:
       timestamp = time.time() * 1e6
 
+    subject = utils.SmartUnicode(subject)
+    documents, latest, to_delete = self._BuildDocuments(
+        subject, values, timestamp, replace, to_delete)
+
+    if to_delete:
+      self.DeleteAttributes(subject, to_delete, token=token)
+
+    self._WriteDocuments(documents, latest, sync)
+
+    # Versions added to attributes with retention policies may make older ones
+    # expire.
+    if not replace:
+      retained = self.RetentionPolicies(values)
+      if retained:
+        self.EnforceRetention(subject, retained, sync=sync, token=token)
+
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Set the values of many subjects with bulk operations."""
+    to_delete = to_delete or {}
+    subjects = set(values) | set(to_delete)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+
+    if timestamp is None:
+      timestamp = time.time() * 1e6
+
+    documents = []
+    latest = []
+    deleted = []
+    for subject in subjects:
+      subject_documents, subject_latest, subject_to_delete = (
+          self._BuildDocuments(utils.SmartUnicode(subject),
+                               values.get(subject, {}), timestamp, replace,
+                               to_delete.get(subject)))
+
+      documents.extend(subject_documents)
+      latest.extend(subject_latest)
+      deleted.extend(
+          dict(subject=utils.SmartUnicode(subject),
+               predicate=utils.SmartUnicode(attribute))
+          for attribute in subject_to_delete)
+
+    # All versions of the attributes of all subjects are deleted at once.
+    if deleted:
+      spec = {"$or": deleted}
+      self.versioned_collection.remove(spec)
+      self.latest_collection.remove(spec)
+
+    self._WriteDocuments(documents, latest, sync)
+
+    if not replace:
+      for subject, subject_values in values.iteritems():
+        retained = self.RetentionPolicies(subject_values)
+        if retained:
+          self.EnforceRetention(subject, retained, sync=sync, token=token)
+
+  def _BuildDocuments(self, subject, values, timestamp, replace, to_delete):
+    """Builds the documents to write for the values of a subject.
+
+    Args:
+      subject: The subject, as unicode.
+      values: A dict of attributes to values, as taken by MultiSet().
+      timestamp: The default timestamp of the values.
+      replace: Bool whether or not to overwrite current records.
+      to_delete: An array of attributes to clear prior to setting.
+
+    Returns:
+      A tuple of the documents for the versioned collection, those for the
+      latest collection and the set of attributes to delete first.
+    """
     # Prepare a mongo bulk insert for all the values.
     documents = []
-    subject = utils.SmartUnicode(subject)
     to_delete = set(to_delete or [])
 
     latest = {}
@@ -145,23 +214,44 @@ class MongoDataStore(data_store.DataStore):
         if replace:
           to_delete.add(attribute)
 
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete, token=token)
+    return documents, latest.values(), to_delete
+
+  def _WriteDocuments(self, documents, latest, sync):
+    """Writes the documents built by _BuildDocuments()."""
+    if not documents:
+      return
 
     # Just write using bulk insert mode.
-    if documents:
-      try:
-        self.versioned_collection.insert(documents, w=1 if sync else 0)
-      except errors.PyMongoError as e:
-        logging.error("Mongo Error %s", e)
-        raise data_store.Error(utils.SmartUnicode(e))
-
-      # Maintain the latest documents in the latest collection.
-      for attribute, document in latest.items():
-        document.pop("_id", None)
-        self.latest_collection.update(
-            dict(subject=subject, predicate=attribute, prefix=prefix),
-            document, upsert=True, w=1 if sync else 0)
+    try:
+      self.versioned_collection.insert(documents, w=1 if sync else 0)
+    except errors.PyMongoError as e:
+      logging.error("Mongo Error %s", e)
+      raise data_store.Error(utils.SmartUnicode(e))
+
+    # Maintain the latest documents in the latest collection.
+    for document in latest:
+      document.pop("_id", None)
+      self.latest_collection.update(
+          dict(subject=document["subject"], predicate=document["predicate"],
+               prefix=document["prefix"]),
+          document, upsert=True, w=1 if sync else 0)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects which need it."""
+    compacted = 0
+    for attribute, policy in data_store.RETENTION_POLICIES.items():
+      spec = dict(predicate=utils.SmartUnicode(attribute))
+
+      # Without a version limit only subjects with old versions are checked.
+      oldest_timestamp = policy.OldestTimestamp()
+      if not policy.max_versions and oldest_timestamp is not None:
+        spec["timestamp"] = {"$lt": oldest_timestamp}
+
+      for subject in self.versioned_collection.distinct("subject", spec):
+        self.EnforceRetention(subject, [attribute], token=token)
+        compacted += 1
+
+    return compacted
 
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
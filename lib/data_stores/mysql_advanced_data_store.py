@@ -4,8 +4,8 @@
 """An implementation of a data store based on mysql."""
 
 
+import hashlib
 import Queue
-import re
 import thread
 import threading
 import time
@@ -18,7 +18,9 @@ from grr.lib import aff4
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
+from grr.lib import stats
 from grr.lib import utils
+from grr.lib.data_stores import common
 
 
 # pylint: disable=nonstandard-exception
@@ -27,6 +29,72 @@ class Error(data_store.Error):
 # pylint: enable=nonstandard-exception
 
 
+# The conditions selecting the attributes of each kind of attribute regex.
+_ATTRIBUTE_CONDITIONS = {
+    "all": "",
+    "exact": " AND aff4.attribute_hash=unhex(md5(%s))",
+    "prefix": " AND attributes.attribute LIKE %s",
+    "prefix_rlike": (" AND attributes.attribute LIKE %s"
+                     " AND attributes.attribute RLIKE %s"),
+    "rlike": " AND attributes.attribute RLIKE %s",
+}
+
+# Attribute regexes planned by PlanAttributeRegex().
+_REGEX_PLANS = utils.FastStore(max_size=1000)
+
+# The SELECT queries built by MySQLAdvancedDataStore._BuildQuery() by query
+# shape. There are only a few shapes for every number of subjects.
+_QUERIES = {}
+
+
+def EscapeLike(literal):
+  """Escapes the wildcards of a LIKE pattern in a literal string."""
+  return literal.replace("\\", "\\\\").replace("%", "\\%").replace(
+      "_", "\\_")
+
+
+def PlanAttributeRegex(regex):
+  """Plans how to select the attributes matching an attribute regex.
+
+  Most attribute regexes are a literal prefix, e.g. "aff4:.*" or
+  "index:dir/.*". These become a LIKE 'prefix%' range scan of the attribute
+  index. Other regexes are also filtered with RLIKE, which can't use an index.
+  Literal regexes select the attribute by its hash.
+
+  Args:
+    regex: The attribute regex.
+
+  Returns:
+    A tuple of the kind of condition in _ATTRIBUTE_CONDITIONS and its
+    arguments.
+  """
+  try:
+    return _REGEX_PLANS.Get(regex)
+  except KeyError:
+    pass
+
+  prefix, rest = common.SplitLiteralPrefix(regex)
+  if not rest:
+    plan = ("exact", [prefix])
+  elif rest in (".*", ".+"):
+    if prefix:
+      # The LIKE wildcard "_" matches the one character ".+" requires.
+      wildcard = "%" if rest == ".*" else "_%"
+      plan = ("prefix", [EscapeLike(prefix) + wildcard])
+    else:
+      plan = ("all", [])
+  else:
+    # Attribute regexes are matched at the start while RLIKE searches.
+    rlike = "^(%s)" % regex
+    if prefix:
+      plan = ("prefix_rlike", [EscapeLike(prefix) + "%", rlike])
+    else:
+      plan = ("rlike", [rlike])
+
+  _REGEX_PLANS.Put(regex, plan)
+  return plan
+
+
 class MySQLConnection(object):
   """A Class to manage MySQL database connections."""
 
@@ -120,6 +188,12 @@ class MySQLAdvancedDataStore(data_store.DataStore):
   POOL = None
   SYSTEM_TABLE = "system"
 
+  # The data store types of the AFF4 attributes, shared by all instances.
+  attribute_types = {}
+
+  # The maximum number of subjects read by a single query.
+  subjects_per_query = 100
+
   def __init__(self):
     # Use the global connection pool.
     if MySQLAdvancedDataStore.POOL is None:
@@ -127,10 +201,14 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     self.pool = self.POOL
 
     self.to_insert = []
-    self._CalculateAttributeStorageTypes()
     self.database_name = config_lib.CONFIG["Mysql.database_name"]
     self.lock = threading.Lock()
 
+    # The latency of the SELECT queries by query shape.
+    stats.STATS.RegisterEventMetric("mysql_advanced_query_latency",
+                                    units="SECONDS",
+                                    fields=[("shape", str)])
+
     super(MySQLAdvancedDataStore, self).__init__()
 
   def Initialize(self):
@@ -196,8 +274,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
         token, [subject], self.GetRequiredResolveAccess(attributes))
 
     for attribute in attributes:
-      query, args = self._BuildQuery(subject, attribute, timestamp, limit)
-      result = self._ExecuteQuery(query, args)
+      result = self._ExecuteSelect(
+          *self._BuildQuery([subject], attribute, timestamp, limit))
 
       for row in result:
         value = self._Decode(attribute, row["value"])
@@ -215,17 +293,42 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     """Result multiple subjects using one or more attribute regexps."""
     result = {}
 
-    for subject in subjects:
-      values = self.ResolveRegex(subject, attribute_regex, token=token,
-                                 timestamp=timestamp, limit=limit)
+    if limit:
+      # The limit applies to the subjects in order, so read them one by one.
+      for subject in subjects:
+        values = self.ResolveRegex(subject, attribute_regex, token=token,
+                                   timestamp=timestamp, limit=limit)
 
-      if values:
-        result[subject] = values
-        if limit:
+        if values:
+          result[subject] = values
           limit -= len(values)
 
-      if limit is not None and limit <= 0:
-        break
+        if limit <= 0:
+          break
+
+      return result.iteritems()
+
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(
+        token, subjects, self.GetRequiredResolveAccess(attribute_regex))
+
+    if isinstance(attribute_regex, basestring):
+      attribute_regex = [attribute_regex]
+
+    # Otherwise many subjects are read with every query.
+    for i in xrange(0, len(subjects), self.subjects_per_query):
+      batch = subjects[i:i + self.subjects_per_query]
+      subjects_by_hash = dict(
+          (hashlib.md5(utils.SmartStr(subject)).digest(), subject)
+          for subject in batch)
+
+      for regex in attribute_regex:
+        for row in self._ExecuteSelect(
+            *self._BuildQuery(batch, regex, timestamp, is_regex=True)):
+          attribute = row["attribute"]
+          value = self._Decode(attribute, row["value"])
+          result.setdefault(subjects_by_hash[row["subject_hash"]], []).append(
+              (attribute, value, row["timestamp"]))
 
     return result.iteritems()
 
@@ -241,9 +344,8 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     results = []
 
     for regex in attribute_regex:
-      query, args = self._BuildQuery(subject, regex, timestamp, limit,
-                                     is_regex=True)
-      rows = self._ExecuteQuery(query, args)
+      rows = self._ExecuteSelect(
+          *self._BuildQuery([subject], regex, timestamp, limit, is_regex=True))
 
       for row in rows:
         attribute = row["attribute"]
@@ -256,12 +358,86 @@ class MySQLAdvancedDataStore(data_store.DataStore):
                to_delete=None, token=None):
     """Set multiple attributes' values for this subject in one operation."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
-    to_delete = set(to_delete or [])
     if timestamp is None:
       timestamp = time.time() * 1e6
 
-    # Prepare a bulk insert operation.
     subject = utils.SmartUnicode(subject)
+    to_delete, to_insert, to_replace = self._PrepareMultiSet(
+        subject, values, timestamp, replace, to_delete)
+
+    if to_delete:
+      self.DeleteAttributes(subject, to_delete, token=token)
+
+    self._WriteRows(to_insert, to_replace, sync)
+
+    # Versions added to attributes with retention policies may make older ones
+    # expire.
+    if not replace:
+      retained = self.RetentionPolicies(values)
+      if retained:
+        self.EnforceRetention(subject, retained, token=token)
+
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Set the values of many subjects with multi-row statements."""
+    to_delete = to_delete or {}
+    subjects = set(values) | set(to_delete)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+    if timestamp is None:
+      timestamp = time.time() * 1e6
+
+    to_insert = []
+    to_replace = []
+    for subject in subjects:
+      subject_values = values.get(subject, {})
+      subject_to_delete, subject_to_insert, subject_to_replace = (
+          self._PrepareMultiSet(utils.SmartUnicode(subject), subject_values,
+                                timestamp, replace, to_delete.get(subject)))
+
+      if subject_to_delete:
+        self.DeleteAttributes(subject, subject_to_delete, token=token)
+
+      to_insert.extend(subject_to_insert)
+      to_replace.extend(subject_to_replace)
+
+    # The rows of all subjects are written together.
+    self._WriteRows(to_insert, to_replace, sync)
+
+    if not replace:
+      for subject, subject_values in values.iteritems():
+        retained = self.RetentionPolicies(subject_values)
+        if retained:
+          self.EnforceRetention(subject, retained, token=token)
+
+  def _WriteRows(self, to_insert, to_replace, sync):
+    """Writes the rows prepared by _PrepareMultiSet()."""
+    if to_replace:
+      transaction = self._BuildReplaces(to_replace)
+      self._ExecuteTransaction(transaction)
+
+    if to_insert:
+      if sync:
+        transaction = self._BuildInserts(to_insert)
+        self._ExecuteTransaction(transaction)
+      else:
+        with self.lock:
+          self.to_insert.extend(to_insert)
+
+  def _PrepareMultiSet(self, subject, values, timestamp, replace, to_delete):
+    """Prepares the rows to write for the values of a subject.
+
+    Args:
+      subject: The subject, as unicode.
+      values: A dict of attributes to values, as taken by MultiSet().
+      timestamp: The default timestamp of the values.
+      replace: Bool whether or not to overwrite current records.
+      to_delete: An array of attributes to clear prior to setting.
+
+    Returns:
+      A tuple of the set of attributes to delete, the rows to insert and the
+      rows to update in place.
+    """
+    to_delete = set(to_delete or [])
     to_insert = []
     to_replace = []
 
@@ -299,20 +475,60 @@ class MySQLAdvancedDataStore(data_store.DataStore):
           to_insert.append(
               [subject, attribute, data, int(entry_timestamp)])
 
-    if to_delete:
-      self.DeleteAttributes(subject, to_delete, token=token)
+    return to_delete, to_insert, to_replace
 
-    if to_replace:
-      transaction = self._BuildReplaces(to_replace)
-      self._ExecuteTransaction(transaction)
+  def EnforceRetention(self, subject, attributes=None, sync=True, token=None):
+    """Deletes the versions which the retention policies don't keep."""
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if attributes is None:
+      attributes = data_store.RETENTION_POLICIES.keys()
 
-    if to_insert:
-      if sync:
-        transaction = self._BuildInserts(to_insert)
-        self._ExecuteTransaction(transaction)
-      else:
-        with self.lock:
-          self.to_insert.extend(to_insert)
+    subject = utils.SmartUnicode(subject)
+    for attribute, policy in self.RetentionPolicies(attributes).iteritems():
+      attribute = utils.SmartUnicode(attribute)
+
+      # Only the timestamps are needed to find the expired versions.
+      query = ("SELECT timestamp FROM aff4 "
+               "WHERE subject_hash=unhex(md5(%s)) "
+               "AND attribute_hash=unhex(md5(%s))")
+      timestamps = [int(row["timestamp"])
+                    for row in self._ExecuteQuery(query, [subject, attribute])]
+
+      expired = policy.Expired(timestamps)
+      if expired is not None:
+        self._ExecuteTransaction(
+            self._BuildDelete(subject, attribute, (0, expired)))
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects which need it."""
+    compacted = 0
+    for attribute, policy in data_store.RETENTION_POLICIES.items():
+      attribute = utils.SmartUnicode(attribute)
+
+      # Subjects with too many versions or with old versions besides the
+      # newest one.
+      conditions = []
+      args = [attribute]
+      if policy.max_versions:
+        conditions.append("COUNT(*) > %s")
+        args.append(policy.max_versions)
+
+      oldest_timestamp = policy.OldestTimestamp()
+      if oldest_timestamp is not None:
+        conditions.append("(COUNT(*) > 1 AND MIN(aff4.timestamp) < %s)")
+        args.append(oldest_timestamp)
+
+      query = ("SELECT subjects.subject AS subject FROM aff4 "
+               "JOIN subjects ON subjects.hash=aff4.subject_hash "
+               "WHERE aff4.attribute_hash=unhex(md5(%s)) "
+               "GROUP BY aff4.subject_hash HAVING " + " OR ".join(conditions))
+
+      for row in self._ExecuteQuery(query, args):
+        self.EnforceRetention(row["subject"], [attribute], token=token)
+        compacted += 1
+
+    return compacted
 
   def Flush(self):
     with self.lock:
@@ -389,13 +605,18 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       with self.pool.GetConnection() as cursor:
         cursor.Execute(query["query"], query["args"])
 
-  def _CalculateAttributeStorageTypes(self):
-    """Build a mapping between column names and types."""
-    self.attribute_types = {}
+  def _AttributeType(self, attribute):
+    """Returns the data store type of an attribute."""
+    try:
+      return self.attribute_types[attribute]
+    except KeyError:
+      aff4_attribute = aff4.Attribute.PREDICATES.get(attribute)
+      if aff4_attribute is None:
+        return "bytes"
 
-    for attribute in aff4.Attribute.PREDICATES.values():
-      self.attribute_types[attribute.predicate] = (
-          attribute.attribute_type.data_store_type)
+      attribute_type = aff4_attribute.attribute_type.data_store_type
+      self.attribute_types[attribute] = attribute_type
+      return attribute_type
 
   def _Encode(self, value):
     """Encode the value for the attribute."""
@@ -406,7 +627,7 @@ class MySQLAdvancedDataStore(data_store.DataStore):
       return buffer(utils.SmartStr(value))
 
   def _Decode(self, attribute, value):
-    required_type = self.attribute_types.get(attribute, "bytes")
+    required_type = self._AttributeType(attribute)
     if isinstance(value, buffer):
       value = str(value)
     if required_type in ("integer", "unsigned_integer"):
@@ -416,76 +637,105 @@ class MySQLAdvancedDataStore(data_store.DataStore):
     else:
       return value
 
-  def _BuildQuery(self, subject, attribute=None, timestamp=None,
+  def _BuildQuery(self, subjects, attribute=None, timestamp=None,
                   limit=None, is_regex=False):
-    """Build the SELECT query to be executed."""
-    args = []
-    fields = ""
-    criteria = "WHERE aff4.subject_hash=unhex(md5(%s))"
-    args.append(subject)
-    sorting = ""
-    tables = "FROM aff4"
+    """Build the SELECT query to be executed.
 
-    subject = utils.SmartUnicode(subject)
+    The SQL only depends on the shape of the query, so it is built once for
+    every shape and only the arguments are built on every call.
 
-    # Set fields, tables, and criteria and append args
-    if attribute is not None:
-      if is_regex:
-        tables += " JOIN attributes ON aff4.attribute_hash=attributes.hash"
-        regex = re.match(r"(^[a-zA-Z0-9_\- /:]+)(.*)", attribute)
-        if not regex:
-          # If attribute has no prefix just rlike
-          criteria += " AND attributes.attribute rlike %s"
-          args.append(attribute)
-        else:
-          rlike = regex.groups()[1]
-
-          if rlike:
-             # If there is a regex component attempt to replace with like
-            like = regex.groups()[0] + "%"
-            criteria += " AND attributes.attribute like %s"
-            args.append(like)
-
-            # If the regex portion is not a match all regex then add rlike
-            if not (rlike == ".*" or rlike == ".+"):
-              criteria += " AND attributes.attribute rlike %s"
-              args.append(rlike)
-          else:
-            # If no regex component then treat as full attribute
-            criteria += " AND aff4.attribute_hash=unhex(md5(%s))"
-            args.append(attribute)
-      else:
-        criteria += " AND aff4.attribute_hash=unhex(md5(%s))"
-        args.append(attribute)
+    Args:
+      subjects: A list of subjects to read.
+      attribute: An attribute or, if is_regex is set, an attribute regex.
+      timestamp: A range of times for consideration.
+      limit: The maximum number of values to read.
+      is_regex: Whether attribute is a regex.
+
+    Returns:
+      A tuple of the query shape, the query and its arguments.
+    """
+    subjects = [utils.SmartUnicode(subject) for subject in subjects]
+    args = list(subjects)
+
+    if attribute is None:
+      attribute_kind = "all"
+    elif is_regex:
+      attribute_kind, attribute_args = PlanAttributeRegex(
+          utils.SmartUnicode(attribute))
+      args.extend(attribute_args)
+    else:
+      attribute_kind = "exact"
+      args.append(attribute)
 
-    # Limit to time range if specified
     if isinstance(timestamp, (tuple, list)):
-      criteria += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
+      timestamp_kind = "range"
       args.append(int(timestamp[0]))
       args.append(int(timestamp[1]))
+    elif timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp_kind = "newest"
+      args.extend(subjects)
+    else:
+      timestamp_kind = "all"
+
+    if limit:
+      args.append(int(limit))
+
+    shape = ":".join(["regex" if is_regex else "attribute", attribute_kind,
+                      timestamp_kind, "limit" if limit else "all"])
+    key = (shape, len(subjects))
+    try:
+      query = _QUERIES[key]
+    except KeyError:
+      query = _QUERIES[key] = self._BuildQuerySQL(
+          len(subjects), attribute_kind, timestamp_kind, limit, is_regex)
+
+    return (shape, query, args)
+
+  def _BuildQuerySQL(self, nr_subjects, attribute_kind, timestamp_kind, limit,
+                     is_regex):
+    """Builds the SQL of a SELECT query shape."""
+    fields = "aff4.subject_hash, aff4.value, aff4.timestamp"
+    tables = "FROM aff4"
+    subject_criteria = "WHERE aff4.subject_hash IN (%s)" % ", ".join(
+        ["unhex(md5(%s))"] * nr_subjects)
+    sorting = ""
 
-    fields = "aff4.value, aff4.timestamp"
     if is_regex:
       fields += ", attributes.attribute"
+      tables += " JOIN attributes ON aff4.attribute_hash=attributes.hash"
+
+    criteria = subject_criteria + _ATTRIBUTE_CONDITIONS[attribute_kind]
+
+    # Limit to time range if specified
+    if timestamp_kind == "range":
+      criteria += " AND aff4.timestamp >= %s AND aff4.timestamp <= %s"
 
     # Modify fields and sorting for timestamps.
-    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
-      tables += (" JOIN (SELECT attribute_hash, MAX(timestamp) timestamp "
-                 "%s %s GROUP BY attribute_hash) maxtime ON "
+    if timestamp_kind == "newest":
+      tables += (" JOIN (SELECT aff4.subject_hash, aff4.attribute_hash, "
+                 "MAX(aff4.timestamp) timestamp %s %s "
+                 "GROUP BY aff4.subject_hash, aff4.attribute_hash) maxtime ON "
+                 "aff4.subject_hash=maxtime.subject_hash AND "
                  "aff4.attribute_hash=maxtime.attribute_hash AND "
                  "aff4.timestamp=maxtime.timestamp") % (tables, criteria)
-      criteria = "WHERE aff4.subject_hash=unhex(md5(%s))"
-      args.append(subject)
+      criteria = subject_criteria
     else:
       # Always order results.
       sorting = "ORDER BY aff4.timestamp DESC"
     # Add limit if set.
     if limit:
-      sorting += " LIMIT %s" % int(limit)
+      sorting += " LIMIT %s"
 
-    query = " ".join(["SELECT", fields, tables, criteria, sorting])
+    return " ".join(["SELECT", fields, tables, criteria, sorting])
 
-    return (query, args)
+  def _ExecuteSelect(self, shape, query, args):
+    """Executes a query built by _BuildQuery() and records its latency."""
+    start_time = time.time()
+    try:
+      return self._ExecuteQuery(query, args)
+    finally:
+      stats.STATS.RecordEvent("mysql_advanced_query_latency",
+                              time.time() - start_time, fields=[shape])
 
   def _BuildDelete(self, subject, attribute=None, timestamp=None):
     """Build the DELETE query to be executed."""
@@ -14,7 +14,9 @@ from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 from grr.lib.data_stores import mysql_advanced_data_store
 
 
@@ -48,6 +50,65 @@ class MysqlAdvancedDataStoreTest(
     MysqlAdvancedTestMixin, data_store_test._DataStoreTest):
   """Test the mysql data store abstraction."""
 
+  def testMultiResolveRegexIsBatched(self):
+    subjects = ["aff4:/batched/%d" % i for i in range(25)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+
+    queries = []
+    original_execute_select = data_store.DB._ExecuteSelect
+
+    def ExecuteSelect(shape, query, args):
+      queries.append(shape)
+      return original_execute_select(shape, query, args)
+
+    with utils.MultiStubber((data_store.DB, "subjects_per_query", 10),
+                            (data_store.DB, "_ExecuteSelect", ExecuteSelect)):
+      results = dict(data_store.DB.MultiResolveRegex(
+          subjects, "metadata:.*", token=self.token))
+
+    self.assertEqual(queries, ["regex:prefix:newest:all"] * 3)
+    self.assertEqual(len(results), 25)
+    for subject in subjects:
+      self.assertEqual(results[subject][0][:2],
+                       (u"metadata:predicate", subject))
+
+  def testQueryShapeStatistics(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "hello",
+                      token=self.token)
+    data_store.DB.Resolve(self.test_row, "metadata:predicate",
+                          token=self.token)
+    data_store.DB.ResolveRegex(self.test_row, "metadata:pre.*",
+                               timestamp=data_store.DB.ALL_TIMESTAMPS,
+                               token=self.token)
+
+    shapes = [fields[0] for fields in stats.STATS.GetMetricFields(
+        "mysql_advanced_query_latency")]
+    self.assertTrue("attribute:exact:newest:all" in shapes)
+    self.assertTrue("regex:prefix:all:all" in shapes)
+
+
+class PlanAttributeRegexTest(test_lib.GRRBaseTest):
+  """Tests planning attribute regexes as index scans."""
+
+  def testPlanAttributeRegex(self):
+    plan = mysql_advanced_data_store.PlanAttributeRegex
+    self.assertEqual(plan("aff4:size"), ("exact", ["aff4:size"]))
+    self.assertEqual(plan("^aff4:size"), ("exact", ["aff4:size"]))
+    self.assertEqual(plan("aff4:.*"), ("prefix", ["aff4:%"]))
+    self.assertEqual(plan("index:dir/.+"), ("prefix", ["index:dir/_%"]))
+    self.assertEqual(plan(".*"), ("all", []))
+
+    # LIKE wildcards in the prefix are escaped.
+    self.assertEqual(plan(r"metadata:a_b%c\.d.*"),
+                     ("prefix", [r"metadata:a\_b\%c.d%"]))
+
+    # Other regexes are also matched with RLIKE, anchored like re.match.
+    self.assertEqual(plan("aff4:s.*e"),
+                     ("prefix_rlike", ["aff4:s%", "^(aff4:s.*e)"]))
+    self.assertEqual(plan("aff4:(a|b)"), ("rlike", ["^(aff4:(a|b))"]))
+
 
 class MysqlAdvancedDataStoreBenchmarks(
     MysqlAdvancedTestMixin, data_store_test.DataStoreBenchmarks):
@@ -361,6 +361,32 @@ class MySQLDataStore(data_store.DataStore):
         with self.lock:
           self.to_set.extend(to_set)
 
+    # Versions added to attributes with retention policies may make older ones
+    # expire.
+    if not replace:
+      retained = self.RetentionPolicies(values)
+      if retained:
+        self.EnforceRetention(subject, retained, token=token)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies for all subjects which need it."""
+    compacted = 0
+    for attribute in data_store.RETENTION_POLICIES.keys():
+      attribute = utils.SmartUnicode(attribute)
+
+      # Only subjects with more than one version can have expired ones.
+      query = ("select subject from `%s` where attribute=%%s "
+               "group by hash having count(*) > 1" % self.table_name)
+      with self.pool.GetConnection() as cursor:
+        subjects = [row["subject"]
+                    for row in cursor.Execute(query, [attribute])]
+
+      for subject in subjects:
+        self.EnforceRetention(subject, [attribute], token=token)
+        compacted += 1
+
+    return compacted
+
   def _MultiSet(self, values):
     if not values:
       return
@@ -32,6 +32,11 @@ SQLITE_DETECT_TYPES = 0
 SQLITE_FACTORY = sqlite3.Connection
 SQLITE_CACHED_STATEMENTS = 20
 SQLITE_PAGE_SIZE = 1024
+# The number of attribute regexes whose query plans are cached.
+SQLITE_REGEX_CACHE_SIZE = 1000
+# The number of subjects read by a single query. SQLite allows at most 999
+# parameters per query.
+SQLITE_SUBJECTS_PER_QUERY = 500
 
 
 class SqliteConnectionCache(utils.FastStore):
@@ -148,11 +153,25 @@ class SqliteConnectionCache(utils.FastStore):
   def KillObject(self, conn):
     conn.Close()
 
-  @utils.Synchronized
   def Get(self, subject):
     """This will create the connection if needed so should not fail."""
     filename, directory = common.ResolveSubjectDestination(subject,
                                                            self.path_regexes)
+    return self.GetFile(directory, filename)
+
+  def GroupByFile(self, subjects):
+    """Returns a dict of (directory, filename) to the subjects in the file."""
+    result = {}
+    for subject in subjects:
+      filename, directory = common.ResolveSubjectDestination(subject,
+                                                             self.path_regexes)
+      result.setdefault((directory, filename), []).append(subject)
+
+    return result
+
+  @utils.Synchronized
+  def GetFile(self, directory, filename):
+    """Returns the connection to a database file, creating it if needed."""
     key = common.MakeDestinationKey(directory, filename)
     try:
       return super(SqliteConnectionCache, self).Get(key)
@@ -177,32 +196,152 @@ class SqliteConnectionCache(utils.FastStore):
       return connection
 
 
+_COMPILED_REGEXES = utils.FastStore(max_size=SQLITE_REGEX_CACHE_SIZE)
+_REGEX_CONDITIONS = utils.FastStore(max_size=SQLITE_REGEX_CACHE_SIZE)
+
+
+def CompileRegex(regex):
+  """Returns the compiled attribute regex, compiling it only once."""
+  try:
+    return _COMPILED_REGEXES.Get(regex)
+  except KeyError:
+    compiled = re.compile(regex, flags=re.DOTALL)
+    _COMPILED_REGEXES.Put(regex, compiled)
+    return compiled
+
+
 def SqliteRegexpFunction(expr, item):
-  reg = re.compile(expr, flags=re.DOTALL)
-  return reg.search(item) is not None
+  return CompileRegex(expr).match(item) is not None
+
+
+def AttributeRegexCondition(regex):
+  """Plans how to select the predicates matching an attribute regex.
+
+  Most attribute regexes are a literal prefix, e.g. "aff4:.*" or
+  "index:dir/.*". These are turned into a range scan of the tbl_index index.
+  Other regexes are also filtered with the REGEXP function.
+
+  Args:
+    regex: The attribute regex.
+
+  Returns:
+    A tuple of the condition to add to the WHERE clause of a query and its
+    arguments.
+  """
+  regex = utils.SmartStr(regex)
+  try:
+    return _REGEX_CONDITIONS.Get(regex)
+  except KeyError:
+    pass
+
+  prefix, rest = common.SplitLiteralPrefix(regex)
+
+  condition = ""
+  args = ()
+  if prefix:
+    # All literal characters are ASCII, so incrementing the last one gives the
+    # smallest string greater than all strings starting with the prefix.
+    condition += " AND predicate >= ? AND predicate < ?"
+    args += (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1))
+
+  if rest not in ("", ".*"):
+    condition += " AND predicate REGEXP ?"
+    args += (regex,)
+
+  _REGEX_CONDITIONS.Put(regex, (condition, args))
+  return condition, args
 
 
 class SqliteConnection(object):
-  """A wrapper around the raw SQLite connection."""
+  """A wrapper around the raw SQLite connection.
+
+  By default all reads and writes use a single connection and every write is
+  committed when the connection is left. In WAL mode the file is kept in
+  write-ahead-log mode instead: reads use separate read only connections and
+  run concurrently with the writer, writes are committed in groups by Sync()
+  or Flush(), and checkpoints are done by Checkpoint() in the background.
+  """
 
   def __init__(self, filename):
     self.filename = filename
-    self.conn = sqlite3.connect(filename, SQLITE_TIMEOUT, SQLITE_DETECT_TYPES,
-                                SQLITE_ISOLATION, False, SQLITE_FACTORY,
-                                SQLITE_CACHED_STATEMENTS)
-    self.conn.text_factory = str
-    self.conn.create_function("REGEXP", 2, SqliteRegexpFunction)
+    self.wal_mode = config_lib.CONFIG["SqliteDatastore.wal_mode"]
+    self.conn = self._Connect()
     self.cursor = self.conn.cursor()
-    self.cursor.execute("PRAGMA synchronous = OFF")
-    self.cursor.execute("PRAGMA journal_mode = OFF")
-    self.cursor.execute("PRAGMA count_changes = OFF")
-    self.cursor.execute("PRAGMA cache_size = 10000")
+    if self.wal_mode:
+      self.cursor.execute("PRAGMA journal_mode = WAL")
+      # Every commit is durable. Group commit keeps the number of syncs low.
+      self.cursor.execute("PRAGMA synchronous = FULL")
+      # Checkpoints are only done by Checkpoint().
+      self.cursor.execute("PRAGMA wal_autocheckpoint = 0")
+    else:
+      self.cursor.execute("PRAGMA synchronous = OFF")
+      self.cursor.execute("PRAGMA journal_mode = OFF")
     self.lock = threading.RLock()
     self.dirty = False
     # Counter for vacuuming purposes.
     self.deleted = 0
     self.next_vacuum_check = config_lib.CONFIG["SqliteDatastore.vacuum_check"]
 
+    # Idle read only connections, only used in WAL mode.
+    self.readers = []
+    self.readers_lock = threading.Lock()
+
+    # Group commit state. Every write leaving the connection increments
+    # write_generation, every commit records the generation it covers.
+    self.write_generation = 0
+    self.committed_generation = 0
+    self.committing = False
+    self.commit_condition = threading.Condition(threading.Lock())
+
+  def _Connect(self):
+    conn = sqlite3.connect(self.filename, SQLITE_TIMEOUT, SQLITE_DETECT_TYPES,
+                           SQLITE_ISOLATION, False, SQLITE_FACTORY,
+                           SQLITE_CACHED_STATEMENTS)
+    conn.text_factory = str
+    conn.create_function("REGEXP", 2, SqliteRegexpFunction)
+    conn.execute("PRAGMA count_changes = OFF")
+    conn.execute("PRAGMA cache_size = 10000")
+    return conn
+
+  def _GetReader(self):
+    with self.readers_lock:
+      if self.readers:
+        return self.readers.pop()
+
+    return self._Connect()
+
+  def _ReleaseReader(self, reader):
+    with self.readers_lock:
+      if (self.conn and len(self.readers) <
+          config_lib.CONFIG["SqliteDatastore.reader_connections"]):
+        self.readers.append(reader)
+        return
+
+    reader.close()
+
+  def _Query(self, query, args=()):
+    """Runs a read only query and returns all the rows.
+
+    In WAL mode the query runs on a reader connection and only sees committed
+    writes. Otherwise it runs on the connection itself.
+
+    Args:
+      query: The SELECT statement.
+      args: The arguments of the statement.
+
+    Returns:
+      A list of rows.
+    """
+    if not self.wal_mode:
+      with self.lock:
+        return self.cursor.execute(query, args).fetchall()
+
+    reader = self._GetReader()
+    try:
+      return reader.execute(query, args).fetchall()
+    finally:
+      self._ReleaseReader(reader)
+
   def Filename(self):
     return self.filename
 
@@ -237,7 +376,6 @@ class SqliteConnection(object):
     self.cursor.execute(query, args)
     self.dirty = True
 
-  @utils.Synchronized
   def GetNewestValue(self, subject, attribute):
     """Returns the newest value for subject/attribute."""
     subject = utils.SmartStr(subject)
@@ -247,14 +385,13 @@ class SqliteConnection(object):
                ORDER BY timestamp DESC
                LIMIT 1"""
     args = (subject, attribute)
-    data = self.cursor.execute(query, args).fetchone()
+    data = self._Query(query, args)
 
     if data:
-      return (data[0], data[1])
+      return (data[0][0], data[0][1])
     else:
       return None
 
-  @utils.Synchronized
   def GetNewestFromRegex(self, subject, regex, limit=None):
     """Returns the newest values for attributes that match 'regex'.
 
@@ -267,21 +404,20 @@ class SqliteConnection(object):
      A list of the form (attribute, value, timestamp).
     """
     subject = utils.SmartStr(subject)
+    condition, condition_args = AttributeRegexCondition(regex)
     query = """SELECT predicate, MAX(timestamp), value FROM tbl
-               WHERE subject = ? AND predicate REGEXP ?
-               GROUP BY predicate"""
+               WHERE subject = ?%s
+               GROUP BY predicate""" % condition
 
+    args = (subject,) + condition_args
     if limit:
       query += " LIMIT ?"
-      args = (subject, regex, limit)
-    else:
-      args = (subject, regex)
+      args += (limit,)
 
     # Reorder columns.
-    data = self.cursor.execute(query, args).fetchall()
+    data = self._Query(query, args)
     return [(pred, val, ts) for pred, ts, val in data]
 
-  @utils.Synchronized
   def GetValuesFromRegex(self, subject, regex, start, end, limit=None):
     """Returns the values of the attributes that match 'regex'.
 
@@ -296,20 +432,74 @@ class SqliteConnection(object):
      A list of the form (attribute, value, timestamp).
     """
     subject = utils.SmartStr(subject)
+    condition, condition_args = AttributeRegexCondition(regex)
     query = """SELECT predicate, value, timestamp FROM tbl
-               WHERE subject = ? AND predicate REGEXP ?
+               WHERE subject = ?%s
                      AND timestamp >= ? AND timestamp <= ?
-                     ORDER BY timestamp DESC"""
+                     ORDER BY timestamp DESC""" % condition
+
+    args = (subject,) + condition_args + (start, end)
     if limit:
       query += " LIMIT ?"
-      args = (subject, regex, start, end, limit)
-    else:
-      args = (subject, regex, start, end)
+      args += (limit,)
 
-    data = self.cursor.execute(query, args).fetchall()
-    return data
+    return self._Query(query, args)
+
+  def GetNewestFromRegexMulti(self, subjects, regex):
+    """Returns the newest values of many subjects' attributes matching regex.
+
+    Args:
+     subjects: A list of subjects.
+     regex: The attribute regex.
+
+    Returns:
+     A list of the form (subject, attribute, value, timestamp).
+    """
+    condition, condition_args = AttributeRegexCondition(regex)
+    subjects = [utils.SmartStr(subject) for subject in subjects]
+
+    result = []
+    for i in xrange(0, len(subjects), SQLITE_SUBJECTS_PER_QUERY):
+      batch = subjects[i:i + SQLITE_SUBJECTS_PER_QUERY]
+      query = """SELECT subject, predicate, MAX(timestamp), value FROM tbl
+                 WHERE subject IN (%s)%s
+                 GROUP BY subject, predicate""" % (
+                     ", ".join("?" * len(batch)), condition)
+
+      data = self._Query(query, tuple(batch) + condition_args)
+      result.extend((subj, pred, val, ts) for subj, pred, ts, val in data)
+
+    return result
+
+  def GetValuesFromRegexMulti(self, subjects, regex, start, end):
+    """Returns the values of many subjects' attributes matching regex.
+
+    Args:
+     subjects: A list of subjects.
+     regex: The attribute regex.
+     start: The start timestamp.
+     end: The end timestamp.
+
+    Returns:
+     A list of the form (subject, attribute, value, timestamp).
+    """
+    condition, condition_args = AttributeRegexCondition(regex)
+    subjects = [utils.SmartStr(subject) for subject in subjects]
+
+    result = []
+    for i in xrange(0, len(subjects), SQLITE_SUBJECTS_PER_QUERY):
+      batch = subjects[i:i + SQLITE_SUBJECTS_PER_QUERY]
+      query = """SELECT subject, predicate, value, timestamp FROM tbl
+                 WHERE subject IN (%s)%s
+                       AND timestamp >= ? AND timestamp <= ?
+                       ORDER BY timestamp DESC""" % (
+                           ", ".join("?" * len(batch)), condition)
+
+      args = tuple(batch) + condition_args + (start, end)
+      result.extend(self._Query(query, args))
+
+    return result
 
-  @utils.Synchronized
   def GetValues(self, subject, attribute, start, end, limit=None):
     """Returns the values of the attribute between 'start' and 'end'.
 
@@ -334,8 +524,7 @@ class SqliteConnection(object):
       args = (subject, attribute, start, end, limit)
     else:
       args = (subject, attribute, start, end)
-    data = self.cursor.execute(query, args).fetchall()
-    return data
+    return self._Query(query, args)
 
   @utils.Synchronized
   def DeleteAttribute(self, subject, attribute):
@@ -381,6 +570,44 @@ class SqliteConnection(object):
     self.dirty = True
     self.deleted += self.cursor.rowcount
 
+  @utils.Synchronized
+  def DeleteExpired(self, attribute, policy, subject=None):
+    """Deletes the versions of an attribute which a retention policy drops.
+
+    Args:
+     attribute: The attribute.
+     policy: The data_store.RetentionPolicy of the attribute.
+     subject: Only delete versions of this subject. By default the versions
+         of all subjects in the database are deleted.
+    """
+    rows = "predicate = ?"
+    args = (utils.SmartStr(attribute),)
+    if subject is not None:
+      rows = "subject = ? AND " + rows
+      args = (utils.SmartStr(subject),) + args
+
+    if policy.max_versions:
+      query = """DELETE FROM tbl WHERE %s AND timestamp < (
+                   SELECT newer.timestamp FROM tbl AS newer
+                   WHERE newer.subject = tbl.subject
+                         AND newer.predicate = tbl.predicate
+                   ORDER BY newer.timestamp DESC
+                   LIMIT 1 OFFSET ?)""" % rows
+      self.cursor.execute(query, args + (policy.max_versions - 1,))
+      self.dirty = True
+      self.deleted += self.cursor.rowcount
+
+    oldest_timestamp = policy.OldestTimestamp()
+    if oldest_timestamp is not None:
+      # The newest version is always kept.
+      query = """DELETE FROM tbl WHERE %s AND timestamp < ? AND timestamp < (
+                   SELECT MAX(newer.timestamp) FROM tbl AS newer
+                   WHERE newer.subject = tbl.subject
+                         AND newer.predicate = tbl.predicate)""" % rows
+      self.cursor.execute(query, args + (oldest_timestamp,))
+      self.dirty = True
+      self.deleted += self.cursor.rowcount
+
   def PrettyPrint(self):
     """Print the SQLite database."""
     query = "SELECT subject, predicate, timestamp, value FROM tbl"
@@ -394,13 +621,26 @@ class SqliteConnection(object):
 
   def __exit__(self, exc_type, exc_value, traceback):
     if self.dirty:
-      self.Flush()
+      if self.wal_mode:
+        # The write is committed by Sync() or Flush().
+        self.write_generation += 1
+      else:
+        self.Flush()
     self.dirty = False
     self.lock.release()
 
   @utils.Synchronized
   def Flush(self):
     """Flush the database."""
+    self._Commit()
+
+    # In WAL mode the database is vacuumed by Checkpoint().
+    if not self.wal_mode:
+      self._VacuumIfNeeded()
+
+  def _Commit(self):
+    """Commits all writes. Must be called with the lock held."""
+    generation = self.write_generation
     if self.conn:
       try:
         self.conn.commit()
@@ -408,6 +648,56 @@ class SqliteConnection(object):
         # Transaction not active.
         pass
 
+    with self.commit_condition:
+      self.committed_generation = max(self.committed_generation, generation)
+      self.commit_condition.notify_all()
+
+  def Sync(self):
+    """Waits until all writes done so far are committed.
+
+    In WAL mode writes are not committed when the connection is left. The
+    first thread calling Sync() commits the writes of all threads in a single
+    transaction while the others wait for it (group commit). Writes which
+    don't need to be synchronous are committed by the next Flush().
+    """
+    if not self.wal_mode:
+      return
+
+    with self.commit_condition:
+      generation = self.write_generation
+      while self.committed_generation < generation:
+        if self.committing:
+          self.commit_condition.wait()
+          continue
+
+        self.committing = True
+        self.commit_condition.release()
+        try:
+          self.Flush()
+        finally:
+          self.commit_condition.acquire()
+          self.committing = False
+          self.commit_condition.notify_all()
+
+  def Checkpoint(self):
+    """Checkpoints the write-ahead-log and vacuums the database if needed.
+
+    This is only used in WAL mode and runs in the background, so neither is
+    done while handling requests.
+    """
+    reader = self._GetReader()
+    try:
+      # A passive checkpoint does not block the writer or the readers.
+      reader.execute("PRAGMA wal_checkpoint(PASSIVE)")
+    finally:
+      self._ReleaseReader(reader)
+
+    with self.lock:
+      if self.conn and self.deleted >= self.next_vacuum_check:
+        self._Commit()
+        self._VacuumIfNeeded()
+
+  def _VacuumIfNeeded(self):
     if self.deleted >= self.next_vacuum_check:
       if self._NeedsVacuum() and not self._HasRecentVacuum():
         self.Vacuum()
@@ -470,13 +760,18 @@ class SqliteConnection(object):
   @utils.Synchronized
   def Close(self):
     """Flush and close connection."""
-    if self.dirty:
+    if self.dirty or self.write_generation > self.committed_generation:
       self.Flush()
     self.cursor.close()
     self.conn.close()
     self.conn = None
     self.cursor = None
 
+    with self.readers_lock:
+      for reader in self.readers:
+        reader.close()
+      self.readers = []
+
 
 class SqliteDataStore(data_store.DataStore):
   """A file based data store using the SQLite database."""
@@ -484,12 +779,47 @@ class SqliteDataStore(data_store.DataStore):
   # A cache of SQLite connections.
   cache = None
 
+  # Whether the sqlite files are kept in write-ahead-log mode.
+  wal_mode = False
+
+  # Checkpoints the sqlite files in WAL mode.
+  checkpoint_thread = None
+
   def __init__(self, path=None):
     self._CalculateAttributeStorageTypes()
     super(SqliteDataStore, self).__init__()
     self.cache = SqliteConnectionCache(
         config_lib.CONFIG["SqliteDatastore.connection_cache_size"], path)
 
+    self.wal_mode = config_lib.CONFIG["SqliteDatastore.wal_mode"]
+    if self.wal_mode:
+      self.checkpoint_thread = utils.InterruptableThread(
+          target=self.Checkpoint,
+          sleep_time=config_lib.CONFIG["SqliteDatastore.checkpoint_interval"])
+      self.checkpoint_thread.start()
+
+  def __del__(self):
+    if self.checkpoint_thread:
+      self.checkpoint_thread.Stop()
+    super(SqliteDataStore, self).__del__()
+
+  def Flush(self):
+    """Commits the writes which are not committed yet in WAL mode."""
+    if not self.wal_mode:
+      return
+
+    for _, sqlite_connection in self.cache:
+      sqlite_connection.Flush()
+
+  def Checkpoint(self):
+    """Checkpoints all open sqlite files in WAL mode."""
+    for _, sqlite_connection in self.cache:
+      try:
+        sqlite_connection.Checkpoint()
+      except sqlite3.Error as e:
+        logging.warning("Checkpoint of %s failed: %s",
+                        sqlite_connection.Filename(), e)
+
   def RecreatePathing(self, pathing):
     self.cache.RecreatePathing(pathing)
 
@@ -524,41 +854,97 @@ class SqliteDataStore(data_store.DataStore):
                sync=True, to_delete=None, token=None):
     """Set multiple values at once."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
-    # All operations are synchronized.
-    _ = sync
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       timestamp = time.time() * 1000000
 
-    if to_delete is None:
-      to_delete = []
+    with self.cache.Get(subject) as sqlite_connection:
+      self._MultiSet(sqlite_connection, subject, values, timestamp, replace,
+                     to_delete)
+
+    if sync:
+      sqlite_connection.Sync()
+
+  def MultiSubjectMultiSet(self, values, timestamp=None, replace=True,
+                           sync=True, to_delete=None, token=None):
+    """Set the values of many subjects with one transaction per file."""
+    to_delete = to_delete or {}
+    subjects = set(values) | set(to_delete)
+    self.security_manager.CheckDataStoreAccess(token, list(subjects), "w")
+    if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
+      timestamp = time.time() * 1000000
+
+    for (directory, filename), file_subjects in self.cache.GroupByFile(
+        subjects).iteritems():
+      with self.cache.GetFile(directory, filename) as sqlite_connection:
+        for subject in file_subjects:
+          self._MultiSet(sqlite_connection, subject, values.get(subject, {}),
+                         timestamp, replace, to_delete.get(subject))
+
+      if sync:
+        sqlite_connection.Sync()
+
+  def _MultiSet(self, sqlite_connection, subject, values, timestamp, replace,
+                to_delete):
+    """Sets the values of a subject on a connection which is entered."""
+    to_delete = list(to_delete or [])
+    if replace:
+      to_delete.extend(values.keys())
+
+    # Delete attribute if needed.
+    for attribute in to_delete:
+      sqlite_connection.DeleteAttribute(subject, attribute)
+
+    for attribute, seq in values.items():
+      for v in seq:
+        element_timestamp = None
+        if isinstance(v, (list, tuple)):
+          v, element_timestamp = v
+        if element_timestamp is None:
+          element_timestamp = timestamp
+
+        element_timestamp = long(element_timestamp)
+        value = self._Encode(v)
+        sqlite_connection.SetAttribute(subject, attribute, value,
+                                       element_timestamp)
+
+    # Versions added to attributes with retention policies may make older
+    # ones expire.
+    if not replace:
+      for attribute, policy in self.RetentionPolicies(values).iteritems():
+        sqlite_connection.DeleteExpired(attribute, policy, subject=subject)
+
+  def EnforceRetention(self, subject, attributes=None, sync=True, token=None):
+    """Deletes the versions which the retention policies don't keep."""
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if attributes is None:
+      attributes = data_store.RETENTION_POLICIES.keys()
 
     with self.cache.Get(subject) as sqlite_connection:
-      if replace:
-        to_delete.extend(values.keys())
+      for attribute, policy in self.RetentionPolicies(attributes).iteritems():
+        sqlite_connection.DeleteExpired(attribute, policy, subject=subject)
 
-      # Delete attribute if needed.
-      if to_delete:
-        for attribute in to_delete:
-          sqlite_connection.DeleteAttribute(subject, attribute)
+    if sync:
+      sqlite_connection.Sync()
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies in all database files."""
+    _ = token
+    compacted = 0
+    for directory, filename in common.DatabaseFiles(self.Location(),
+                                                    self.FileExtension()):
+      with self.cache.GetFile(directory, filename) as sqlite_connection:
+        for attribute, policy in data_store.RETENTION_POLICIES.items():
+          sqlite_connection.DeleteExpired(attribute, policy)
 
-      for attribute, seq in values.items():
-        for v in seq:
-          element_timestamp = None
-          if isinstance(v, (list, tuple)):
-            v, element_timestamp = v
-          if element_timestamp is None:
-            element_timestamp = timestamp
+      sqlite_connection.Sync()
+      compacted += 1
 
-          element_timestamp = long(element_timestamp)
-          value = self._Encode(v)
-          sqlite_connection.SetAttribute(subject, attribute, value,
-                                         element_timestamp)
+    return compacted
 
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
     """Remove some attributes from a subject."""
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
-    _ = sync
 
     with self.cache.Get(subject) as sqlite_connection:
       if start is None and end is None:
@@ -575,16 +961,26 @@ class SqliteDataStore(data_store.DataStore):
           sqlite_connection.DeleteAttributeRange(subject, attribute, start,
                                                  end)
 
+    if sync:
+      sqlite_connection.Sync()
+
   def DeleteSubject(self, subject, sync=False, token=None):
-    _ = sync
     self.security_manager.CheckDataStoreAccess(token, [subject], "w")
 
     with self.cache.Get(subject) as sqlite_connection:
       sqlite_connection.DeleteSubject(subject)
 
+    if sync:
+      sqlite_connection.Sync()
+
   def MultiResolveRegex(self, subjects, attribute_regex, timestamp=None,
                         limit=None, token=None):
     """Result multiple subjects using one or more attribute regexps."""
+    if not limit:
+      return self._MultiResolveRegexBatched(subjects, attribute_regex,
+                                            timestamp=timestamp, token=token)
+
+    # The limit applies to the subjects in order, so read them one by one.
     result = {}
 
     remaining_limit = limit
@@ -602,6 +998,45 @@ class SqliteDataStore(data_store.DataStore):
 
     return result.iteritems()
 
+  def _MultiResolveRegexBatched(self, subjects, attribute_regex,
+                                timestamp=None, token=None):
+    """Reads all subjects stored in the same database file at once."""
+    subjects = list(subjects)
+    self.security_manager.CheckDataStoreAccess(
+        token, subjects, self.GetRequiredResolveAccess(attribute_regex))
+
+    if isinstance(attribute_regex, str):
+      attribute_regex = [attribute_regex]
+
+    start, end = self._GetStartEndTimestamp(timestamp)
+
+    destinations = {}
+    for subject in subjects:
+      filename, directory = common.ResolveSubjectDestination(
+          subject, self.cache.path_regexes)
+      destination = common.MakeDestinationKey(directory, filename)
+      destinations.setdefault(destination, {})[utils.SmartStr(subject)] = (
+          subject)
+
+    result = {}
+    for destination_subjects in destinations.itervalues():
+      sqlite_connection = self.cache.Get(
+          destination_subjects.itervalues().next())
+      for regex in attribute_regex:
+        if timestamp == self.NEWEST_TIMESTAMP:
+          data = sqlite_connection.GetNewestFromRegexMulti(
+              destination_subjects.keys(), regex)
+        else:
+          data = sqlite_connection.GetValuesFromRegexMulti(
+              destination_subjects.keys(), regex, start, end)
+
+        for subject, attribute, value, ts in data:
+          value = self._Decode(attribute, value)
+          result.setdefault(destination_subjects[subject], []).append(
+              (attribute, value, ts))
+
+    return result.iteritems()
+
   def _GetStartEndTimestamp(self, timestamp):
     if timestamp == self.ALL_TIMESTAMPS or timestamp is None:
       return 0, (2 ** 63) - 1
@@ -631,27 +1066,27 @@ class SqliteDataStore(data_store.DataStore):
     # are lists of timestamped data.
     results = []
 
-    with self.cache.Get(subject) as sqlite_connection:
-      for regex in attribute_regex:
-        nr_results = len(results)
-        if limit and nr_results >= limit:
-          break
-        new_limit = limit
-        if new_limit:
-          new_limit -= nr_results
-        if timestamp == self.NEWEST_TIMESTAMP:
-          data = sqlite_connection.GetNewestFromRegex(subject, regex, new_limit)
-          for attribute, value, ts in data:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-        else:
-          data = sqlite_connection.GetValuesFromRegex(subject, regex, start,
-                                                      end, new_limit)
-          for attribute, value, ts in data:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
+    sqlite_connection = self.cache.Get(subject)
+    for regex in attribute_regex:
+      nr_results = len(results)
+      if limit and nr_results >= limit:
+        break
+      new_limit = limit
+      if new_limit:
+        new_limit -= nr_results
+      if timestamp == self.NEWEST_TIMESTAMP:
+        data = sqlite_connection.GetNewestFromRegex(subject, regex, new_limit)
+        for attribute, value, ts in data:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+      else:
+        data = sqlite_connection.GetValuesFromRegex(subject, regex, start,
+                                                    end, new_limit)
+        for attribute, value, ts in data:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
 
-      return results
+    return results
 
   def ResolveMulti(self, subject, attributes, timestamp=None,
                    limit=None, token=None):
@@ -664,27 +1099,27 @@ class SqliteDataStore(data_store.DataStore):
     results = []
     start, end = self._GetStartEndTimestamp(timestamp)
 
-    with self.cache.Get(subject) as sqlite_connection:
-      for attribute in attributes:
-        if timestamp == self.NEWEST_TIMESTAMP:
-          ret = sqlite_connection.GetNewestValue(subject, attribute)
-          if ret:
-            value, ts = ret
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-            if limit and len(results) >= limit:
-              break
-        else:
-          new_limit = limit
-          if new_limit:
-            new_limit = limit - len(results)
-          values = sqlite_connection.GetValues(subject, attribute, start, end,
-                                               new_limit)
-          for value, ts in values:
-            value = self._Decode(attribute, value)
-            results.append((attribute, value, ts))
-        if limit and len(results) >= limit:
-          break
+    sqlite_connection = self.cache.Get(subject)
+    for attribute in attributes:
+      if timestamp == self.NEWEST_TIMESTAMP:
+        ret = sqlite_connection.GetNewestValue(subject, attribute)
+        if ret:
+          value, ts = ret
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+          if limit and len(results) >= limit:
+            break
+      else:
+        new_limit = limit
+        if new_limit:
+          new_limit = limit - len(results)
+        values = sqlite_connection.GetValues(subject, attribute, start, end,
+                                             new_limit)
+        for value, ts in values:
+          value = self._Decode(attribute, value)
+          results.append((attribute, value, ts))
+      if limit and len(results) >= limit:
+        break
 
     return results
 
@@ -2,6 +2,9 @@
 """Tests the SQLite data store."""
 
 import shutil
+import threading
+
+import sqlite3
 
 
 # pylint: disable=unused-import,g-bad-import-order
@@ -13,6 +16,7 @@ from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import server_benchmark_test
 from grr.lib import test_lib
 from grr.lib import utils
 
@@ -50,6 +54,180 @@ class SqliteTestMixin(object):
 class SqliteDataStoreTest(SqliteTestMixin, data_store_test._DataStoreTest):
   """Test the sqlite data store."""
 
+  def testAttributeRegexCondition(self):
+    # Prefixes become range scans of the index.
+    condition, args = sqlite_data_store.AttributeRegexCondition("aff4:.*")
+    self.assertEqual(condition, " AND predicate >= ? AND predicate < ?")
+    self.assertEqual(args, ("aff4:", "aff4;"))
+
+    condition, args = sqlite_data_store.AttributeRegexCondition(
+        r"index:dir/foo\.txt.*")
+    self.assertEqual(args, ("index:dir/foo.txt", "index:dir/foo.txu"))
+
+    # Everything else is filtered with the regex as well.
+    condition, args = sqlite_data_store.AttributeRegexCondition("aff4:t.+e")
+    self.assertEqual(condition, " AND predicate >= ? AND predicate < ?"
+                     " AND predicate REGEXP ?")
+    self.assertEqual(args, ("aff4:", "aff4;", "aff4:t.+e"))
+
+    condition, args = sqlite_data_store.AttributeRegexCondition("(?i)AFF4:.*")
+    self.assertEqual(condition, " AND predicate REGEXP ?")
+
+    self.assertEqual(sqlite_data_store.AttributeRegexCondition(".*"), ("", ()))
+
+  def testRegexesMatchAtTheStart(self):
+    data_store.DB.Set(self.test_row, "metadata:aff4:foo", "value",
+                      token=self.token)
+    data_store.DB.Set(self.test_row, "aff4:foo", "value", token=self.token)
+
+    for regex in ["aff4:.*", "aff4:f.o", "(aff4|xxx):foo"]:
+      self.assertEqual(
+          [x[0] for x in data_store.DB.ResolveRegex(self.test_row, regex,
+                                                    token=self.token)],
+          ["aff4:foo"])
+
+  def testMultiResolveRegexReadsSubjectsTogether(self):
+    subjects = ["aff4:/batched/%d" % i for i in range(20)]
+    for subject in subjects:
+      data_store.DB.MultiSet(subject, {"metadata:predicate": [subject],
+                                       "aff4:type": ["Test"]},
+                             token=self.token)
+
+    def Fail(*unused_args):
+      raise AssertionError("Subjects were read one by one.")
+
+    with utils.MultiStubber(
+        (sqlite_data_store.SqliteConnection, "GetNewestFromRegex", Fail),
+        (sqlite_data_store.SqliteConnection, "GetValuesFromRegex", Fail)):
+      for timestamp in [data_store.DB.NEWEST_TIMESTAMP,
+                        data_store.DB.ALL_TIMESTAMPS]:
+        results = dict(data_store.DB.MultiResolveRegex(
+            subjects, ["metadata:.*"], timestamp=timestamp, token=self.token))
+
+        self.assertEqual(sorted(results), sorted(subjects))
+        for subject in subjects:
+          self.assertEqual([x[:2] for x in results[subject]],
+                           [("metadata:predicate", subject)])
+
+
+class SqliteWALTestMixin(SqliteTestMixin):
+
+  def InitDatastore(self):
+    config_lib.CONFIG.Set("SqliteDatastore.wal_mode", True)
+    super(SqliteWALTestMixin, self).InitDatastore()
+
+    # Asynchronous writes are only committed when the tests flush them.
+    data_store.DB.flusher_thread.Stop()
+
+
+class SqliteWALDataStoreTest(SqliteWALTestMixin, SqliteDataStoreTest):
+  """Test the sqlite data store in WAL mode."""
+
+  def testFilesAreInWALMode(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+    sqlite_connection = data_store.DB.cache.Get(self.test_row)
+
+    conn = sqlite3.connect(sqlite_connection.Filename())
+    try:
+      self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0],
+                       "wal")
+    finally:
+      conn.close()
+
+  def testReadsDoNotWaitForTheWriter(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      token=self.token)
+    results = []
+
+    def Read():
+      results.append(data_store.DB.Resolve(self.test_row, "metadata:predicate",
+                                           token=self.token)[0])
+
+    # Another thread reads while this one holds the writer.
+    with data_store.DB.cache.Get(self.test_row):
+      reader = threading.Thread(target=Read)
+      reader.start()
+      reader.join(10)
+      self.assertFalse(reader.is_alive())
+
+    self.assertEqual(results, ["value"])
+
+  def testAsyncWritesAreCommittedByFlush(self):
+    data_store.DB.Set(self.test_row, "metadata:predicate", "value",
+                      sync=False, token=self.token)
+
+    # Readers only see committed writes.
+    self.assertEqual(data_store.DB.Resolve(
+        self.test_row, "metadata:predicate", token=self.token), (None, 0))
+
+    data_store.DB.Flush()
+    self.assertEqual(data_store.DB.Resolve(
+        self.test_row, "metadata:predicate", token=self.token)[0], "value")
+
+  def testWritesAreCommittedTogether(self):
+    commits = []
+    original_commit = sqlite_data_store.SqliteConnection._Commit
+
+    def Commit(sqlite_connection):
+      if (sqlite_connection.write_generation >
+          sqlite_connection.committed_generation):
+        commits.append(sqlite_connection.write_generation)
+      original_commit(sqlite_connection)
+
+    subjects = ["aff4:/group/%d" % i for i in range(10)]
+    with utils.Stubber(sqlite_data_store.SqliteConnection, "_Commit", Commit):
+      for subject in subjects:
+        data_store.DB.Set(subject, "metadata:predicate", subject, sync=False,
+                          token=self.token)
+
+      # The synchronous write commits the earlier ones as well.
+      data_store.DB.Set("aff4:/group/sync", "metadata:predicate", "value",
+                        token=self.token)
+
+    self.assertEqual(commits, [11])
+    for subject in subjects + ["aff4:/group/sync"]:
+      self.assertTrue(data_store.DB.Resolve(subject, "metadata:predicate",
+                                            token=self.token)[0])
+
+  def testConcurrentSynchronousWrites(self):
+    subjects = ["aff4:/concurrent/%d" % i for i in range(50)]
+    read_back = {}
+
+    def Write(subject):
+      data_store.DB.MultiSet(subject, {"metadata:predicate": [subject]},
+                             token=self.token)
+      # Synchronous writes are visible to the readers once they return.
+      read_back[subject] = data_store.DB.Resolve(
+          subject, "metadata:predicate", token=self.token)[0]
+
+    threads = [threading.Thread(target=Write, args=(subject,))
+               for subject in subjects]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+
+    self.assertEqual(read_back, dict((subject, subject)
+                                     for subject in subjects))
+    results = dict(data_store.DB.MultiResolveRegex(
+        subjects, ["metadata:predicate"], token=self.token))
+    self.assertEqual(sorted(results), sorted(subjects))
+
+  def testCheckpoint(self):
+    subjects = ["aff4:/checkpoint/%d" % i for i in range(10)]
+    for subject in subjects:
+      data_store.DB.Set(subject, "metadata:predicate", subject,
+                        token=self.token)
+    for subject in subjects:
+      data_store.DB.DeleteSubject(subject, sync=True, token=self.token)
+
+    data_store.DB.Checkpoint()
+
+    for subject in subjects:
+      self.assertEqual(data_store.DB.Resolve(
+          subject, "metadata:predicate", token=self.token), (None, 0))
+
 
 class SqliteDataStoreBenchmarks(SqliteTestMixin,
                                 data_store_test.DataStoreBenchmarks):
@@ -61,6 +239,11 @@ class SqliteDataStoreCSVBenchmarks(SqliteTestMixin,
   """Benchmark the SQLite data store abstraction."""
 
 
+class SqliteServerBenchmarks(SqliteTestMixin,
+                             server_benchmark_test._ServerBenchmarks):
+  """Benchmark the server on the SQLite data store."""
+
+
 def main(args):
   test_lib.main(args)
 
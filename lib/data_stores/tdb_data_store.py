@@ -16,8 +16,10 @@ This data store has the following properties:
 - May work on networked filesystems as long as locking is supported, but this is
   untested
 """
+import bisect
 import os
 import re
+import struct
 import threading
 import time
 
@@ -33,9 +35,16 @@ from grr.lib.data_stores import common
 TDB_SEPARATOR = "\x00"
 TDB_EXTENSION = "tdb"
 
+# Timestamp indexes are stored as this marker followed by the sorted
+# timestamps packed as 64 bit integers. Older versions stored them like
+# attribute indexes.
+TDB_TIMESTAMP_INDEX_MARKER = "\xffTS1"
+TDB_TIMESTAMP_FORMAT = "<q"
+TDB_TIMESTAMP_SIZE = struct.calcsize(TDB_TIMESTAMP_FORMAT)
+
 
 class TDBIndex(rdfvalue.RDFBytes):
-  """An index for columns or timestamps."""
+  """An index of the attributes of a subject, kept in sorted order."""
 
   def __init__(self, *parts, **kwargs):
     self.parts = parts
@@ -45,29 +54,63 @@ class TDBIndex(rdfvalue.RDFBytes):
 
     super(TDBIndex, self).__init__(**kwargs)
 
-    # The index is always a byte string, but we read and write unicode objects
-    # to it.
-    self.index = set(self._value.split(TDB_SEPARATOR))
-    self.index.discard("")
+    self._Load(self._value)
     self._dirty = False
 
+  def _Load(self, value):
+    # The index is always a byte string, but we read and write unicode objects
+    # to it. Indexes written by older versions are not sorted.
+    self.index = sorted(value.split(TDB_SEPARATOR)) if value else []
+
+  def _Dump(self):
+    return TDB_SEPARATOR.join(self.index)
+
   def __contains__(self, other):
-    return utils.SmartStr(other) in self.index
+    other = utils.SmartStr(other)
+    i = bisect.bisect_left(self.index, other)
+    return i < len(self.index) and self.index[i] == other
 
   def Add(self, value):
-    self.index.add(utils.SmartStr(value))
-    self._dirty = True
+    value = utils.SmartStr(value)
+    i = bisect.bisect_left(self.index, value)
+    if i == len(self.index) or self.index[i] != value:
+      self.index.insert(i, value)
+      self._dirty = True
 
   def Remove(self, value):
-    self.index.discard(utils.SmartStr(value))
-    self._dirty = True
+    value = utils.SmartStr(value)
+    i = bisect.bisect_left(self.index, value)
+    if i < len(self.index) and self.index[i] == value:
+      del self.index[i]
+      self._dirty = True
+
+  def Migrate(self):
+    """Marks the index to be rewritten if an older version wrote it.
+
+    Returns:
+      True if the index is rewritten when it is left.
+    """
+    if self._Dump() != self._value:
+      self._dirty = True
+    return self._dirty
+
+  def StartingWith(self, prefix):
+    """Returns the entries starting with prefix, using a bisected range."""
+    prefix = utils.SmartStr(prefix)
+    result = []
+    for i in xrange(bisect.bisect_left(self.index, prefix), len(self.index)):
+      if not self.index[i].startswith(prefix):
+        break
+      result.append(self.index[i])
+
+    return result
 
   def __enter__(self):
     return self
 
   def __exit__(self, exc_type, exc_value, traceback):
     if self._dirty:
-      self._value = TDB_SEPARATOR.join(self.index)
+      self._value = self._Dump()
       self.context.Put(self._value, *self.parts)
 
   def __len__(self):
@@ -77,6 +120,101 @@ class TDBIndex(rdfvalue.RDFBytes):
     return iter(self.index)
 
 
+class TDBTimestampIndex(TDBIndex):
+  """The timestamps of an attribute as a sorted array of integers.
+
+  Reads work directly on the packed array: the newest timestamp is the last
+  entry and time ranges are found by bisecting. The array is only unpacked
+  into a list when it is modified.
+  """
+
+  def _Load(self, value):
+    # The unpacked timestamps, once the index is modified.
+    self.index = None
+    if value.startswith(TDB_TIMESTAMP_INDEX_MARKER):
+      self.packed = value[len(TDB_TIMESTAMP_INDEX_MARKER):]
+    else:
+      timestamps = sorted(int(x) for x in value.split(TDB_SEPARATOR) if x)
+      self.packed = struct.pack("<%dq" % len(timestamps), *timestamps)
+
+  def _Dump(self):
+    if self.index is not None:
+      self.packed = struct.pack("<%dq" % len(self.index), *self.index)
+    return TDB_TIMESTAMP_INDEX_MARKER + self.packed
+
+  def _Get(self, i):
+    if self.index is not None:
+      return self.index[i]
+    return struct.unpack_from(TDB_TIMESTAMP_FORMAT, self.packed,
+                              i * TDB_TIMESTAMP_SIZE)[0]
+
+  def _Slice(self, start, end):
+    if self.index is not None:
+      return self.index[start:end]
+    return list(struct.unpack(
+        "<%dq" % (end - start),
+        self.packed[start * TDB_TIMESTAMP_SIZE:end * TDB_TIMESTAMP_SIZE]))
+
+  def _Bisect(self, timestamp):
+    """Returns the position of the first timestamp >= timestamp."""
+    low, high = 0, len(self)
+    while low < high:
+      middle = (low + high) // 2
+      if self._Get(middle) < timestamp:
+        low = middle + 1
+      else:
+        high = middle
+
+    return low
+
+  def __contains__(self, other):
+    other = int(other)
+    i = self._Bisect(other)
+    return i < len(self) and self._Get(i) == other
+
+  def Add(self, value):
+    value = int(value)
+    i = self._Bisect(value)
+    if i == len(self) or self._Get(i) != value:
+      if self.index is None:
+        self.index = self._Slice(0, len(self))
+      self.index.insert(i, value)
+      self._dirty = True
+
+  def Remove(self, value):
+    value = int(value)
+    i = self._Bisect(value)
+    if i < len(self) and self._Get(i) == value:
+      if self.index is None:
+        self.index = self._Slice(0, len(self))
+      del self.index[i]
+      self._dirty = True
+
+  def Newest(self):
+    """Returns the newest timestamp or None if the index is empty."""
+    if not len(self):
+      return None
+
+    return self._Get(len(self) - 1)
+
+  def Range(self, start=None, end=None):
+    """Returns the sorted timestamps within [start, end]."""
+    first = 0 if start is None else self._Bisect(start)
+    last = len(self) if end is None else self._Bisect(end + 1)
+    if first >= last:
+      return []
+
+    return self._Slice(first, last)
+
+  def __len__(self):
+    if self.index is not None:
+      return len(self.index)
+    return len(self.packed) // TDB_TIMESTAMP_SIZE
+
+  def __iter__(self):
+    return iter(self._Slice(0, len(self)))
+
+
 class TDBContextCache(utils.FastStore):
   """A local cache of tdb context objects."""
 
@@ -99,11 +237,15 @@ class TDBContextCache(utils.FastStore):
   def RootPath(self):
     return self.root_path
 
-  @utils.Synchronized
   def Get(self, subject):
     """This will create the object if needed so should not fail."""
     filename, directory = common.ResolveSubjectDestination(subject,
                                                            self.path_regexes)
+    return self.GetFile(directory, filename)
+
+  @utils.Synchronized
+  def GetFile(self, directory, filename):
+    """Returns the context of a database file, creating it if needed."""
     key = common.MakeDestinationKey(directory, filename)
     try:
       return super(TDBContextCache, self).Get(key)
@@ -172,6 +314,34 @@ class TDBContext(object):
     self.context.close()
     self.context = None
 
+  def MigrateIndexes(self):
+    """Rewrites the indexes written by older versions in the current format.
+
+    Returns:
+      The number of indexes rewritten.
+    """
+    migrated = 0
+    with self:
+      for key in list(self.context):
+        parts = key.split(TDB_SEPARATOR)
+        if parts[-1] != TDBDataStore.INDEX_SUFFIX:
+          continue
+
+        # Subject and attribute indexes have two parts, timestamp indexes have
+        # three.
+        if len(parts) == 2:
+          index_class = TDBIndex
+        elif len(parts) == 3:
+          index_class = TDBTimestampIndex
+        else:
+          continue
+
+        with index_class(*parts, context=self) as index:
+          if index.Migrate():
+            migrated += 1
+
+    return migrated
+
   def PrettyPrint(self):
     """Pretty print the entire tdb database."""
     for key in self.context:
@@ -257,9 +427,9 @@ class TDBDataStore(data_store.DataStore):
 
         for attribute, seq in values.items():
           attribute_index.Add(attribute)
-          with TDBIndex(subject, attribute,
-                        self.INDEX_SUFFIX,
-                        context=tdb_context) as timestamp_index:
+          with TDBTimestampIndex(subject, attribute,
+                                 self.INDEX_SUFFIX,
+                                 context=tdb_context) as timestamp_index:
             for v in seq:
               element_timestamp = None
               if isinstance(v, (list, tuple)):
@@ -273,6 +443,13 @@ class TDBDataStore(data_store.DataStore):
               tdb_context.Put(self._Encode(v),
                               subject, attribute, element_timestamp)
 
+            # Versions added to attributes with retention policies may make
+            # older ones expire.
+            policy = data_store.RETENTION_POLICIES.get(attribute)
+            if policy and not replace:
+              self._DeleteExpired(subject, attribute, policy, timestamp_index,
+                                  tdb_context)
+
   def DeleteAttributes(self, subject, attributes, start=None, end=None,
                        sync=True, token=None):
     """Remove some attributes from a subject."""
@@ -290,18 +467,17 @@ class TDBDataStore(data_store.DataStore):
             self._DeleteAttribute(subject, attribute, tdb_context)
         else:
           # This code path is taken when we have a timestamp range - we
-          # first enumerate all existing timestamps and then remove
-          # the ones that fall in that range.
+          # look up the timestamps in that range in the index and then remove
+          # them.
           start = start or 0
           if end is None:
             end = (2 ** 63) - 1  # sys.maxint
           for attribute in list(attributes):
             attribute_removed = False
-            with TDBIndex(subject, attribute,
-                          self.INDEX_SUFFIX,
-                          context=tdb_context) as timestamp_index:
-              filtered_ts = [x for x in timestamp_index
-                             if start <= int(x) <= end]
+            with TDBTimestampIndex(subject, attribute,
+                                   self.INDEX_SUFFIX,
+                                   context=tdb_context) as timestamp_index:
+              filtered_ts = timestamp_index.Range(int(start), int(end))
               attribute_removed = (len(filtered_ts) == len(timestamp_index))
               for timestamp in filtered_ts:
                 tdb_context.Delete(subject, attribute, timestamp)
@@ -365,15 +541,20 @@ class TDBDataStore(data_store.DataStore):
 
     with self.cache.Get(subject) as tdb_context:
       remaining_limit = limit
+      attribute_index = TDBIndex(subject, self.INDEX_SUFFIX,
+                                 context=tdb_context)
       for regex in attribute_regex:
-        regex = re.compile(regex)
-
-        attribute_index = TDBIndex(subject, self.INDEX_SUFFIX,
-                                   context=tdb_context)
+        # Only the attributes starting with the literal prefix of the regex
+        # can match, these are a range of the sorted index.
+        prefix, rest = common.SplitLiteralPrefix(utils.SmartStr(regex))
+        if rest in ("", ".*"):
+          regex = None
+        else:
+          regex = re.compile(regex)
 
-        for attribute in attribute_index:
+        for attribute in attribute_index.StartingWith(prefix):
 
-          if regex.match(utils.SmartUnicode(attribute)):
+          if regex is None or regex.match(utils.SmartUnicode(attribute)):
             for result in self._GetTimestampsForAttribute(
                 subject, attribute, timestamp, tdb_context):
               results.append(result[1:])
@@ -408,10 +589,59 @@ class TDBDataStore(data_store.DataStore):
 
       return results
 
+  def EnforceRetention(self, subject, attributes=None, sync=True, token=None):
+    """Deletes the versions which the retention policies don't keep."""
+    _ = sync
+    self.security_manager.CheckDataStoreAccess(token, [subject], "w")
+    if attributes is None:
+      attributes = data_store.RETENTION_POLICIES.keys()
+
+    with self.cache.Get(subject) as tdb_context:
+      for attribute, policy in self.RetentionPolicies(attributes).iteritems():
+        with TDBTimestampIndex(subject, attribute, self.INDEX_SUFFIX,
+                               context=tdb_context) as timestamp_index:
+          self._DeleteExpired(subject, attribute, policy, timestamp_index,
+                              tdb_context)
+
+  def CompactRetention(self, token=None):
+    """Enforces the retention policies in all database files."""
+    _ = token
+    compacted = 0
+    for directory, filename in common.DatabaseFiles(self.Location(),
+                                                    self.FileExtension()):
+      with self.cache.GetFile(directory, filename) as tdb_context:
+        for key in list(tdb_context.context):
+          parts = key.split(TDB_SEPARATOR)
+          if len(parts) != 3 or parts[2] != self.INDEX_SUFFIX:
+            continue
+
+          subject, attribute, _ = parts
+          policy = data_store.RETENTION_POLICIES.get(attribute)
+          if policy:
+            with TDBTimestampIndex(*parts,
+                                   context=tdb_context) as timestamp_index:
+              self._DeleteExpired(subject, attribute, policy, timestamp_index,
+                                  tdb_context)
+
+      compacted += 1
+
+    return compacted
+
+  def _DeleteExpired(self, subject, attribute, policy, timestamp_index,
+                     tdb_context):
+    """Deletes the versions in timestamp_index which policy drops."""
+    expired = policy.Expired(timestamp_index)
+    if expired is None:
+      return
+
+    for timestamp in timestamp_index.Range(None, expired):
+      tdb_context.Delete(subject, attribute, timestamp)
+      timestamp_index.Remove(timestamp)
+
   def _DeleteAttribute(self, subject, attribute, tdb_context):
     # Find the matching timestamps through the index.
-    timestamp_index = TDBIndex(subject, attribute, self.INDEX_SUFFIX,
-                               context=tdb_context)
+    timestamp_index = TDBTimestampIndex(subject, attribute, self.INDEX_SUFFIX,
+                                        context=tdb_context)
 
     # Remove all timestamps.
     for timestamp in timestamp_index:
@@ -423,30 +653,32 @@ class TDBDataStore(data_store.DataStore):
                                  tdb_context):
     """Use the timestamp index to select ranges of timestamps."""
     # Find the matching timestamps through the index.
-    timestamp_index = TDBIndex(subject, attribute, self.INDEX_SUFFIX,
-                               context=tdb_context)
+    timestamp_index = TDBTimestampIndex(subject, attribute, self.INDEX_SUFFIX,
+                                        context=tdb_context)
 
     if timestamp is None or timestamp == self.NEWEST_TIMESTAMP:
       # We only care about the latest timestamp.
-      matching_timestamp = max(timestamp_index)
+      matching_timestamp = timestamp_index.Newest()
+      if matching_timestamp is None:
+        return []
+
       value = self._Decode(
           attribute, tdb_context.Get(subject, attribute, matching_timestamp))
 
-      return [(subject, attribute, value, int(matching_timestamp))]
+      return [(subject, attribute, value, matching_timestamp)]
 
     # Timestamps are a range or ALL_TIMESTAMPS.
-    timestamps = sorted([int(t) for t in timestamp_index],
-                        reverse=True)
-    results = []
-    for matching_timestamp in timestamps:
-      if (timestamp == self.ALL_TIMESTAMPS or
-          (matching_timestamp >= timestamp[0] and
-           matching_timestamp <= timestamp[1])):
+    if timestamp == self.ALL_TIMESTAMPS:
+      timestamps = timestamp_index.Range()
+    else:
+      timestamps = timestamp_index.Range(int(timestamp[0]), int(timestamp[1]))
 
-        value = self._Decode(
-            attribute, tdb_context.Get(subject, attribute, matching_timestamp))
+    results = []
+    for matching_timestamp in reversed(timestamps):
+      value = self._Decode(
+          attribute, tdb_context.Get(subject, attribute, matching_timestamp))
 
-        results.append((subject, attribute, value, matching_timestamp))
+      results.append((subject, attribute, value, matching_timestamp))
 
     return results
 
@@ -469,6 +701,24 @@ class TDBDataStore(data_store.DataStore):
     """Get location of the data store."""
     return self.cache.RootPath()
 
+  def MigrateIndexes(self):
+    """Converts the indexes in all TDB files to the current format in place.
+
+    Indexes written by older versions are still read and are converted when
+    they are next written. This converts all of them at once, e.g. after an
+    upgrade. Every index is converted on its own, so this can be interrupted
+    and run again.
+
+    Returns:
+      The number of indexes converted.
+    """
+    migrated = 0
+    for directory, filename in common.DatabaseFiles(self.Location(),
+                                                    self.FileExtension()):
+      migrated += self.cache.GetFile(directory, filename).MigrateIndexes()
+
+    return migrated
+
   def Transaction(self, subject, lease_time=None, token=None):
     return TDBTransaction(self, subject, lease_time=lease_time, token=token)
 
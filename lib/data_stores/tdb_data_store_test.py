@@ -13,6 +13,7 @@ from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import data_store_test
 from grr.lib import flags
+from grr.lib import server_benchmark_test
 from grr.lib import test_lib
 from grr.lib.data_stores import tdb_data_store
 
@@ -44,6 +45,78 @@ class TDBTestMixin(object):
 class TDBDataStoreTest(TDBTestMixin, data_store_test._DataStoreTest):
   """Test the tdb data store."""
 
+  def testTimestampIndex(self):
+    for timestamp in [300, 100, 200]:
+      data_store.DB.Set(self.test_row, "metadata:predicate", str(timestamp),
+                        timestamp=timestamp, replace=False, token=self.token)
+
+    with data_store.DB.cache.Get(self.test_row) as tdb_context:
+      index = tdb_data_store.TDBTimestampIndex(
+          self.test_row, "metadata:predicate", "index", context=tdb_context)
+
+    self.assertEqual(list(index), [100, 200, 300])
+    self.assertEqual(index.Newest(), 300)
+    self.assertEqual(index.Range(150, 300), [200, 300])
+    self.assertEqual(index.Range(301), [])
+    self.assertTrue(200 in index)
+    self.assertFalse(201 in index)
+
+    self.assertEqual(
+        data_store.DB.ResolveMulti(self.test_row, ["metadata:predicate"],
+                                   timestamp=(150, 250), token=self.token),
+        [("metadata:predicate", "200", 200)])
+
+  def testPrefixRegexesAreRangeScans(self):
+    for attribute in ["aff4:type", "aff4:size", "metadata:aff4:x", "aff4s:x"]:
+      data_store.DB.Set(self.test_row, attribute, "value", token=self.token)
+
+    with data_store.DB.cache.Get(self.test_row) as tdb_context:
+      index = tdb_data_store.TDBIndex(self.test_row, "index",
+                                      context=tdb_context)
+
+    self.assertEqual(list(index), sorted(index))
+    self.assertEqual(index.StartingWith("aff4:"), ["aff4:size", "aff4:type"])
+
+    results = data_store.DB.ResolveRegex(self.test_row, "aff4:.*",
+                                         token=self.token)
+    self.assertEqual([x[0] for x in results], ["aff4:size", "aff4:type"])
+
+    results = data_store.DB.ResolveRegex(self.test_row, "aff4:t.*e",
+                                         token=self.token)
+    self.assertEqual([x[0] for x in results], ["aff4:type"])
+
+  def testMigrateIndexes(self):
+    # Indexes as written by older versions: unsorted and as decimal strings.
+    with data_store.DB.cache.Get(self.test_row) as tdb_context:
+      tdb_context.Put("metadata:b\x00metadata:a", self.test_row, "index")
+      for attribute in ["metadata:a", "metadata:b"]:
+        tdb_context.Put("200\x00100", self.test_row, attribute, "index")
+        for timestamp in [100, 200]:
+          tdb_context.Put("%s%d" % (attribute, timestamp), self.test_row,
+                          attribute, timestamp)
+
+    # Old indexes can be read.
+    self.assertEqual(
+        data_store.DB.ResolveRegex(self.test_row, "metadata:.*",
+                                   token=self.token),
+        [("metadata:a", "metadata:a200", 200),
+         ("metadata:b", "metadata:b200", 200)])
+
+    self.assertEqual(data_store.DB.MigrateIndexes(), 3)
+    self.assertEqual(data_store.DB.MigrateIndexes(), 0)
+
+    with data_store.DB.cache.Get(self.test_row) as tdb_context:
+      self.assertEqual(tdb_context.Get(self.test_row, "index"),
+                       "metadata:a\x00metadata:b")
+      timestamp_index = tdb_context.Get(self.test_row, "metadata:a", "index")
+      self.assertTrue(timestamp_index.startswith(
+          tdb_data_store.TDB_TIMESTAMP_INDEX_MARKER))
+
+    results = data_store.DB.ResolveRegex(
+        self.test_row, "metadata:.*", timestamp=data_store.DB.ALL_TIMESTAMPS,
+        token=self.token)
+    self.assertEqual([x[2] for x in results], [200, 100, 200, 100])
+
 
 class TDBDataStoreBenchmarks(TDBTestMixin,
                              data_store_test.DataStoreBenchmarks):
@@ -55,6 +128,11 @@ class TDBDataStoreCSVBenchmarks(TDBTestMixin,
   """Benchmark the TDB data store abstraction."""
 
 
+class TDBServerBenchmarks(TDBTestMixin,
+                          server_benchmark_test._ServerBenchmarks):
+  """Benchmark the server on the TDB data store."""
+
+
 def main(args):
   test_lib.main(args)
 
@@ -9,6 +9,7 @@ This module loads and registers all the data store tests.
 # pylint: disable=unused-import,g-import-not-at-top
 
 from grr.lib.data_stores import fake_data_store_test
+from grr.lib.data_stores import memory_data_store_test
 try:
   from grr.lib.data_stores import mongo_data_store_test
 except ImportError:
@@ -43,6 +43,7 @@ self.state.context.args: The flow runners args. This is an instance of
 
 import functools
 import operator
+import threading
 import time
 
 
@@ -53,6 +54,7 @@ import logging
 from grr.client import actions
 from grr.lib import access_control
 from grr.lib import aff4
+from grr.lib import client_key_cache
 from grr.lib import communicator
 from grr.lib import config_lib
 from grr.lib import data_store
@@ -95,7 +97,20 @@ class Responses(object):
     self._responses = []
     self._dropped_responses = []
 
-    if responses:
+    # Requests with very many responses are streamed from the data store. We
+    # then only check the status up front and filter the other responses while
+    # the state method iterates over them.
+    self._stream = None
+    if isinstance(responses, queue_manager.ResponseStream):
+      self._stream = responses
+      self.iterator = None
+      for _ in self._FilterResponses([responses.status]):
+        pass
+
+      if self.status is None:
+        raise FlowError("No valid Status message.")
+
+    elif responses:
       # This may not be needed if we can assume that responses are
       # returned in lexical order from the data_store.
       responses.sort(key=operator.attrgetter("response_id"))
@@ -104,38 +119,7 @@ class Responses(object):
       # be passed back to actions that expect an iterator.
       self.iterator = None
 
-      # Filter the responses by authorized states
-      for msg in responses:
-        # Check if the message is authenticated correctly.
-        if msg.auth_state == msg.AuthorizationState.DESYNCHRONIZED or (
-            self._auth_required and
-            msg.auth_state != msg.AuthorizationState.AUTHENTICATED):
-          logging.warning("%s: Messages must be authenticated (Auth state %s)",
-                          msg.session_id, msg.auth_state)
-          self._dropped_responses.append(msg)
-          # Skip this message - it is invalid
-          continue
-
-        # Check for iterators
-        if msg.type == msg.Type.ITERATOR:
-          self.iterator = rdfvalue.Iterator()
-          self.iterator.ParseFromString(msg.args)
-          continue
-
-        # Look for a status message
-        if msg.type == msg.Type.STATUS:
-          # Our status is set to the first status message that we see in
-          # the responses. We ignore all other messages after that.
-          self.status = rdfvalue.GrrStatus(msg.args)
-
-          # Check this to see if the call succeeded
-          self.success = self.status.status == self.status.ReturnedStatus.OK
-
-          # Ignore all other messages
-          break
-
-        # Use this message
-        self._responses.append(msg)
+      self._responses = list(self._FilterResponses(responses))
 
       if self.status is None:
         # This is a special case of de-synchronized messages.
@@ -151,10 +135,49 @@ class Responses(object):
     # This is the raw message accessible while going through the iterator
     self.message = None
 
+  def _FilterResponses(self, responses):
+    """Yields the valid responses up to the status message."""
+    for msg in responses:
+      # Check if the message is authenticated correctly.
+      if msg.auth_state == msg.AuthorizationState.DESYNCHRONIZED or (
+          self._auth_required and
+          msg.auth_state != msg.AuthorizationState.AUTHENTICATED):
+        logging.warning("%s: Messages must be authenticated (Auth state %s)",
+                        msg.session_id, msg.auth_state)
+        self._dropped_responses.append(msg)
+        # Skip this message - it is invalid
+        continue
+
+      # Check for iterators
+      if msg.type == msg.Type.ITERATOR:
+        self.iterator = rdfvalue.Iterator()
+        self.iterator.ParseFromString(msg.args)
+        continue
+
+      # Look for a status message
+      if msg.type == msg.Type.STATUS:
+        # Our status is set to the first status message that we see in
+        # the responses. We ignore all other messages after that.
+        self.status = rdfvalue.GrrStatus(msg.args)
+
+        # Check this to see if the call succeeded
+        self.success = self.status.status == self.status.ReturnedStatus.OK
+
+        # Ignore all other messages
+        break
+
+      # Use this message
+      yield msg
+
   def __iter__(self):
     """An iterator which returns all the responses in order."""
+    if self._stream is not None:
+      messages = self._FilterResponses(self._stream)
+    else:
+      messages = self._responses
+
     old_response_id = None
-    for message in self._responses:
+    for message in messages:
       self.message = rdfvalue.GrrMessage(message)
 
       # Handle retransmissions
@@ -191,10 +214,14 @@ class Responses(object):
       return x
 
   def __len__(self):
+    if self._stream is not None:
+      # All the responses but the status.
+      return len(self._stream) - 1
+
     return len(self._responses)
 
   def __nonzero__(self):
-    return bool(self._responses)
+    return bool(len(self))
 
   def _LogFlowState(self, responses):
     session_id = responses[0].session_id
@@ -1374,9 +1401,18 @@ class Events(object):
 class ServerPubKeyCache(communicator.PubKeyCache):
   """A public key cache used by servers getting the key from the AFF4 client."""
 
-  def __init__(self, client_cache, token=None):
+  def __init__(self, client_cache, token=None, key_cache=None):
     self.client_cache = client_cache
     self.token = token
+    if key_cache is None:
+      key_cache = client_key_cache.ClientKeyCache(
+          config_lib.CONFIG["Frontend.client_key_cache_size"],
+          shared_cache=client_key_cache.GetSharedCache())
+    self.key_cache = key_cache
+
+  def Flush(self):
+    """Flushes the keys cached by this process."""
+    self.key_cache.Flush()
 
   def GetRSAPublicKey(self, common_name="Server"):
     """Retrieves the public key for the common_name from data_store.
@@ -1396,10 +1432,19 @@ class ServerPubKeyCache(communicator.PubKeyCache):
     """
     # We dont want a unicode object here
     common_name = str(common_name)
+    try:
+      return self.key_cache.Get(common_name)
+    except KeyError:
+      pass
+
+    # The key is cached at the generation it had before we read the cert.
+    generation = self.key_cache.GetGeneration(common_name)
     try:
       client = self.client_cache.Get(common_name)
       cert = client.Get(client.Schema.CERT)
-      return cert.GetPubKey()
+      return self.key_cache.Put(common_name,
+                                client_key_cache.PEMFromCert(cert),
+                                generation)
 
     except (KeyError, AttributeError):
       # Fetch the client's cert - We will be updating its clock attribute.
@@ -1418,12 +1463,16 @@ class ServerPubKeyCache(communicator.PubKeyCache):
       stats.STATS.SetGaugeValue("grr_frontendserver_client_cache_size",
                                 len(self.client_cache))
 
-      return cert.GetPubKey()
+      return self.key_cache.Put(common_name,
+                                client_key_cache.PEMFromCert(cert), generation)
 
 
 class ServerCommunicator(communicator.Communicator):
   """A communicator which stores certificates using AFF4."""
 
+  sent_direction = communicator.SERVER_TO_CLIENT
+  received_direction = communicator.CLIENT_TO_SERVER
+
   def __init__(self, certificate, private_key, token=None):
     self.client_cache = utils.FastStore(1000)
     self.token = token
@@ -1431,6 +1480,11 @@ class ServerCommunicator(communicator.Communicator):
                                              private_key=private_key)
     self.pub_key_cache = ServerPubKeyCache(self.client_cache, token=token)
 
+    secrets = config_lib.CONFIG["Frontend.session_ticket_keys"]
+    if secrets:
+      self.session_tickets = communicator.SessionTickets(
+          secrets, config_lib.CONFIG["Frontend.session_ticket_lifetime"])
+
   def _LoadOurCertificate(self):
     """Loads the server certificate."""
     self.cert = X509.load_cert_string(str(self.certificate))
@@ -1533,6 +1587,11 @@ class FrontEndServer(object):
 
     self.data_store = store or data_store.DB
     self.receive_thread_pool = {}
+    # The messages of concurrent requests are written in shared batches.
+    self.receive_batcher = queue_manager.FlushBatcher(
+        store=self.data_store, token=self.token,
+        interval=config_lib.CONFIG["Frontend.receive_batch_interval"],
+        max_operations=config_lib.CONFIG["Frontend.receive_batch_size"])
     self.message_expiry_time = message_expiry_time
     self.max_retransmission_time = max_retransmission_time
     self.max_queue_size = max_queue_size
@@ -1549,6 +1608,21 @@ class FrontEndServer(object):
       if well_known_flow not in config_lib.CONFIG["Frontend.well_known_flows"]:
         del self.well_known_flows[well_known_flow]
 
+    if config_lib.CONFIG["Frontend.client_key_cache_prewarm"]:
+      prewarm_thread = threading.Thread(target=self._PrewarmKeyCache,
+                                        name="ClientKeyCachePrewarm")
+      prewarm_thread.daemon = True
+      prewarm_thread.start()
+
+  def _PrewarmKeyCache(self):
+    """Loads the keys of known clients before they connect."""
+    try:
+      loaded = self._communicator.pub_key_cache.key_cache.Prewarm(
+          token=self.token)
+      logging.info("Loaded the keys of %d clients.", loaded)
+    except Exception as e:  # pylint: disable=broad-except
+      logging.warning("Could not prewarm the client key cache: %s", e)
+
   def SetThrottleCallBack(self, callback):
     self.throttle_callback = callback
 
@@ -1639,8 +1713,9 @@ class FrontEndServer(object):
        tuple of (source, message_count) where message_count is the number of
        messages received from the client with common name source.
     """
+    cipher = self._communicator.DecodeCipher(request_comms)
     messages, source, timestamp = self._communicator.DecodeMessages(
-        request_comms)
+        request_comms, cipher=cipher)
 
     now = time.time()
     if messages:
@@ -1669,7 +1744,8 @@ class FrontEndServer(object):
     try:
       self._communicator.EncodeMessages(
           message_list, response_comms, destination=str(source),
-          timestamp=timestamp, api_version=request_comms.api_version)
+          timestamp=timestamp, api_version=request_comms.api_version,
+          session=cipher)
     except communicator.UnknownClientCert:
       # We can not encode messages to the client yet because we do not have the
       # client certificate - return them to the queue so we can try again later.
@@ -1742,15 +1818,16 @@ class FrontEndServer(object):
 
     For each message we update the request object, and place the
     response in that request's queue. If the request is complete, we
-    send a message to the worker.
+    send a message to the worker. The changes are written together with
+    the ones of concurrent requests, and are in the data store when this
+    returns.
 
     Args:
       client_id: The client which sent the messages.
       messages: A list of GrrMessage RDFValues.
     """
     now = time.time()
-    with queue_manager.QueueManager(
-        token=self.token, store=self.data_store) as manager:
+    with self.receive_batcher.Batch() as manager:
       for msg in messages:
         # Messages for well known flows should notify even though they dont have
         # a status.
@@ -1860,6 +1937,9 @@ class FlowInit(registry.InitHook):
     # misconfiguration.
     stats.STATS.RegisterCounterMetric(
         "frontend_inactive_request_count", fields=[("source", str)])
+    # Client requests turned away because the frontend was overloaded.
+    stats.STATS.RegisterCounterMetric(
+        "frontend_rejected_request_count", fields=[("source", str)])
     stats.STATS.RegisterEventMetric(
         "frontend_request_latency", fields=[("source", str)])
 
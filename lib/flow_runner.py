@@ -91,6 +91,15 @@ class FlowRunner(object):
   process_requests_in_order = True
   queue_manager = None
 
+  # Requests with many responses are streamed to the state methods to keep
+  # memory use bounded. This requires the responses to be consumed before
+  # the request is deleted, i.e. the state method must run synchronously.
+  stream_responses = True
+
+  # If True, FlushMessages() leaves flushing the queue manager to the caller.
+  # The worker uses this to write the messages of a batch of flows at once.
+  defer_message_flush = False
+
   client_id = None
 
   def __init__(self, flow_obj, parent_runner=None, runner_args=None,
@@ -387,7 +396,7 @@ class FlowRunner(object):
     # ASAP. This must happen before we actually run the flow to ensure the
     # client requests are removed from the client queues.
     with queue_manager.QueueManager(token=self.token) as manager:
-      for request, _ in manager.FetchCompletedRequests(
+      for request, _ in self.queue_manager.FetchCompletedRequests(
           self.session_id, timestamp=(0, notification.timestamp)):
         # Requests which are not destined to clients have no embedded request
         # message.
@@ -407,7 +416,8 @@ class FlowRunner(object):
         # Here we only care about completed requests - i.e. those requests with
         # responses followed by a status message.
         for request, responses in self.queue_manager.FetchCompletedResponses(
-            self.session_id, timestamp=(0, notification.timestamp)):
+            self.session_id, timestamp=(0, notification.timestamp),
+            stream=self.stream_responses):
 
           if request.id == 0:
             continue
@@ -432,8 +442,14 @@ class FlowRunner(object):
             continue
 
           # Do we have all the responses here? This can happen if some of the
-          # responses were lost.
-          if len(responses) != responses[-1].response_id:
+          # responses were lost. Streamed responses have not been read yet so we
+          # check the stored ones without holding them in memory.
+          if isinstance(responses, queue_manager.ResponseStream):
+            complete = responses.IsComplete()
+          else:
+            complete = len(responses) == responses[-1].response_id
+
+          if not complete:
             # If we can retransmit do so. Note, this is different from the
             # automatic retransmission facilitated by the task scheduler (the
             # Task.task_ttl field) which would happen regardless of these.
@@ -489,8 +505,11 @@ class FlowRunner(object):
           event.wait()
 
         # We did not read all the requests/responses in this run in order to
-        # keep a low memory footprint and have to make another pass.
-        self.FlushMessages()
+        # keep a low memory footprint and have to make another pass. The
+        # processed requests must be deleted before that, even if our messages
+        # are otherwise flushed later.
+        if self.parent_runner is None:
+          self.queue_manager.Flush()
         self.flow_obj.Flush()
         continue
 
@@ -872,8 +891,9 @@ class FlowRunner(object):
 
   def FlushMessages(self):
     """Flushes the messages that were queued."""
-    # Only flush queues if we are the top level runner.
-    if self.parent_runner is None:
+    # Only flush queues if we are the top level runner and the messages are
+    # not flushed together with those of other flows.
+    if self.parent_runner is None and not self.defer_message_flush:
       self.queue_manager.Flush()
 
   def Error(self, backtrace, client_id=None, status=None):
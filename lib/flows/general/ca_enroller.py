@@ -11,6 +11,7 @@ from M2Crypto import X509
 
 import logging
 from grr.lib import aff4
+from grr.lib import client_key_cache
 from grr.lib import config_lib
 from grr.lib import flow
 from grr.lib import queues
@@ -71,6 +72,9 @@ class CAEnroler(flow.GRRFlow):
 
     client.Close(sync=True)
 
+    # Frontends must not keep verifying the client with an older key.
+    client_key_cache.InvalidateClient(self.cn)
+
     # Publish the client enrollment message.
     self.Publish("ClientEnrollment", certificate_attribute.common_name)
 
@@ -63,6 +63,10 @@ class HuntRunner(flow_runner.FlowRunner):
   schedule_kill_notifications = False
   process_requests_in_order = False
 
+  # State methods run on the thread pool after the request was deleted, so
+  # responses can not be read lazily.
+  stream_responses = False
+
   def _AddClient(self, client_id):
     next_client_due = self.flow_obj.state.context.next_client_due
     if self.args.client_rate > 0:
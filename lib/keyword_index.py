@@ -69,10 +69,10 @@ class AFF4KeywordIndex(aff4.AFF4Object):
       keywords: A collection of keywords to associate with name.
       **kwargs: Additional arguments to pass to the datastore.
     """
-    for keyword in set(keywords):
-      data_store.DB.Set(
-          self._KeywordToURN(keyword),
-          self.INDEX_COLUMN_FORMAT % name, "",
-          token=self.token, sync=False, **kwargs)
+    data_store.DB.MultiSubjectMultiSet(
+        dict((self._KeywordToURN(keyword),
+              {self.INDEX_COLUMN_FORMAT % name: [""]})
+             for keyword in set(keywords)),
+        token=self.token, sync=False, **kwargs)
     if sync:
       data_store.DB.Flush()
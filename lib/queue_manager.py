@@ -3,15 +3,18 @@
 
 
 
+import contextlib
 import os
 import random
 import socket
+import threading
 import time
 
 import logging
 
 from grr.lib import config_lib
 from grr.lib import data_store
+from grr.lib import queue_notifier
 from grr.lib import rdfvalue
 from grr.lib import registry
 from grr.lib import stats
@@ -26,6 +29,66 @@ class MoreDataException(Error):
   """Raised when there is more data available."""
 
 
+class ResponseStream(object):
+  """The responses to a single request, read from the data store in pages.
+
+  This stands in for the list of responses of requests which have too many
+  responses to hold in memory at once. The status message is known up front
+  and tells us the ids of all the responses, so each page is read with a single
+  ResolveMulti call for the exact attributes.
+  """
+
+  def __init__(self, manager, session_id, request, status, timestamp):
+    self.manager = manager
+    self.request = request
+    self.status = status
+    self.timestamp = timestamp
+    self.subject = manager.GetFlowResponseSubject(session_id, request.id)
+
+  def __len__(self):
+    # The status message is the last response. IsComplete() checks that none
+    # of the responses before it are missing.
+    return self.status.response_id
+
+  def _ReadPages(self):
+    """Yields the stored (predicate, value, timestamp) rows of each page."""
+    page_size = self.manager.response_page_size
+    last_response_id = self.status.response_id
+    for start in xrange(1, last_response_id + 1, page_size):
+      predicates = [
+          self.manager.FLOW_RESPONSE_TEMPLATE % (self.request.id, response_id)
+          for response_id in xrange(
+              start, min(start + page_size, last_response_id + 1))]
+
+      yield self.manager.data_store.ResolveMulti(
+          self.subject, predicates, timestamp=self.timestamp,
+          token=self.manager.token)
+
+  def IsComplete(self):
+    """Checks that every response up to the status message was stored.
+
+    This reads the responses page by page without decoding or keeping them, so
+    requests which lost responses can be retransmitted before they are
+    processed.
+
+    Returns:
+      True if none of the responses are missing.
+    """
+    stored = 0
+    for rows in self._ReadPages():
+      stored += len(set(predicate for predicate, _, _ in rows))
+    return stored == self.status.response_id
+
+  def __iter__(self):
+    """Yields the responses in ascending order of response ids."""
+    for rows in self._ReadPages():
+      responses = [rdfvalue.GrrMessage(serialized)
+                   for _, serialized, _ in rows]
+
+      for response in sorted(responses, key=lambda msg: msg.response_id):
+        yield response
+
+
 class QueueManager(object):
   """This class manages the representation of the flow within the data store.
 
@@ -88,6 +151,10 @@ class QueueManager(object):
   request_limit = 1000000
   response_limit = 1000000
 
+  # Requests with more responses than this can be streamed to the flow in
+  # pages of this size instead of being read into memory at once.
+  response_page_size = 1000
+
   notification_shard_counters = {}
 
   def __init__(self, store=None, sync=True, token=None):
@@ -108,6 +175,16 @@ class QueueManager(object):
     self.new_client_messages = []
     self.notifications = []
 
+    # Queue shards whose subscribers need to be woken up once the
+    # notifications written to them reach the data store.
+    self.shards_to_wake = set()
+
+    # Flow states and responses read ahead of time by
+    # PrefetchCompletedResponses(), keyed by session id. They are valid until
+    # the next Flush() writes our pending changes.
+    self.prefetched_states = {}
+    self.prefetched_responses = {}
+
     self.prev_frozen_timestamps = []
     self.frozen_timestamp = None
 
@@ -204,6 +281,61 @@ class QueueManager(object):
         status_available.add(m)
     return status_available
 
+  def PrefetchCompletedResponses(self, session_ids, timestamp=None,
+                                 limit=10000):
+    """Reads the completed requests and responses of many flows at once.
+
+    The data is kept in this queue manager and used by FetchCompletedRequests()
+    and FetchCompletedResponses() instead of querying the data store for each
+    flow separately.
+
+    Args:
+      session_ids: The session ids of the flows to read.
+      timestamp: Tuple (start, end) with a time range. This must cover the
+                 time ranges later passed to the Fetch methods.
+      limit: Responses are not prefetched for flows with more than this many
+             completed responses.
+    """
+    if timestamp is None:
+      timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
+
+    subjects = dict((session_id.Add("state"), session_id)
+                    for session_id in session_ids)
+    states = dict(self.data_store.MultiResolveRegex(
+        subjects, [self.FLOW_REQUEST_REGEX, self.FLOW_STATUS_REGEX],
+        token=self.token, timestamp=timestamp))
+
+    response_subjects = []
+    for subject, session_id in subjects.iteritems():
+      self.prefetched_states[session_id] = states.get(utils.SmartUnicode(
+          subject), [])
+
+      flow_subjects = []
+      total_size = 0
+      for request, status in self.FetchCompletedRequests(session_id,
+                                                         timestamp=timestamp):
+        total_size += status.response_id
+
+        # Requests this big are streamed instead.
+        if status.response_id <= self.response_page_size:
+          flow_subjects.append(self.GetFlowResponseSubject(session_id,
+                                                           request.id))
+
+      # Big flows read their responses in multiple passes anyways.
+      if total_size <= limit:
+        response_subjects.extend(flow_subjects)
+
+    for subject, values in self.data_store.MultiResolveRegex(
+        response_subjects, self.FLOW_RESPONSE_REGEX, token=self.token,
+        timestamp=timestamp):
+      self.prefetched_responses[utils.SmartUnicode(subject)] = values
+
+    for subject in response_subjects:
+      self.prefetched_responses.setdefault(utils.SmartUnicode(subject), [])
+
+  def _InTimeRange(self, ts, timestamp):
+    return timestamp[0] <= ts <= timestamp[1]
+
   def FetchCompletedRequests(self, session_id, timestamp=None):
     """Fetch all the requests with a status message queued for them."""
     subject = session_id.Add("state")
@@ -213,9 +345,16 @@ class QueueManager(object):
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
 
-    for predicate, serialized, _ in self.data_store.ResolveRegex(
-        subject, [self.FLOW_REQUEST_REGEX, self.FLOW_STATUS_REGEX],
-        token=self.token, limit=self.request_limit, timestamp=timestamp):
+    if session_id in self.prefetched_states:
+      rows = [(predicate, serialized, ts) for predicate, serialized, ts
+              in self.prefetched_states[session_id]
+              if self._InTimeRange(ts, timestamp)]
+    else:
+      rows = self.data_store.ResolveRegex(
+          subject, [self.FLOW_REQUEST_REGEX, self.FLOW_STATUS_REGEX],
+          token=self.token, limit=self.request_limit, timestamp=timestamp)
+
+    for predicate, serialized, _ in rows:
 
       parts = predicate.split(":", 3)
       request_id = parts[2]
@@ -229,9 +368,28 @@ class QueueManager(object):
         yield (rdfvalue.RequestState(serialized),
                rdfvalue.GrrMessage(status[request_id]))
 
-  def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000):
-    """Fetch only completed requests and responses up to a limit."""
+  def FetchCompletedResponses(self, session_id, timestamp=None, limit=10000,
+                              stream=False):
+    """Fetch only completed requests and responses up to a limit.
+
+    Args:
+      session_id: The session_id to get the requests/responses for.
+      timestamp: Tuple (start, end) with a time range. Fetched requests and
+                 responses will have timestamp in this range.
+      limit: The maximum number of responses to read into memory.
+      stream: If True, requests with more than response_page_size responses
+              are yielded with a ResponseStream instead of a list, which reads
+              the responses page by page while it is iterated.
+
+    Yields:
+      A tuple (request protobuf, responses) in ascending order of request ids.
+
+    Raises:
+      MoreDataException: When there is more data available than read by the
+                         limited query.
+    """
     response_subjects = {}
+    streams = {}
 
     if timestamp is None:
       timestamp = (0, self.frozen_timestamp or rdfvalue.RDFDatetime().Now())
@@ -242,16 +400,41 @@ class QueueManager(object):
       response_subject = self.GetFlowResponseSubject(session_id, request.id)
       response_subjects[response_subject] = request
 
+      if stream and status.response_id > self.response_page_size:
+        streams[response_subject] = ResponseStream(
+            self, session_id, request, status, timestamp)
+        total_size += self.response_page_size
+      else:
+        total_size += status.response_id
+
       # Quit if there are too many responses.
-      total_size += status.response_id
       if total_size > limit:
         break
 
-    response_data = dict(self.data_store.MultiResolveRegex(
-        response_subjects, self.FLOW_RESPONSE_REGEX, token=self.token,
-        timestamp=timestamp))
+    response_data = {}
+    to_read = []
+    for response_subject in response_subjects:
+      if response_subject in streams:
+        continue
+
+      prefetched = self.prefetched_responses.get(
+          utils.SmartUnicode(response_subject))
+      if prefetched is None:
+        to_read.append(response_subject)
+      else:
+        response_data[response_subject] = [
+            row for row in prefetched if self._InTimeRange(row[2], timestamp)]
+
+    if to_read:
+      response_data.update(self.data_store.MultiResolveRegex(
+          to_read, self.FLOW_RESPONSE_REGEX, token=self.token,
+          timestamp=timestamp))
 
     for response_urn, request in sorted(response_subjects.items()):
+      if response_urn in streams:
+        yield (request, streams[response_urn])
+        continue
+
       responses = []
       for _, serialized, _ in response_data.get(response_urn, []):
         responses.append(rdfvalue.GrrMessage(serialized))
@@ -348,17 +531,29 @@ class QueueManager(object):
 
   def Flush(self):
     """Writes the changes in this object to the datastore."""
+    # Prefetched data does not reflect the changes we are about to write.
+    self.prefetched_states = {}
+    self.prefetched_responses = {}
+
     session_ids = set(self.to_write) | set(self.to_delete)
-    for session_id in session_ids:
-      try:
-        self.data_store.MultiSet(session_id, self.to_write.get(session_id, {}),
-                                 to_delete=self.to_delete.get(session_id, []),
-                                 sync=False, token=self.token)
-      except data_store.Error:
-        pass
 
+    # The writes to the flows and the deletions from the client queues are
+    # sent together.
+    to_delete = dict(self.to_delete)
     for client_id, messages in self.client_messages_to_delete.iteritems():
-      self.Delete(client_id.Queue(), messages)
+      to_delete.setdefault(client_id.Queue(), []).extend(
+          self._TaskPredicates(messages))
+
+    try:
+      self.data_store.MultiSubjectMultiSet(self.to_write, to_delete=to_delete,
+                                           sync=False, token=self.token)
+    except data_store.Error as e:
+      logging.warning("Could not write the queued changes of %d flows: %s",
+                      len(session_ids), e)
+      # Messages left in the client queues would be sent again, so their
+      # deletions are retried on their own and raise if they fail as well.
+      for client_id, messages in self.client_messages_to_delete.iteritems():
+        self.Delete(client_id.Queue(), messages)
 
     if self.new_client_messages:
       for timestamp, messages in utils.GroupBy(
@@ -371,18 +566,63 @@ class QueueManager(object):
     if self.sync and session_ids:
       self.data_store.Flush()
 
-    for notification, timestamp in self.notifications:
-      self.NotifyQueue(notification, timestamp=timestamp, sync=False)
+    # Notifications are written with one operation per queue.
+    for queue, notifications in utils.GroupBy(
+        self.notifications,
+        lambda x: x[0].session_id.Queue()).iteritems():
+      self._WriteNotifications(queue, notifications, sync=False)
 
     if self.sync:
       self.data_store.Flush()
 
+    self._WakeUpWorkers()
+
     self.to_write = {}
     self.to_delete = {}
     self.client_messages_to_delete = {}
     self.notifications = []
     self.new_client_messages = []
 
+  def Merge(self, other):
+    """Adds the changes pending in another queue manager to ours.
+
+    The changes keep their timestamps. Within a Flush() deletions are applied
+    before writes, so the merged changes must not delete what others write.
+
+    Args:
+      other: A QueueManager, its pending changes are moved to this one.
+    """
+    for subject, attributes in other.to_write.iteritems():
+      queue = self.to_write.setdefault(subject, {})
+      for attribute, values in attributes.iteritems():
+        queue.setdefault(attribute, []).extend(values)
+
+    for subject, attributes in other.to_delete.iteritems():
+      self.to_delete.setdefault(subject, []).extend(attributes)
+
+    for client_id, task_ids in other.client_messages_to_delete.iteritems():
+      self.client_messages_to_delete.setdefault(client_id, []).extend(task_ids)
+
+    self.new_client_messages.extend(other.new_client_messages)
+    self.notifications.extend(other.notifications)
+    self.shards_to_wake.update(other.shards_to_wake)
+
+    other.to_write = {}
+    other.to_delete = {}
+    other.client_messages_to_delete = {}
+    other.new_client_messages = []
+    other.notifications = []
+    other.shards_to_wake = set()
+
+  def PendingOperations(self):
+    """Returns the number of changes waiting for Flush()."""
+    return (sum(len(values) for attributes in self.to_write.itervalues()
+                for values in attributes.itervalues()) +
+            sum(len(attributes) for attributes in self.to_delete.itervalues()) +
+            sum(len(task_ids) for task_ids in
+                self.client_messages_to_delete.itervalues()) +
+            len(self.new_client_messages) + len(self.notifications))
+
   def QueueResponse(self, session_id, response, timestamp=None):
     """Queues the message on the flow's state."""
     if timestamp is None:
@@ -449,32 +689,37 @@ class QueueManager(object):
           or integers representing the task_id.
     """
     if queue:
-      predicates = []
-      for task in tasks:
-        try:
-          task_id = task.task_id
-        except AttributeError:
-          task_id = int(task)
-        predicates.append(self._TaskIdToColumn(task_id))
-
       data_store.DB.DeleteAttributes(
-          queue, predicates, token=self.token, sync=False)
+          queue, self._TaskPredicates(tasks), token=self.token, sync=False)
+
+  def _TaskPredicates(self, tasks):
+    """Returns the predicates of Task() instances or task ids."""
+    predicates = []
+    for task in tasks:
+      try:
+        task_id = task.task_id
+      except AttributeError:
+        task_id = int(task)
+      predicates.append(self._TaskIdToColumn(task_id))
+
+    return predicates
 
   def Schedule(self, tasks, sync=False, timestamp=None):
     """Schedule a set of Task() instances."""
     if timestamp is None:
       timestamp = self.frozen_timestamp
 
+    to_schedule = {}
     for queue, queued_tasks in utils.GroupBy(
         tasks, lambda x: x.queue).iteritems():
       if queue:
-        to_schedule = dict(
+        to_schedule[queue] = dict(
             [(self._TaskIdToColumn(task.task_id),
               [task.SerializeToString()]) for task in queued_tasks])
 
-        self.data_store.MultiSet(
-            queue, to_schedule, timestamp=timestamp, sync=sync,
-            token=self.token)
+    if to_schedule:
+      self.data_store.MultiSubjectMultiSet(
+          to_schedule, timestamp=timestamp, sync=sync, token=self.token)
 
   def _SortByPriority(self, notifications, queue, output_dict=None):
     """Sort notifications by priority into output_dict."""
@@ -496,11 +741,20 @@ class QueueManager(object):
 
     return output_dict
 
-  def GetNotificationsByPriority(self, queue):
-    """Retrieves session ids for processing grouped by priority."""
+  def GetNotificationsByPriority(self, queue, queue_shard=None):
+    """Retrieves session ids for processing grouped by priority.
+
+    Args:
+      queue: usually rdfvalue.RDFURN("aff4:/W")
+      queue_shard: The shard of the queue to read. If not given, the shards are
+        read in turn.
+    Returns:
+      dict of notifications objects keyed by priority.
+    """
     # Check which sessions have new data.
     # Read all the sessions that have notifications.
-    queue_shard = self.GetNotificationShard(queue)
+    if queue_shard is None:
+      queue_shard = self.GetNotificationShard(queue)
     return self._SortByPriority(
         self._GetUnsortedNotifications(queue_shard).values(), queue)
 
@@ -622,10 +876,16 @@ class QueueManager(object):
 
   def _MultiNotifyQueue(self, queue, notifications, timestamp=None, sync=True):
     """Does the actual queuing."""
+    self._WriteNotifications(
+        queue, [(notification, timestamp) for notification in notifications],
+        sync=sync)
+
+  def _WriteNotifications(self, queue, notifications, sync=True):
+    """Writes (notification, timestamp) pairs to a shard of a queue."""
     serialized_notifications = {}
     now = rdfvalue.RDFDatetime().Now()
     expiry_time = config_lib.CONFIG["Worker.notification_expiry_time"]
-    for notification in notifications:
+    for notification, timestamp in notifications:
       if not notification.first_queued:
         notification.first_queued = (self.frozen_timestamp or
                                      rdfvalue.RDFDatetime().Now())
@@ -639,15 +899,33 @@ class QueueManager(object):
       # Don't serialize session ids to save some bytes.
       notification.session_id = None
       notification.timestamp = None
-      serialized_notifications[session_id] = notification.SerializeToString()
+      serialized_notifications.setdefault(
+          self.NOTIFY_PREDICATE_PREFIX % session_id, []).append(
+              (notification.SerializeToString(), timestamp))
 
+    queue_shard = self.GetNotificationShard(queue)
     data_store.DB.MultiSet(
-        self.GetNotificationShard(queue),
-        dict([(self.NOTIFY_PREDICATE_PREFIX % session_id,
-               [(data, timestamp)])
-              for session_id, data in serialized_notifications.iteritems()]),
+        queue_shard, serialized_notifications,
         sync=sync, replace=False, token=self.token)
 
+    # Notifications scheduled for the future are left to the polling workers.
+    if (queue_notifier.NOTIFIER is not None and
+        any(timestamp is None or timestamp <= now
+            for values in serialized_notifications.itervalues()
+            for _, timestamp in values)):
+      self.shards_to_wake.add(queue_shard)
+
+      # Unsynced writes may not be visible to the workers until the data store
+      # is flushed so we wake them up in Flush() instead.
+      if sync:
+        self._WakeUpWorkers()
+
+  def _WakeUpWorkers(self):
+    """Tells the workers about shards which received new notifications."""
+    if self.shards_to_wake:
+      queue_notifier.NOTIFIER.Notify(self.shards_to_wake)
+      self.shards_to_wake = set()
+
   def DeleteNotification(self, session_id, start=None, end=None):
     """This deletes the notification when all messages have been processed."""
     if not isinstance(session_id, rdfvalue.SessionID):
@@ -823,6 +1101,110 @@ class WellKnownQueueManager(QueueManager):
       yield rdfvalue.RequestState(id=0), [response]
 
 
+class FlushBatcher(object):
+  """Writes the changes of concurrent queue managers in shared flushes.
+
+  Callers collect their changes in the queue manager of Batch() and block on
+  leaving it until the changes are written. The changes of all the callers
+  leaving in the meantime are merged and written by a single Flush(). The
+  first caller waiting becomes the writer: while other batches are still open
+  it waits up to interval seconds for them to join, unless max_operations
+  changes are pending already. If the flush fails, its error is raised in all
+  the callers whose changes it contained.
+  """
+
+  def __init__(self, store=None, token=None, interval=0.005,
+               max_operations=1000):
+    self.store = store
+    self.token = token
+    self.interval = interval
+    self.max_operations = max_operations
+    self.condition = threading.Condition(threading.Lock())
+    self.manager = QueueManager(store=store, token=token)
+    # Number of batches handed out which were not merged yet.
+    self.open_batches = 0
+    # Flushes are numbered. Changes merged now are written by the flush
+    # numbered generation, flushed_generation is the last one done.
+    self.generation = 0
+    self.flushed_generation = -1
+    self.flushing = False
+    # Maps generations to the number of callers waiting for them, and failed
+    # generations to their errors until all their callers have seen them.
+    self.waiting = {}
+    self.errors = {}
+
+  @contextlib.contextmanager
+  def Batch(self):
+    """Yields a queue manager whose changes are written on exit."""
+    manager = QueueManager(store=self.store, token=self.token)
+    with self.condition:
+      self.open_batches += 1
+
+    manager.FreezeTimestamp()
+    try:
+      yield manager
+    finally:
+      manager.UnfreezeTimestamp()
+      with self.condition:
+        self.open_batches -= 1
+        self.manager.Merge(manager)
+        self.condition.notify_all()
+
+        generation = self.generation
+        self.waiting[generation] = self.waiting.get(generation, 0) + 1
+        try:
+          self._WaitForFlush(generation)
+        finally:
+          self.waiting[generation] -= 1
+          if self.waiting[generation]:
+            error = self.errors.get(generation)
+          else:
+            del self.waiting[generation]
+            error = self.errors.pop(generation, None)
+
+        if error is not None:
+          raise error
+
+  def _WaitForFlush(self, generation):
+    """Waits until a flush is done, called with the condition held."""
+    while self.flushed_generation < generation:
+      if self.flushing:
+        self.condition.wait()
+        continue
+
+      # No flush is running, this thread writes the pending changes.
+      self.flushing = True
+      deadline = time.time() + self.interval
+      while (self.open_batches and
+             self.manager.PendingOperations() < self.max_operations):
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.condition.wait(remaining)
+
+      manager = self.manager
+      flushed = self.generation
+      self.manager = QueueManager(store=self.store, token=self.token)
+      self.generation += 1
+
+      error = None
+      self.condition.release()
+      try:
+        stats.STATS.RecordEvent("grr_queue_batched_flush_operations",
+                                manager.PendingOperations())
+        manager.Flush()
+      except Exception as e:  # pylint: disable=broad-except
+        logging.exception("Batched flush failed: %s", e)
+        error = e
+      finally:
+        self.condition.acquire()
+        if error is not None:
+          self.errors[flushed] = error
+        self.flushing = False
+        self.flushed_generation = flushed
+        self.condition.notify_all()
+
+
 class QueueManagerInit(registry.InitHook):
   """Registers vars used by the QueueManager."""
 
@@ -832,6 +1214,7 @@ class QueueManagerInit(registry.InitHook):
     # Counters used by the QueueManager.
     stats.STATS.RegisterCounterMetric("grr_task_retransmission_count")
     stats.STATS.RegisterCounterMetric("grr_task_ttl_expired_count")
+    stats.STATS.RegisterEventMetric("grr_queue_batched_flush_operations")
     stats.STATS.RegisterGaugeMetric("notification_queue_count", int,
                                     fields=[("queue_name", str),
                                             ("priority", str)])
@@ -2,6 +2,7 @@
 """Tests the queue manager."""
 
 
+import threading
 import time
 
 
@@ -12,11 +13,13 @@ from grr.lib import server_plugins
 from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import flags
+from grr.lib import flow
 from grr.lib import queue_manager
 from grr.lib import queues
 from grr.lib import rdfvalue
 from grr.lib import stats
 from grr.lib import test_lib
+from grr.lib import utils
 
 # pylint: mode=test
 
@@ -118,6 +121,97 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
     # Make sure the manager told us that more data is available.
     self.assertTrue(more_data)
 
+  def testPrefetchCompletedResponses(self):
+    """Tests that prefetched flows are served without data store reads."""
+    session_ids = [rdfvalue.SessionID(flow_name="prefetch%d" % i)
+                   for i in range(3)]
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      for session_id in session_ids:
+        manager.QueueRequest(session_id, rdfvalue.RequestState(
+            id=1, client_id=self.client_id, next_state="TestState",
+            session_id=session_id))
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=1, response_id=1))
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=1, response_id=2,
+            type=rdfvalue.GrrMessage.Type.STATUS))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.PrefetchCompletedResponses(session_ids)
+
+    with utils.Stubber(data_store.DB, "ResolveRegex", None):
+      with utils.Stubber(data_store.DB, "MultiResolveRegex", None):
+        for session_id in session_ids:
+          self.assertEqual(
+              len(list(manager.FetchCompletedRequests(session_id))), 1)
+
+          completed = list(manager.FetchCompletedResponses(session_id))
+          self.assertEqual(len(completed), 1)
+          self.assertEqual(len(completed[0][1]), 2)
+
+    # Flushing invalidates the prefetched data.
+    manager.DeleteFlowRequestStates(session_ids[0],
+                                    rdfvalue.RequestState(id=1))
+    manager.Flush()
+    self.assertEqual(list(manager.FetchCompletedRequests(session_ids[0])), [])
+
+  def testStreamedResponses(self):
+    """Tests that big response sets are read page by page."""
+    session_id = rdfvalue.SessionID(flow_name="stream")
+
+    with queue_manager.QueueManager(token=self.token) as manager:
+      manager.QueueRequest(session_id, rdfvalue.RequestState(
+          id=1, client_id=self.client_id, next_state="TestState",
+          session_id=session_id))
+      for response_id in range(1, 26):
+        manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+            request_id=1, response_id=response_id,
+            auth_state=rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED))
+      manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+          request_id=1, response_id=26,
+          auth_state=rdfvalue.GrrMessage.AuthorizationState.AUTHENTICATED,
+          payload=rdfvalue.GrrStatus(),
+          type=rdfvalue.GrrMessage.Type.STATUS))
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.response_page_size = 10
+
+    # Without streaming all the responses are read at once.
+    (_, responses), = manager.FetchCompletedResponses(session_id)
+    self.assertEqual(len(responses), 26)
+
+    (request, stream), = manager.FetchCompletedResponses(session_id,
+                                                         stream=True)
+    self.assertTrue(isinstance(stream, queue_manager.ResponseStream))
+    self.assertEqual(len(stream), 26)
+
+    pages = []
+    original_resolve_multi = data_store.DB.ResolveMulti
+
+    def ResolveMulti(subject, attributes, **kwargs):
+      pages.append(len(attributes))
+      return original_resolve_multi(subject, attributes, **kwargs)
+
+    with utils.Stubber(data_store.DB, "ResolveMulti", ResolveMulti):
+      self.assertEqual([msg.response_id for msg in stream], range(1, 27))
+
+      responses = flow.Responses(request=request, responses=stream)
+      self.assertTrue(responses.success)
+      self.assertEqual(len(responses), 25)
+      self.assertEqual(len(list(responses)), 25)
+
+    self.assertEqual(pages, [10, 10, 6, 10, 10, 6])
+    self.assertTrue(stream.IsComplete())
+
+    # Lost responses are noticed before the stream is processed.
+    data_store.DB.DeleteAttributes(
+        stream.subject, [manager.FLOW_RESPONSE_TEMPLATE % (1, 12)],
+        token=self.token)
+    (_, stream), = manager.FetchCompletedResponses(session_id, stream=True)
+    self.assertEqual(len(stream), 26)
+    self.assertFalse(stream.IsComplete())
+
   def testDeleteFlowRequestStates(self):
     """Check that we can efficiently destroy a single flow request."""
     session_id = rdfvalue.SessionID(flow_name="test3")
@@ -310,6 +404,33 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
 
     self.assertEqual(len(tasks), 0)
 
+  def testClientMessagesAreDeletedWhenFlushFails(self):
+    """Test that failed flow writes do not keep the client messages."""
+    task = rdfvalue.GrrMessage(queue=self.client_id.Queue(),
+                               session_id="aff4:/Test")
+
+    manager = queue_manager.QueueManager(token=self.token)
+    manager.Schedule([task])
+    tasks = manager.QueryAndOwn(self.client_id.Queue(), lease_seconds=100,
+                                limit=100)
+    self.assertEqual(len(tasks), 1)
+
+    manager.QueueResponse("aff4:/Test", rdfvalue.GrrMessage(
+        request_id=1, response_id=1))
+    manager.DeQueueClientRequest(self.client_id, tasks[0].task_id)
+
+    def MultiSubjectMultiSet(*unused_args, **unused_kwargs):
+      raise data_store.Error("Data store is down.")
+
+    with utils.Stubber(data_store.DB, "MultiSubjectMultiSet",
+                       MultiSubjectMultiSet):
+      manager.Flush()
+
+    self._current_mock_time += 1000
+    tasks = manager.QueryAndOwn(self.client_id.Queue(), lease_seconds=100,
+                                limit=100)
+    self.assertEqual(len(tasks), 0)
+
   def testReSchedule(self):
     """Test the ability to re-schedule a task."""
     test_queue = rdfvalue.RDFURN("fooReschedule")
@@ -421,6 +542,86 @@ class QueueManagerTest(test_lib.FlowTestsBaseclass):
         self.assertEqual(
             len(manager2.GetNotificationsForAllShards(queues.HUNTS)), 1)
 
+  def testFlushBatcher(self):
+    """Tests that concurrent batches are written by a single flush."""
+    session_id = rdfvalue.SessionID(flow_name="batched")
+    batcher = queue_manager.FlushBatcher(token=self.token, interval=60)
+
+    def QueueStatus(manager, request_id):
+      manager.QueueRequest(session_id, rdfvalue.RequestState(
+          id=request_id, client_id=self.client_id, next_state="TestState",
+          session_id=session_id))
+      manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+          request_id=request_id, response_id=1,
+          type=rdfvalue.GrrMessage.Type.STATUS))
+      manager.QueueNotification(session_id=session_id,
+                                last_status=request_id)
+
+    def SecondBatch():
+      with batcher.Batch() as manager:
+        QueueStatus(manager, 2)
+
+    # The second batch is closed first, its flush waits for the open one.
+    first = batcher.Batch()
+    QueueStatus(first.__enter__(), 1)
+    thread = threading.Thread(target=SecondBatch)
+    thread.start()
+    for _ in range(100):
+      if batcher.manager.PendingOperations():
+        break
+      time.sleep(0.01)
+    first.__exit__(None, None, None)
+    thread.join()
+
+    self.assertEqual(batcher.flushed_generation, 0)
+    completed = list(batcher.manager.FetchCompletedRequests(session_id))
+    self.assertEqual(sorted(request.id for request, _ in completed), [1, 2])
+    self.assertEqual(
+        len(batcher.manager.GetNotificationsForAllShards(session_id.Queue())),
+        1)
+
+  def testFlushBatcherErrors(self):
+    """Tests that a failed flush is raised in all the batches it contained."""
+    session_id = rdfvalue.SessionID(flow_name="batched")
+    batcher = queue_manager.FlushBatcher(token=self.token, interval=60)
+    errors = []
+
+    def QueueResponse(manager, request_id):
+      manager.QueueResponse(session_id, rdfvalue.GrrMessage(
+          request_id=request_id, response_id=1))
+
+    def SecondBatch():
+      try:
+        with batcher.Batch() as manager:
+          QueueResponse(manager, 2)
+      except IOError as e:
+        errors.append(e)
+
+    def MultiSubjectMultiSet(*unused_args, **unused_kwargs):
+      raise IOError("Data store is down.")
+
+    with utils.Stubber(data_store.DB, "MultiSubjectMultiSet",
+                       MultiSubjectMultiSet):
+      first = batcher.Batch()
+      QueueResponse(first.__enter__(), 1)
+      thread = threading.Thread(target=SecondBatch)
+      thread.start()
+      for _ in range(100):
+        if batcher.manager.PendingOperations():
+          break
+        time.sleep(0.01)
+      self.assertRaises(IOError, first.__exit__, None, None, None)
+      thread.join()
+
+    self.assertEqual(len(errors), 1)
+    self.assertEqual(batcher.flushed_generation, 0)
+    self.assertEqual(batcher.errors, {})
+
+    # Later batches are written again.
+    with batcher.Batch() as manager:
+      QueueResponse(manager, 3)
+    self.assertEqual(batcher.flushed_generation, 1)
+
   def testMultipleNotificationsForTheSameSessionId(self):
     manager = queue_manager.QueueManager(token=self.token)
     manager.QueueNotification(
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+"""Wakes up workers as soon as new notifications are queued.
+
+Workers find new work by polling the notification shards of their queues. On
+an idle system this means a steady stream of ResolveRegex calls which return
+nothing, and on a busy one up to a full polling interval of added latency for
+every flow state transition.
+
+A QueueNotifier is a side channel which the QueueManager signals whenever it
+writes notifications to a queue shard. Workers subscribe to the shards they
+process and block on the subscription instead of sleeping, so they run as soon
+as there is something to do. Wakeups are only hints: the notifications
+themselves are still read from the data store and workers keep polling at a
+lower rate to pick up anything a notifier did not deliver.
+"""
+
+
+import errno
+import itertools
+import os
+import select
+import socket
+import zlib
+
+
+import logging
+
+from grr.lib import config_lib
+from grr.lib import registry
+from grr.lib import stats
+from grr.lib import utils
+
+
+class QueueSubscription(object):
+  """A set of queue shards a worker waits on."""
+
+  def Wait(self, timeout):
+    """Blocks until one of the queue shards is notified.
+
+    Args:
+      timeout: The maximum number of seconds to wait.
+
+    Returns:
+      A list of the queue shards which were notified. Empty if the timeout
+      expired first.
+    """
+    raise NotImplementedError()
+
+  def Close(self):
+    """Stops receiving wakeups."""
+
+
+class QueueNotifier(object):
+  """Base class for all queue notifier implementations."""
+
+  __metaclass__ = registry.MetaclassRegistry
+  __abstract = True  # pylint: disable=g-bad-name
+
+  def Notify(self, queue_shards):
+    """Wakes up all the workers subscribed to any of the queue shards."""
+    raise NotImplementedError()
+
+  def Subscribe(self, queue_shards):
+    """Returns a QueueSubscription for the queue shards."""
+    raise NotImplementedError()
+
+
+class UnixSocketQueueSubscription(QueueSubscription):
+  """A subscription holding one datagram socket per queue shard."""
+
+  def __init__(self, notifier, queue_shards):
+    super(UnixSocketQueueSubscription, self).__init__()
+    self.sockets = {}
+    try:
+      for queue_shard in queue_shards:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.setblocking(0)
+        self.sockets[sock] = (queue_shard, notifier.NewSocketPath(queue_shard))
+        sock.bind(self.sockets[sock][1])
+    except:
+      self.Close()
+      raise
+
+  def Wait(self, timeout):
+    try:
+      readable, _, _ = select.select(self.sockets.keys(), [], [], timeout)
+    except select.error as e:
+      if e.args[0] != errno.EINTR:
+        raise
+      return []
+
+    result = []
+    for sock in readable:
+      # Many notifications for the same shard only need a single run, so we
+      # drain everything that has been queued so far.
+      try:
+        while sock.recv(1):
+          pass
+      except socket.error as e:
+        if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          raise
+
+      result.append(self.sockets[sock][0])
+
+    if result:
+      stats.STATS.IncrementCounter("queue_notifier_wakeups_received")
+
+    return result
+
+  def Close(self):
+    for sock, (_, path) in self.sockets.items():
+      sock.close()
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
+
+    self.sockets = {}
+
+
+class UnixSocketQueueNotifier(QueueNotifier):
+  """A notifier for all the processes on one node using unix sockets.
+
+  Every subscribed worker binds a datagram socket in a directory named after
+  the queue shard:
+
+    <Worker.queue_notifier_socket_dir>/<hash of queue shard>/<pid>.<n>
+
+  Notify() sends a single byte to every socket in the directory of the shard.
+  There is no broker process, sockets of workers which died without cleaning
+  up are removed by the first process which fails to deliver to them.
+  """
+
+  def __init__(self, socket_dir=None):
+    super(UnixSocketQueueNotifier, self).__init__()
+    self.socket_dir = (socket_dir or
+                       config_lib.CONFIG["Worker.queue_notifier_socket_dir"])
+    self.socket_ids = itertools.count()
+    self.sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    self.sender.setblocking(0)
+
+  def _ShardDirectory(self, queue_shard):
+    return os.path.join(
+        self.socket_dir,
+        "%08x" % (zlib.crc32(utils.SmartStr(queue_shard)) & 0xffffffff))
+
+  def NewSocketPath(self, queue_shard):
+    directory = self._ShardDirectory(queue_shard)
+    try:
+      os.makedirs(directory, 0700)
+    except OSError as e:
+      if e.errno != errno.EEXIST:
+        raise
+
+    return os.path.join(directory,
+                        "%d.%d" % (os.getpid(), self.socket_ids.next()))
+
+  def Notify(self, queue_shards):
+    for queue_shard in queue_shards:
+      directory = self._ShardDirectory(queue_shard)
+      try:
+        names = os.listdir(directory)
+      except OSError:
+        # Nobody ever subscribed to this shard.
+        continue
+
+      for name in names:
+        path = os.path.join(directory, name)
+        try:
+          self.sender.sendto("\x00", path)
+          stats.STATS.IncrementCounter("queue_notifier_wakeups_sent")
+        except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS):
+            # The worker has not picked up the previous wakeups yet so it
+            # will run anyways.
+            continue
+
+          if e.errno in (errno.ECONNREFUSED, errno.ENOENT):
+            logging.debug("Removing stale queue notifier socket %s", path)
+            try:
+              os.unlink(path)
+            except OSError:
+              pass
+            continue
+
+          logging.warning("Unable to wake up %s: %s", path, e)
+
+  def Subscribe(self, queue_shards):
+    return UnixSocketQueueSubscription(self, queue_shards)
+
+
+# The notifier used by this process, None if wakeups are disabled.
+NOTIFIER = None
+
+
+class QueueNotifierInit(registry.InitHook):
+  """Creates the queue notifier and registers its stats."""
+
+  pre = ["StatsInit"]
+
+  def RunOnce(self):
+    """Initialize the queue notifier."""
+    global NOTIFIER  # pylint: disable=global-statement
+
+    stats.STATS.RegisterCounterMetric("queue_notifier_wakeups_sent")
+    stats.STATS.RegisterCounterMetric("queue_notifier_wakeups_received")
+
+    notifier_name = config_lib.CONFIG["Worker.queue_notifier"]
+    if notifier_name:
+      try:
+        cls = QueueNotifier.GetPlugin(notifier_name)
+      except KeyError:
+        raise RuntimeError("No queue notifier %s found." % notifier_name)
+
+      NOTIFIER = cls()
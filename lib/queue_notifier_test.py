@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+"""Tests for the queue notifiers."""
+
+
+import os
+import socket
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import flags
+from grr.lib import queue_manager
+from grr.lib import queue_notifier
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils
+
+
+class UnixSocketQueueNotifierTest(test_lib.GRRBaseTest):
+  """Test the unix socket queue notifier."""
+
+  def setUp(self):
+    super(UnixSocketQueueNotifierTest, self).setUp()
+    self.notifier = queue_notifier.UnixSocketQueueNotifier(
+        socket_dir=os.path.join(self.temp_dir, "notifier"))
+    self.shard1 = rdfvalue.RDFURN("aff4:/W")
+    self.shard2 = rdfvalue.RDFURN("aff4:/W/1")
+
+  def testWakeup(self):
+    subscription = self.notifier.Subscribe([self.shard1, self.shard2])
+    try:
+      self.assertEqual(subscription.Wait(0), [])
+
+      # Repeated wakeups for a shard only wake up the subscriber once.
+      self.notifier.Notify([self.shard2])
+      self.notifier.Notify([self.shard2])
+      self.assertEqual(subscription.Wait(1), [self.shard2])
+      self.assertEqual(subscription.Wait(0), [])
+
+      self.notifier.Notify([rdfvalue.RDFURN("aff4:/W/2")])
+      self.assertEqual(subscription.Wait(0), [])
+    finally:
+      subscription.Close()
+
+  def testAllSubscribersAreWokenUp(self):
+    # Another notifier instance behaves like another process.
+    other_notifier = queue_notifier.UnixSocketQueueNotifier(
+        socket_dir=self.notifier.socket_dir)
+    subscription1 = self.notifier.Subscribe([self.shard1])
+    subscription2 = other_notifier.Subscribe([self.shard1])
+    try:
+      other_notifier.Notify([self.shard1])
+      self.assertEqual(subscription1.Wait(1), [self.shard1])
+      self.assertEqual(subscription2.Wait(1), [self.shard1])
+    finally:
+      subscription1.Close()
+      subscription2.Close()
+
+  def testStaleSocketsAreRemoved(self):
+    path = self.notifier.NewSocketPath(self.shard1)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+    sock.bind(path)
+    # Closing the socket without unlinking it is what a crashed worker leaves
+    # behind.
+    sock.close()
+
+    self.notifier.Notify([self.shard1])
+    self.assertFalse(os.path.exists(path))
+
+  def testQueueManagerWakesUpWorkers(self):
+    subscription = self.notifier.Subscribe(
+        queue_manager.QueueManager(token=self.token).GetAllNotificationShards(
+            rdfvalue.RDFURN("aff4:/W")))
+    session_id = rdfvalue.SessionID("aff4:/W/Test")
+
+    try:
+      with utils.Stubber(queue_notifier, "NOTIFIER", self.notifier):
+        manager = queue_manager.QueueManager(token=self.token)
+        manager.NotifyQueue(rdfvalue.GrrNotification(session_id=session_id))
+        self.assertEqual(len(subscription.Wait(1)), 1)
+
+        # Unsynced notifications only wake up workers when they are flushed.
+        with queue_manager.QueueManager(token=self.token) as manager:
+          manager.QueueNotification(session_id=session_id)
+          self.assertEqual(subscription.Wait(0), [])
+        self.assertEqual(len(subscription.Wait(1)), 1)
+
+        # Notifications for the future are picked up by polling.
+        manager.NotifyQueue(rdfvalue.GrrNotification(session_id=session_id),
+                            timestamp=rdfvalue.RDFDatetime().Now() + 3600)
+        self.assertEqual(subscription.Wait(0), [])
+    finally:
+      subscription.Close()
+
+
+def main(argv):
+  test_lib.main(argv)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
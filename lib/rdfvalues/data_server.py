@@ -22,6 +22,10 @@ class DataServerInformation(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerInformation
 
 
+class DataServerVirtualNode(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerVirtualNode
+
+
 class DataServerMapping(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerMapping
 
@@ -42,9 +46,21 @@ class DataServerRebalance(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataServerRebalance
 
 
+class DataServerMigration(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerMigration
+
+
 class DataStoreRegistrationRequest(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataStoreRegistrationRequest
 
 
 class DataStoreAuthToken(rdfvalue.RDFProtoStruct):
   protobuf = data_server_pb2.DataStoreAuthToken
+
+
+class DataServerChange(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerChange
+
+
+class DataServerReplicaRequest(rdfvalue.RDFProtoStruct):
+  protobuf = data_server_pb2.DataServerReplicaRequest
@@ -299,6 +299,10 @@ class CipherMetadata(rdfvalue.RDFProtoStruct):
   protobuf = jobs_pb2.CipherMetadata
 
 
+class SessionTicketState(rdfvalue.RDFProtoStruct):
+  protobuf = jobs_pb2.SessionTicketState
+
+
 class HuntError(rdfvalue.RDFProtoStruct):
   """An RDFValue class representing a hunt error."""
   protobuf = jobs_pb2.HuntError
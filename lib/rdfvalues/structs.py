@@ -924,7 +924,16 @@ class ProtoNested(ProtoType):
       value, index = type_info_obj.Read(buff, index)
 
       if type_info_obj.__class__ is ProtoList:
-        value_obj.Get(type_info_obj.name).Append(wire_format=value)
+        # Append the wire format directly rather than through Get() and
+        # Append(), so parsing does not mark value_obj or the list as dirty.
+        entry = raw_data.get(type_info_obj.name)
+        if entry is None:
+          repeated = type_info_obj.GetDefault(container=value_obj)
+          raw_data[type_info_obj.name] = (repeated, None, type_info_obj)
+        else:
+          repeated = entry[0]
+
+        repeated.wrapped_list.append((None, value))
       else:
         raw_data[type_info_obj.name] = (None, value, type_info_obj)
 
@@ -1105,7 +1114,7 @@ class RepeatedFieldHelper(object):
 
     # If any of the items is dirty we are also dirty.
     for item in self.wrapped_list:
-      if self.type_descriptor.IsDirty(item[0]):
+      if item[0] is not None and self.type_descriptor.IsDirty(item[0]):
         self.dirty = True
         return True
 
@@ -1115,6 +1124,13 @@ class RepeatedFieldHelper(object):
     return RepeatedFieldHelper(wrapped_list=self.wrapped_list[:],
                                type_descriptor=self.type_descriptor)
 
+  def __copy__(self):
+    # A copy must not share our list, otherwise appending to the copy would
+    # change the original without marking it dirty.
+    return RepeatedFieldHelper(wrapped_list=self.wrapped_list[:],
+                               type_descriptor=self.type_descriptor,
+                               container=self.container)
+
   def Append(self, rdf_value=utils.NotAValue, wire_format=None, **kwargs):
     """Append the value to our internal list."""
     if rdf_value is utils.NotAValue:
@@ -1133,12 +1149,14 @@ class RepeatedFieldHelper(object):
                                        type(rdf_value), e))
 
     self.wrapped_list.append((rdf_value, wire_format))
+    self.dirty = True
 
     return rdf_value
 
   def Pop(self, item):
     result = self[item]
     self.wrapped_list.pop(item)
+    self.dirty = True
     return result
 
   def Extend(self, iterable):
@@ -1628,6 +1646,11 @@ class RDFStruct(rdfvalue.RDFValue):
 
   _data = None
 
+  # A tuple of the string this object was parsed from and a snapshot of the raw
+  # data parsing produced. As long as the raw data still matches the snapshot,
+  # SerializeToString() returns the string instead of encoding every field.
+  _serialized = None
+
   # This is the serializer which will be used by this class. It can be
   # interchanged or overriden as required.
   _serializer = JsonSerializer()
@@ -1751,12 +1774,62 @@ class RDFStruct(rdfvalue.RDFValue):
     self.dirty = True
 
   def SerializeToString(self):
+    if self._serialized is not None:
+      if self._MatchesSerialized():
+        return self._serialized[0]
+
+      # Once modified the string is never valid again.
+      self._serialized = None
+
     return self._serializer.SerializeToString(self)
 
   def ParseFromString(self, string):
+    # Parsing into an object which already has fields merges them, so the string
+    # alone does not describe the result.
+    reusable = not self._data and string.__class__ is str
+
     self._serializer.ParseFromString(self, string)
     self.dirty = True
 
+    if reusable:
+      self._serialized = (string, self._data.copy())
+    else:
+      self._serialized = None
+
+  def _MatchesSerialized(self):
+    """Checks that no field changed since this object was parsed.
+
+    Fields which were only decoded keep their wire format, so comparing the raw
+    data entries with the snapshot taken after parsing finds every field which
+    was set, cleared or replaced since. Decoded values which were modified in
+    place report themselves through their type descriptor's IsDirty().
+
+    Returns:
+      True if serializing this object would produce the parsed string.
+    """
+    parsed_data = self._serialized[1]
+    if len(self._data) != len(parsed_data):
+      return False
+
+    for name, (python_format, wire_format,
+               type_descriptor) in self._data.iteritems():
+      parsed = parsed_data.get(name)
+      if parsed is None:
+        return False
+
+      # Repeated fields are parsed straight into their python format.
+      if wire_format is None:
+        if python_format is not parsed[0]:
+          return False
+
+      elif wire_format is not parsed[1]:
+        return False
+
+      if python_format is not None and type_descriptor.IsDirty(python_format):
+        return False
+
+    return True
+
   def __eq__(self, other):
     if not isinstance(other, self.__class__):
       return False
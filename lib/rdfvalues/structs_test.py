@@ -9,6 +9,7 @@ from google.protobuf import message_factory
 
 from grr.lib import rdfvalue
 from grr.lib import type_info
+from grr.lib import utils
 from grr.lib.rdfvalues import structs
 from grr.lib.rdfvalues import test_base
 
@@ -292,6 +293,55 @@ class RDFStructsTest(test_base.RDFValueTestCase):
     # old result instead.
     self.assertTrue("booo" in path.SerializeToString())
 
+  def testSerializedFormIsReused(self):
+    tested = TestStruct(foobar="hello", repeated=["a", "b"])
+    tested.nested.foobar = "nested"
+    tested.repeat_nested.Append(foobar="repeated nested")
+    data = tested.SerializeToString()
+
+    def Fail(*unused_args):
+      raise AssertionError("Unmodified struct was encoded again.")
+
+    parsed = TestStruct(data)
+
+    # Reading fields decodes them without modifying the struct.
+    self.assertEqual(parsed.foobar, "hello")
+    self.assertEqual(parsed.repeated, ["a", "b"])
+    self.assertEqual(parsed.nested.foobar, "nested")
+    self.assertEqual(parsed.repeat_nested[0].foobar, "repeated nested")
+
+    # Neither does modifying a copy.
+    parsed.Copy().repeated.Append("c")
+    self.assertEqual(parsed.repeated, ["a", "b"])
+
+    with utils.Stubber(structs.ProtocolBufferSerializer, "SerializeToString",
+                       Fail):
+      self.assertTrue(parsed.SerializeToString() is data)
+
+    # Repeated embedded items which were never decoded are not dirty either.
+    parsed = TestStruct(data)
+    self.assertEqual(parsed.foobar, "hello")
+    with utils.Stubber(structs.ProtocolBufferSerializer, "SerializeToString",
+                       Fail):
+      self.assertTrue(parsed.SerializeToString() is data)
+
+    modifications = [
+        lambda x: setattr(x, "foobar", "changed"),
+        lambda x: setattr(x, "int", 10),
+        lambda x: x.repeated.Append("c"),
+        lambda x: x.repeated.Pop(0),
+        lambda x: setattr(x.nested, "foobar", "changed"),
+        lambda x: setattr(x.repeat_nested[0], "foobar", "changed"),
+        lambda x: x.Clear()]
+
+    for modification in modifications:
+      parsed = TestStruct(data)
+      modification(parsed)
+
+      serialized = parsed.SerializeToString()
+      self.assertNotEqual(serialized, data)
+      self.assertEqual(TestStruct(serialized), parsed)
+
   def testWireFormatAccess(self):
 
     m = rdfvalue.SignedMessageList()
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+"""Benchmarks of the hot code paths of the GRR server.
+
+The data store specific subclasses of _ServerBenchmarks live next to the data
+store tests. Run them with --labels=benchmark, for example:
+
+  run_tests.py --labels=benchmark --tests=SqliteServerBenchmarks \
+      --benchmark_results_dir=/tmp/new --benchmark_baseline_dir=/tmp/old
+"""
+
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.client import comms
+from grr.lib import aff4
+from grr.lib import config_lib
+from grr.lib import flow
+from grr.lib import queue_manager
+from grr.lib import queues
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+
+class _ServerBenchmarks(test_lib.ThroughputBenchmarks):
+  """Benchmarks the server against a data store.
+
+  Subclasses set up the data store to benchmark in InitDatastore().
+  """
+
+  REPEATS = 20
+
+  # The number of clients opened at once.
+  nr_clients = 10000
+
+  # The number of messages in every bundle, queue or collection.
+  nr_messages = 100
+
+  def setUp(self):
+    super(_ServerBenchmarks, self).setUp()
+    self.InitDatastore()
+
+  def tearDown(self):
+    super(_ServerBenchmarks, self).tearDown()
+    self.DestroyDatastore()
+
+  def InitDatastore(self):
+    """Initiates custom data store."""
+
+  def DestroyDatastore(self):
+    """Destroys custom data store."""
+
+  def _MakeStatEntry(self, i):
+    return rdfvalue.StatEntry(
+        aff4path="aff4:/C.1000000000000000/fs/os/dir/file%d" % i,
+        st_mode=33261, st_ino=1026267, st_dev=51713, st_nlink=1, st_uid=0,
+        st_gid=0, st_size=60064, st_atime=1308964274, st_mtime=1285093975,
+        st_ctime=1299502221, st_blocks=128, st_blksize=4096, st_rdev=0,
+        pathspec=rdfvalue.PathSpec(path="/dir/file%d" % i, pathtype="OS"))
+
+  def _MakeMessage(self, i, **kwargs):
+    return rdfvalue.GrrMessage(
+        session_id=rdfvalue.SessionID(base="aff4:/flows", queue=queues.FLOWS,
+                                      flow_name="Benchmark"),
+        name="ListDirectory", request_id=1, response_id=i + 1,
+        payload=self._MakeStatEntry(i), **kwargs)
+
+  @test_lib.SetLabel("benchmark")
+  def testRDFValueSerialization(self):
+    stat_entry = self._MakeStatEntry(0)
+    message = self._MakeMessage(0)
+    serialized_stat_entry = stat_entry.SerializeToString()
+    serialized_message = message.SerializeToString()
+    repetitions = self.REPEATS * 100
+
+    def EncodeStatEntry():
+      self._MakeStatEntry(0).SerializeToString()
+
+    def DecodeStatEntry():
+      result = rdfvalue.StatEntry(serialized_stat_entry)
+      return result.aff4path, result.st_size, result.pathspec.path
+
+    def EncodeGrrMessage():
+      self._MakeMessage(0).SerializeToString()
+
+    def DecodeGrrMessage():
+      result = rdfvalue.GrrMessage(serialized_message)
+      return result.session_id, result.payload.st_size
+
+    def RouteGrrMessage():
+      # Messages which are only passed on are decoded and encoded again.
+      result = rdfvalue.GrrMessage(serialized_message)
+      return result.session_id, result.SerializeToString()
+
+    for callback in [EncodeStatEntry, DecodeStatEntry, EncodeGrrMessage,
+                     DecodeGrrMessage, RouteGrrMessage]:
+      self.Measure(callback, repetitions=repetitions)
+
+  @test_lib.SetLabel("benchmark")
+  def testMultiOpenClients(self):
+    client_ids = [rdfvalue.ClientURN("C.%016X" % i)
+                  for i in xrange(self.nr_clients)]
+    for client_id in client_ids:
+      with aff4.FACTORY.Create(client_id, "VFSGRRClient", mode="w",
+                               token=self.token) as fd:
+        fd.Set(fd.Schema.HOSTNAME("Host-%s" % client_id.Basename()))
+
+    def MultiOpenClients():
+      fds = list(aff4.FACTORY.MultiOpen(client_ids, mode="r",
+                                        ignore_cache=True, token=self.token))
+      self.assertEqual(len(fds), self.nr_clients)
+
+    self.Measure(MultiOpenClients,
+                 name="MultiOpen %d clients" % self.nr_clients,
+                 repetitions=3, operations=self.nr_clients)
+
+  @test_lib.SetLabel("benchmark")
+  def testQueueManager(self):
+    manager = queue_manager.QueueManager(token=self.token)
+    queue_urns = [rdfvalue.RDFURN("aff4:/benchmark/queue%d" % i)
+                  for i in xrange(self.REPEATS)]
+    tasks = [[self._MakeMessage(i, queue=queue_urn)
+              for i in xrange(self.nr_messages)] for queue_urn in queue_urns]
+
+    # Every repetition uses its own queue.
+    to_schedule = iter(tasks)
+    to_lease = iter(queue_urns)
+
+    def Schedule():
+      manager.Schedule(next(to_schedule), sync=True)
+
+    def QueryAndOwn():
+      leased = manager.QueryAndOwn(next(to_lease), lease_seconds=100,
+                                   limit=self.nr_messages)
+      self.assertEqual(len(leased), self.nr_messages)
+
+    self.Measure(Schedule, operations=self.nr_messages)
+    self.Measure(QueryAndOwn, operations=self.nr_messages)
+
+  @test_lib.SetLabel("benchmark")
+  def testHandleMessageBundles(self):
+    client_private_key = config_lib.CONFIG["Client.private_key"]
+    client_communicator = comms.ClientCommunicator(
+        private_key=client_private_key)
+    client_communicator.LoadServerCertificate(
+        server_certificate=config_lib.CONFIG["Frontend.certificate"],
+        ca_certificate=config_lib.CONFIG["CA.certificate"])
+
+    # The server needs the certificate of the client to answer it.
+    cert = rdfvalue.RDFX509Cert(
+        self.ClientCertFromPrivateKey(client_private_key).as_pem())
+    with aff4.FACTORY.Create(cert.common_name, "VFSGRRClient",
+                             token=self.token) as fd:
+      fd.Set(fd.Schema.CERT, cert)
+
+    server = flow.FrontEndServer(
+        certificate=config_lib.CONFIG["Frontend.certificate"],
+        private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+        threadpool_prefix="pool-%s" % self._testMethodName)
+
+    message_list = rdfvalue.MessageList(
+        job=[self._MakeMessage(i) for i in xrange(self.nr_messages)])
+
+    # Every bundle is encrypted again, since the server rejects replays.
+    request_comms = []
+
+    def EncodeBundle():
+      result = rdfvalue.ClientCommunication()
+      client_communicator.EncodeMessages(message_list, result)
+      request_comms[:] = [result]
+
+    def HandleMessageBundles():
+      server.HandleMessageBundles(request_comms[0],
+                                  rdfvalue.ClientCommunication())
+
+    self.Measure(HandleMessageBundles, operations=self.nr_messages,
+                 pre=EncodeBundle)
+
+  @test_lib.SetLabel("benchmark")
+  def testPackedVersionedCollectionCompact(self):
+    urn = rdfvalue.RDFURN("aff4:/benchmark/collection")
+    aff4.FACTORY.Create(urn, "PackedVersionedCollection", mode="w",
+                        token=self.token).Close()
+
+    def AddItems():
+      with aff4.FACTORY.Open(urn, "PackedVersionedCollection", mode="rw",
+                             token=self.token) as fd:
+        for i in xrange(self.nr_messages):
+          fd.Add(self._MakeMessage(i))
+
+    def Compact():
+      with aff4.FACTORY.OpenWithLock(urn, "PackedVersionedCollection",
+                                     token=self.token) as fd:
+        self.assertEqual(fd.Compact(), self.nr_messages)
+
+    self.Measure(Compact, operations=self.nr_messages, pre=AddItems)
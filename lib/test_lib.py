@@ -42,6 +42,7 @@ from grr.client.client_actions import standard
 from grr.lib import access_control
 from grr.lib import action_mocks
 from grr.lib import aff4
+from grr.lib import benchmark_lib
 from grr.lib import client_index
 from grr.lib import config_lib
 
@@ -77,6 +78,17 @@ flags.DEFINE_list("tests", None,
 flags.DEFINE_list("labels", ["small"],
                   "A list of test labels to run. (e.g. benchmarks,small).")
 
+flags.DEFINE_string("benchmark_results_dir", None,
+                    "If set, benchmarks write their results as JSON files into "
+                    "this directory.")
+
+flags.DEFINE_string("benchmark_baseline_dir", None,
+                    "The benchmark_results_dir of an earlier run. Benchmarks "
+                    "which got slower since are reported as regressions.")
+
+flags.DEFINE_float("benchmark_regression_threshold", 0.1,
+                   "The relative slowdown reported as a benchmark regression.")
+
 
 class Error(Exception):
   """Test base error."""
@@ -1259,6 +1271,87 @@ class AverageMicroBenchmarks(MicroBenchmarks):
     self.AddResult(name, time_taken, repetitions, return_value)
 
 
+class ThroughputBenchmarks(MicroBenchmarks):
+  """Benchmarks which report throughput and latency percentiles.
+
+  The results of each test are also written as JSON into the directory given
+  by --benchmark_results_dir and compared against --benchmark_baseline_dir.
+  """
+
+  REPEATS = 100
+  units = "ms"
+
+  def setUp(self):
+    super(ThroughputBenchmarks, self).setUp(
+        ["Throughput (ops/s)", "p50 (ms)", "p99 (ms)"], ["<20", "<12", "<12"])
+    self.results = []
+
+  def tearDown(self):
+    super(ThroughputBenchmarks, self).tearDown()
+    if not self.results:
+      return
+
+    benchmark = "%s.%s" % (self.__class__.__name__, self._testMethodName)
+    if flags.FLAGS.benchmark_results_dir:
+      benchmark_lib.WriteResults(flags.FLAGS.benchmark_results_dir, benchmark,
+                                 self.results,
+                                 data_store=data_store.DB.__class__.__name__)
+
+    if flags.FLAGS.benchmark_baseline_dir:
+      baseline = benchmark_lib.ReadResults(flags.FLAGS.benchmark_baseline_dir,
+                                           benchmark)
+      if baseline is None:
+        print "No baseline for benchmark %s." % benchmark
+        return
+
+      for name, metric, old, new in benchmark_lib.CompareResults(
+          baseline, self.results,
+          threshold=flags.FLAGS.benchmark_regression_threshold):
+        print "REGRESSION %s: %s %s: %.6g -> %.6g" % (benchmark, name, metric,
+                                                      old, new)
+
+  def Measure(self, callback, name=None, repetitions=None, operations=1,
+              pre=None, **kwargs):
+    """Times every call of the callback and records the summary.
+
+    Args:
+      callback: The function to benchmark, called with kwargs.
+      name: The name of the result, by default the name of the callback.
+      repetitions: How often to call the callback, by default REPEATS.
+      operations: The number of operations each call does, used to calculate
+          the throughput.
+      pre: If set, this is called before every call of the callback. Its time
+          is not measured.
+      **kwargs: Passed to the callback.
+
+    Returns:
+      The summary, as returned by benchmark_lib.Summarize().
+    """
+    if repetitions is None:
+      repetitions = self.REPEATS
+
+    if name is None:
+      name = callback.__name__
+
+    durations = []
+    for _ in xrange(repetitions):
+      if pre is not None:
+        pre()
+
+      start = time.time()
+      callback(**kwargs)
+      durations.append(time.time() - start)
+
+    result = benchmark_lib.Summarize(name, durations, operations=operations)
+    self.results.append(result)
+    self.AddResult(name, result["mean"], repetitions,
+                   "%.2f" % result["throughput"],
+                   "%.4f" % (result["p50"] * 1e3),
+                   "%.4f" % (result["p99"] * 1e3))
+
+    return result
+
+
 class GRRTestLoader(unittest.TestLoader):
   """A test suite loader which searches for tests in all the plugins."""
 
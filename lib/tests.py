@@ -7,10 +7,13 @@ This module loads and registers all the GRR library tests.
 
 # These need to register plugins so, pylint: disable=unused-import
 from grr.lib import access_control_test
+from grr.lib import aff4_shared_cache_test
 from grr.lib import aff4_test
 from grr.lib import artifact_lib_test
 from grr.lib import artifact_test
+from grr.lib import benchmark_lib_test
 from grr.lib import build_test
+from grr.lib import client_key_cache_test
 from grr.lib import communicator_test
 from grr.lib import config_lib_test
 from grr.lib import config_validation_test
@@ -28,6 +31,7 @@ from grr.lib import lexer_test
 from grr.lib import objectfilter_test
 from grr.lib import parsers_test
 from grr.lib import queue_manager_test
+from grr.lib import queue_notifier_test
 from grr.lib import rekall_profile_server_test
 from grr.lib import search_test
 from grr.lib import stats_test
@@ -45,4 +49,5 @@ from grr.lib.hunts import tests
 from grr.lib.output_plugins import tests
 from grr.lib.rdfvalues import tests
 from grr.tools import entry_point_test
+from grr.tools import http_server_test
 # pylint: enable=unused-import
@@ -15,6 +15,7 @@ from grr.lib import flags
 from grr.lib import flow
 from grr.lib import master
 from grr.lib import queue_manager as queue_manager_lib
+from grr.lib import queue_notifier
 from grr.lib import queues as queues_config
 from grr.lib import rdfvalue
 from grr.lib import registry
@@ -92,24 +93,36 @@ class GRRWorker(object):
     self.flow_lease_time = config_lib.CONFIG["Worker.flow_lease_time"]
     self.well_known_flow_lease_time = config_lib.CONFIG[
         "Worker.well_known_flow_lease_time"]
+    self.flow_batch_size = config_lib.CONFIG["Worker.flow_batch_size"]
+
+    # If a queue notifier is configured we wait for wakeups on all the queue
+    # shards we process instead of just sleeping between polls.
+    self.subscription = None
+    self.queues_by_shard = {}
+    if queue_notifier.NOTIFIER is not None:
+      manager = queue_manager_lib.QueueManager(token=token)
+      for queue in self.queues:
+        for queue_shard in manager.GetAllNotificationShards(queue):
+          self.queues_by_shard[queue_shard] = queue
+
+      self.subscription = queue_notifier.NOTIFIER.Subscribe(
+          self.queues_by_shard.keys())
+      self.notifier_polling_interval = config_lib.CONFIG[
+          "Worker.queue_notifier_polling_interval"]
 
   def Run(self):
     """Event loop."""
+    queue_shards = None
     try:
       while 1:
         if master.MASTER_WATCHER.IsMaster():
-          processed = self.RunOnce()
+          processed = self.RunOnce(queue_shards=queue_shards)
         else:
           processed = 0
 
+        queue_shards = None
         if processed == 0:
-
-          if time.time() - self.last_active > self.SHORT_POLL_TIME:
-            interval = self.POLLING_INTERVAL
-          else:
-            interval = self.SHORT_POLLING_INTERVAL
-
-          time.sleep(interval)
+          queue_shards = self.WaitForNotifications()
         else:
           self.last_active = time.time()
 
@@ -117,27 +130,58 @@ class GRRWorker(object):
       logging.info("Caught interrupt, exiting.")
       self.thread_pool.Join()
 
-  def RunOnce(self):
+    finally:
+      if self.subscription is not None:
+        self.subscription.Close()
+
+  def WaitForNotifications(self):
+    """Waits until there might be new work to do.
+
+    Returns:
+      A list of queue shards which have been notified, or None if all the
+      queues should be polled.
+    """
+    if self.subscription is not None:
+      return self.subscription.Wait(self.notifier_polling_interval) or None
+
+    if time.time() - self.last_active > self.SHORT_POLL_TIME:
+      interval = self.POLLING_INTERVAL
+    else:
+      interval = self.SHORT_POLLING_INTERVAL
+
+    time.sleep(interval)
+
+  def RunOnce(self, queue_shards=None):
     """Processes one set of messages from Task Scheduler.
 
     The worker processes new jobs from the task master. For each job
     we retrieve the session from the Task Scheduler.
 
+    Args:
+        queue_shards: If given, only these queue shards are processed.
+            Otherwise one shard of each queue is polled.
+
     Returns:
         Total number of messages processed by this call.
     """
     start_time = time.time()
     processed = 0
 
+    if queue_shards is None:
+      to_process = [(queue, None) for queue in self.queues]
+    else:
+      to_process = [(self.queues_by_shard[queue_shard], queue_shard)
+                    for queue_shard in queue_shards]
+
     queue_manager = queue_manager_lib.QueueManager(token=self.token)
-    for queue in self.queues:
+    for queue, queue_shard in to_process:
       # Freezeing the timestamp used by queue manager to query/delete
       # notifications to avoid possible race conditions.
       queue_manager.FreezeTimestamp()
 
       fetch_messages_start = time.time()
       notifications_by_priority = queue_manager.GetNotificationsByPriority(
-          queue)
+          queue, queue_shard=queue_shard)
       stats.STATS.RecordEvent("worker_time_to_retrieve_notifications",
                               time.time() - fetch_messages_start)
 
@@ -221,6 +265,7 @@ class GRRWorker(object):
     """
     now = time.time()
     processed = 0
+    batch = []
     for notification in active_notifications:
       if notification.session_id not in self.queued_flows:
         if time_limit and time.time() - now > time_limit:
@@ -228,10 +273,26 @@ class GRRWorker(object):
 
         processed += 1
         self.queued_flows.Put(notification.session_id, 1)
-        self.thread_pool.AddTask(target=self._ProcessMessages,
-                                 args=(notification,
-                                       queue_manager.Copy()),
-                                 name=self.__class__.__name__)
+
+        if (self.flow_batch_size > 1 and
+            notification.session_id.FlowName() not in self.well_known_flows):
+          batch.append(notification)
+          if len(batch) >= self.flow_batch_size:
+            self.thread_pool.AddTask(target=self._ProcessMessageBatch,
+                                     args=(batch, queue_manager.Copy()),
+                                     name=self.__class__.__name__)
+            batch = []
+
+        else:
+          self.thread_pool.AddTask(target=self._ProcessMessages,
+                                   args=(notification,
+                                         queue_manager.Copy()),
+                                   name=self.__class__.__name__)
+
+    if batch:
+      self.thread_pool.AddTask(target=self._ProcessMessageBatch,
+                               args=(batch, queue_manager.Copy()),
+                               name=self.__class__.__name__)
 
     return processed
 
@@ -380,6 +441,108 @@ class GRRWorker(object):
       queue_manager.DeleteNotification(session_id)
 
 
+  def _ProcessMessageBatch(self, notifications, queue_manager):
+    """Processes a number of regular flows together.
+
+    All the flows are read from the data store at once and their completed
+    requests and responses are prefetched in a single pass. The messages the
+    flows queue are written together once all of them have been processed,
+    and the flows are only unlocked after that.
+
+    Args:
+      notifications: The notifications for the flows to process.
+      queue_manager: QueueManager object used to delete the notifications.
+    """
+    notifications_by_urn = dict((str(notification.session_id), notification)
+                                for notification in notifications)
+
+    try:
+      flow_objs = aff4.FACTORY.MultiOpenWithLock(
+          [notification.session_id for notification in notifications],
+          lease_time=self.flow_lease_time, token=self.token)
+    except Exception:  # pylint: disable=broad-except
+      logging.exception("Error opening flows for batch processing.")
+      flow_objs = []
+
+    # The flows we did not get are processed on their own. This deals with
+    # lock failures and flows which can not be opened in the usual way.
+    locked_urns = set(str(flow_obj.urn) for flow_obj in flow_objs)
+    for urn, notification in notifications_by_urn.iteritems():
+      if urn not in locked_urns:
+        self._ProcessMessages(notification, queue_manager)
+
+    batch_manager = queue_manager_lib.QueueManager(token=self.token)
+    for flow_obj in flow_objs:
+      notification = notifications_by_urn[str(flow_obj.urn)]
+      queue_manager.DeleteNotification(notification.session_id,
+                                       end=notification.timestamp)
+
+      if isinstance(flow_obj, flow.GRRFlow):
+        runner = flow_obj.GetRunner()
+        runner.queue_manager = batch_manager
+        runner.defer_message_flush = True
+
+    try:
+      batch_manager.PrefetchCompletedResponses(
+          [notifications_by_urn[str(flow_obj.urn)].session_id
+           for flow_obj in flow_objs],
+          timestamp=(0, max(notification.timestamp
+                            for notification in notifications)))
+    except Exception:  # pylint: disable=broad-except
+      # The flows will read their own data instead.
+      logging.exception("Error prefetching flow requests and responses.")
+
+    processed = []
+    try:
+      for flow_obj in flow_objs:
+        notification = notifications_by_urn[str(flow_obj.urn)]
+        session_id = notification.session_id
+        now = time.time()
+        try:
+          try:
+            self._ProcessRegularFlowMessages(flow_obj, notification)
+          finally:
+            # The flow state is written now but the lease is only released
+            # once the messages of the whole batch have been written. Until
+            # then no other worker can process the same responses again.
+            flow_obj.Flush()
+
+          processed.append((flow_obj, session_id, now))
+
+        except FlowProcessingError:
+          # Do nothing as we expect the error to be correctly logged and
+          # accounted already.
+          pass
+
+        except Exception as e:    # pylint: disable=broad-except
+          logging.exception("Error processing session %s: %s", session_id, e)
+          stats.STATS.IncrementCounter("worker_session_errors",
+                                       fields=[str(type(e))])
+          queue_manager.DeleteNotification(session_id)
+
+      # All the flows have been written so it is now safe to write their
+      # messages.
+      batch_manager.Flush()
+
+    finally:
+      for flow_obj in flow_objs:
+        try:
+          flow_obj.Close()
+        except Exception as e:  # pylint: disable=broad-except
+          logging.exception("Error closing session %s: %s", flow_obj.urn, e)
+          if flow_obj.transaction:
+            flow_obj.transaction.Abort()
+
+    for flow_obj, session_id, now in processed:
+      elapsed = time.time() - now
+      logging.debug("Done processing %s: %s sec", session_id, elapsed)
+      stats.STATS.RecordEvent("worker_flow_processing_time", elapsed,
+                              fields=[flow_obj.Name()])
+
+      # Everything went well -> session can be run again.
+      self.queued_flows.ExpireObject(session_id)
+
+
 class WorkerInit(registry.InitHook):
   """Registers worker stats variables."""
 
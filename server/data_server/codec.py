@@ -0,0 +1,305 @@
+#!/usr/bin/env python
+"""A compact wire format for batches of data store writes.
+
+Clients which negotiated the compact protocol prefix every frame with a frame
+type. Protobuf frames carry a DataStoreCommand as before, batch frames carry
+many MultiSet operations at once:
+
+  token length, serialized ACLToken
+  number of operations
+  for each operation:
+    shared subject prefix length, suffix length, suffix
+    number of values
+    for each value:
+      attribute index or NEW_ATTRIBUTE, name length, name
+      replace flag, value type, timestamp, value
+
+Attribute names are interned per connection: the first time a name is sent it
+follows the NEW_ATTRIBUTE marker and gets the next free index. Afterwards only
+the index is sent. Subjects are sent as the length of the prefix they share
+with the previous subject in the frame followed by the rest of the subject.
+"""
+
+
+import os
+import struct
+import zlib
+
+
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+
+# Frame types.
+FRAME_PROTO = "P"
+FRAME_BATCH = "B"
+FRAME_BATCH_ZLIB = "Z"
+
+_COUNT = struct.Struct("<I")
+_SUBJECT = struct.Struct("<II")
+_NAME = struct.Struct("<H")
+_VALUE = struct.Struct("<?cq")
+_INTEGER = struct.Struct("<q")
+_FLOAT = struct.Struct("<d")
+_BOOL = struct.Struct("<?")
+
+# Marks an attribute name sent for the first time on a connection.
+NEW_ATTRIBUTE = 2 ** 32 - 1
+
+_INT64_MIN = -2 ** 63
+_INT64_MAX = 2 ** 63 - 1
+
+
+class Error(Exception):
+  """Raised when a compact frame can not be decoded."""
+
+
+class CompactBatch(object):
+  """A batch of MultiSet operations sent in one compact frame.
+
+  Each operation is a (subject, entries) tuple where entries is a list of
+  (attribute, replace, timestamp, value) tuples. A value of None only deletes
+  the attribute.
+  """
+
+  def __init__(self, token=None, operations=None):
+    self.token = token
+    self.operations = operations or []
+
+  def Add(self, subject, entries):
+    self.operations.append((subject, entries))
+
+  def __len__(self):
+    return len(self.operations)
+
+
+def _EncodeValue(value):
+  """Returns the type tag and the encoded value."""
+  if value is None:
+    return "n", ""
+
+  if isinstance(value, str):
+    return "d", _COUNT.pack(len(value)) + value
+
+  if isinstance(value, unicode):
+    value = value.encode("utf8")
+    return "s", _COUNT.pack(len(value)) + value
+
+  if isinstance(value, bool):
+    return "b", _BOOL.pack(value)
+
+  if isinstance(value, (int, long)) and _INT64_MIN <= value <= _INT64_MAX:
+    return "i", _INTEGER.pack(value)
+
+  if isinstance(value, float):
+    return "f", _FLOAT.pack(value)
+
+  # Everything else goes through a DataBlob as in the protobuf frames.
+  blob = rdfvalue.DataBlob().SetValue(value).SerializeToString()
+  return "x", _COUNT.pack(len(blob)) + blob
+
+
+class CompactEncoder(object):
+  """Encodes batches for one connection to a data server."""
+
+  def __init__(self, compression_threshold=0):
+    self.attributes = {}
+    self.compression_threshold = compression_threshold
+
+  def Encode(self, batch):
+    """Returns the frame for a CompactBatch, including the frame type."""
+    token = batch.token.SerializeToString() if batch.token else ""
+    parts = [_COUNT.pack(len(token)), token, _COUNT.pack(len(batch))]
+
+    previous = ""
+    for subject, entries in batch.operations:
+      subject = utils.SmartStr(subject)
+      shared = len(os.path.commonprefix((previous, subject)))
+      parts.append(_SUBJECT.pack(shared, len(subject) - shared))
+      parts.append(subject[shared:])
+      previous = subject
+
+      parts.append(_COUNT.pack(len(entries)))
+      for attribute, replace, timestamp, value in entries:
+        attribute = utils.SmartStr(attribute)
+        index = self.attributes.get(attribute)
+        if index is None:
+          self.attributes[attribute] = len(self.attributes)
+          parts.append(_COUNT.pack(NEW_ATTRIBUTE))
+          parts.append(_NAME.pack(len(attribute)))
+          parts.append(attribute)
+        else:
+          parts.append(_COUNT.pack(index))
+
+        tag, encoded = _EncodeValue(value)
+        parts.append(_VALUE.pack(bool(replace), tag, int(timestamp)))
+        parts.append(encoded)
+
+    body = "".join(parts)
+    if self.compression_threshold and len(body) >= self.compression_threshold:
+      compressed = zlib.compress(body)
+      if len(compressed) < len(body):
+        return FRAME_BATCH_ZLIB + compressed
+
+    return FRAME_BATCH + body
+
+
+class CompactDecoder(object):
+  """Decodes the batch frames received on one data server connection."""
+
+  def __init__(self):
+    self.attributes = []
+
+  def Decode(self, frame):
+    """Decodes a batch frame (without the frame type) into a CompactBatch."""
+    try:
+      return self._Decode(frame)
+    except (struct.error, zlib.error, IndexError, UnicodeDecodeError) as e:
+      raise Error("Invalid compact frame: %s" % e)
+
+  def _Decode(self, data):
+    offset = 0
+    token_length, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+    token = None
+    if token_length:
+      token = rdfvalue.ACLToken(data[offset:offset + token_length])
+      offset += token_length
+
+    batch = CompactBatch(token=token)
+    num_operations, = _COUNT.unpack_from(data, offset)
+    offset += _COUNT.size
+
+    previous = ""
+    for _ in xrange(num_operations):
+      shared, suffix_length = _SUBJECT.unpack_from(data, offset)
+      offset += _SUBJECT.size
+      subject = previous[:shared] + data[offset:offset + suffix_length]
+      offset += suffix_length
+      previous = subject
+
+      num_entries, = _COUNT.unpack_from(data, offset)
+      offset += _COUNT.size
+      entries = []
+      for _ in xrange(num_entries):
+        index, = _COUNT.unpack_from(data, offset)
+        offset += _COUNT.size
+        if index == NEW_ATTRIBUTE:
+          name_length, = _NAME.unpack_from(data, offset)
+          offset += _NAME.size
+          attribute = data[offset:offset + name_length].decode("utf8")
+          offset += name_length
+          self.attributes.append(attribute)
+        else:
+          attribute = self.attributes[index]
+
+        replace, tag, timestamp = _VALUE.unpack_from(data, offset)
+        offset += _VALUE.size
+        value, offset = self._DecodeValue(tag, data, offset)
+        entries.append((attribute, replace, timestamp, value))
+
+      batch.Add(subject.decode("utf8"), entries)
+
+    if offset != len(data):
+      raise Error("Trailing data in compact frame.")
+
+    return batch
+
+  def _DecodeValue(self, tag, data, offset):
+    """Returns the value with the given type tag and the new offset."""
+    if tag == "n":
+      return None, offset
+
+    if tag in ("d", "s", "x"):
+      length, = _COUNT.unpack_from(data, offset)
+      offset += _COUNT.size
+      value = data[offset:offset + length]
+      if len(value) != length:
+        raise Error("Truncated value in compact frame.")
+      offset += length
+      if tag == "s":
+        value = value.decode("utf8")
+      elif tag == "x":
+        value = rdfvalue.DataBlob(value).GetValue()
+      return value, offset
+
+    if tag == "i":
+      return _INTEGER.unpack_from(data, offset)[0], offset + _INTEGER.size
+
+    if tag == "f":
+      return _FLOAT.unpack_from(data, offset)[0], offset + _FLOAT.size
+
+    if tag == "b":
+      return _BOOL.unpack_from(data, offset)[0], offset + _BOOL.size
+
+    raise Error("Unknown value type %r in compact frame." % tag)
+
+
+def DecodeFrame(decoder, frame):
+  """Splits a frame from a compact client by frame type.
+
+  Args:
+    decoder: The CompactDecoder of the connection.
+    frame: The frame, starting with its frame type.
+
+  Returns:
+    A DataStoreCommand for protobuf frames or a CompactBatch.
+
+  Raises:
+    Error: If the frame is invalid.
+  """
+  frame_type, data = frame[:1], frame[1:]
+  if frame_type == FRAME_PROTO:
+    return rdfvalue.DataStoreCommand(data)
+
+  if frame_type == FRAME_BATCH_ZLIB:
+    try:
+      data = zlib.decompress(data)
+    except zlib.error as e:
+      raise Error("Invalid compressed frame: %s" % e)
+    return decoder.Decode(data)
+
+  if frame_type == FRAME_BATCH:
+    return decoder.Decode(data)
+
+  raise Error("Unknown frame type %r." % frame_type)
+
+
+def MultiSetCommand(subject, entries, token=None, sync=False):
+  """Builds a MULTI_SET command.
+
+  Args:
+    subject: The subject to write to.
+    entries: A list of (attribute, replace, timestamp, value) tuples. A value
+      of None only deletes the attribute.
+    token: An ACL token.
+    sync: Whether the data server should write the values synchronously.
+
+  Returns:
+    A DataStoreCommand.
+  """
+  request = rdfvalue.DataStoreRequest(sync=sync)
+  if token:
+    request.token = token
+  request.subject.Append(subject)
+
+  for attribute, replace, timestamp, value in entries:
+    option = rdfvalue.DataStoreValue.Option.DEFAULT
+    if replace:
+      option = rdfvalue.DataStoreValue.Option.REPLACE
+
+    new_value = request.values.Append(attribute=attribute, option=option)
+    new_value.timestamp = rdfvalue.TimestampSpec(
+        start=timestamp, type=rdfvalue.TimestampSpec.Type.SPECIFIC_TIME)
+
+    if value is not None:
+      new_value.value.SetValue(value)
+
+  return rdfvalue.DataStoreCommand(
+      command=rdfvalue.DataStoreCommand.Command.MULTI_SET, request=request)
+
+
+def BatchToCommands(batch):
+  """Converts a CompactBatch into MULTI_SET commands."""
+  return [MultiSetCommand(subject, entries, token=batch.token)
+          for subject, entries in batch.operations]
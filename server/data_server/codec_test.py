@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+"""Tests the compact wire format of the data servers."""
+
+
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+from grr.server.data_server import codec
+
+
+class CodecTest(test_lib.GRRBaseTest):
+  """Tests encoding and decoding of compact batches."""
+
+  def _MakeBatch(self, num_subjects):
+    batch = codec.CompactBatch(token=self.token)
+    for i in range(num_subjects):
+      batch.Add(u"aff4:/C.%016X/fs/os/c/file%d" % (i, i), [
+          (u"aff4:type", True, 1000 + i, u"VFSFile"),
+          (u"aff4:size", True, 2000 + i, i * 1024),
+          (u"aff4:content", False, 3000 + i, "\x00\xffdata"),
+          (u"aff4:stored", True, 4000 + i, i % 2 == 0),
+          (u"aff4:ratio", False, 5000 + i, 0.5 * i),
+          (u"aff4:urn", False, 6000 + i, rdfvalue.RDFURN("aff4:/foo")),
+          (u"aff4:deleted", True, 0, None)])
+    return batch
+
+  def testRoundTrip(self):
+    batch = self._MakeBatch(10)
+    frame = codec.CompactEncoder().Encode(batch)
+    self.assertEqual(frame[0], codec.FRAME_BATCH)
+
+    decoded = codec.DecodeFrame(codec.CompactDecoder(), frame)
+    self.assertEqual(decoded.token, self.token)
+    self.assertEqual(len(decoded), 10)
+
+    for (subject, entries), (expected_subject, expected_entries) in zip(
+        decoded.operations, batch.operations):
+      self.assertEqual(subject, expected_subject)
+      # RDFValues travel as serialized DataBlobs.
+      self.assertEqual(entries[5][3], "aff4:/foo")
+      self.assertEqual(entries[:5] + entries[6:],
+                       expected_entries[:5] + expected_entries[6:])
+
+  def testAttributesAreInternedPerConnection(self):
+    encoder = codec.CompactEncoder()
+    decoder = codec.CompactDecoder()
+
+    first = encoder.Encode(self._MakeBatch(1))
+    second = encoder.Encode(self._MakeBatch(1))
+    # The second frame only refers to the attributes sent in the first one.
+    self.assertFalse("aff4:content" in second)
+    self.assertLess(len(second), len(first))
+
+    codec.DecodeFrame(decoder, first)
+    decoded = codec.DecodeFrame(decoder, second)
+    self.assertEqual([entry[0] for entry in decoded.operations[0][1]],
+                     [entry[0] for entry in self._MakeBatch(1).operations[0][1]])
+
+    # A new connection does not know about them.
+    self.assertRaises(codec.Error, codec.DecodeFrame, codec.CompactDecoder(),
+                      second)
+
+  def testCompression(self):
+    batch = self._MakeBatch(100)
+    plain = codec.CompactEncoder().Encode(batch)
+    compressed = codec.CompactEncoder(compression_threshold=1024).Encode(batch)
+
+    self.assertEqual(compressed[0], codec.FRAME_BATCH_ZLIB)
+    self.assertLess(len(compressed), len(plain))
+
+    decoded = codec.DecodeFrame(codec.CompactDecoder(), compressed)
+    self.assertEqual(len(decoded), 100)
+
+  def testProtoFrames(self):
+    command = rdfvalue.DataStoreCommand(
+        command=rdfvalue.DataStoreCommand.Command.DELETE_SUBJECT,
+        request=rdfvalue.DataStoreRequest(subject=["aff4:/foo"]))
+
+    decoded = codec.DecodeFrame(codec.CompactDecoder(),
+                                codec.FRAME_PROTO + command.SerializeToString())
+    self.assertEqual(decoded, command)
+
+  def testInvalidFrames(self):
+    frame = codec.CompactEncoder().Encode(self._MakeBatch(2))
+    for invalid in [frame[:-3], frame + "x", "Q" + frame[1:],
+                    codec.FRAME_BATCH_ZLIB + "garbage"]:
+      self.assertRaises(codec.Error, codec.DecodeFrame,
+                        codec.CompactDecoder(), invalid)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -10,6 +10,24 @@ REBALANCE_DIRECTORY = ".GRR_REBALANCE"
 TRANSACTION_FILENAME = ".TRANSACTION"
 REMOVE_FILENAME = ".TRANSACTION_REMOVE"
 
+# Capabilities a data store client can ask for when it starts using a data
+# server. Servers which do not know about them reply as usual.
+CLIENT_CAPABILITIES_HEADER = "X-Data-Store-Capabilities"
+CAPABILITY_COMPACT = "compact"
+CAPABILITY_PIPELINE = "pipeline"
+
+# Handshake replies to a data store client.
+CLIENT_ACK = "OK\n"
+CLIENT_ACK_COMPACT = "OC\n"
+# Only sent to clients asking for pipelining. It is followed by the size and
+# the comma separated names of the capabilities the data server accepted.
+CLIENT_ACK_CAPABILITIES = "OX\n"
+CLIENT_INVALID_PASSWORD = "IP\n"
+
+# Handshake reply to a replica which can not resume from its position in the
+# change log.
+REPLICA_GAP = "GP\n"
+
 # HTTP status codes.
 RESPONSE_OK = 200
 
@@ -33,3 +51,4 @@ RESPONSE_IS_MASTER_SERVER = 404
 RESPONSE_INCOMPLETE_SYNC = 503
 RESPONSE_DATA_SERVER_NOT_FOUND = 409
 RESPONSE_RANGE_NOT_EMPTY = 402
+RESPONSE_NO_CHANGE_LOG = 404
@@ -29,10 +29,12 @@ from grr.lib import stats
 from grr.lib import utils
 
 from grr.server.data_server import auth
+from grr.server.data_server import codec
 from grr.server.data_server import constants
 from grr.server.data_server import errors
 from grr.server.data_server import master
 from grr.server.data_server import rebalance
+from grr.server.data_server import replication
 from grr.server.data_server import store
 from grr.server.data_server import utils as sutils
 
@@ -45,6 +47,10 @@ flags.DEFINE_string("path", None,
 flags.DEFINE_bool("master", False,
                   "Mark this data server as the master.")
 
+flags.DEFINE_string("replica_of", None,
+                    "Run as a read only replica of the data server at this "
+                    "location.")
+
 
 # Data store service.
 SERVICE = None
@@ -123,8 +129,17 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         return ""
     return ret
 
-  def HandleClient(self, sock, permissions):
-    """Handles new client requests readable from 'read'."""
+  def HandleClient(self, sock, permissions, decoder=None):
+    """Handles new client requests readable from 'read'.
+
+    Args:
+      sock: The client socket.
+      permissions: The permissions of the client.
+      decoder: A codec.CompactDecoder if the client uses the compact protocol.
+
+    Returns:
+      The reply to send back or "" if the connection must be closed.
+    """
     # Use a long timeout here.
     sock.settimeout(self.CLIENT_TIMEOUT_TIME)
     cmdlen_str = self._ReadExactlyFailAfterFirst(sock, sutils.SIZE_PACKER.size)
@@ -137,7 +152,18 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       cmd_str = self._ReadExactly(sock, cmdlen)
     except (socket.timeout, socket.error):
       return ""
-    cmd = rdfvalue.DataStoreCommand(cmd_str)
+
+    if decoder:
+      try:
+        cmd = codec.DecodeFrame(decoder, cmd_str)
+      except codec.Error as e:
+        logging.error("Bad frame from %s: %s", self.client_address, e)
+        return ""
+
+      if isinstance(cmd, codec.CompactBatch):
+        return self._HandleCompactBatch(cmd, permissions)
+    else:
+      cmd = rdfvalue.DataStoreCommand(cmd_str)
 
     request = cmd.request
     op = cmd.command
@@ -159,6 +185,20 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
 
     return sutils.SIZE_PACKER.pack(len(response)) + response
 
+  def _HandleCompactBatch(self, batch, permissions):
+    """Applies a batch of writes, answering with a single response."""
+    if "w" in permissions:
+      response = SERVICE.CompactMultiSet(batch)
+    else:
+      status_desc = ("Operation not allowed: required w but only have "
+                     "%s permissions" % permissions)
+      resp = rdfvalue.DataStoreResponse(
+          status_desc=status_desc,
+          status=rdfvalue.DataStoreResponse.Status.AUTHORIZATION_DENIED)
+      response = resp.SerializeToString()
+
+    return sutils.SIZE_PACKER.pack(len(response)) + response
+
   def HandleRegister(self):
     """Registers a data server in the master."""
     if not MASTER:
@@ -237,17 +277,33 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     token = rdfvalue.DataStoreAuthToken(self.post_data)
     perms = NONCE_STORE.ValidateAuthTokenClient(token)
     if not perms:
-      sock.sendall("IP\n")
+      sock.sendall(constants.CLIENT_INVALID_PASSWORD)
       sock.close()
       self.close_connection = 1
       return
 
+    capabilities = self.headers.get(
+        constants.CLIENT_CAPABILITIES_HEADER, "").split(",")
+    decoder = None
+    ack = constants.CLIENT_ACK
+    if constants.CAPABILITY_COMPACT in capabilities:
+      decoder = codec.CompactDecoder()
+      ack = constants.CLIENT_ACK_COMPACT
+    if constants.CAPABILITY_PIPELINE in capabilities:
+      # Responses carry the request_id of their request.
+      accepted = [constants.CAPABILITY_PIPELINE]
+      if decoder:
+        accepted.append(constants.CAPABILITY_COMPACT)
+      accepted = ",".join(accepted)
+      ack = (constants.CLIENT_ACK_CAPABILITIES +
+             sutils.SIZE_PACKER.pack(len(accepted)) + accepted)
+
     logging.info("Client %s has started using the data server",
                  self.client_address)
     try:
       # Send handshake.
       sock.settimeout(self.LOGIN_TIMEOUT)  # 10 seconds to login.
-      sock.sendall("OK\n")
+      sock.sendall(ack)
     except (socket.error, socket.timeout):
       logging.warning("Could not login client %s", self.client_address)
       self.close_connection = 1
@@ -255,7 +311,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
 
     while True:
       # Handle requests
-      replybody = self.HandleClient(sock, perms)
+      replybody = self.HandleClient(sock, perms, decoder=decoder)
 
       if not replybody:
         # Client probably died or there was an error in the connection.
@@ -276,6 +332,64 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
         self.close_connection = 1
         return
 
+  def HandleReplicaHandshake(self):
+    """Starts the handshake with replicas of this data server."""
+    if not SERVICE.change_log:
+      self._EmptyResponse(constants.RESPONSE_NO_CHANGE_LOG)
+      return
+    self.HandleHandshake()
+
+  def HandleReplicaStream(self):
+    """Streams the change log to a replica."""
+    if not SERVICE.change_log:
+      self._EmptyResponse(constants.RESPONSE_NO_CHANGE_LOG)
+      return
+    # Like data store clients, replicas keep using the socket.
+    sock = self.connection
+    sock.setblocking(1)
+    self.close_connection = 1
+
+    request = rdfvalue.DataServerReplicaRequest(self.post_data)
+    if not NONCE_STORE.ValidateAuthTokenServer(request.token):
+      sock.sendall(constants.CLIENT_INVALID_PASSWORD)
+      sock.close()
+      return
+
+    try:
+      sequence = SERVICE.change_log.Start(request.sequence)
+    except replication.ChangeLogGapError as e:
+      logging.error("Replica %s can not follow the change log: %s",
+                    self.client_address, e)
+      sock.sendall(constants.REPLICA_GAP)
+      sock.close()
+      return
+
+    logging.info("Replica %s follows the change log from %d",
+                 self.client_address, sequence)
+    try:
+      sock.settimeout(self.SEND_TIMEOUT)
+      sock.sendall(constants.CLIENT_ACK)
+      while True:
+        changes = SERVICE.change_log.Read(
+            sequence, replication.HEARTBEAT_INTERVAL)
+        if changes:
+          sequence = changes[-1].sequence
+        else:
+          # Tell the replica it did not miss anything.
+          changes = [rdfvalue.DataServerChange(sequence=sequence)]
+
+        data = []
+        for change in changes:
+          change_str = change.SerializeToString()
+          data.append(sutils.SIZE_PACKER.pack(len(change_str)))
+          data.append(change_str)
+        sock.sendall("".join(data))
+
+    except (socket.error, socket.timeout, replication.ChangeLogGapError) as e:
+      logging.warning("Replica %s stopped following the change log: %s",
+                      self.client_address, e)
+    sock.close()
+
   def HandleMapping(self):
     """Returns the mapping to a client or server."""
     if not MAPPING:
@@ -385,10 +499,13 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     # But only for regular data servers since the master is responsible for
     # starting the operation.
     if DATA_SERVER:
+      mapping = MAPPING.Copy()
       for i, serv in enumerate(list(reb.mapping.servers)):
-        MAPPING.servers[i].interval.start = serv.interval.start
-        MAPPING.servers[i].interval.end = serv.interval.end
-      DATA_SERVER.SetMapping(MAPPING)
+        mapping.servers[i].interval.start = serv.interval.start
+        mapping.servers[i].interval.end = serv.interval.end
+        mapping.servers[i].weight = serv.weight
+      mapping.nodes = list(reb.mapping.nodes)
+      DATA_SERVER.SetMapping(mapping)
     # Send back server state.
     stat = GetStatistics()
     body = stat.SerializeToString()
@@ -410,6 +527,102 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     body = reb.SerializeToString()
     self._Response(constants.RESPONSE_OK, body)
 
+  def HandleRebalanceStart(self):
+    """Call master to move the data of a rebalance chunk by chunk."""
+    if not MASTER:
+      return self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
+    reb = rdfvalue.DataServerRebalance(self.post_data)
+    current = MASTER.IsRebalancing()
+    if not current or current.id != reb.id:
+      return self._EmptyResponse(constants.RESPONSE_WRONG_TRANSACTION)
+    if not MASTER.StartMigrations():
+      return self._EmptyResponse(constants.RESPONSE_NOT_COMMITED)
+    # The rebalance goes on when the manager disconnects.
+    self.rebalance_id = None
+    self._Response(constants.RESPONSE_OK, current.SerializeToString())
+
+  def HandleRebalanceProgress(self):
+    """Call master to report the progress of the current or last rebalance."""
+    if not MASTER:
+      return self._EmptyResponse(constants.RESPONSE_NOT_MASTER_SERVER)
+    reb = MASTER.RebalanceProgress()
+    if not reb:
+      return self._EmptyResponse(constants.RESPONSE_TRANSACTION_NOT_FOUND)
+    self._Response(constants.RESPONSE_OK, reb.SerializeToString())
+
+  def HandleRebalanceMigrate(self):
+    """Call data server to start moving a chunk to another data server."""
+    info = rdfvalue.DataServerMigration(self.post_data)
+    migration = rebalance.Migration(info, SERVICE.pathing)
+    SERVICE.AddMigration(migration)
+    try:
+      ok = rebalance.CopyChunk(migration)
+      if ok:
+        # Catch up with the writes applied while copying.
+        migration.Flush()
+    except (data_store.Error, IOError, OSError) as e:
+      logging.warning("Failed to move chunk %s: %s", info.id, e)
+      ok = False
+    if not ok:
+      SERVICE.RemoveMigration(info.id)
+      migration.Close()
+      return self._EmptyResponse(constants.RESPONSE_FILES_NOT_COPIED)
+    self._Response(constants.RESPONSE_OK, info.SerializeToString())
+
+  def HandleRebalanceSwitch(self):
+    """Call data server to forward every write to a chunk from now on."""
+    info = rdfvalue.DataServerMigration(self.post_data)
+    migration = SERVICE.GetMigration(info.id)
+    if not migration:
+      return self._EmptyResponse(constants.RESPONSE_TRANSACTION_NOT_FOUND)
+    try:
+      migration.Switch()
+    except data_store.Error as e:
+      logging.warning("Failed to switch chunk %s: %s", info.id, e)
+      return self._EmptyResponse(constants.RESPONSE_NOT_COMMITED)
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceCleanup(self):
+    """Call data server to stop forwarding and delete the files of a chunk."""
+    info = rdfvalue.DataServerMigration(self.post_data)
+    migration = SERVICE.GetMigration(info.id)
+    SERVICE.RemoveMigration(info.id)
+    if migration:
+      migration.Close()
+    index = 0
+    if not MASTER:
+      index = DATA_SERVER.Index()
+    rebalance.DeleteChunk(info, MAPPING, index)
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceInstall(self):
+    """Call data server to move the copied files of a chunk into place."""
+    info = rdfvalue.DataServerMigration(self.post_data)
+    if SERVICE.change_log:
+      # The files would never reach the replicas, which would then answer
+      # reads of the chunk with nothing.
+      logging.critical("Refusing to install chunk %s on a data server with "
+                       "a change log.", info.id)
+      return self._EmptyResponse(constants.RESPONSE_FILES_NOT_MOVED)
+    if not rebalance.InstallChunk(info):
+      logging.critical("Failed to install chunk %s", info.id)
+      return self._EmptyResponse(constants.RESPONSE_FILES_NOT_MOVED)
+    self._EmptyResponse(constants.RESPONSE_OK)
+
+  def HandleRebalanceForward(self):
+    """Applies the writes forwarded by the data server a chunk moves from."""
+    data = self.post_data or ""
+    try:
+      while data:
+        size = sutils.SIZE_PACKER.unpack(data[:sutils.SIZE_PACKER.size])[0]
+        data = data[sutils.SIZE_PACKER.size:]
+        SERVICE.ApplyForwarded(rdfvalue.DataStoreCommand(data[:size]))
+        data = data[size:]
+    except data_store.Error as e:
+      logging.warning("Failed to apply forwarded writes: %s", e)
+      return self._EmptyResponse(constants.RESPONSE_NOT_COMMITED)
+    self._EmptyResponse(constants.RESPONSE_OK)
+
   def _UnpackNewServer(self):
     data = self.post_data
     addrlen_str = data[:sutils.SIZE_PACKER.size]
@@ -487,9 +700,8 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
     server = MASTER.HasServer(addr, port)
     if not server:
       return self._EmptyResponse(constants.RESPONSE_DATA_SERVER_NOT_FOUND)
-    # Interval range must be 0.
-    interval = server.Interval()
-    if interval.start != interval.end:
+    # The server must not own any hashes.
+    if not sutils.ServerIsEmpty(MAPPING, server.Index()):
       return self._EmptyResponse(constants.RESPONSE_RANGE_NOT_EMPTY)
     return self._EmptyResponse(constants.RESPONSE_OK)
 
@@ -541,7 +753,7 @@ class DataServerHandler(BaseHTTPRequestHandler, object):
       self.data_server = None
     elif self.rebalance_id:
       reb = MASTER.IsRebalancing()
-      if reb:
+      if reb and not MASTER.IsMigrating():
         MASTER.CancelRebalancing()
         logging.warning("Rebalancing operation %s canceled", reb.id)
       self.rebalance_id = False
@@ -560,6 +772,8 @@ HTTP_TABLE = {
     "/client/start": DataServerHandler.HandleDataStoreService,
     "/client/handshake": DataServerHandler.HandleClientHandshake,
     "/client/mapping": DataServerHandler.HandleMapping,
+    "/replica/handshake": DataServerHandler.HandleReplicaHandshake,
+    "/replica/stream": DataServerHandler.HandleReplicaStream,
     "/rebalance/phase1": DataServerHandler.HandleRebalancePhase1,
     "/rebalance/phase2": DataServerHandler.HandleRebalancePhase2,
     "/rebalance/statistics": DataServerHandler.HandleRebalanceStatistics,
@@ -567,6 +781,13 @@ HTTP_TABLE = {
     "/rebalance/commit": DataServerHandler.HandleRebalanceCommit,
     "/rebalance/perform": DataServerHandler.HandleRebalancePerform,
     "/rebalance/recover": DataServerHandler.HandleRebalanceRecover,
+    "/rebalance/start": DataServerHandler.HandleRebalanceStart,
+    "/rebalance/progress": DataServerHandler.HandleRebalanceProgress,
+    "/rebalance/migrate": DataServerHandler.HandleRebalanceMigrate,
+    "/rebalance/switch": DataServerHandler.HandleRebalanceSwitch,
+    "/rebalance/cleanup": DataServerHandler.HandleRebalanceCleanup,
+    "/rebalance/install": DataServerHandler.HandleRebalanceInstall,
+    "/rebalance/forward": DataServerHandler.HandleRebalanceForward,
     "/servers/add/check": DataServerHandler.HandleServerAddCheck,
     "/servers/add": DataServerHandler.HandleServerAdd,
     "/servers/rem/check": DataServerHandler.HandleServerRemCheck,
@@ -767,12 +988,32 @@ def InitDataServer(port):
   logging.info("Starting Data Server on port %d ...", port)
 
 
+def InitReplicaServer(port, location):
+  """Initiates a read only replica of the data server at location."""
+  global MAPPING
+  # Replicas start from a copy of the data store of their primary, including
+  # its mapping.
+  MAPPING = SERVICE.LoadServerMapping()
+  # Replicas do not register with the master.
+  creds = auth.ClientCredentials()
+  creds.InitializeFromConfig()
+  NONCE_STORE.SetClientCredentials(creds)
+  SERVICE.replicator = replication.Replicator(SERVICE, location, NONCE_STORE)
+  SERVICE.replicator.Start()
+  logging.info("Starting Data Server replica of %s on port %d ...", location,
+               port)
+
+
 def Start(db, port=0, is_master=False, server_cls=ThreadedHTTPServer,
-          reqhandler_cls=DataServerHandler):
+          reqhandler_cls=DataServerHandler, replica_of=None):
   """Start the data server."""
   # This is the service that will handle requests to the data store.
   global SERVICE
-  SERVICE = store.DataStoreService(db)
+  change_log = None
+  change_log_size = config_lib.CONFIG["Dataserver.change_log_size"]
+  if change_log_size and not replica_of:
+    change_log = replication.ChangeLog(change_log_size)
+  SERVICE = store.DataStoreService(db, change_log=change_log)
 
   # Create the command table for faster execution of remote calls.
   # Along with a method, each command has the required permissions.
@@ -800,7 +1041,10 @@ def Start(db, port=0, is_master=False, server_cls=ThreadedHTTPServer,
 
   server_port = port or config_lib.CONFIG["Dataserver.port"]
 
-  if is_master:
+  if replica_of:
+    logging.debug("Replica data server running on port '%i'", server_port)
+    InitReplicaServer(server_port, replica_of)
+  elif is_master:
     logging.debug("Master server running on port '%i'", server_port)
     InitMasterServer(server_port)
   else:
@@ -818,8 +1062,10 @@ def Start(db, port=0, is_master=False, server_cls=ThreadedHTTPServer,
   finally:
     if MASTER:
       MASTER.Stop()
-    else:
+    elif DATA_SERVER:
       DATA_SERVER.Stop()
+    if SERVICE.replicator:
+      SERVICE.replicator.Stop()
 
 
 def main(unused_argv):
@@ -840,7 +1086,8 @@ def main(unused_argv):
                       "GRRAFF4Init"])
   registry.Init(skip_set=do_not_start)
 
-  Start(data_store.DB, port=flags.FLAGS.port, is_master=flags.FLAGS.master)
+  Start(data_store.DB, port=flags.FLAGS.port, is_master=flags.FLAGS.master,
+        replica_of=flags.FLAGS.replica_of)
 
 if __name__ == "__main__":
   flags.StartMain(main)
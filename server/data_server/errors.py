@@ -6,3 +6,8 @@
 class DataServerError(Exception):
   """Raised when some error condition happens in a data server."""
   pass
+
+
+class ReplicaBehindError(DataServerError):
+  """Raised when a replica did not apply the writes a read has to see."""
+  pass
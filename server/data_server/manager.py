@@ -91,6 +91,9 @@ class Manager(object):
     self._ShowRange(self.mapping)
 
   def _ShowRange(self, mapping):
+    if mapping.nodes:
+      self._ShowNodes(mapping)
+      return
     for i, serv in enumerate(list(mapping.servers)):
       addr = serv.address
       port = serv.port
@@ -102,6 +105,18 @@ class Manager(object):
                                                str(start).zfill(20),
                                                str(end).zfill(20))
 
+  def _ShowNodes(self, mapping):
+    """Shows the share of the hashing ring owned by each server."""
+    share = [0] * len(mapping.servers)
+    ranges = [0] * len(mapping.servers)
+    for start, end, index in sutils.MappingRanges(mapping):
+      share[index] += end - start
+      ranges[index] += 1
+    for i, serv in enumerate(list(mapping.servers)):
+      perc = 100 * float(share[i]) / float(2 ** 64)
+      print "Server %d %s:%d %d%% (weight %.2f, %d ranges)" % (
+          i, serv.address, serv.port, perc, serv.weight, ranges[i])
+
   def _ComputeMappingSize(self, mapping):
     totalsize = 0
     servers = list(mapping.servers)
@@ -111,6 +126,10 @@ class Manager(object):
 
   def _ComputeMappingFromPercentages(self, mapping, newperc):
     """Builds a new mapping based on the new server range percentages."""
+    if config_lib.CONFIG["Dataserver.virtual_nodes"]:
+      # On the hashing ring, percentages are relative weights.
+      weights = [perc * len(newperc) for perc in newperc]
+      return self._ComputeMappingFromWeights(mapping, weights)
     newstart = 0
     n_servers = self.mapping.num_servers
     servers = list(mapping.servers)
@@ -133,6 +152,46 @@ class Manager(object):
                                  interval=interval)
     return new_mapping
 
+  def _ComputeMappingFromWeights(self, mapping, weights):
+    """Builds a new mapping with virtual nodes for the new server weights."""
+    new_mapping = rdfvalue.DataServerMapping(version=self.mapping.version + 1,
+                                             num_servers=len(weights),
+                                             pathing=self.mapping.pathing)
+    for old_server, weight in zip(list(mapping.servers), weights):
+      new_mapping.servers.Append(index=old_server.index,
+                                 address=old_server.address,
+                                 port=old_server.port,
+                                 state=old_server.state,
+                                 interval=old_server.interval,
+                                 weight=weight)
+    new_mapping.nodes = sutils.CreateVirtualNodes(
+        list(new_mapping.servers),
+        config_lib.CONFIG["Dataserver.virtual_nodes"])
+    return new_mapping
+
+  def _SetWeight(self, addr, port, weight):
+    """Changes the share of the keys of a server."""
+    if not config_lib.CONFIG["Dataserver.virtual_nodes"]:
+      print "Weights need Dataserver.virtual_nodes to be set."
+      return
+    server, index = self._FindServer(addr, port)
+    if not server:
+      print "Server not found."
+      return
+    if weight < 0:
+      print "Wrong weight: %f" % weight
+      return
+    weights = [serv.weight for serv in self.mapping.servers]
+    weights[index] = weight
+    if not any(weights):
+      print "At least one server needs a weight."
+      return
+    new_mapping = self._ComputeMappingFromWeights(self.mapping, weights)
+    print "The new ranges will be:"
+    self._ShowRange(new_mapping)
+    print
+    self._DoRebalance(new_mapping)
+
   def _Rebalance(self):
     """Starts the rebalance process."""
     if not self.mapping:
@@ -184,36 +243,50 @@ class Manager(object):
     body = rebalance.SerializeToString()
     headers = {"Content-Length": len(body)}
     try:
-      res = pool.urlopen("POST", "/rebalance/phase2", headers=headers,
+      res = pool.urlopen("POST", "/rebalance/start", headers=headers,
                          body=body)
     except urllib3.exceptions.MaxRetryError:
-      print "Unable to contact server for re-sharding."
-      print "Make sure the data servers are up and try again."
+      print "Unable to contact master..."
       return
     if res.status != constants.RESPONSE_OK:
-      print "Could not start copying files for re-sharding"
+      print "Could not start re-sharding."
       print "Make sure the data servers are up and try again."
       return
 
+    rebalance = rdfvalue.DataServerRebalance(res.data)
+    print ("Rebalance with id %s started, moving %d chunks while the data "
+           "servers keep serving.") % (rebalance.id, rebalance.migrations)
+    print "Run 'progress' to follow it."
+
+  def _Progress(self):
+    """Shows the progress of the current or last rebalance."""
+    body = ""
+    headers = {"Content-Length": len(body)}
     try:
-      res = pool.urlopen("POST", "/rebalance/commit", headers=headers,
-                         body=body)
+      res = self.pool.urlopen("POST", "/rebalance/progress", headers=headers,
+                              body=body)
     except urllib3.exceptions.MaxRetryError:
-      print ("Could not commit the re-sharding transaction with id "
-             "%s") % rebalance.id
-      print "Make sure the data servers are up and then run:"
-      print "'recover %s' in order to re-run transaction" % rebalance.id
+      print "Unable to contact master..."
+      return
+    if res.status == constants.RESPONSE_TRANSACTION_NOT_FOUND:
+      print "No rebalance was started."
       return
-
     if res.status != constants.RESPONSE_OK:
-      print "Could not commit the transaction %s" % rebalance.id
-      print "Make sure the data servers are up and then run:"
-      print "'recover %s' in order to re-run transaction" % rebalance.id
+      print "Master server error. Is the server running?"
       return
-
-    self.mapping = rdfvalue.DataServerMapping(res.data)
-
-    print "Rebalance with id %s fully performed." % rebalance.id
+    rebalance = rdfvalue.DataServerRebalance(res.data)
+    perc = 100
+    if rebalance.migrations:
+      perc = 100 * rebalance.migrations_done / rebalance.migrations
+    print "Rebalance %s: %d of %d chunks moved (%d%%, %dKB)" % (
+        rebalance.id, rebalance.migrations_done, rebalance.migrations, perc,
+        rebalance.moved / 1024)
+    if rebalance.error:
+      print "Failed: %s" % rebalance.error
+    elif rebalance.finished:
+      print "Rebalance fully performed."
+    elif rebalance.migrations_done == rebalance.migrations:
+      print "Waiting for clients to use the new mapping to remove old copies."
 
   def _Recover(self, transid):
     """Completes a rebalancing transaction that was unsuccessful."""
@@ -417,11 +490,11 @@ class Manager(object):
   def _RemServer(self, addr, port):
     """Remove server from group."""
     # Find server.
-    server, _ = self._FindServer(addr, port)
+    server, index = self._FindServer(addr, port)
     if not server:
       print "Server not found."
       return
-    if server.interval.start != server.interval.end:
+    if not sutils.ServerIsEmpty(self.mapping, index):
       print "Server has some data in it!"
       print "Giving up..."
       return
@@ -520,10 +593,13 @@ class Manager(object):
     print "ranges\t\t\t\tDisplay server range information."
     print "rebalance\t\t\tRebalance server load."
     print "recover <transaction id>\tComplete a pending transaction."
+    print "progress\t\t\tDisplay the progress of the last rebalance."
     print "addserver <address> <port>\tAdd new server to the group."
     print ("dropserver <address> <port>\tMove all the data from the server "
            "to others.")
     print "remserver <address> <port>\tRemove server from server group."
+    print ("weight <address> <port> <weight>\tChange the share of the keys "
+           "of a server.")
     print "sync\t\t\t\tSync server information between data servers."
 
   def _HandleCommand(self, cmd, args):
@@ -538,6 +614,8 @@ class Manager(object):
       self._ShowRanges()
     elif cmd == "rebalance":
       self._Rebalance()
+    elif cmd == "progress":
+      self._Progress()
     elif cmd == "recover":
       if len(args) != 1:
         print "Syntax: recover <transaction-id>"
@@ -563,6 +641,13 @@ class Manager(object):
         self._RemServer(args[0], int(args[1]))
       except ValueError:
         print "Invalid port number: %s" % args[1]
+    elif cmd == "weight":
+      if len(args) != 3:
+        print "Syntax: weight <address> <port> <weight>"
+      try:
+        self._SetWeight(args[0], int(args[1]), float(args[2]))
+      except ValueError:
+        print "Invalid port number or weight: %s %s" % (args[1], args[2])
     elif cmd == "sync":
       self._Sync()
     else:
@@ -4,6 +4,7 @@
 
 import socket
 import threading
+import time
 import urlparse
 
 
@@ -130,6 +131,10 @@ class DataMaster(object):
       self.mapping = rdfvalue.DataServerMapping(version=0,
                                                 num_servers=len(self.servers),
                                                 servers=servers_info)
+      virtual_nodes = config_lib.CONFIG["Dataserver.virtual_nodes"]
+      if virtual_nodes:
+        self.mapping.nodes = sutils.CreateVirtualNodes(servers_info,
+                                                       virtual_nodes)
       self.service.SaveServerMapping(self.mapping, create_pathing=True)
     else:
       # Check mapping and configuration matching.
@@ -160,6 +165,9 @@ class DataMaster(object):
     # Holds current rebalance operation.
     self.rebalance = None
     self.rebalance_pool = []
+    # Incremental rebalancing, see StartMigrations().
+    self.migration_thread = None
+    self.last_rebalance = None
 
   def LoadMapping(self):
     return self.mapping
@@ -252,22 +260,39 @@ class DataMaster(object):
   def IsRebalancing(self):
     return self.rebalance
 
+  def IsMigrating(self):
+    return self.migration_thread and self.migration_thread.is_alive()
+
+  def RebalanceProgress(self):
+    """Returns the current or last rebalance, with its progress."""
+    return self.rebalance or self.last_rebalance
+
   def AddServer(self, addr, port):
     """Add new server to the group."""
     server = DataServer("http://%s:%d" % (addr, port), len(self.servers))
     self.servers.append(server)
     server.SetInterval(constants.MAX_RANGE, constants.MAX_RANGE)
+    # The server gets its virtual nodes when the data is rebalanced.
+    server.GetInfo().weight = 0
     self.mapping.servers.Append(server.GetInfo())
     self.mapping.num_servers += 1
+    self.mapping.version += 1
     # At this point, the new server is now part of the group.
     return server
 
   def RemoveServer(self, removed_server):
     """Remove a server. Returns None if server interval is not empty."""
-    interval = removed_server.Interval()
-    # Interval range must be 0.
-    if interval.start != interval.end:
+    # The server must not own any hashes.
+    if not sutils.ServerIsEmpty(self.mapping, removed_server.Index()):
       return None
+    # Replace the nodes rather than renumbering them in place, so lookups
+    # cached for the old list are dropped.
+    nodes = list(self.mapping.nodes)
+    for node in nodes:
+      if node.server > removed_server.Index():
+        node.server -= 1
+    if nodes:
+      self.mapping.nodes = nodes
     # Update ids of other servers.
     newserverlist = []
     for serv in self.servers:
@@ -279,6 +304,7 @@ class DataMaster(object):
     # Change list of servers.
     self.mapping.servers = newserverlist
     self.mapping.num_servers -= 1
+    self.mapping.version += 1
     self.servers.pop(removed_server.Index())
     self.DeregisterServer(removed_server)
     removed_server.Remove()
@@ -385,6 +411,9 @@ class DataMaster(object):
     mapping = self.rebalance.mapping
     for i, serv in enumerate(list(self.mapping.servers)):
       serv.interval = mapping.servers[i].interval
+      serv.weight = mapping.servers[i].weight
+    self.mapping.nodes = list(mapping.nodes)
+    self.mapping.version += 1
     self.rebalance.mapping = self.mapping
     self.service.SaveServerMapping(self.mapping)
     # We can finally delete the temporary file, since we have succeeded.
@@ -392,3 +421,126 @@ class DataMaster(object):
     rebalance.RemoveDirectory(self.rebalance)
     self.CancelRebalancing()
     return self.mapping
+
+  def _HasReplicas(self, index):
+    """Checks if Dataserver.replicas lists replicas of a data server."""
+    server = self.servers[index]
+    for entry in config_lib.CONFIG["Dataserver.replicas"]:
+      primary = urlparse.urlparse(entry.split("=", 1)[0], scheme="http")
+      if (primary.hostname == server.Address() and
+          primary.port == server.Port()):
+        return True
+    return False
+
+  def StartMigrations(self):
+    """Moves the data of the rebalance operation chunk by chunk.
+
+    The data servers keep serving while the chunks move in the background.
+    RebalanceProgress() reports how far it got.
+
+    Chunks are installed on their target outside its change log, so they
+    can not move to data servers with replicas.
+
+    Returns:
+      False if the new mapping can not be reached by moving chunks.
+    """
+    new_mapping = self.rebalance.mapping
+    if len(new_mapping.servers) != len(self.servers):
+      return False
+    chunks = max(1, config_lib.CONFIG["Dataserver.rebalance_chunks"])
+    try:
+      migrations = rebalance.PlanMigrations(self.mapping, new_mapping,
+                                            constants.MAX_RANGE // chunks)
+    except ValueError as e:
+      logging.warning("Can not rebalance to the new mapping: %s", e)
+      return False
+    for index in sorted(set(m.target for m in migrations)):
+      if self._HasReplicas(index):
+        logging.warning("Can not move data to server %d, it has replicas.",
+                        index)
+        return False
+    if new_mapping.nodes and not self.mapping.nodes:
+      # Same placement of the keys, but the migrations move virtual nodes.
+      self.mapping.nodes = sutils.RangesToNodes(self.mapping)
+      self.mapping.version += 1
+    self.rebalance.migrations = len(migrations)
+    self.last_rebalance = self.rebalance
+    self.migration_thread = threading.Thread(target=self._RunMigrations,
+                                             args=(migrations,),
+                                             name="Rebalance")
+    self.migration_thread.daemon = True
+    self.migration_thread.start()
+    return True
+
+  def _PostMigration(self, index, path, migration):
+    """Sends a migration to a data server. Returns the response data."""
+    body = migration.SerializeToString()
+    headers = {"Content-Length": len(body)}
+    try:
+      res = self.rebalance_pool[index].urlopen("POST", path, headers=headers,
+                                                body=body)
+    except urllib3.exceptions.MaxRetryError:
+      return None
+    if res.status != constants.RESPONSE_OK:
+      return None
+    return res.data
+
+  def _RunMigrations(self, migrations):
+    """Moves the chunks one by one."""
+    reb = self.rebalance
+    started = []
+    try:
+      for i, migration in enumerate(migrations):
+        target = self.servers[migration.target]
+        migration.rebalance_id = reb.id
+        migration.id = "%s-%d" % (reb.id, i)
+        migration.target_address = target.Address()
+        migration.target_port = target.Port()
+        started.append(migration)
+        logging.info("Moving hashes [%d, %d[ from server %d to %d",
+                     migration.interval.start, migration.interval.end,
+                     migration.source, migration.target)
+        data = self._PostMigration(migration.source, "/rebalance/migrate",
+                                   migration)
+        if data is None:
+          reb.error = "Could not copy chunk %d to server %d." % (
+              i, migration.target)
+          return
+        reb.moved += rdfvalue.DataServerMigration(data).moved
+        if self._PostMigration(migration.source, "/rebalance/switch",
+                               migration) is None:
+          reb.error = "Could not switch chunk %d to server %d." % (
+              i, migration.target)
+          return
+        # The chunk belongs to the target from now on.
+        rebalance.ApplyMigration(self.mapping, migration)
+        if not self.SyncMapping():
+          reb.error = "Could not send the new mapping to the data servers."
+          return
+        reb.migrations_done += 1
+      # Replace the virtual nodes left by the migrations with the ones of the
+      # new mapping, which place the keys the same way.
+      for i, serv in enumerate(list(self.mapping.servers)):
+        serv.interval = reb.mapping.servers[i].interval
+        serv.weight = reb.mapping.servers[i].weight
+      self.mapping.nodes = list(reb.mapping.nodes)
+      self.mapping.version += 1
+      if not self.SyncMapping():
+        reb.error = "Could not send the new mapping to the data servers."
+    finally:
+      self._FinishMigrations(reb, started)
+
+  def _FinishMigrations(self, reb, migrations):
+    """Stops forwarding and deletes the files the sources do not own."""
+    if migrations:
+      # Clients pick up the new mapping in the meantime.
+      time.sleep(config_lib.CONFIG["Dataserver.rebalance_cleanup_delay"])
+    for migration in migrations:
+      if self._PostMigration(migration.source, "/rebalance/cleanup",
+                             migration) is None:
+        logging.warning("Could not clean up chunk %s on server %d",
+                        migration.id, migration.source)
+    reb.finished = True
+    logging.info("Rebalance %s finished: %d of %d chunks moved", reb.id,
+                 reb.migrations_done, reb.migrations)
+    self.CancelRebalancing()
@@ -221,6 +221,30 @@ class MasterTest(test_lib.GRRBaseTest):
     self.assertEqual(utils._FindServerInMapping(mapping,
                                                 constants.MAX_RANGE), 3)
 
+  def testNoMigrationsToReplicatedServers(self):
+    m = master.DataMaster(7000, self.mock_service)
+    for port in self.ports[1:]:
+      m.RegisterServer(self.host, port)
+    mapping = m.LoadMapping()
+    new_mapping = mapping.Copy()
+    # Server 0 gives some of its hashes to server 1.
+    middle = mapping.servers[0].interval.end / 2
+    new_mapping.servers[0].interval.end = middle
+    new_mapping.servers[1].interval.start = middle
+    m.SetRebalancing(rdfvalue.DataServerRebalance(id="rebalance",
+                                                  mapping=new_mapping))
+
+    config_lib.CONFIG.Set("Dataserver.replicas",
+                          ["http://127.0.0.1:7001=http://127.0.0.1:7101"])
+    self.assertFalse(m.StartMigrations())
+    self.assertFalse(m.IsMigrating())
+
+    # Replicas of the other servers do not matter.
+    config_lib.CONFIG.Set("Dataserver.replicas",
+                          ["http://127.0.0.1:7002=http://127.0.0.1:7102"])
+    self.assertTrue(m._HasReplicas(2))
+    self.assertFalse(m._HasReplicas(1))
+
 
 def main(args):
   test_lib.main(args)
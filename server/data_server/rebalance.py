@@ -1,10 +1,28 @@
 #!/usr/bin/env python
-"""Utilities for load rebalancing."""
+"""Utilities for load rebalancing.
 
+Rebalancing moves data between data servers in small chunks of hashes, one
+chunk at a time, while the data servers keep serving. The source data server
+of a chunk keeps the writes to it from the moment the migration starts, copies
+the files of the chunk to the target at a limited rate and then forwards the
+writes applied after each file was copied. Once it caught up, the master moves
+the chunk to the target in the mapping. The source keeps applying and
+forwarding the writes of clients which still use the old mapping until the
+files of the chunk are deleted at the end of the rebalance.
 
+The copied files are installed outside the change log of the target, so
+chunks never move to data servers with replicas.
+"""
+
+
+import bisect
+import collections
 import os
+import re
 import shutil
 import StringIO
+import threading
+import time
 import zlib
 
 import urllib3
@@ -12,6 +30,7 @@ from urllib3 import connectionpool
 
 import logging
 
+from grr.lib import config_lib
 from grr.lib import data_store
 from grr.lib import rdfvalue
 from grr.lib import utils
@@ -68,10 +87,34 @@ def ComputeRebalanceSize(mapping, server_id):
   return _RecComputeRebalanceSize(mapping, server_id, loc, "")
 
 
+class Throttle(object):
+  """Limits an operation to a number of units per second, 0 means no limit."""
+
+  def __init__(self, rate):
+    self.rate = rate
+    self.allowance = rate
+    self.last = time.time()
+    self.lock = threading.Lock()
+
+  def Consume(self, units):
+    """Waits until units can be used without exceeding the rate."""
+    if not self.rate:
+      return
+    with self.lock:
+      now = time.time()
+      self.allowance = min(self.rate,
+                           self.allowance + (now - self.last) * self.rate)
+      self.last = now
+      self.allowance -= units
+      wait = -self.allowance / float(self.rate)
+    if wait > 0:
+      time.sleep(wait)
+
+
 class FileCopyWrapper(object):
   """Wraps the database file for post'ing it to the server."""
 
-  def __init__(self, rebalance, directory, filename, fullpath):
+  def __init__(self, rebalance, directory, filename, fullpath, throttle=None):
     filesize = os.path.getsize(fullpath)
     filecopy = rdfvalue.DataServerFileCopy(rebalance_id=rebalance.id,
                                            directory=directory,
@@ -91,6 +134,8 @@ class FileCopyWrapper(object):
     self.end_of_stream = False
     # Flag to indicate that we are going to read the header first.
     self.read_header = True
+    # Limits the bandwidth used to send the file.
+    self.throttle = throttle
 
   def read(self, blocksize):  # pylint: disable=invalid-name
     """Returns data back to the HTTP post request."""
@@ -126,6 +171,8 @@ class FileCopyWrapper(object):
       # Once the data is exhausted, we mark the end of the stream
       # and we simply return the 0 marker.
       self.end_of_stream = True
+    if self.throttle:
+      self.throttle.Consume(len(ret))
     # Return the size of the block plus the block itself.
     return sutils.SIZE_PACKER.pack(len(ret)) + ret
 
@@ -134,9 +181,11 @@ class FileCopyWrapper(object):
     self.header.close()
 
 
-def _SendFileToServer(pool, fullpath, subpath, basename, rebalance):
+def _SendFileToServer(pool, fullpath, subpath, basename, rebalance,
+                      throttle=None):
   """Sends a specific data store file to the server."""
-  fp = FileCopyWrapper(rebalance, subpath, basename, fullpath)
+  fp = FileCopyWrapper(rebalance, subpath, basename, fullpath,
+                       throttle=throttle)
 
   try:
     # Content-Length is 0 since we do not know the size of the compressed data.
@@ -408,3 +457,336 @@ def RemoveDirectory(rebalance):
       shutil.rmtree(tempdir)
   except OSError:
     pass
+
+
+def PlanMigrations(mapping, new_mapping, chunk_size):
+  """Splits a rebalance into migrations of small chunks of hashes.
+
+  Between mappings without virtual nodes, every migration moves the boundary
+  between two neighbouring data servers by at most chunk_size, so each data
+  server keeps a single interval after every migration. Otherwise every range
+  of hashes changing owner is split into chunks.
+
+  Args:
+    mapping: The current DataServerMapping.
+    new_mapping: The DataServerMapping after the rebalance.
+    chunk_size: The maximum number of hashes moved by one migration.
+
+  Returns:
+    A list of DataServerMigration objects with interval, source and target.
+
+  Raises:
+    ValueError: If the new mapping does not place the keys properly.
+  """
+  if mapping.nodes or new_mapping.nodes:
+    return _PlanRingMigrations(mapping, new_mapping, chunk_size)
+  return _PlanIntervalMigrations(mapping, new_mapping, chunk_size)
+
+
+def _PlanRingMigrations(mapping, new_mapping, chunk_size):
+  """Splits the ranges of hashes changing owner into migrations."""
+  if not new_mapping.nodes and not any(
+      serv.interval.start < serv.interval.end for serv in new_mapping.servers):
+    raise ValueError("The new mapping does not place any keys.")
+  if new_mapping.nodes and new_mapping.nodes[0].position:
+    raise ValueError("The first virtual node must start at 0.")
+  old = sutils.MappingRanges(mapping)
+  new = sutils.MappingRanges(new_mapping)
+  starts = sorted(set([start for start, _, _ in old] +
+                      [start for start, _, _ in new]))
+  ends = starts[1:] + [constants.MAX_RANGE]
+  old_starts = [start for start, _, _ in old]
+  new_starts = [start for start, _, _ in new]
+  moves = []
+  for start, end in zip(starts, ends):
+    source = old[bisect.bisect_right(old_starts, start) - 1][2]
+    target = new[bisect.bisect_right(new_starts, start) - 1][2]
+    if source == target:
+      continue
+    if moves and moves[-1][1] == start and moves[-1][2:] == [source, target]:
+      moves[-1][1] = end
+    else:
+      moves.append([start, end, source, target])
+
+  migrations = []
+  for start, end, source, target in moves:
+    for chunk_start in range(start, end, chunk_size):
+      interval = rdfvalue.DataServerInterval(
+          start=chunk_start, end=min(chunk_start + chunk_size, end))
+      migrations.append(rdfvalue.DataServerMigration(interval=interval,
+                                                     source=source,
+                                                     target=target))
+  return migrations
+
+
+def _PlanIntervalMigrations(mapping, new_mapping, chunk_size):
+  """Moves the boundaries between neighbouring servers chunk by chunk."""
+  current = [serv.interval.end for serv in mapping.servers][:-1]
+  target = [serv.interval.end for serv in new_mapping.servers][:-1]
+  if len(current) != len(target):
+    raise ValueError("Mappings have a different number of data servers.")
+  migrations = []
+  while current != target:
+    moved = False
+    for i, end in enumerate(current):
+      if end < target[i]:
+        # Server i grows into the interval of server i + 1.
+        upper = constants.MAX_RANGE
+        if i + 1 < len(current):
+          upper = current[i + 1]
+        new_end = min(end + chunk_size, target[i], upper)
+        interval = rdfvalue.DataServerInterval(start=end, end=new_end)
+        source, dest = i + 1, i
+      elif end > target[i]:
+        # Server i + 1 grows into the interval of server i.
+        lower = 0
+        if i:
+          lower = current[i - 1]
+        new_end = max(end - chunk_size, target[i], lower)
+        interval = rdfvalue.DataServerInterval(start=new_end, end=end)
+        source, dest = i, i + 1
+      else:
+        continue
+      if new_end == end:
+        # A neighbouring boundary has to move first.
+        continue
+      migrations.append(rdfvalue.DataServerMigration(interval=interval,
+                                                     source=source,
+                                                     target=dest))
+      current[i] = new_end
+      moved = True
+    if not moved:
+      raise ValueError("Intervals of the new mapping are not in order.")
+  return migrations
+
+
+def ApplyMigration(mapping, migration):
+  """Gives the interval of a migration to its target in the mapping."""
+  mapping.version += 1
+  if mapping.nodes:
+    start = migration.interval.start
+    end = migration.interval.end
+    ranges = sutils.MappingRanges(mapping)
+    owners = [(s, index) for s, _, index in ranges if not start <= s < end]
+    if end < constants.MAX_RANGE and end not in [s for s, _ in owners]:
+      # The hashes after the interval keep their owner.
+      owners.append((end, sutils.FindServerForHash(mapping, end)))
+    owners.append((start, migration.target))
+    mapping.nodes = [rdfvalue.DataServerVirtualNode(position=s, server=index)
+                     for s, index in sorted(owners)]
+    return
+
+  source = mapping.servers[migration.source].interval
+  target = mapping.servers[migration.target].interval
+  if migration.target < migration.source:
+    target.end = source.start = migration.interval.end
+  else:
+    source.end = target.start = migration.interval.start
+
+
+class Migration(object):
+  """A chunk of hashes moving from this data server to another one.
+
+  Writes to the chunk hold the lock of the migration. Until the switch they
+  are kept, by database file, to be forwarded once the file was copied to the
+  target. After the switch they are forwarded right away.
+  """
+
+  # Maximum number of writes forwarded in one request.
+  MAX_FORWARD = 1000
+
+  def __init__(self, migration, pathing):
+    self.migration = migration
+    self.path_regexes = [re.compile(path) for path in pathing]
+    self.lock = threading.Lock()
+    # Writes by database file key, in the order they were applied.
+    self.pending = collections.OrderedDict()
+    self.switched = False
+    self.pool = connectionpool.HTTPConnectionPool(migration.target_address,
+                                                  port=migration.target_port)
+
+  def _Key(self, subject):
+    filename, directory = common.ResolveSubjectDestination(subject,
+                                                           self.path_regexes)
+    return common.MakeDestinationKey(directory, filename)
+
+  def CoversKey(self, key):
+    interval = self.migration.interval
+    return interval.start <= sutils.HashKey(key) < interval.end
+
+  def Covers(self, subject):
+    return self.CoversKey(self._Key(subject))
+
+  def Record(self, commands):
+    """Keeps or forwards the writes to the chunk, called with the lock held."""
+    if self.switched:
+      self._Forward([command for command in commands
+                     if self.Covers(command.request.subject[0])])
+      return
+    for command in commands:
+      key = self._Key(command.request.subject[0])
+      if self.CoversKey(key):
+        self.pending.setdefault(key, []).append(command)
+
+  def Snapshot(self, key, paths, tempdir):
+    """Copies the files of a key while no write can change them.
+
+    Args:
+      key: The key of the database files.
+      paths: The paths of the files.
+      tempdir: Directory for the copies.
+
+    Returns:
+      A list of (filename, path of the copy) tuples.
+    """
+    copies = []
+    with self.lock:
+      # Writes which are not committed yet would be missing from the copy.
+      data_store.DB.Flush()
+      for path in paths:
+        if not os.path.isfile(path):
+          continue
+        copy = utils.JoinPath(tempdir, os.path.basename(path))
+        shutil.copyfile(path, copy)
+        copies.append((os.path.basename(path), copy))
+      # The copies include the writes kept so far.
+      self.pending.pop(key, None)
+    return copies
+
+  def _Forward(self, commands):
+    """Applies writes on the target data server."""
+    target = (self.migration.target_address, self.migration.target_port)
+    for i in range(0, len(commands), self.MAX_FORWARD):
+      body = ""
+      for command in commands[i:i + self.MAX_FORWARD]:
+        command_str = command.SerializeToString()
+        body += sutils.SIZE_PACKER.pack(len(command_str)) + command_str
+      try:
+        res = self.pool.urlopen("POST", "/rebalance/forward",
+                                headers={"Content-Length": len(body)},
+                                body=body)
+      except urllib3.exceptions.MaxRetryError:
+        raise data_store.Error("Could not forward writes to %s:%d." % target)
+      if res.status != constants.RESPONSE_OK:
+        raise data_store.Error("Data server %s:%d did not apply forwarded "
+                               "writes." % target)
+
+  def _TakePending(self):
+    pending = self.pending
+    self.pending = collections.OrderedDict()
+    return [command for commands in pending.itervalues()
+            for command in commands]
+
+  def Flush(self):
+    """Forwards the writes kept so far without blocking new writes."""
+    with self.lock:
+      commands = self._TakePending()
+    self._Forward(commands)
+
+  def Switch(self):
+    """Forwards the remaining writes and every later one right away."""
+    self.Flush()
+    with self.lock:
+      self._Forward(self._TakePending())
+      self.switched = True
+
+  def Install(self):
+    """Asks the target to move the copied files into its data store."""
+    body = self.migration.SerializeToString()
+    try:
+      res = self.pool.urlopen("POST", "/rebalance/install",
+                              headers={"Content-Length": len(body)},
+                              body=body)
+    except urllib3.exceptions.MaxRetryError:
+      return False
+    return res.status == constants.RESPONSE_OK
+
+  def Close(self):
+    self.pool.close()
+
+
+def _RecFindChunkFiles(interval, dspath, subpath):
+  """Yields the database files with keys in an interval, grouped by key."""
+  fulldir = utils.JoinPath(dspath, subpath)
+  files = collections.OrderedDict()
+  for comp in sorted(os.listdir(fulldir)):
+    if comp == constants.REBALANCE_DIRECTORY:
+      continue
+    path = utils.JoinPath(fulldir, comp)
+    name, unused_extension = os.path.splitext(comp)
+    if name in COPY_EXCEPTIONS:
+      continue
+    if os.path.isdir(path):
+      for found in _RecFindChunkFiles(interval, dspath,
+                                      utils.JoinPath(subpath, comp)):
+        yield found
+    elif os.path.isfile(path):
+      key = common.MakeDestinationKey(subpath, name)
+      if interval.start <= sutils.HashKey(key) < interval.end:
+        files.setdefault(key, []).append(path)
+  for key, paths in files.iteritems():
+    yield key, subpath, paths
+
+
+def CopyChunk(migration):
+  """Copies the database files of a migration to its target data server.
+
+  Args:
+    migration: A Migration object, registered with the data store service so
+      it sees the writes to the chunk.
+
+  Returns:
+    True if the target installed the files.
+  """
+  info = migration.migration
+  loc = data_store.DB.Location()
+  if not os.path.exists(loc) or not os.path.isdir(loc):
+    return migration.Install()
+  bandwidth = Throttle(config_lib.CONFIG["Dataserver.rebalance_bandwidth"])
+  files = Throttle(config_lib.CONFIG["Dataserver.rebalance_files_per_second"])
+  tempdir = _CreateDirectory(loc, info.id + ".snapshot")
+  try:
+    for key, subpath, paths in _RecFindChunkFiles(info.interval, loc, ""):
+      files.Consume(len(paths))
+      for filename, copy in migration.Snapshot(key, paths, tempdir):
+        size = os.path.getsize(copy)
+        ok = _SendFileToServer(migration.pool, copy, subpath, filename, info,
+                               throttle=bandwidth)
+        os.unlink(copy)
+        if not ok:
+          return False
+        info.moved += size
+  finally:
+    shutil.rmtree(tempdir, ignore_errors=True)
+  return migration.Install()
+
+
+def InstallChunk(migration):
+  """Moves the files of a chunk copied to this data server into place."""
+  loc = data_store.DB.Location()
+  if not os.path.exists(loc) or not os.path.isdir(loc):
+    return False
+  tempdir = _CreateDirectory(loc, migration.id)
+  try:
+    _RecMoveFiles(tempdir, loc, "")
+  except OSError:
+    return False
+  if tempdir.startswith(loc):
+    shutil.rmtree(tempdir)
+  return True
+
+
+def DeleteChunk(migration, mapping, server_id):
+  """Deletes the files of a moved chunk which this server does not own."""
+  loc = data_store.DB.Location()
+  if not os.path.exists(loc) or not os.path.isdir(loc):
+    return
+  for key, _, paths in list(_RecFindChunkFiles(migration.interval, loc, "")):
+    if sutils.MapKeyToServer(mapping, key) == server_id:
+      continue
+    for path in paths:
+      logging.info("Removing file %s", path)
+      try:
+        os.unlink(path)
+      except OSError:
+        pass
@@ -0,0 +1,245 @@
+#!/usr/bin/env python
+"""Tests the incremental rebalancing of data servers."""
+
+
+import os
+
+
+from urllib3 import connectionpool
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.lib import utils as libutils
+
+from grr.lib.data_stores import sqlite_data_store
+
+from grr.server.data_server import codec
+from grr.server.data_server import constants
+from grr.server.data_server import master_test
+from grr.server.data_server import rebalance
+from grr.server.data_server import store
+from grr.server.data_server import utils as sutils
+
+
+def _Mapping(ends):
+  mapping = rdfvalue.DataServerMapping(num_servers=len(ends))
+  start = 0
+  for i, end in enumerate(ends):
+    mapping.servers.Append(index=i, address="127.0.0.1", port=7000 + i,
+                           interval=rdfvalue.DataServerInterval(start=start,
+                                                                end=end))
+    start = end
+  return mapping
+
+
+class PlanMigrationsTest(test_lib.GRRBaseTest):
+  """Tests splitting a rebalance into migrations."""
+
+  def _Intervals(self, mapping):
+    return [(s.interval.start, s.interval.end) for s in mapping.servers]
+
+  def _CheckPlan(self, mapping, new_mapping, chunk_size):
+    migrations = rebalance.PlanMigrations(mapping, new_mapping, chunk_size)
+    for migration in migrations:
+      interval = migration.interval
+      self.assertTrue(0 < interval.end - interval.start <= chunk_size)
+      self.assertEqual(abs(migration.source - migration.target), 1)
+      rebalance.ApplyMigration(mapping, migration)
+      # Every server keeps a single interval.
+      intervals = self._Intervals(mapping)
+      for (start, end), (next_start, _) in zip(intervals, intervals[1:]):
+        self.assertTrue(start <= end)
+        self.assertEqual(end, next_start)
+    self.assertEqual(self._Intervals(mapping), self._Intervals(new_mapping))
+    return migrations
+
+  def testShrink(self):
+    quarter = constants.MAX_RANGE / 4
+    migrations = self._CheckPlan(
+        _Mapping([2 * quarter, constants.MAX_RANGE]),
+        _Mapping([quarter, constants.MAX_RANGE]), quarter / 4)
+    self.assertEqual(len(migrations), 4)
+    self.assertEqual([(m.source, m.target) for m in migrations], [(0, 1)] * 4)
+    self.assertEqual(migrations[0].interval.end, 2 * quarter)
+
+  def testAddServer(self):
+    third = constants.MAX_RANGE / 3
+    migrations = self._CheckPlan(
+        _Mapping([constants.MAX_RANGE / 2, constants.MAX_RANGE,
+                  constants.MAX_RANGE]),
+        _Mapping([third, 2 * third, constants.MAX_RANGE]),
+        constants.MAX_RANGE / 64)
+    self.assertTrue(migrations)
+
+  def testUnorderedMapping(self):
+    mapping = _Mapping([constants.MAX_RANGE / 2, constants.MAX_RANGE / 2,
+                        constants.MAX_RANGE])
+    new_mapping = _Mapping([constants.MAX_RANGE / 2, constants.MAX_RANGE / 4,
+                            constants.MAX_RANGE])
+    self.assertRaises(ValueError, rebalance.PlanMigrations, mapping,
+                      new_mapping, constants.MAX_RANGE / 64)
+
+
+class PlanRingMigrationsTest(test_lib.GRRBaseTest):
+  """Tests splitting a rebalance of the hashing ring into migrations."""
+
+  def _Ring(self, num_servers, weights=None):
+    mapping = rdfvalue.DataServerMapping(num_servers=num_servers)
+    for i in range(num_servers):
+      weight = weights[i] if weights else 1
+      mapping.servers.Append(index=i, address="127.0.0.1", port=7000 + i,
+                             weight=weight)
+    mapping.nodes = sutils.CreateVirtualNodes(list(mapping.servers), 16)
+    return mapping
+
+  def _Share(self, mapping, index):
+    return sum(end - start for start, end, server
+               in sutils.MappingRanges(mapping) if server == index)
+
+  def _CheckPlan(self, mapping, new_mapping, chunk_size):
+    migrations = rebalance.PlanMigrations(mapping, new_mapping, chunk_size)
+    for migration in migrations:
+      interval = migration.interval
+      self.assertTrue(0 < interval.end - interval.start <= chunk_size)
+      rebalance.ApplyMigration(mapping, migration)
+    self.assertEqual(sutils.MappingRanges(mapping),
+                     sutils.MappingRanges(new_mapping))
+    return migrations
+
+  def testAddServer(self):
+    mapping = self._Ring(3, weights=[1, 1, 0])
+    new_mapping = self._Ring(3)
+    self.assertEqual(self._Share(mapping, 2), 0)
+    migrations = self._CheckPlan(mapping, new_mapping,
+                                 constants.MAX_RANGE / 64)
+
+    # Only the keys of the new server move.
+    self.assertTrue(migrations)
+    self.assertTrue(all(m.target == 2 for m in migrations))
+    moved = sum(m.interval.end - m.interval.start for m in migrations)
+    self.assertEqual(moved, self._Share(new_mapping, 2))
+    self.assertTrue(constants.MAX_RANGE / 6 < moved < constants.MAX_RANGE / 2)
+
+  def testIntervalsToRing(self):
+    mapping = _Mapping([constants.MAX_RANGE / 2, constants.MAX_RANGE])
+    new_mapping = self._Ring(2)
+    mapping.nodes = sutils.RangesToNodes(mapping)
+    self.assertEqual(sutils.MappingRanges(mapping),
+                     [(0, constants.MAX_RANGE / 2, 0),
+                      (constants.MAX_RANGE / 2, constants.MAX_RANGE, 1)])
+    self._CheckPlan(mapping, new_mapping, constants.MAX_RANGE / 64)
+
+  def testLookupsAfterMigration(self):
+    mapping = self._Ring(3)
+    ranges = sutils.MappingRanges(mapping)
+    (start, _, _), (next_start, next_end, next_server) = ranges[:2]
+    target = [i for i in range(3) if i != next_server][0]
+    middle = next_start + (next_end - next_start) / 2
+    self.assertEqual(sutils.FindServerForHash(mapping, middle), next_server)
+
+    # The chunk ends inside the next range, so the number of nodes stays the
+    # same.
+    num_nodes = len(mapping.nodes)
+    rebalance.ApplyMigration(mapping, rdfvalue.DataServerMigration(
+        interval=rdfvalue.DataServerInterval(start=start, end=middle),
+        target=target))
+    self.assertEqual(len(mapping.nodes), num_nodes)
+
+    self.assertEqual(sutils.FindServerForHash(mapping, start), target)
+    self.assertEqual(sutils.FindServerForHash(mapping, middle - 1), target)
+    self.assertEqual(sutils.FindServerForHash(mapping, middle), next_server)
+
+  def testServerIsEmpty(self):
+    mapping = self._Ring(3, weights=[1, 0, 1])
+    self.assertTrue(sutils.ServerIsEmpty(mapping, 1))
+    self.assertFalse(sutils.ServerIsEmpty(mapping, 2))
+    for i in range(100):
+      self.assertNotEqual(
+          sutils.MapKeyToServer(mapping, "aff4:/C.%016d" % i), 1)
+
+
+class MigrationTest(test_lib.GRRBaseTest):
+  """Tests forwarding the writes to a moving chunk."""
+
+  def setUp(self):
+    super(MigrationTest, self).setUp()
+    self.service = store.DataStoreService(
+        sqlite_data_store.SqliteDataStore(os.path.join(self.temp_dir, "db")))
+    info = rdfvalue.DataServerMigration(
+        id="migration", target_address="127.0.0.1", target_port=7001,
+        interval=rdfvalue.DataServerInterval(start=0,
+                                             end=constants.MAX_RANGE))
+    self.responses = [master_test.MockResponse(constants.RESPONSE_OK)
+                      for _ in range(10)]
+    self.pool_class = master_test.GetMockHTTPConnectionPoolClass(
+        self.responses)
+    self.pool_class.requests = []
+    with libutils.Stubber(connectionpool, "HTTPConnectionPool",
+                          self.pool_class):
+      self.migration = rebalance.Migration(info, self.service.pathing)
+    self.service.AddMigration(self.migration)
+
+  def _Write(self, subject):
+    command = codec.MultiSetCommand(
+        subject, [(u"metadata:predicate", True, 1000, "value")],
+        token=self.token, sync=True)
+    response = rdfvalue.DataStoreResponse(
+        self.service.MultiSet(command.request))
+    self.assertEqual(response.status, rdfvalue.DataStoreResponse.Status.OK)
+
+  def _Forwarded(self):
+    subjects = []
+    for request in self.pool_class.requests:
+      self.assertEqual(request["url"], "/rebalance/forward")
+      data = request["body"]
+      while data:
+        size = sutils.SIZE_PACKER.unpack(data[:sutils.SIZE_PACKER.size])[0]
+        data = data[sutils.SIZE_PACKER.size:]
+        command = rdfvalue.DataStoreCommand(data[:size])
+        subjects.append(command.request.subject[0])
+        data = data[size:]
+    return subjects
+
+  def testWritesAreKeptUntilForwarded(self):
+    self._Write("aff4:/C.0000000000000001")
+    self._Write("aff4:/C.0000000000000002")
+    self.assertEqual(self._Forwarded(), [])
+
+    self.migration.Flush()
+    self.assertEqual(self._Forwarded(), ["aff4:/C.0000000000000001",
+                                         "aff4:/C.0000000000000002"])
+
+    # After the switch every write is forwarded right away.
+    self.pool_class.requests = []
+    self.migration.Switch()
+    self._Write("aff4:/C.0000000000000003")
+    self.assertEqual(self._Forwarded(), ["aff4:/C.0000000000000003"])
+
+  def testCopiedFilesDropKeptWrites(self):
+    self._Write("aff4:/C.0000000000000001")
+    key, _, paths = list(rebalance._RecFindChunkFiles(
+        self.migration.migration.interval, self.service.GetLocation(), ""))[0]
+    copies = self.migration.Snapshot(key, paths, self.temp_dir)
+    self.assertTrue(copies)
+
+    # The copy already has the write.
+    self.migration.Flush()
+    self.assertEqual(self._Forwarded(), [])
+
+  def testWritesOutsideTheChunk(self):
+    self.migration.migration.interval.end = 0
+    self._Write("aff4:/C.0000000000000001")
+    self.migration.Flush()
+    self.assertEqual(self._Forwarded(), [])
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+"""Replication of data servers to read only replicas.
+
+A data server with Dataserver.change_log_size set keeps the writes it applied
+in a change log. Replicas connect to it, tell it how far they got and then
+receive every new write as a DataServerChange, prefixed with its size, as soon
+as it is applied. The replica applies the changes in order and remembers its
+position so it can resume after a reconnection.
+
+Positions continue from the startup time of the primary in microseconds, so
+they keep growing when it restarts and clients can compare the positions of
+their writes with the one of a replica. A replica without a position starts
+from the beginning of the change log, which only works if it was seeded with
+a copy of the data store of the primary taken before the primary started.
+Replicas which can not resume from their position anymore stop answering
+reads until they are seeded again.
+"""
+
+
+import collections
+import contextlib
+import httplib
+import itertools
+import socket
+import threading
+import time
+import urlparse
+
+import logging
+
+from grr.lib import rdfvalue
+from grr.lib import utils
+
+from grr.server.data_server import constants
+from grr.server.data_server import utils as sutils
+
+
+# The primary sends an empty change this often when there are no writes.
+HEARTBEAT_INTERVAL = 5
+
+# Replicas which did not hear from their primary for this long do not answer
+# reads anymore.
+MAX_SILENCE = 6 * HEARTBEAT_INTERVAL
+
+
+class ChangeLogGapError(Exception):
+  """Raised when the changes a replica needs were dropped from the log."""
+
+
+class ChangeLog(object):
+  """The writes applied by a primary data server, kept for its replicas."""
+
+  # The maximum number of changes handed out by a single Read().
+  MAX_CHANGES = 1000
+
+  def __init__(self, size, num_stripes=64):
+    self.size = size
+    self.changes = collections.deque()
+    self.condition = threading.Condition()
+    self.initial_sequence = int(time.time() * 1e6)
+    # The log holds the changes after first_sequence up to last_sequence.
+    self.first_sequence = self.initial_sequence
+    self.last_sequence = self.initial_sequence
+    self.stripes = [threading.Lock() for _ in range(num_stripes)]
+
+  @contextlib.contextmanager
+  def OrderedWrite(self, subjects):
+    """Locks the subjects of a write while it is applied and logged.
+
+    Writes to the same subject must reach the replicas in the order they were
+    applied on the primary.
+
+    Args:
+      subjects: The subjects the write modifies.
+
+    Yields:
+      Nothing, the subjects stay locked until the block exits.
+    """
+    # Stripes are always taken in the same order so writes can not deadlock.
+    stripes = [self.stripes[i] for i in sorted(set(
+        hash(utils.SmartUnicode(subject)) % len(self.stripes)
+        for subject in subjects))]
+    for stripe in stripes:
+      stripe.acquire()
+    try:
+      yield
+    finally:
+      for stripe in reversed(stripes):
+        stripe.release()
+
+  def Extend(self, commands):
+    """Adds DataStoreCommands to the log.
+
+    Args:
+      commands: A list of DataStoreCommand objects.
+
+    Returns:
+      The position of the last command in the log.
+    """
+    with self.condition:
+      for command in commands:
+        self.last_sequence += 1
+        self.changes.append(rdfvalue.DataServerChange(
+            sequence=self.last_sequence, command=command))
+
+      while len(self.changes) > self.size:
+        self.changes.popleft()
+        self.first_sequence += 1
+
+      self.condition.notify_all()
+      return self.last_sequence
+
+  def Start(self, sequence):
+    """Returns the position a replica resumes from.
+
+    Args:
+      sequence: The position of the replica, 0 if it has none.
+
+    Returns:
+      The position to pass to Read().
+
+    Raises:
+      ChangeLogGapError: If the log does not have all the changes after the
+        position anymore.
+    """
+    with self.condition:
+      if not sequence:
+        sequence = self.initial_sequence
+
+      if not self.first_sequence <= sequence <= self.last_sequence:
+        raise ChangeLogGapError(
+            "Changes after %d are not available, the log holds %d to %d." %
+            (sequence, self.first_sequence + 1, self.last_sequence))
+      return sequence
+
+  def Read(self, sequence, timeout):
+    """Returns the changes after a position.
+
+    Args:
+      sequence: The position of the last change the caller has.
+      timeout: Seconds to wait for a change if there is none yet.
+
+    Returns:
+      A list of DataServerChange objects, empty after the timeout.
+
+    Raises:
+      ChangeLogGapError: If the changes were dropped from the log already.
+    """
+    with self.condition:
+      if self.last_sequence <= sequence:
+        self.condition.wait(timeout)
+
+      if sequence < self.first_sequence:
+        raise ChangeLogGapError("Changes after %d were dropped." % sequence)
+
+      start = len(self.changes) - (self.last_sequence - sequence)
+      return list(itertools.islice(self.changes, start,
+                                   start + self.MAX_CHANGES))
+
+
+class Replicator(object):
+  """Follows the change log of the primary data server of a replica."""
+
+  RECONNECTION_TIME = 5
+  LOGIN_TIMEOUT = 5
+
+  # The position is saved after this many changes and on every heartbeat.
+  SAVE_INTERVAL = 1000
+
+  def __init__(self, service, location, nonce_store):
+    loc = urlparse.urlparse(location, scheme="http")
+    self.primary_addr = loc.hostname
+    self.primary_port = loc.port
+    self.service = service
+    self.nonce_store = nonce_store
+    self.condition = threading.Condition()
+    self.sequence = service.LoadReplicationSequence()
+    self.saved_sequence = self.sequence
+    self.last_contact = 0
+    # Set once the primary can not give us the changes we miss.
+    self.stale = False
+    self.thread = None
+
+  def Start(self):
+    self.thread = utils.InterruptableThread(
+        target=self._Follow, sleep_time=self.RECONNECTION_TIME)
+    self.thread.start()
+
+  def Stop(self):
+    if self.thread:
+      self.thread.Stop()
+
+  def _ReadExactly(self, sock, n):
+    ret = ""
+    while len(ret) < n:
+      data = sock.recv(n - len(ret))
+      if not data:
+        raise socket.error("Connection closed by the primary data server.")
+      ret += data
+    return ret
+
+  def _Follow(self):
+    """Applies the changes of the primary until the connection drops."""
+    if self.stale:
+      return
+
+    conn = httplib.HTTPConnection(self.primary_addr, self.primary_port,
+                                  timeout=self.LOGIN_TIMEOUT)
+    try:
+      conn.request("POST", "/replica/handshake", "", {})
+      response = conn.getresponse()
+      if response.status != constants.RESPONSE_OK:
+        logging.warning("Data server %s:%d does not keep a change log.",
+                        self.primary_addr, self.primary_port)
+        return
+      nonce = response.read()
+
+      request = rdfvalue.DataServerReplicaRequest(
+          sequence=self.sequence,
+          token=self.nonce_store.GenerateServerAuthToken(nonce))
+      body = request.SerializeToString()
+      conn.request("POST", "/replica/stream", body,
+                   {"Content-Length": len(body)})
+      sock = conn.sock
+      ack = self._ReadExactly(sock, len(constants.CLIENT_ACK))
+      if ack == constants.REPLICA_GAP:
+        logging.critical("Data server %s:%d does not have the changes after "
+                         "%d anymore. The replica must be seeded again.",
+                         self.primary_addr, self.primary_port, self.sequence)
+        with self.condition:
+          self.stale = True
+          self.condition.notify_all()
+        return
+      if ack != constants.CLIENT_ACK:
+        logging.warning("Could not follow the change log of %s:%d.",
+                        self.primary_addr, self.primary_port)
+        return
+
+      logging.info("Following the change log of %s:%d from %d.",
+                   self.primary_addr, self.primary_port, self.sequence)
+      sock.settimeout(3 * HEARTBEAT_INTERVAL)
+      while not self.thread.exit:
+        size_str = self._ReadExactly(sock, sutils.SIZE_PACKER.size)
+        size = sutils.SIZE_PACKER.unpack(size_str)[0]
+        self.Apply(rdfvalue.DataServerChange(self._ReadExactly(sock, size)))
+
+    except (httplib.HTTPException, socket.error, socket.timeout) as e:
+      logging.warning("Lost the change log of %s:%d: %s", self.primary_addr,
+                      self.primary_port, e)
+    finally:
+      conn.close()
+
+  def Apply(self, change):
+    """Applies a DataServerChange from the primary."""
+    if change.HasField("command"):
+      self.service.ApplyChange(change.command)
+
+    with self.condition:
+      self.sequence = max(self.sequence, change.sequence)
+      self.last_contact = time.time()
+      self.condition.notify_all()
+
+    if (not change.HasField("command") or
+        self.sequence - self.saved_sequence >= self.SAVE_INTERVAL):
+      self.service.SaveReplicationSequence(self.sequence)
+      self.saved_sequence = self.sequence
+
+  def WaitFor(self, sequence, timeout):
+    """Waits until the replica applied the changes up to a position.
+
+    Args:
+      sequence: The position, 0 for reads which accept any recent state.
+      timeout: Seconds to wait.
+
+    Returns:
+      True if the replica can answer the read.
+    """
+    deadline = time.time() + timeout
+    with self.condition:
+      while not self.stale:
+        if (self.sequence >= sequence and
+            time.time() - self.last_contact < MAX_SILENCE):
+          return True
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+          break
+        self.condition.wait(remaining)
+
+    return False
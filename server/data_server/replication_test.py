@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+"""Tests the replication of data servers."""
+
+
+import os
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+
+from grr.lib.data_stores import sqlite_data_store
+
+from grr.server.data_server import codec
+from grr.server.data_server import replication
+from grr.server.data_server import store
+
+
+class ChangeLogTest(test_lib.GRRBaseTest):
+  """Tests the change log of primary data servers."""
+
+  def _Commands(self, num):
+    return [codec.MultiSetCommand("aff4:/row%d" % i,
+                                  [(u"metadata:predicate", True, 1, "value")])
+            for i in range(num)]
+
+  def testReadAndGaps(self):
+    log = replication.ChangeLog(3)
+    start = log.Start(0)
+    self.assertEqual(start, log.initial_sequence)
+    self.assertEqual(log.Read(start, 0), [])
+
+    self.assertEqual(log.Extend(self._Commands(2)), start + 2)
+    changes = log.Read(start, 0)
+    self.assertEqual([change.sequence for change in changes],
+                     [start + 1, start + 2])
+    self.assertEqual(changes[1].command.request.subject[0], "aff4:/row1")
+    self.assertEqual([c.sequence for c in log.Read(start + 1, 0)], [start + 2])
+
+    # Only the last three changes are kept.
+    log.Extend(self._Commands(2))
+    self.assertEqual([c.sequence for c in log.Read(start + 1, 0)],
+                     [start + 2, start + 3, start + 4])
+    self.assertRaises(replication.ChangeLogGapError, log.Read, start, 0)
+    self.assertRaises(replication.ChangeLogGapError, log.Start, 0)
+    self.assertEqual(log.Start(start + 4), start + 4)
+    self.assertRaises(replication.ChangeLogGapError, log.Start, start + 5)
+
+
+class ReplicationTest(test_lib.GRRBaseTest):
+  """Tests applying the change log of a primary on a replica."""
+
+  def setUp(self):
+    super(ReplicationTest, self).setUp()
+    config_lib.CONFIG.Set("Dataserver.replica_wait_timeout", 0)
+    self.primary = store.DataStoreService(
+        sqlite_data_store.SqliteDataStore(os.path.join(self.temp_dir, "p")),
+        change_log=replication.ChangeLog(100))
+    self.replica = store.DataStoreService(
+        sqlite_data_store.SqliteDataStore(os.path.join(self.temp_dir, "r")))
+    self.replica.replicator = replication.Replicator(
+        self.replica, "http://127.0.0.1:7000", None)
+
+  def _Read(self, service, min_sequence=0):
+    request = rdfvalue.DataStoreRequest(subject=["aff4:/row"],
+                                        token=self.token,
+                                        min_sequence=min_sequence)
+    request.values.Append(attribute="metadata:predicate")
+    request.timestamp = rdfvalue.TimestampSpec(
+        type=rdfvalue.TimestampSpec.Type.ALL_TIMESTAMPS)
+    return rdfvalue.DataStoreResponse(service.ResolveMulti(request))
+
+  def testReplicaAppliesChanges(self):
+    start = self.primary.change_log.Start(0)
+    command = codec.MultiSetCommand(
+        "aff4:/row", [(u"metadata:predicate", True, 1000, "value")],
+        token=self.token, sync=True)
+    response = rdfvalue.DataStoreResponse(
+        self.primary.MultiSet(command.request))
+    self.assertEqual(response.sequence, start + 1)
+
+    # The replica did not hear from the primary yet.
+    response = self._Read(self.replica)
+    self.assertEqual(response.status,
+                     rdfvalue.DataStoreResponse.Status.REPLICA_BEHIND)
+
+    for change in self.primary.change_log.Read(start, 0):
+      self.replica.replicator.Apply(change)
+
+    response = self._Read(self.replica, min_sequence=start + 1)
+    self.assertEqual(response.status, rdfvalue.DataStoreResponse.Status.OK)
+    attribute, _, timestamp = response.results[0].payload[0]
+    self.assertEqual((attribute, timestamp), ("metadata:predicate", 1000))
+
+    # Reads of later writes have to go to the primary.
+    response = self._Read(self.replica, min_sequence=start + 2)
+    self.assertEqual(response.status,
+                     rdfvalue.DataStoreResponse.Status.REPLICA_BEHIND)
+
+    # Heartbeats save the position of the replica.
+    self.replica.replicator.Apply(
+        rdfvalue.DataServerChange(sequence=start + 1))
+    self.assertEqual(self.replica.LoadReplicationSequence(), start + 1)
+
+  def testReplicasAreReadOnly(self):
+    command = codec.MultiSetCommand(
+        "aff4:/row", [(u"metadata:predicate", True, 1000, "value")],
+        token=self.token, sync=True)
+    response = rdfvalue.DataStoreResponse(
+        self.replica.MultiSet(command.request))
+    self.assertEqual(response.status,
+                     rdfvalue.DataStoreResponse.Status.DATA_STORE_ERROR)
+
+    request = rdfvalue.DataStoreRequest(subject=["aff4:/row"],
+                                        token=self.token)
+    request.timestamp = rdfvalue.TimestampSpec(
+        start=10, type=rdfvalue.TimestampSpec.Type.SPECIFIC_TIME)
+    response = rdfvalue.DataStoreResponse(self.replica.LockSubject(request))
+    self.assertEqual(response.status,
+                     rdfvalue.DataStoreResponse.Status.DATA_STORE_ERROR)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -19,10 +19,21 @@ from grr.lib import utils
 
 from grr.lib.data_stores import common
 
+from grr.server.data_server import codec
+from grr.server.data_server import errors
+
 
 BASE_MAP_SUBJECT = "servers_map"
 MAP_SUBJECT = "aff4:/" + BASE_MAP_SUBJECT
 MAP_VALUE_PREDICATE = "metadata:value"
+# Position of a replica in the change log of its primary data server.
+REPLICATION_SEQUENCE_PREDICATE = "metadata:replication_sequence"
+
+
+def _AttachRequest(response, request):
+  # Compact batches are not protobufs and are not sent back.
+  if isinstance(request, rdfvalue.DataStoreRequest):
+    response.request = request
 
 
 def RPCWrapper(f):
@@ -49,11 +60,18 @@ def RPCWrapper(f):
     try:
       f(self, request, response)
       failed = False
+    except errors.ReplicaBehindError as e:
+      # The client sends the request to the primary data server instead.
+      response.Clear()
+      response.status = rdfvalue.DataStoreResponse.Status.REPLICA_BEHIND
+      response.status_desc = utils.SmartUnicode(e)
+      failed = False
+
     except access_control.UnauthorizedAccess as e:
       # Attach a copy of the request to the response so the caller can tell why
       # we failed the request.
       response.Clear()
-      response.request = request
+      _AttachRequest(response, request)
 
       response.status = rdfvalue.DataStoreResponse.Status.AUTHORIZATION_DENIED
       if e.subject:
@@ -65,7 +83,7 @@ def RPCWrapper(f):
       # Attach a copy of the request to the response so the caller can tell why
       # we failed the request.
       response.Clear()
-      response.request = request
+      _AttachRequest(response, request)
 
       response.status = rdfvalue.DataStoreResponse.Status.DATA_STORE_ERROR
       response.status_desc = utils.SmartUnicode(e)
@@ -74,7 +92,7 @@ def RPCWrapper(f):
       # Attach a copy of the request to the response so the caller can tell why
       # we failed the request.
       response.Clear()
-      response.request = request
+      _AttachRequest(response, request)
 
       response.status = rdfvalue.DataStoreResponse.Status.TIMEOUT_ERROR
       response.status_desc = utils.SmartUnicode(e)
@@ -82,6 +100,11 @@ def RPCWrapper(f):
     if failed:
       # Limit the size of the error report since it can be quite large.
       logging.info("Failed: %s", utils.SmartStr(response)[:1000])
+
+    # Pipelining clients match responses to their requests with this id.
+    if getattr(request, "request_id", None):
+      response.request_id = request.request_id
+
     serialized_response = response.SerializeToString()
     return serialized_response
 
@@ -89,25 +112,185 @@ def RPCWrapper(f):
 
 
 class DataStoreService(object):
-  """Class that responds to DataStore requests."""
+  """Class that responds to DataStore requests.
+
+  Primary data servers with replicas record their writes in a change log.
+  Replicas only answer reads and apply the writes of their primary through
+  ApplyChange(). While rebalancing, writes to the chunks moving to other data
+  servers are also handed to their rebalance.Migration.
+  """
 
-  def __init__(self, db):
+  def __init__(self, db, change_log=None):
     self.db = db
+    self.change_log = change_log
+    # The replication.Replicator of a replica.
+    self.replicator = None
     self.transaction_lock = threading.Lock()
     self.transactions = {}
+    # The rebalance.Migration objects of the chunks moving to other servers.
+    self.migrations = []
+    # Writes in progress by the number of migrations added when they started.
+    self.migration_condition = threading.Condition()
+    self.migration_epoch = 0
+    self.writes_in_epoch = {}
     old_pathing = config_lib.CONFIG.Get("Datastore.pathing")
     # Need to add a fixed rule for the file where the server mapping is stored.
     new_pathing = [r"(?P<path>" + BASE_MAP_SUBJECT + ")"] + old_pathing
     self.pathing = new_pathing
     self.db.RecreatePathing(self.pathing)
 
+  def _CheckWritable(self):
+    if self.replicator:
+      raise data_store.Error("Replica data servers are read only.")
+
+  def _RecordWrite(self, subjects, write, commands, response):
+    """Applies a write and adds it to the change log for the replicas.
+
+    Args:
+      subjects: The subjects the write modifies.
+      write: A function applying the write to the data store.
+      commands: A function returning the DataStoreCommands of the write.
+      response: The DataStoreResponse, gets the position of the write.
+    """
+    with self.migration_condition:
+      epoch = self.migration_epoch
+      migrations = self.migrations
+      self.writes_in_epoch[epoch] = self.writes_in_epoch.get(epoch, 0) + 1
+
+    try:
+      migrations = [m for m in migrations
+                    if any(m.Covers(subject) for subject in subjects)]
+      if migrations:
+        write = self._MigratingWrite(migrations, write, commands)
+
+      if not self.change_log:
+        write()
+        return
+
+      with self.change_log.OrderedWrite(subjects):
+        write()
+        response.sequence = self.change_log.Extend(commands())
+    finally:
+      with self.migration_condition:
+        self.writes_in_epoch[epoch] -= 1
+        if not self.writes_in_epoch[epoch]:
+          del self.writes_in_epoch[epoch]
+          self.migration_condition.notify_all()
+
+  def _MigratingWrite(self, migrations, write, commands):
+    """Wraps a write to chunks moving to other data servers."""
+
+    def Write():
+      for migration in migrations:
+        migration.lock.acquire()
+      try:
+        write()
+        for migration in migrations:
+          migration.Record(commands())
+      finally:
+        for migration in reversed(migrations):
+          migration.lock.release()
+
+    return Write
+
+  def AddMigration(self, migration):
+    """Hands the writes to a chunk to its migration.
+
+    Returns once the writes which started before, and do not know about the
+    migration, are done.
+
+    Args:
+      migration: The rebalance.Migration.
+    """
+    with self.migration_condition:
+      self.migrations = self.migrations + [migration]
+      self.migration_epoch += 1
+      while any(epoch < self.migration_epoch
+                for epoch in self.writes_in_epoch):
+        self.migration_condition.wait()
+
+  def GetMigration(self, migration_id):
+    for migration in self.migrations:
+      if migration.migration.id == migration_id:
+        return migration
+
+  def RemoveMigration(self, migration_id):
+    with self.migration_condition:
+      self.migrations = [m for m in self.migrations
+                         if m.migration.id != migration_id]
+
+  def _WaitForReplication(self, request):
+    """Checks that a replica applied the writes a read has to see."""
+    if not self.replicator:
+      return
+
+    timeout = config_lib.CONFIG["Dataserver.replica_wait_timeout"]
+    if not self.replicator.WaitFor(request.min_sequence, timeout):
+      raise errors.ReplicaBehindError(
+          "Replica did not apply the change log up to %d." %
+          request.min_sequence)
+
+  def ApplyChange(self, command):
+    """Applies a write received from the primary data server."""
+    cmd = rdfvalue.DataStoreCommand.Command
+    appliers = {cmd.MULTI_SET: self._MultiSet,
+                cmd.DELETE_ATTRIBUTES: self._DeleteAttributes,
+                cmd.DELETE_SUBJECT: self._DeleteSubject}
+    applier = appliers.get(command.command)
+    if not applier:
+      logging.error("Unexpected command %d in the change log.",
+                    command.command)
+      return
+
+    try:
+      applier(command.request)
+    except (data_store.Error, access_control.UnauthorizedAccess) as e:
+      logging.error("Could not apply change to %s: %s",
+                    list(command.request.subject), e)
+
+  def ApplyForwarded(self, command):
+    """Applies a write forwarded by the data server a chunk moves from.
+
+    Forwarded writes are logged like any other, so they reach the replicas of
+    this data server and the data servers its own chunks move to.
+
+    Args:
+      command: The DataStoreCommand of the write.
+
+    Raises:
+      data_store.Error: If the write could not be applied.
+    """
+    cmd = rdfvalue.DataStoreCommand.Command
+    methods = {cmd.MULTI_SET: self.MultiSet,
+               cmd.DELETE_ATTRIBUTES: self.DeleteAttributes,
+               cmd.DELETE_SUBJECT: self.DeleteSubject}
+    method = methods.get(command.command)
+    if not method:
+      raise data_store.Error("Unexpected forwarded command %d." %
+                             command.command)
+
+    response = rdfvalue.DataStoreResponse(method(command.request))
+    if response.status != rdfvalue.DataStoreResponse.Status.OK:
+      raise data_store.Error("Could not apply forwarded write to %s: %s" %
+                             (list(command.request.subject),
+                              response.status_desc))
+
+  def _Command(self, typ, request):
+    return lambda: [rdfvalue.DataStoreCommand(command=typ, request=request)]
+
   # Every service method must write to the response argument.
   # The response will then be serialized to a string.
 
   @RPCWrapper
-  def MultiSet(self, request, unused_response):
+  def MultiSet(self, request, response):
     """Set multiple attributes for a given subject at once."""
+    self._CheckWritable()
+    self._RecordWrite(
+        request.subject, lambda: self._MultiSet(request),
+        self._Command(rdfvalue.DataStoreCommand.Command.MULTI_SET, request),
+        response)
 
+  def _MultiSet(self, request):
     values = {}
     to_delete = set()
 
@@ -127,9 +310,39 @@ class DataStoreService(object):
                      sync=request.sync, replace=False,
                      token=request.token)
 
+  @RPCWrapper
+  def CompactMultiSet(self, batch, response):
+    """Applies the MultiSet operations of a codec.CompactBatch."""
+    self._CheckWritable()
+    self._RecordWrite([subject for subject, _ in batch.operations],
+                      lambda: self._CompactMultiSet(batch),
+                      lambda: codec.BatchToCommands(batch), response)
+
+  def _CompactMultiSet(self, batch):
+    values = {}
+    to_delete = {}
+    for subject, entries in batch.operations:
+      # Writes to the same subject must be applied in order.
+      if subject in values or subject in to_delete:
+        self.db.MultiSubjectMultiSet(values, to_delete=to_delete, sync=False,
+                                     replace=False, token=batch.token)
+        values = {}
+        to_delete = {}
+
+      for attribute, replace, timestamp, value in entries:
+        if replace:
+          to_delete.setdefault(subject, set()).add(attribute)
+        if value is not None:
+          values.setdefault(subject, {}).setdefault(attribute, []).append(
+              (value, timestamp))
+
+    self.db.MultiSubjectMultiSet(values, to_delete=to_delete, sync=False,
+                                 replace=False, token=batch.token)
+
   @RPCWrapper
   def ResolveMulti(self, request, response):
     """Resolve multiple attributes for a given subject at once."""
+    self._WaitForReplication(request)
     attribute_regex = []
 
     for v in request.values:
@@ -150,6 +363,7 @@ class DataStoreService(object):
   @RPCWrapper
   def MultiResolveRegex(self, request, response):
     """Resolve multiple attributes for a given subject at once."""
+    self._WaitForReplication(request)
     attribute_regex = [utils.SmartUnicode(v.attribute) for v in request.values]
 
     timestamp = self.FromTimestampSpec(request.timestamp)
@@ -165,8 +379,16 @@ class DataStoreService(object):
                    for (attribute, value, ts) in values])
 
   @RPCWrapper
-  def DeleteAttributes(self, request, unused_response):
+  def DeleteAttributes(self, request, response):
     """Delete attributes from a given subject."""
+    self._CheckWritable()
+    self._RecordWrite(
+        request.subject, lambda: self._DeleteAttributes(request),
+        self._Command(rdfvalue.DataStoreCommand.Command.DELETE_ATTRIBUTES,
+                      request),
+        response)
+
+  def _DeleteAttributes(self, request):
     timestamp = self.FromTimestampSpec(request.timestamp)
     subject = request.subject[0]
     sync = request.sync
@@ -177,7 +399,15 @@ class DataStoreService(object):
                              token=token, sync=sync)
 
   @RPCWrapper
-  def DeleteSubject(self, request, unused_response):
+  def DeleteSubject(self, request, response):
+    self._CheckWritable()
+    self._RecordWrite(
+        request.subject, lambda: self._DeleteSubject(request),
+        self._Command(rdfvalue.DataStoreCommand.Command.DELETE_SUBJECT,
+                      request),
+        response)
+
+  def _DeleteSubject(self, request):
     subject = request.subject[0]
     token = request.token
     self.db.DeleteSubject(subject, token=token)
@@ -195,6 +425,7 @@ class DataStoreService(object):
 
   @RPCWrapper
   def LockSubject(self, request, response):
+    self._CheckWritable()
     duration = self.FromTimestampSpec(request.timestamp)
     if not request.subject:
       # No return value.
@@ -218,6 +449,7 @@ class DataStoreService(object):
 
   @RPCWrapper
   def ExtendSubject(self, request, response):
+    self._CheckWritable()
     duration = self.FromTimestampSpec(request.timestamp)
     if not request.subject or not request.values:
       # No return value.
@@ -240,6 +472,7 @@ class DataStoreService(object):
 
   @RPCWrapper
   def UnlockSubject(self, request, response):
+    self._CheckWritable()
     if not request.subject or not request.values:
       return
     subject = request.subject[0]
@@ -319,6 +552,18 @@ class DataStoreService(object):
     token = access_control.ACLToken(username="GRRSystem").SetUID()
     self.db.MultiSet(MAP_SUBJECT, {MAP_VALUE_PREDICATE: mapping}, token=token)
 
+  def LoadReplicationSequence(self):
+    """Returns the position of a replica in the change log of its primary."""
+    token = access_control.ACLToken(username="GRRSystem").SetUID()
+    sequence, _ = self.db.Resolve(MAP_SUBJECT, REPLICATION_SEQUENCE_PREDICATE,
+                                  token=token)
+    return int(sequence or 0)
+
+  def SaveReplicationSequence(self, sequence):
+    token = access_control.ACLToken(username="GRRSystem").SetUID()
+    self.db.MultiSet(MAP_SUBJECT, {REPLICATION_SEQUENCE_PREDICATE: [sequence]},
+                     sync=False, token=token)
+
   def GetLocation(self):
     return self.db.Location()
 
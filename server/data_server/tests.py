@@ -3,5 +3,8 @@
 
 # These need to register plugins so, pylint: disable=unused-import
 from grr.server.data_server import auth_test
+from grr.server.data_server import codec_test
 from grr.server.data_server import master_test
+from grr.server.data_server import rebalance_test
+from grr.server.data_server import replication_test
 # pylint: enable=unused-import
@@ -2,6 +2,7 @@
 """Data server utilities."""
 
 
+import bisect
 import hashlib
 import struct
 
@@ -27,6 +28,73 @@ def CreateStartInterval(index, total):
   return ret
 
 
+def CreateVirtualNodes(servers, nodes_per_server):
+  """Places the virtual nodes of weighted data servers on the hashing ring.
+
+  The positions of the nodes of a server only depend on its location, so
+  adding a server or changing its weight only moves the keys of its own nodes.
+
+  Args:
+    servers: The DataServerInformation objects of the servers.
+    nodes_per_server: The number of nodes of a server of weight 1.
+
+  Returns:
+    A list of DataServerVirtualNode objects sorted by position.
+  """
+  nodes = []
+  for serv in servers:
+    for i in range(int(round(serv.weight * nodes_per_server))):
+      position = HashKey("%s:%d/%d" % (serv.address, serv.port, i))
+      nodes.append((position, serv.index))
+  nodes.sort()
+  if nodes and nodes[0][0]:
+    # Hashes before the first node belong to the last one.
+    nodes.insert(0, (0, nodes[-1][1]))
+  return [rdfvalue.DataServerVirtualNode(position=position, server=index)
+          for position, index in nodes]
+
+
+def MappingRanges(mapping):
+  """Returns the ranges of hashes of a mapping.
+
+  Args:
+    mapping: A DataServerMapping, with or without virtual nodes.
+
+  Returns:
+    A sorted list of (start, end, server index) tuples covering all hashes,
+    where neighbouring ranges belong to different servers.
+  """
+  if mapping.nodes:
+    owners = [(node.position, node.server) for node in mapping.nodes]
+    if owners[0][0]:
+      owners.insert(0, (0, owners[-1][1]))
+  else:
+    owners = [(serv.interval.start, i)
+              for i, serv in enumerate(mapping.servers)
+              if serv.interval.start < serv.interval.end]
+  ends = [start for start, _ in owners[1:]] + [constants.MAX_RANGE]
+  ranges = []
+  for (start, index), end in zip(owners, ends):
+    if start == end:
+      continue
+    if ranges and ranges[-1][2] == index:
+      # Neighbouring nodes of the same server form a single range.
+      start = ranges.pop()[0]
+    ranges.append((start, end, index))
+  return ranges
+
+
+def RangesToNodes(mapping):
+  """Returns virtual nodes placing the keys like the mapping does."""
+  return [rdfvalue.DataServerVirtualNode(position=start, server=index)
+          for start, _, index in MappingRanges(mapping)]
+
+
+def ServerIsEmpty(mapping, index):
+  """Checks that a data server does not own any hashes."""
+  return all(server != index for _, _, server in MappingRanges(mapping))
+
+
 def _FindServerInMapping(mapping, hashed):
   """Find the corresponding data server id given an hashed subject."""
   server_list = list(mapping.servers)
@@ -52,7 +120,48 @@ def _BisectHashList(ls, left, right, value):
     return _BisectHashList(ls, left, middle - 1, value)
 
 
+class _Ring(object):
+  """The virtual nodes of a mapping as lists, for fast lookups."""
+
+  def __init__(self, mapping):
+    # Assigning the nodes of a mapping replaces the list, so the ring stays
+    # valid for as long as the mapping holds the same one.
+    self.nodes = mapping.nodes
+    self.positions = [node.position for node in self.nodes]
+    self.servers = [node.server for node in self.nodes]
+
+  def Matches(self, mapping):
+    return (self.nodes is mapping.nodes and
+            len(self.positions) == len(self.nodes))
+
+
+# The ring of the last mapping used, which rarely changes.
+_ring = None
+
+
+def _FindServerInRing(mapping, hashed):
+  """Find the data server owning an hashed subject on the hashing ring."""
+  global _ring
+  ring = _ring
+  if ring is None or not ring.Matches(mapping):
+    ring = _Ring(mapping)
+    _ring = ring
+  # Hashes before the first node wrap around to the last one.
+  return ring.servers[bisect.bisect_right(ring.positions, hashed) - 1]
+
+
+def FindServerForHash(mapping, hashed):
+  """Returns the ID of the server owning a hash."""
+  if mapping.nodes:
+    return _FindServerInRing(mapping, hashed)
+  return _FindServerInMapping(mapping, hashed)
+
+
+def HashKey(key):
+  """Returns the position of a key in the range of hashes."""
+  return int(hashlib.sha1(key).hexdigest()[:16], 16)
+
+
 def MapKeyToServer(mapping, key):
   """Takes some key and returns the ID of the server."""
-  hsh = int(hashlib.sha1(key).hexdigest()[:16], 16)
-  return _FindServerInMapping(mapping, hsh)
+  return FindServerForHash(mapping, HashKey(key))
@@ -1,15 +1,28 @@
 #!/usr/bin/env python
-"""This is the GRR frontend HTTP Server."""
+"""This is the GRR frontend HTTP Server.
+
+By default every client POST is handled on its own thread. With
+Frontend.event_loop set, a single event loop thread serves all the connections
+and hands the message bundles to a bounded pool of worker threads.
+"""
 
 
 
 import BaseHTTPServer
 import cgi
+import collections
 import cStringIO
+import errno
+import fcntl
+import mimetools
+import os
 import pdb
+import Queue
+import select
 import socket
 import SocketServer
 import threading
+import time
 
 
 import ipaddr
@@ -42,9 +55,6 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                 406: "406 Not Acceptable",
                 500: "500 Internal Server Error"}
 
-  active_counter_lock = threading.Lock()
-  active_counter = 0
-
   def Send(self, data, status=200, ctype="application/octet-stream",
            last_modified=0):
 
@@ -87,81 +97,127 @@ class GRRHTTPServerHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     """Process encrypted message bundles."""
     self.Control()
 
-  @stats.Counted("frontend_request_count", fields=["http"])
-  @stats.Timed("frontend_request_latency", fields=["http"])
   def Control(self):
     """Handle POSTS."""
-    if not master.MASTER_WATCHER.IsMaster():
-      # We shouldn't be getting requests from the client unless we
-      # are the active instance.
-      stats.STATS.IncrementCounter("frontend_inactive_request_count",
-                                   fields=["http"])
-      logging.info("Request sent to inactive frontend from %s",
-                   self.client_address[0])
-
-    # Get the api version
     try:
-      api_version = int(cgi.parse_qs(self.path.split("?")[1])["api"][0])
-    except (ValueError, KeyError, IndexError):
-      # The oldest api version we support if not specified.
-      api_version = 3
+      length = int(self.headers.getheader("content-length"))
+      data = self._GetPOSTData(length)
+    except (TypeError, ValueError) as e:
+      logging.error("Had to respond with status 500: %s.", e)
+      self.Send("Error", status=500)
+      return
+
+    status, body = HandleControl(self.server.frontend, self.path, self.headers,
+                                 data, self.client_address)
+    self.Send(body, status=status)
+
+
+# Number of requests being processed, over all the server threads.
+_active_counter_lock = threading.Lock()
+_active_counter = 0
+
+
+def _ChangeActiveCounter(delta):
+  global _active_counter
+  with _active_counter_lock:
+    _active_counter += delta
+    stats.STATS.SetGaugeValue("frontend_active_count", _active_counter,
+                              fields=["http"])
+
+
+@stats.Counted("frontend_request_count", fields=["http"])
+@stats.Timed("frontend_request_latency", fields=["http"])
+def HandleControl(frontend, path, headers, data, client_address):
+  """Processes the message bundles POSTed by a client.
+
+  Args:
+    frontend: The FrontEndServer handling the messages.
+    path: The path of the request, with the query string.
+    headers: The headers of the request.
+    data: The body of the request.
+    client_address: The (address, port) of the client.
+
+  Returns:
+    A tuple of the HTTP status and the body of the response.
+  """
+  if not master.MASTER_WATCHER.IsMaster():
+    # We shouldn't be getting requests from the client unless we
+    # are the active instance.
+    stats.STATS.IncrementCounter("frontend_inactive_request_count",
+                                 fields=["http"])
+    logging.info("Request sent to inactive frontend from %s",
+                 client_address[0])
+
+  # Get the api version
+  try:
+    api_version = int(cgi.parse_qs(path.split("?")[1])["api"][0])
+  except (ValueError, KeyError, IndexError):
+    # The oldest api version we support if not specified.
+    api_version = 3
 
-    with GRRHTTPServerHandler.active_counter_lock:
-      GRRHTTPServerHandler.active_counter += 1
-      stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
-                                fields=["http"])
+  _ChangeActiveCounter(1)
+  try:
+    request_comms = rdfvalue.ClientCommunication(data)
 
-    try:
-      length = int(self.headers.getheader("content-length"))
+    # If the client did not supply the version in the protobuf we use the get
+    # parameter.
+    if not request_comms.api_version:
+      request_comms.api_version = api_version
 
-      request_comms = rdfvalue.ClientCommunication(self._GetPOSTData(length))
+    # Reply using the same version we were requested with.
+    responses_comms = rdfvalue.ClientCommunication(
+        api_version=request_comms.api_version)
 
-      # If the client did not supply the version in the protobuf we use the get
-      # parameter.
-      if not request_comms.api_version:
-        request_comms.api_version = api_version
+    source_ip = ipaddr.IPAddress(client_address[0])
 
-      # Reply using the same version we were requested with.
-      responses_comms = rdfvalue.ClientCommunication(
-          api_version=request_comms.api_version)
+    if source_ip.version == 6:
+      source_ip = source_ip.ipv4_mapped or source_ip
 
-      source_ip = ipaddr.IPAddress(self.client_address[0])
+    request_comms.orig_request = rdfvalue.HttpRequest(
+        raw_headers=utils.SmartStr(headers),
+        source_ip=utils.SmartStr(source_ip))
 
-      if source_ip.version == 6:
-        source_ip = source_ip.ipv4_mapped or source_ip
+    source, nr_messages = frontend.HandleMessageBundles(
+        request_comms, responses_comms)
 
-      request_comms.orig_request = rdfvalue.HttpRequest(
-          raw_headers=utils.SmartStr(self.headers),
-          source_ip=utils.SmartStr(source_ip))
+    logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
+                 " %d messages sent.",
+                 source, utils.SmartStr(source_ip), len(data), nr_messages,
+                 responses_comms.num_messages)
 
-      source, nr_messages = self.server.frontend.HandleMessageBundles(
-          request_comms, responses_comms)
+    return 200, responses_comms.SerializeToString()
 
-      logging.info("HTTP request from %s (%s), %d bytes - %d messages received,"
-                   " %d messages sent.",
-                   source, utils.SmartStr(source_ip), length, nr_messages,
-                   responses_comms.num_messages)
+  except communicator.UnknownClientCert:
+    # "406 Not Acceptable: The server can only generate a response that is not
+    # accepted by the client". This is because we can not encrypt for the
+    # client appropriately.
+    return 406, "Enrollment required"
 
-      self.Send(responses_comms.SerializeToString())
+  except Exception as e:  # pylint: disable=broad-except
+    if flags.FLAGS.debug:
+      pdb.post_mortem()
 
-    except communicator.UnknownClientCert:
-      # "406 Not Acceptable: The server can only generate a response that is not
-      # accepted by the client". This is because we can not encrypt for the
-      # client appropriately.
-      self.Send("Enrollment required", status=406)
+    logging.error("Had to respond with status 500: %s.", e)
+    return 500, "Error"
 
-    except Exception as e:
-      if flags.FLAGS.debug:
-        pdb.post_mortem()
+  finally:
+    _ChangeActiveCounter(-1)
 
-      logging.error("Had to respond with status 500: %s.", e)
-      self.Send("Error", status=500)
 
-    finally:
-      with GRRHTTPServerHandler.active_counter_lock:
-        GRRHTTPServerHandler.active_counter -= 1
-        stats.STATS.SetGaugeValue("frontend_active_count", self.active_counter,
-                                  fields=["http"])
+def _CreateFrontEnd():
+  return flow.FrontEndServer(
+      certificate=config_lib.CONFIG["Frontend.certificate"],
+      private_key=config_lib.CONFIG["PrivateKeys.server_key"],
+      max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
+      message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
+      max_retransmission_time=config_lib.CONFIG[
+          "Frontend.max_retransmission_time"])
+
+
+def _AddressFamily(address):
+  if ipaddr.IPAddress(address).version == 4:
+    return socket.AF_INET
+  return socket.AF_INET6
 
 
 class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
@@ -176,34 +232,413 @@ class GRRHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
     stats.STATS.SetGaugeValue("frontend_max_active_count",
                               self.request_queue_size)
 
-    if frontend:
-      self.frontend = frontend
-    else:
-      self.frontend = flow.FrontEndServer(
-          certificate=config_lib.CONFIG["Frontend.certificate"],
-          private_key=config_lib.CONFIG["PrivateKeys.server_key"],
-          max_queue_size=config_lib.CONFIG["Frontend.max_queue_size"],
-          message_expiry_time=config_lib.CONFIG["Frontend.message_expiry_time"],
-          max_retransmission_time=config_lib.CONFIG[
-              "Frontend.max_retransmission_time"])
+    self.frontend = frontend or _CreateFrontEnd()
     self.server_cert = config_lib.CONFIG["Frontend.certificate"]
 
     (address, _) = server_address
-    version = ipaddr.IPAddress(address).version
-    if version == 4:
-      self.address_family = socket.AF_INET
-    elif version == 6:
-      self.address_family = socket.AF_INET6
+    self.address_family = _AddressFamily(address)
 
     logging.info("Will attempt to listen on %s", server_address)
     BaseHTTPServer.HTTPServer.__init__(self, server_address, handler, *args,
                                        **kwargs)
 
 
+class _Poller(object):
+  """Readiness notifications for many sockets, from epoll when available."""
+
+  # The poll event bits have the same values as the epoll ones.
+  READ = select.POLLIN
+  WRITE = select.POLLOUT
+
+  def __init__(self):
+    if hasattr(select, "epoll"):
+      self.poller = select.epoll()
+      self.scale = 1
+    else:
+      self.poller = select.poll()
+      self.scale = 1000
+
+  def Register(self, fd, events):
+    self.poller.register(fd, events)
+
+  def Modify(self, fd, events):
+    self.poller.modify(fd, events)
+
+  def Unregister(self, fd):
+    self.poller.unregister(fd)
+
+  def Poll(self, timeout):
+    try:
+      return self.poller.poll(timeout * self.scale)
+    except (IOError, OSError, select.error) as e:
+      if e.args[0] == errno.EINTR:
+        return []
+      raise
+
+  def Close(self):
+    if hasattr(self.poller, "close"):
+      self.poller.close()
+
+
+class _Connection(object):
+  """A client connection of the event loop server."""
+
+  # Idle keep-alive connections only cost this object and their socket.
+  __slots__ = ("sock", "fd", "address", "data", "received", "request",
+               "body_length", "keep_alive", "out", "sent", "state", "closed")
+
+  READING = 0
+  PROCESSING = 1
+  WRITING = 2
+
+  def __init__(self, sock, address):
+    self.sock = sock
+    self.fd = sock.fileno()
+    self.address = address
+    # The bytes received and not parsed yet.
+    self.data = []
+    self.received = 0
+    # (method, path, headers) of a request waiting for its body.
+    self.request = None
+    self.body_length = 0
+    self.keep_alive = False
+    self.out = ""
+    self.sent = 0
+    self.state = self.READING
+    self.closed = False
+
+  def Buffer(self):
+    """Returns the bytes received so far as a single string."""
+    if len(self.data) != 1:
+      self.data = ["".join(self.data)]
+    return self.data[0]
+
+  def Consume(self, size):
+    """Removes the first bytes received and returns them."""
+    data = self.Buffer()
+    self.data = [data[size:]]
+    self.received -= size
+    return data[:size]
+
+
+class GRRAsyncHTTPServer(object):
+  """The GRR HTTP frontend server running on an event loop.
+
+  A single thread accepts the connections, parses the requests and writes the
+  responses of all the clients. The message bundles are processed on a bounded
+  pool of worker threads. Requests arriving when too many are waiting for a
+  worker are answered with a 503, and the client retries later.
+  """
+
+  statustext = {200: "200 OK",
+                400: "400 Bad Request",
+                404: "404 Not Found",
+                406: "406 Not Acceptable",
+                413: "413 Request Entity Too Large",
+                500: "500 Internal Server Error",
+                501: "501 Not Implemented",
+                503: "503 Service Unavailable"}
+
+  request_queue_size = 1024
+  RECV_BLOCK_SIZE = 65536
+  MAX_HEADER_SIZE = 65536
+  # Seconds overloaded clients are asked to wait before retrying.
+  RETRY_AFTER = 10
+  # Seconds between two checks for idle connections.
+  IDLE_CHECK_INTERVAL = 1
+
+  def __init__(self, server_address, frontend=None):
+    self.max_pending = config_lib.CONFIG["Frontend.max_pending_requests"]
+    self.num_workers = config_lib.CONFIG["Frontend.worker_threads"]
+    self.keep_alive_timeout = config_lib.CONFIG["Frontend.keep_alive_timeout"]
+    self.max_request_size = config_lib.CONFIG["Frontend.max_request_size"]
+    stats.STATS.SetGaugeValue("frontend_max_active_count", self.max_pending)
+
+    self.frontend = frontend or _CreateFrontEnd()
+    self.server_cert = utils.SmartStr(config_lib.CONFIG["Frontend.certificate"])
+
+    (address, _) = server_address
+    logging.info("Will attempt to listen on %s", server_address)
+    self.socket = socket.socket(_AddressFamily(address), socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(server_address)
+    self.socket.listen(self.request_queue_size)
+    self.socket.setblocking(0)
+    self.server_address = self.socket.getsockname()
+
+    self.poller = _Poller()
+    # Worker threads wake up the loop by writing to this pipe.
+    self.wakeup_read, self.wakeup_write = os.pipe()
+    for fd in (self.wakeup_read, self.wakeup_write):
+      fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) |
+                  os.O_NONBLOCK)
+
+    # Connections by file descriptor.
+    self.connections = {}
+    # Connections waiting for a request, least recently active first.
+    self.idle = collections.OrderedDict()
+    self.requests = Queue.Queue(maxsize=self.max_pending)
+    # (connection, status, body) of the processed requests.
+    self.completed = collections.deque()
+    self.workers = []
+    self.exit = False
+
+  def _Work(self):
+    while True:
+      item = self.requests.get()
+      if item is None:
+        return
+      conn, path, headers, data = item
+      status, body = HandleControl(self.frontend, path, headers, data,
+                                   conn.address)
+      self.completed.append((conn, status, body))
+      self._Wakeup()
+
+  def _Wakeup(self):
+    try:
+      os.write(self.wakeup_write, "x")
+    except OSError as e:
+      # A full pipe wakes up the loop as well.
+      if e.errno != errno.EAGAIN:
+        raise
+
+  def serve_forever(self):
+    """Runs the event loop until shutdown() is called."""
+    for i in range(self.num_workers):
+      worker = threading.Thread(target=self._Work,
+                                name="FrontendWorker%d" % i)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+    listen_fd = self.socket.fileno()
+    self.poller.Register(listen_fd, self.poller.READ)
+    self.poller.Register(self.wakeup_read, self.poller.READ)
+    last_idle_check = time.time()
+    try:
+      while not self.exit:
+        for fd, events in self.poller.Poll(self.IDLE_CHECK_INTERVAL):
+          if fd == listen_fd:
+            self._Accept()
+          elif fd == self.wakeup_read:
+            self._Complete()
+          else:
+            conn = self.connections.get(fd)
+            if conn is None:
+              continue
+            if events & self.poller.READ:
+              self._Read(conn)
+            elif events & self.poller.WRITE:
+              if conn.state == conn.WRITING:
+                self._Write(conn)
+            else:
+              # The client hung up while its request was processed.
+              self._Close(conn)
+
+        now = time.time()
+        if now - last_idle_check >= self.IDLE_CHECK_INTERVAL:
+          self._CloseIdle(now)
+          last_idle_check = now
+    finally:
+      self.poller.Unregister(listen_fd)
+      self.poller.Unregister(self.wakeup_read)
+      for _ in self.workers:
+        self.requests.put(None)
+      self.workers = []
+
+  def shutdown(self):
+    """Stops the event loop, can be called from any thread."""
+    self.exit = True
+    self._Wakeup()
+
+  def server_close(self):
+    for conn in self.connections.values():
+      self._Close(conn)
+    self.socket.close()
+    self.poller.Close()
+    os.close(self.wakeup_read)
+    os.close(self.wakeup_write)
+
+  def _Accept(self):
+    while True:
+      try:
+        sock, address = self.socket.accept()
+      except socket.error as e:
+        if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+          logging.warning("Could not accept a connection: %s", e)
+        return
+      sock.setblocking(0)
+      conn = _Connection(sock, address)
+      self.connections[conn.fd] = conn
+      self.idle[conn.fd] = (conn, time.time())
+      self.poller.Register(conn.fd, self.poller.READ)
+
+  def _CloseIdle(self, now):
+    expired = []
+    for conn, last_activity in self.idle.itervalues():
+      if now - last_activity < self.keep_alive_timeout:
+        break
+      expired.append(conn)
+    for conn in expired:
+      self._Close(conn)
+
+  def _Close(self, conn):
+    if conn.closed:
+      return
+    conn.closed = True
+    self.poller.Unregister(conn.fd)
+    del self.connections[conn.fd]
+    self.idle.pop(conn.fd, None)
+    conn.sock.close()
+
+  def _Read(self, conn):
+    try:
+      data = conn.sock.recv(self.RECV_BLOCK_SIZE)
+    except socket.error as e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self._Close(conn)
+      return
+    if not data:
+      self._Close(conn)
+      return
+
+    conn.data.append(data)
+    conn.received += len(data)
+    # Reading moves the connection to the end of the idle list.
+    self.idle.pop(conn.fd, None)
+    self.idle[conn.fd] = (conn, time.time())
+    self._Parse(conn)
+
+  def _Parse(self, conn):
+    """Dispatches the request of a connection once it was fully received."""
+    if conn.request is None:
+      end = conn.Buffer().find("\r\n\r\n")
+      if end < 0:
+        if conn.received > self.MAX_HEADER_SIZE:
+          self._Respond(conn, 400, "Bad request", close=True)
+        return
+
+      lines = conn.Consume(end + 4).split("\r\n", 1)
+      request_line = lines[0].split()
+      if len(request_line) != 3:
+        self._Respond(conn, 400, "Bad request", close=True)
+        return
+      method, path, version = request_line
+      headers = mimetools.Message(cStringIO.StringIO(lines[1]), 0)
+
+      connection = (headers.getheader("connection") or "").lower()
+      if version == "HTTP/1.1":
+        conn.keep_alive = connection != "close"
+      else:
+        conn.keep_alive = connection == "keep-alive"
+
+      conn.body_length = 0
+      if method == "POST":
+        try:
+          conn.body_length = int(headers.getheader("content-length"))
+        except (TypeError, ValueError):
+          self._Respond(conn, 400, "Content-Length required", close=True)
+          return
+        if not 0 <= conn.body_length <= self.max_request_size:
+          self._Respond(conn, 413, "Request too large", close=True)
+          return
+      conn.request = (method, path, headers)
+
+    if conn.received < conn.body_length:
+      return
+
+    method, path, headers = conn.request
+    data = conn.Consume(conn.body_length)
+    conn.request = None
+
+    if method == "GET":
+      if path.startswith("/server.pem"):
+        self._Respond(conn, 200, self.server_cert)
+      else:
+        self._Respond(conn, 404, "Not found")
+    elif method == "POST":
+      self._Submit(conn, path, headers, data)
+    else:
+      self._Respond(conn, 501, "Not implemented", close=True)
+
+  def _Submit(self, conn, path, headers, data):
+    """Hands a POST to the worker threads, or turns it away."""
+    try:
+      self.requests.put_nowait((conn, path, headers, data))
+    except Queue.Full:
+      stats.STATS.IncrementCounter("frontend_rejected_request_count",
+                                   fields=["http"])
+      self._Respond(conn, 503, "Server overloaded",
+                    headers=[("Retry-After", self.RETRY_AFTER)])
+      return
+
+    # Stop reading from the client until its request is processed.
+    conn.state = conn.PROCESSING
+    self.idle.pop(conn.fd, None)
+    self.poller.Modify(conn.fd, 0)
+
+  def _Complete(self):
+    try:
+      while os.read(self.wakeup_read, 4096):
+        pass
+    except OSError as e:
+      if e.errno != errno.EAGAIN:
+        raise
+
+    while self.completed:
+      conn, status, body = self.completed.popleft()
+      if not conn.closed:
+        self._Respond(conn, status, body)
+
+  def _Respond(self, conn, status, body, headers=None, close=False):
+    if close:
+      conn.keep_alive = False
+    lines = ["HTTP/1.1 %s" % self.statustext[status],
+             "Server: GRR",
+             "Content-Type: application/octet-stream",
+             "Content-Length: %d" % len(body),
+             "Connection: %s" % ("keep-alive" if conn.keep_alive else "close")]
+    for name, value in headers or []:
+      lines.append("%s: %s" % (name, value))
+    conn.out = "\r\n".join(lines) + "\r\n\r\n" + body
+    conn.sent = 0
+    conn.state = conn.WRITING
+    self.idle.pop(conn.fd, None)
+    self.poller.Modify(conn.fd, self.poller.WRITE)
+    # Most responses fit in the socket buffer right away.
+    self._Write(conn)
+
+  def _Write(self, conn):
+    try:
+      conn.sent += conn.sock.send(buffer(conn.out, conn.sent))
+    except socket.error as e:
+      if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+        self._Close(conn)
+      return
+    if conn.sent < len(conn.out):
+      return
+
+    conn.out = ""
+    if not conn.keep_alive:
+      self._Close(conn)
+      return
+
+    conn.state = conn.READING
+    self.idle[conn.fd] = (conn, time.time())
+    self.poller.Modify(conn.fd, self.poller.READ)
+    if conn.received:
+      # The client already sent its next request.
+      self._Parse(conn)
+
+
 def CreateServer(frontend=None):
   server_address = (config_lib.CONFIG["Frontend.bind_address"],
                     config_lib.CONFIG["Frontend.bind_port"])
-  httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler, frontend=frontend)
+  if config_lib.CONFIG["Frontend.event_loop"]:
+    httpd = GRRAsyncHTTPServer(server_address, frontend=frontend)
+  else:
+    httpd = GRRHTTPServer(server_address, GRRHTTPServerHandler,
+                          frontend=frontend)
 
   sa = httpd.socket.getsockname()
   logging.info("Serving HTTP on %s port %d ...", sa[0], sa[1])
@@ -229,6 +664,8 @@ def main(unused_argv):
     httpd.serve_forever()
   except KeyboardInterrupt:
     print "Caught keyboard interrupt, stopping"
+  finally:
+    httpd.server_close()
 
 if __name__ == "__main__":
   flags.StartMain(main)
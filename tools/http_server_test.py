@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+"""Tests the event loop mode of the frontend HTTP server."""
+
+
+import httplib
+import threading
+import time
+
+
+# pylint: disable=unused-import,g-bad-import-order
+from grr.lib import server_plugins
+# pylint: enable=unused-import,g-bad-import-order
+
+from grr.lib import config_lib
+from grr.lib import flags
+from grr.lib import rdfvalue
+from grr.lib import test_lib
+from grr.tools import http_server
+
+
+class MockFrontEnd(object):
+  """A frontend which blocks until it is released."""
+
+  def __init__(self):
+    self.released = threading.Event()
+    self.released.set()
+    self.entered = threading.Event()
+
+  def HandleMessageBundles(self, unused_request_comms, unused_responses):
+    self.entered.set()
+    self.released.wait(10)
+    return "C.1000000000000000", 0
+
+
+class GRRAsyncHTTPServerTest(test_lib.GRRBaseTest):
+  """Tests the event loop frontend."""
+
+  def setUp(self):
+    super(GRRAsyncHTTPServerTest, self).setUp()
+    config_lib.CONFIG.Set("Frontend.worker_threads", 1)
+    config_lib.CONFIG.Set("Frontend.max_pending_requests", 1)
+    self.frontend = MockFrontEnd()
+    self.server = http_server.GRRAsyncHTTPServer(("127.0.0.1", 0),
+                                                 frontend=self.frontend)
+    self.thread = threading.Thread(target=self.server.serve_forever)
+    self.thread.start()
+
+  def tearDown(self):
+    self.frontend.released.set()
+    self.server.shutdown()
+    self.thread.join()
+    self.server.server_close()
+    super(GRRAsyncHTTPServerTest, self).tearDown()
+
+  def _Connect(self):
+    return httplib.HTTPConnection("127.0.0.1", self.server.server_address[1])
+
+  def _Post(self, conn):
+    conn.request("POST", "/control?api=3",
+                 rdfvalue.ClientCommunication().SerializeToString())
+
+  def testKeepAlive(self):
+    conn = self._Connect()
+    conn.request("GET", "/server.pem")
+    response = conn.getresponse()
+    self.assertEqual(response.status, 200)
+    self.assertEqual(response.read(), self.server.server_cert)
+
+    # Further requests reuse the connection.
+    for _ in range(3):
+      self._Post(conn)
+      response = conn.getresponse()
+      self.assertEqual(response.status, 200)
+      self.assertEqual(response.getheader("connection"), "keep-alive")
+      comms = rdfvalue.ClientCommunication(response.read())
+      self.assertEqual(comms.api_version, 3)
+    self.assertEqual(len(self.server.connections), 1)
+
+  def testOverloadedServerAsksToRetry(self):
+    self.frontend.released.clear()
+    processing = self._Connect()
+    self._Post(processing)
+    self.assertTrue(self.frontend.entered.wait(10))
+
+    # The only worker is busy and one request may wait for it.
+    waiting = self._Connect()
+    self._Post(waiting)
+    for _ in range(100):
+      if self.server.requests.qsize():
+        break
+      time.sleep(0.1)
+
+    rejected = self._Connect()
+    self._Post(rejected)
+    response = rejected.getresponse()
+    self.assertEqual(response.status, 503)
+    self.assertEqual(response.getheader("retry-after"),
+                     str(self.server.RETRY_AFTER))
+
+    self.frontend.released.set()
+    self.assertEqual(processing.getresponse().status, 200)
+    self.assertEqual(waiting.getresponse().status, 200)
+
+
+def main(args):
+  test_lib.main(args)
+
+if __name__ == "__main__":
+  flags.StartMain(main)
@@ -322,6 +322,87 @@ class GrrWorkerTest(test_lib.FlowTestsBaseclass):
     self.assertEqual(flow_obj.state.context["current_state"],
                      "End")
 
+  def testProcessMessagesInBatches(self):
+    """Test processing several flows in a single batch."""
+    config_lib.CONFIG.Set("Worker.flow_batch_size", 10)
+
+    session_ids = []
+    for flow_name in ["WorkerSendingTestFlow", "WorkerSendingTestFlow2"]:
+      flow_obj = self.FlowSetup(flow_name)
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id, data in zip(session_ids, ["Hello1", "Hello2"]):
+      self.SendResponse(session_id, data)
+
+    worker_obj = worker.GRRWorker(token=self.token)
+
+    with utils.MultiStubber(
+        (aff4.FACTORY, "OpenWithLock", None),
+        (worker_obj, "_ProcessMessages", None)):
+      worker_obj.RunOnce()
+      worker_obj.thread_pool.Join()
+
+    RESULTS.sort()
+    self.assertEqual(RESULTS, ["Hello1", "Hello2"])
+
+    # The messages the flows queued have been written after the batch.
+    manager = queue_manager.QueueManager(token=self.token)
+    self.assertEqual(len(manager.Query(self.client_id.Queue(), 100)), 9)
+
+    flow_obj = aff4.FACTORY.Open(session_ids[0], token=self.token)
+    self.assertEqual(flow_obj.state.context["current_state"], "Incoming")
+    flow_obj = aff4.FACTORY.Open(session_ids[1], token=self.token)
+    self.assertEqual(flow_obj.state.context.state,
+                     rdfvalue.Flow.State.TERMINATED)
+
+    # The locks have been released.
+    with aff4.FACTORY.OpenWithLock(session_ids[0], blocking=False,
+                                   token=self.token):
+      pass
+
+  def testBatchIsWrittenBeforeFlowsAreUnlocked(self):
+    """Test that no other worker can see processed responses of a batch."""
+    config_lib.CONFIG.Set("Worker.flow_batch_size", 10)
+
+    session_ids = []
+    for flow_name in ["WorkerSendingTestFlow", "WorkerSendingTestFlow2"]:
+      flow_obj = self.FlowSetup(flow_name)
+      session_ids.append(flow_obj.session_id)
+      flow_obj.Close()
+
+    for session_id, data in zip(session_ids, ["Hello1", "Hello2"]):
+      self.SendResponse(session_id, data)
+
+    worker_obj = worker.GRRWorker(token=self.token)
+    left_responses = {}
+    original_close = flow.GRRFlow.Close
+    test = self
+
+    def Close(flow_obj, sync=True):
+      original_close(flow_obj, sync=sync)
+      # Lock the flow again right away, as another worker could.
+      transaction = data_store.DB.Transaction(flow_obj.urn, token=test.token)
+      try:
+        manager = queue_manager.QueueManager(token=test.token)
+        left_responses[flow_obj.urn] = list(
+            manager.FetchCompletedResponses(flow_obj.urn))
+      finally:
+        transaction.Commit()
+
+    with utils.MultiStubber(
+        (aff4.FACTORY, "OpenWithLock", None),
+        (worker_obj, "_ProcessMessages", None),
+        (flow.GRRFlow, "Close", Close)):
+      worker_obj.RunOnce()
+      worker_obj.thread_pool.Join()
+
+    RESULTS.sort()
+    self.assertEqual(RESULTS, ["Hello1", "Hello2"])
+    self.assertEqual(sorted(left_responses), sorted(session_ids))
+    for responses in left_responses.values():
+      self.assertEqual(responses, [])
+
   def testNoKillNotificationsScheduledForHunts(self):
     worker_obj = worker.GRRWorker(token=self.token)
     initial_time = rdfvalue.RDFDatetime().FromSecondsFromEpoch(0)